@@ -2,8 +2,6 @@ import json
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
-import geomet.wkt
-import pandas as pd
 LOGGER = logging.getLogger(__name__)
 
 
@@ -13,6 +11,11 @@ try:
     import aqua90m.utils.geojson_helpers as geojson_helpers
     import aqua90m.utils.exceptions as exc
     import aqua90m.geofresh.temp_table_for_queries as temp_tables
+    import aqua90m.utils.point_table as point_table
+    import aqua90m.geofresh.pagination as pagination
+    import aqua90m.geofresh.basin_graph as basin_graph
+    import aqua90m.geofresh.prepared_statements as prepared_statements
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
@@ -20,6 +23,11 @@ except ModuleNotFoundError as e1:
         import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
         import pygeoapi.process.aqua90m.utils.exceptions as exc
         import pygeoapi.process.aqua90m.geofresh.temp_table_for_queries as temp_tables
+        import pygeoapi.process.aqua90m.utils.point_table as point_table
+        import pygeoapi.process.aqua90m.geofresh.pagination as pagination
+        import pygeoapi.process.aqua90m.geofresh.basin_graph as basin_graph
+        import pygeoapi.process.aqua90m.geofresh.prepared_statements as prepared_statements
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -28,6 +36,9 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+pd = lazy_import('pandas')
+geomet = lazy_import('geomet')
+
 
 #####################################
 ### Functions for singular points ###
@@ -62,16 +73,11 @@ def get_regid_from_lonlat(conn, LOGGER, lon, lat):
          58
     (1 row)
     """
-    query = f'''
-    SELECT reg_id
-    FROM regional_units
-    WHERE st_intersects(ST_SetSRID(ST_MakePoint({lon}, {lat}),4326), geom)
-    '''
+    # (prepared statement, see prepared_statements.py)
 
     ### Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = prepared_statements.execute(conn, 'regid_from_lonlat', [lon, lat])
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results and construct GeoJSON:
@@ -145,16 +151,11 @@ def get_basinid_regid_from_subcid(conn, LOGGER, subc_id):
     # TODO: We need this in plural for geofresh.get_env90m_data_for_subcids.py
 
     ### Define query:
-    query = f'''
-    SELECT basin_id, reg_id
-    FROM sub_catchments
-    WHERE subc_id = {subc_id}
-    '''
+    # (prepared statement, see prepared_statements.py)
 
     ### Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = prepared_statements.execute(conn, 'basinid_regid_from_subcid', [subc_id])
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results and construct GeoJSON:
@@ -213,19 +214,11 @@ def get_subcid_basinid_from_lonlat_regid(conn, LOGGER, lon, lat, reg_id):
     (1 row)
     """
 
-    query = f'''
-    SELECT
-        subc_id,
-        basin_id
-    FROM sub_catchments
-    WHERE st_intersects(ST_SetSRID(ST_MakePoint({lon}, {lat}),4326), geom)
-        AND reg_id = {reg_id}
-    '''
+    # (prepared statement, see prepared_statements.py)
 
     ### Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = prepared_statements.execute(conn, 'subcid_basinid_from_lonlat_regid', [lon, lat, reg_id])
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results:
@@ -243,17 +236,9 @@ def get_subcid_basinid_from_lonlat_regid(conn, LOGGER, lon, lat, reg_id):
 
 def get_regid_from_basinid(conn, LOGGER, basin_id):
 
-    ### Define query:
-    query = f'''
-    SELECT reg_id
-    FROM hydro.basins
-    WHERE basin_id = {basin_id}
-    '''
-
-    ### Query database:
-    cursor = conn.cursor()
+    ### Query database (prepared statement, see prepared_statements.py):
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = prepared_statements.execute(conn, 'regid_from_basinid', [basin_id])
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results and construct GeoJSON:
@@ -268,15 +253,35 @@ def get_regid_from_basinid(conn, LOGGER, basin_id):
     return reg_id
 
 
-def get_all_subcids_from_basinid(conn, LOGGER, basin_id, reg_id, min_strahler=None):
+def get_all_subcids_from_basinid(conn, LOGGER, basin_id, reg_id, min_strahler=None, limit=None, after_subc_id=None):
+
+    # Taken from the cached basin graph, already pruned to min_strahler
+    # (see basin_graph), sorted by subc_id.
+    # (If paged: Only the first "limit" subc_ids after "after_subc_id", see pagination)
+    graph = basin_graph.get_basin_graph(conn, basin_id, reg_id)
+    subc_ids = graph.subc_ids_sorted(min_strahler, limit, after_subc_id)
 
-    # Define query:
+    # Complain if no subcatchments (an empty page after the last one is fine):
+    if len(subc_ids) == 0 and after_subc_id is None:
+        err_msg = f'No subcatchments found for basin_id {basin_id},'
+        if min_strahler is None:
+            err_msg += ' (any strahler order)!'
+        else:
+            err_msg += f' (strahler >= {min_strahler})!'
+        LOGGER.error(err_msg)
+        raise exc.GeoFreshUnexpectedResultException(err_msg)
+
+    return subc_ids
+
+
+def _all_subcids_query(basin_id, reg_id, min_strahler, limit, after_subc_id):
+    page = pagination.sql_parts(limit, after_subc_id)
     if min_strahler is None:
         query = f'''
         SELECT subc_id, strahler
         FROM hydro.stream_segments
         WHERE basin_id = {basin_id}
-            AND reg_id = {reg_id}
+            AND reg_id = {reg_id}{page['where']}{page['order']}
         '''
     else:
         query = f'''
@@ -284,45 +289,40 @@ def get_all_subcids_from_basinid(conn, LOGGER, basin_id, reg_id, min_strahler=No
         FROM hydro.stream_segments
         WHERE basin_id = {basin_id}
             AND reg_id = {reg_id}
-            AND strahler >= {min_strahler}
+            AND strahler >= {min_strahler}{page['where']}{page['order']}
         '''
+    return query
 
-    # Query database:
-    cursor = conn.cursor()
-    LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
-    LOGGER.log(logging.TRACE, 'Querying database... DONE.')
-
-    # Get results:
-    subc_ids = [row[0] for row in cursor.fetchall()]
 
-    # Complain if no subcatchments:
-    if len(subc_ids) == 0:
-        err_msg = f'No subcatchments found for basin_id {basin_id},'
-        if min_strahler is None:
-            err_msg += ' (any strahler order)!'
-        else:
-            err_msg += f' (strahler >= {min_strahler})!'
-        LOGGER.error(err_msg)
-        raise exc.GeoFreshUnexpectedResultException(err_msg)
+def stream_subcids_from_basinid(conn, basin_id, reg_id, min_strahler=None, limit=None, after_subc_id=None,
+        chunk_rows=10000):
+    # Same as get_all_subcids_from_basinid(), but as generator of NDJSON text
+    # chunks (one line per subcatchment, ordered by subc_id), read through a
+    # server-side cursor, so no list of the whole basin is built.
+    query = _all_subcids_query(basin_id, reg_id, min_strahler, limit, after_subc_id)
+    if not pagination.is_paged(limit, after_subc_id):
+        query += '        ORDER BY subc_id\n'
 
-    return subc_ids
+    cursor = conn.cursor(name=f'subcids_{basin_id}_{reg_id}')
+    cursor.itersize = chunk_rows
+    try:
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield ''.join(
+                f'{{"subc_id": {row[0]}, "strahler": {row[1]}, "basin_id": {basin_id}, "reg_id": {reg_id}}}\n'
+                for row in rows)
+    finally:
+        cursor.close()
 
 
 def get_strahler_order(conn, subc_id, basin_id, reg_id):
 
-    query = f'''
-    SELECT strahler
-    FROM hydro.stream_segments
-    WHERE subc_id = {subc_id}
-        AND reg_id = {reg_id}
-        AND basin_id = {basin_id}
-    '''
-
-    ### Query database:
-    cursor = conn.cursor()
+    ### Query database (prepared statement, see prepared_statements.py):
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = prepared_statements.execute(conn, 'strahler_order', [subc_id, reg_id, basin_id])
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     row = cursor.fetchone()
@@ -342,13 +342,15 @@ def get_strahler_order(conn, subc_id, basin_id, reg_id):
 #################################
 
 
-def get_subcid_basinid_regid__dataframe_to_dataframe(conn, input_df, colname_lon, colname_lat, colname_site_id=None):
-    # INPUT:  Dataframe with site_id, lon, lat
-    # OUTPUT: Dataframe with site_id, subc_id, basin_id, reg_id
-    list_of_insert_rows = temp_tables.make_insertion_rows_from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+def get_subcid_basinid_regid__points_to_dataframe(conn, points):
+    # INPUT:  PointTable (see utils/point_table.py) with lon, lat, possibly site_id
+    # OUTPUT: Dataframe with (site_id), lon, lat, subc_id, basin_id, reg_id
+    # Note: If the points have no site_ids, we can return the dataframe, but it
+    # cannot be matched to the input points.
+    list_of_insert_rows = temp_tables.make_insertion_rows_from_points(points)
     cursor = conn.cursor()
     tablename, reg_ids = temp_tables.create_and_populate_temp_table(cursor, list_of_insert_rows)
-    if colname_site_id is None:
+    if points.site_ids is None:
         query = f'''
         SELECT lon, lat, subc_id, basin_id, reg_id
         FROM {tablename}
@@ -371,22 +373,20 @@ def get_subcid_basinid_regid__dataframe_to_dataframe(conn, input_df, colname_lon
     return output_df
 
 
-def get_subcid_basinid_regid__geojson_to_dataframe(conn, input_geojson, colname_site_id=None):
-    # INPUT:  GeoJSON (MultiPoint or GeometryCollection or FeatureCollection)
-    # OUTPUT: Dataframe with site_id, subc_id, basin_id, reg_id
-    # Note: If no colname_site_id is given, we can return the dataframe, but it
-    # cannot be matched to the input points.
-    list_of_insert_rows = temp_tables.make_insertion_rows_from_geojson(input_geojson, colname_site_id=colname_site_id)
+def get_regid__points_to_dataframe(conn, points):
+    # INPUT:  PointTable (see utils/point_table.py) with lon, lat, possibly site_id
+    # OUTPUT: Dataframe with (site_id), lon, lat, reg_id
+    list_of_insert_rows = temp_tables.make_insertion_rows_from_points(points)
     cursor = conn.cursor()
-    tablename, reg_ids = temp_tables.create_and_populate_temp_table(cursor, list_of_insert_rows)
-    if colname_site_id is None:
+    tablename, reg_ids = temp_tables.create_and_populate_temp_table(cursor, list_of_insert_rows, add_subcids=False)
+    if points.site_ids is None:
         query = f'''
-        SELECT lon, lat, subc_id, basin_id, reg_id
+        SELECT lon, lat, reg_id
         FROM {tablename}
         '''
     else:
         query = f'''
-        SELECT site_id, lon, lat, subc_id, basin_id, reg_id
+        SELECT site_id, lon, lat, reg_id
         FROM {tablename}
         '''
     output_df = pd.read_sql_query(query, conn)
@@ -395,67 +395,41 @@ def get_subcid_basinid_regid__geojson_to_dataframe(conn, input_geojson, colname_
     # Apparently, pd.read_sql_query() casts to numeric to be safe.
     # Casting back to int:
     output_df = output_df.astype({
-        "subc_id": "Int64",
-        "basin_id": "Int64",
         "reg_id": "Int64"
     })
     return output_df
 
 
+# Just a wrapper
+def get_subcid_basinid_regid__dataframe_to_dataframe(conn, input_df, colname_lon, colname_lat, colname_site_id=None):
+    # INPUT:  Dataframe with site_id, lon, lat
+    # OUTPUT: Dataframe with site_id, subc_id, basin_id, reg_id
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return get_subcid_basinid_regid__points_to_dataframe(conn, points)
+
+
+# Just a wrapper
+def get_subcid_basinid_regid__geojson_to_dataframe(conn, input_geojson, colname_site_id=None):
+    # INPUT:  GeoJSON (MultiPoint or GeometryCollection or FeatureCollection)
+    # OUTPUT: Dataframe with site_id, subc_id, basin_id, reg_id
+    points = point_table.from_geojson(input_geojson, colname_site_id=colname_site_id)
+    return get_subcid_basinid_regid__points_to_dataframe(conn, points)
+
+
+# Just a wrapper
 def get_regid__dataframe_to_dataframe(conn, input_df, colname_lon, colname_lat, colname_site_id=None):
     # INPUT:  Dataframe with lon, lat, possibly site_id
     # OUTPUT: Dataframe with lon, lat, reg_id, possibly site_id
-    list_of_insert_rows = temp_tables.make_insertion_rows_from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
-    cursor = conn.cursor()
-    tablename, reg_ids = temp_tables.create_and_populate_temp_table(cursor, list_of_insert_rows, add_subcids=False)
-    if colname_site_id is None:
-        query = f'''
-        SELECT lon, lat, reg_id
-        FROM {tablename}
-        '''
-    else:
-        query = f'''
-        SELECT site_id, lon, lat, reg_id
-        FROM {tablename}
-        '''
-    output_df = pd.read_sql_query(query, conn)
-    # TODO: UserWarning: pandas only supports SQLAlchemy connectable (engine/connection) or database string URI or sqlite3 DBAPI2 connection. Other DBAPI2 objects are not tested. Please consider using SQLAlchemy.
-    temp_tables.drop_temp_table(cursor, tablename)
-    # Apparently, pd.read_sql_query() casts to numeric to be safe.
-    # Casting back to int:
-    output_df = output_df.astype({
-        "reg_id": "Int64"
-    })
-    return output_df
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return get_regid__points_to_dataframe(conn, points)
 
 
+# Just a wrapper
 def get_regid__geojson_to_dataframe(conn, input_geojson, colname_site_id=None):
     # INPUT:  GeoJSON (MultiPoint or GeometryCollection or FeatureCollection)
     # OUTPUT: Dataframe with site_id, reg_id
-    # Note: If no colname_site_id is given, we can return the dataframe, but it
-    # cannot be matched to the input points.
-    list_of_insert_rows = temp_tables.make_insertion_rows_from_geojson(input_geojson, colname_site_id=colname_site_id)
-    cursor = conn.cursor()
-    tablename, reg_ids = temp_tables.create_and_populate_temp_table(cursor, list_of_insert_rows, add_subcids=False)
-    if colname_site_id is None:
-        query = f'''
-        SELECT lon, lat, reg_id
-        FROM {tablename}
-        '''
-    else:
-        query = f'''
-        SELECT site_id, lon, lat, reg_id
-        FROM {tablename}
-        '''
-    output_df = pd.read_sql_query(query, conn)
-    # TODO: UserWarning: pandas only supports SQLAlchemy connectable (engine/connection) or database string URI or sqlite3 DBAPI2 connection. Other DBAPI2 objects are not tested. Please consider using SQLAlchemy.
-    temp_tables.drop_temp_table(cursor, tablename)
-    # Apparently, pd.read_sql_query() casts to numeric to be safe.
-    # Casting back to int:
-    output_df = output_df.astype({
-        "reg_id": "Int64"
-    })
-    return output_df
+    points = point_table.from_geojson(input_geojson, colname_site_id=colname_site_id)
+    return get_regid__points_to_dataframe(conn, points)
 
 
 def get_basinid_regid_from_subcid_plural(conn, subc_ids, columns=['subc_id', 'basin_id', 'reg_id']):
@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import threading
+import collections
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+
+'''
+Per-worker cache of the stream network of a basin ("basin graph"), so
+that upstream, downstream and listing queries do not have to rebuild the
+network in the database (pgr_connectedComponents, pgr_dijkstra, or a
+filter on strahler) on every request.
+
+A basin is loaded with one query (subc_id, target, strahler, length of all
+its stream segments), and kept as NumPy arrays, sorted by subc_id. The
+network is a tree: Each segment has one parent (its target, the next
+segment downstream), the segments flowing into the outlet have none.
+
+For every Strahler order s present in the basin, the network pruned to the
+segments with strahler >= s is precomputed ("topology level", see
+TopologyLevel): Which segments survive, and their parent in the pruned
+network (the next surviving segment downstream). Each level also stores
+the segments in pre-order (nested sets), so that all segments upstream of
+a segment are one contiguous slice. So queries with a min_strahler run on
+an already pruned network, in time proportional to the size of the result:
+
+* subc_ids_sorted(min_strahler): All segments of the basin (sorted by subc_id).
+* upstream_ids(subc_id, min_strahler): All segments upstream, incl. itself.
+* downstream_ids(subc_id, min_strahler): The path to the outlet.
+
+Basins are evicted (least recently used first) once the cached basins have
+more than "basin_graph_cache_segments" (config) stream segments in total.
+
+Usage:
+
+    graph = basin_graph.get_basin_graph(conn, basin_id, reg_id)
+    upstream_ids = graph.upstream_ids(subc_id, min_strahler=3)
+'''
+
+# Defaults, can be overridden in config:
+DEFAULT_CACHE_SEGMENTS = 5000000
+
+# global variables:
+_CACHE = collections.OrderedDict()
+_CACHE_SEGMENTS = 0
+_MAX_SEGMENTS = None
+_LOCK = threading.Lock()
+_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'load_seconds': 0.0}
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Basin graph cache not configured (config file not found), using defaults.")
+        return {}
+
+
+def _get_max_segments():
+    global _MAX_SEGMENTS
+    if _MAX_SEGMENTS is None:
+        _MAX_SEGMENTS = int(_read_config().get('basin_graph_cache_segments', DEFAULT_CACHE_SEGMENTS))
+    return _MAX_SEGMENTS
+
+
+class TopologyLevel:
+    # The network of a basin, pruned to the segments with strahler >= min_strahler.
+    # Positions (0..n-1) index the surviving segments, sorted by subc_id.
+
+    def __init__(self, min_strahler, subc_ids, parents):
+        self.min_strahler = min_strahler
+        # subc_ids of the surviving segments (sorted):
+        self.ids = subc_ids
+        # Position of the parent in the pruned network, or -1:
+        self.parent = parents
+        self.pre, self.size, self.order = _nested_sets(parents)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __repr__(self):
+        return f'<TopologyLevel> strahler >= {self.min_strahler}: {len(self)} segments'
+
+    def position(self, subc_id):
+        # Position of the segment, or None if it does not survive at this level:
+        pos = int(np.searchsorted(self.ids, subc_id))
+        if pos < len(self) and self.ids[pos] == subc_id:
+            return pos
+        return None
+
+    def upstream_positions(self, pos):
+        # Pre-order: The segment itself, then everything upstream of it.
+        start = self.pre[pos]
+        return self.order[start:start+self.size[pos]]
+
+    def downstream_positions(self, pos):
+        path = []
+        while pos >= 0:
+            path.append(pos)
+            pos = int(self.parent[pos])
+        return path
+
+
+class BasinGraph:
+
+    def __init__(self, basin_id, reg_id, subc_ids, targets, strahler, length):
+        self.basin_id = basin_id
+        self.reg_id = reg_id
+        # Sort by subc_id, so we can look up segments by binary search:
+        sort = np.argsort(subc_ids, kind='stable')
+        self.subc_ids = np.asarray(subc_ids, dtype='int64')[sort]
+        self.targets = np.asarray(targets, dtype='int64')[sort]
+        self.strahler = np.asarray(strahler, dtype='int16')[sort]
+        self.length = np.asarray(length, dtype='float64')[sort]
+
+        # Parent (index of the target segment), -1 if the target is not a
+        # segment of this basin (i.e. the outlet):
+        self.parent = _lookup(self.subc_ids, self.targets)
+
+        # One pruned network per Strahler order present in the basin:
+        self.strahler_orders = np.unique(self.strahler).tolist()
+        self.levels = {}
+        for min_strahler in self.strahler_orders:
+            survives = self.strahler >= min_strahler
+            self.levels[min_strahler] = _prune(self.subc_ids, self.parent, survives, min_strahler)
+        self._empty_level = TopologyLevel(None, np.empty(0, dtype='int64'), np.empty(0, dtype='int64'))
+        # Chain-contracted routing graph, made when needed (see contracted_graph):
+        self.contracted = None
+
+    def __len__(self):
+        return self.subc_ids.shape[0]
+
+    def __repr__(self):
+        return f'<BasinGraph> basin {self.basin_id} (region {self.reg_id}): {len(self)} segments, {len(self.levels)} levels'
+
+    def num_cached_items(self):
+        return len(self) + sum(len(level) for level in self.levels.values())
+
+    def level(self, min_strahler=None):
+        # The pruned network for this min_strahler (strahler >= min_strahler
+        # selects the same segments as >= the next order present in the basin):
+        for strahler_order in self.strahler_orders:
+            if min_strahler is None or strahler_order >= min_strahler:
+                return self.levels[strahler_order]
+        return self._empty_level
+
+    def contains(self, subc_id):
+        return self.level().position(subc_id) is not None
+
+    def strahler_of(self, subc_id):
+        pos = self.level().position(subc_id)
+        if pos is None:
+            return None
+        return int(self.strahler[pos])
+
+    def subc_ids_sorted(self, min_strahler=None, limit=None, after_subc_id=None):
+        # All (surviving) segments, sorted by subc_id, or one page of them:
+        return self._page(min_strahler, limit, after_subc_id).tolist()
+
+    def _page(self, min_strahler, limit, after_subc_id):
+        # Slice of the sorted ids (see pagination), no copy:
+        ids = self.level(min_strahler).ids
+        start = 0 if after_subc_id is None else int(np.searchsorted(ids, after_subc_id, side='right'))
+        end = ids.shape[0] if limit is None else start + int(limit)
+        return ids[start:end]
+
+    def upstream_ids(self, subc_id, min_strahler=None):
+        # All segments upstream of subc_id, incl. itself. Empty if subc_id
+        # itself does not reach min_strahler.
+        self._check_subc_id(subc_id)
+        level = self.level(min_strahler)
+        pos = level.position(subc_id)
+        if pos is None:
+            return []
+        return level.ids[level.upstream_positions(pos)].tolist()
+
+    def downstream_ids(self, subc_id, min_strahler=None):
+        # Path from subc_id to the outlet (incl. subc_id itself).
+        self._check_subc_id(subc_id)
+        level = self.level(min_strahler)
+        pos = level.position(subc_id)
+        if pos is None:
+            return []
+        return level.ids[level.downstream_positions(pos)].tolist()
+
+    def summary_by_strahler(self, min_strahler=None, limit=None, after_subc_id=None):
+        # Number and total length of the (surviving) segments, per Strahler
+        # order, as dict: strahler -> (number, length). Optionally of one page.
+        idx = np.searchsorted(self.subc_ids, self._page(min_strahler, limit, after_subc_id))
+        strahler_orders, inverse = np.unique(self.strahler[idx], return_inverse=True)
+        counts = np.bincount(inverse, minlength=strahler_orders.shape[0])
+        lengths = np.bincount(inverse, weights=self.length[idx], minlength=strahler_orders.shape[0])
+        return {int(order): (int(count), float(length))
+            for order, count, length in zip(strahler_orders.tolist(), counts.tolist(), lengths.tolist())}
+
+    def _check_subc_id(self, subc_id):
+        if not self.contains(subc_id):
+            err_msg = f'Subcatchment {subc_id} is not part of basin {self.basin_id} (region {self.reg_id}).'
+            LOGGER.error(err_msg)
+            raise exc.GeoFreshUnexpectedResultException(err_msg)
+
+
+def _lookup(sorted_ids, wanted_ids):
+    # Index of each wanted id in sorted_ids, or -1 if not there:
+    if sorted_ids.shape[0] == 0:
+        return np.full(np.shape(wanted_ids), -1, dtype='int64')
+    idx = np.minimum(np.searchsorted(sorted_ids, wanted_ids), sorted_ids.shape[0]-1)
+    return np.where(sorted_ids[idx] == wanted_ids, idx, -1)
+
+
+def _prune(subc_ids, parent, survives, min_strahler):
+    # Parent in the pruned network: The nearest surviving segment downstream.
+    # (Strahler orders only grow downstream, so this is usually the parent
+    # itself, but we do not rely on the data for that.)
+    ancestor = parent.copy()
+    for _ in range(parent.shape[0]):
+        removed = ancestor >= 0
+        removed[removed] = ~survives[ancestor[removed]]
+        if not removed.any():
+            break
+        # Jump over the removed ones (pointer jumping, log(depth) rounds):
+        ancestor[removed] = ancestor[ancestor[removed]]
+
+    nodes = np.flatnonzero(survives)
+    pruned_parents = ancestor[nodes]
+    has_parent = pruned_parents >= 0
+    # Basin index -> position in the pruned network (nodes are sorted):
+    pruned_parents[has_parent] = np.searchsorted(nodes, pruned_parents[has_parent])
+    return TopologyLevel(min_strahler, subc_ids[nodes], pruned_parents)
+
+
+def layers_from_roots(parent):
+    # The nodes of a forest (given by its parent array), layer by layer, from
+    # the roots upstream (list of arrays), one NumPy step per layer. Also
+    # returns the children, grouped by parent (CSR: child_nodes, child_ptr).
+    n = parent.shape[0]
+    has_parent = parent >= 0
+    child_nodes = np.flatnonzero(has_parent)
+    child_nodes = child_nodes[np.argsort(parent[child_nodes], kind='stable')]
+    child_ptr = np.zeros(n+1, dtype='int64')
+    np.cumsum(np.bincount(parent[child_nodes], minlength=n), out=child_ptr[1:])
+
+    layers = [np.flatnonzero(~has_parent)]
+    num_reached = layers[0].shape[0]
+    while True:
+        frontier = layers[-1]
+        starts = child_ptr[frontier]
+        counts = child_ptr[frontier+1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            break
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        layers.append(child_nodes[offsets])
+        num_reached += total
+    if num_reached < n:
+        LOGGER.warning(f'Stream network is not a tree: {n-num_reached} of {n} segments are in cycles, ignoring them.')
+    return layers, child_nodes, child_ptr
+
+
+def _nested_sets(parent):
+    # Pre-order number and subtree size of every node of a forest (given by
+    # its parent array), and the nodes in pre-order. All upstream nodes of
+    # node x are then order[pre[x]:pre[x]+size[x]].
+    # Computed layer by layer (from the roots up), one NumPy step per layer.
+    n = parent.shape[0]
+    pre = np.zeros(n, dtype='int64')
+    size = np.ones(n, dtype='int64')
+    if n == 0:
+        return pre, size, np.empty(0, dtype='int64')
+
+    layers, child_nodes, child_ptr = layers_from_roots(parent)
+
+    # Subtree sizes, from the headwaters down:
+    for layer in reversed(layers[1:]):
+        np.add.at(size, parent[layer], size[layer])
+
+    # Pre-order numbers, from the roots up: Each node comes right after its
+    # parent, plus the sizes of its earlier siblings.
+    sibling_sizes = np.cumsum(size[child_nodes]) - size[child_nodes]
+    slot = np.empty(n, dtype='int64')
+    slot[child_nodes] = np.arange(child_nodes.shape[0])
+    roots = layers[0]
+    pre[roots] = np.cumsum(size[roots]) - size[roots]
+    for layer in layers[1:]:
+        parents = parent[layer]
+        group_start = sibling_sizes[child_ptr[parents]]
+        pre[layer] = pre[parents] + 1 + sibling_sizes[slot[layer]] - group_start
+
+    order = np.zeros(n, dtype='int64')
+    order[pre[np.concatenate(layers)]] = np.concatenate(layers)
+    return pre, size, order
+
+
+def load_basin_graph(conn, basin_id, reg_id):
+    query = f'''
+    SELECT subc_id, COALESCE(target, 0), COALESCE(strahler, 0), COALESCE(length, 0)
+    FROM hydro.stream_segments
+    WHERE reg_id = {reg_id}
+        AND basin_id = {basin_id}
+    '''
+
+    ### Query database:
+    cursor = conn.cursor()
+    LOGGER.log(logging.TRACE, 'Querying database...')
+    cursor.execute(query)
+    LOGGER.log(logging.TRACE, 'Querying database... DONE.')
+    rows = cursor.fetchall()
+
+    if len(rows) == 0:
+        err_msg = f'No stream segments found for basin_id {basin_id} (region {reg_id})!'
+        LOGGER.error(err_msg)
+        raise exc.GeoFreshUnexpectedResultException(err_msg)
+
+    ids = np.array([row[0] for row in rows], dtype='int64')
+    targets = np.array([row[1] for row in rows], dtype='int64')
+    strahler = np.array([row[2] for row in rows], dtype='int16')
+    length = np.array([row[3] for row in rows], dtype='float64')
+    return BasinGraph(basin_id, reg_id, ids, targets, strahler, length)
+
+
+def get_basin_graph(conn, basin_id, reg_id):
+    # Returns the BasinGraph, from the cache if possible.
+    global _CACHE_SEGMENTS
+    key = (int(reg_id), int(basin_id))
+    with _LOCK:
+        graph = _CACHE.get(key)
+        if graph is not None:
+            _CACHE.move_to_end(key)
+            _STATS['hits'] += 1
+            LOGGER.log(logging.TRACE, f'Basin graph cache hit: basin {basin_id}')
+            return graph
+        _STATS['misses'] += 1
+
+    # Load outside the lock, this may take a while for large basins:
+    LOGGER.debug(f'Basin graph cache miss, loading basin {basin_id} (region {reg_id})...')
+    start = time.time()
+    graph = load_basin_graph(conn, basin_id, reg_id)
+    seconds = time.time() - start
+    LOGGER.debug(f'Loaded {graph} in {seconds:.3f} seconds.')
+
+    max_segments = _get_max_segments()
+    with _LOCK:
+        _STATS['load_seconds'] += seconds
+        if not key in _CACHE and graph.num_cached_items() <= max_segments:
+            _CACHE[key] = graph
+            _CACHE_SEGMENTS += graph.num_cached_items()
+            while _CACHE_SEGMENTS > max_segments:
+                _, evicted = _CACHE.popitem(last=False)
+                _CACHE_SEGMENTS -= evicted.num_cached_items()
+                _STATS['evictions'] += 1
+                LOGGER.debug(f'Basin graph cache full, evicted: {evicted}')
+    return graph
+
+
+def peek_basin_graph(basin_id, reg_id):
+    # The BasinGraph if it is cached, otherwise None (never loads it, e.g.
+    # for cost estimates, see cost_estimator):
+    with _LOCK:
+        return _CACHE.get((int(reg_id), int(basin_id)))
+
+
+def clear_cache():
+    global _CACHE_SEGMENTS
+    with _LOCK:
+        _CACHE.clear()
+        _CACHE_SEGMENTS = 0
+
+
+def log_cache_stats(comment=''):
+    with _LOCK:
+        LOGGER.info(f'Basin graph cache{comment}: {len(_CACHE)} basins, {_CACHE_SEGMENTS} segments, '
+                    f'{_STATS["hits"]} hits, {_STATS["misses"]} misses, {_STATS["evictions"]} evictions, '
+                    f'{_STATS["load_seconds"]:.3f} seconds spent loading.')
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    # Small network: 1 and 2 flow into 3, 3 and 4 into 5, 5 into the outlet (-7):
+    graph = BasinGraph(7, 58,
+        subc_ids=[5, 1, 2, 3, 4],
+        targets=[-7, 3, 3, 5, 5],
+        strahler=[2, 1, 1, 2, 1],
+        length=[100.0, 10.0, 20.0, 30.0, 40.0])
+    print(graph, graph.levels)
+    print(graph.upstream_ids(5), graph.upstream_ids(5, min_strahler=2), graph.upstream_ids(1, min_strahler=2))
+    print(graph.downstream_ids(1), graph.subc_ids_sorted(min_strahler=2))
+    print(graph.summary_by_strahler())
@@ -1,5 +1,4 @@
 import json
-import geomet.wkt
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -8,10 +7,12 @@ LOGGER = logging.getLogger(__name__)
 try:
     # If the package is installed in local python PATH:
     import aqua90m.geofresh.upstream_subcids as upstream_subcids
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -20,6 +21,8 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+geomet = lazy_import('geomet')
+
 
 def get_bbox_feature(conn, subc_ids, basin_id, reg_id, add_subc_ids = False):
     bbox_simplegeom = get_bbox_simplegeom(conn, subc_ids, basin_id, reg_id)
@@ -0,0 +1,287 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.geofresh.basin_graph as basin_graph
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.geofresh.basin_graph as basin_graph
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+
+'''
+Chain-contracted routing graph of a basin, so that routing between two
+segments (or to the outlet) does not need pgr_dijkstra, which rebuilds the
+whole network of the basin in the database for every single request.
+
+The stream network is a tree, so there is exactly one path between two
+segments: Up from both to their lowest common ancestor (the confluence
+where they meet), or to the outlet. No Dijkstra needed, only a tree walk.
+
+To make the walk short, every maximal chain of segments between two
+confluences (segments that have exactly one segment upstream) is contracted
+into one edge, which stores its member segments (in flow direction) and
+their total length. The walk then goes from chain to chain, and the chains
+are expanded back to their segments only if the path itself is needed
+(path_ids()). For distances, every segment knows its distance to the
+outlet (the summed length of itself and all segments downstream), so the
+distance between two segments is:
+
+    dist_to_outlet(a) + dist_to_outlet(b) - 2 * dist_to_outlet(confluence)
+
+The paths and distances are the same as those of pgr_dijkstra (undirected,
+edge = segment from subc_id to target, cost = length) on the same basin.
+
+The contracted graph is made when it is first needed, from the cached
+BasinGraph (see basin_graph), and stored on it, so it stays cached (and is
+evicted) together with the basin.
+
+Usage:
+
+    contracted = contracted_graph.get_contracted_graph(conn, basin_id, reg_id)
+    segment_ids = contracted.path_ids(start_subc_id, end_subc_id)
+    dist = contracted.distance(start_subc_id, end_subc_id)
+'''
+
+
+class ContractedGraph:
+    # Positions (0..n-1) index the segments, sorted by subc_id, as in BasinGraph.
+    # Chains are numbered 0..num_chains-1.
+
+    def __init__(self, subc_ids, parent, targets, length):
+        self.ids = subc_ids
+        self.parent = parent
+        self.targets = targets
+        n = subc_ids.shape[0]
+
+        # A chain starts at every segment that does not have exactly one
+        # segment upstream (headwaters and segments below confluences), and
+        # continues downstream through the segments that have:
+        has_parent = parent >= 0
+        num_children = np.bincount(parent[has_parent], minlength=n)
+        child = np.full(n, -1, dtype='int64')
+        child[parent[has_parent]] = np.flatnonzero(has_parent)
+        is_head = num_children != 1
+        head, rank = _rank_chains(child, is_head)
+        if (rank < 0).any():
+            # Only in a network with cycles: Cut them.
+            LOGGER.warning(f'Stream network is not a tree: {int((rank < 0).sum())} of {n} segments are in cycles.')
+            is_head |= rank < 0
+            head, rank = _rank_chains(child, is_head)
+
+        # Chain of each segment, and its position in the chain (0 = upstream end):
+        heads = np.flatnonzero(is_head)
+        chain_index = np.full(n, -1, dtype='int64')
+        chain_index[heads] = np.arange(heads.shape[0])
+        self.chain_of = chain_index[head]
+        self.rank = rank
+
+        # Members of each chain, in flow direction (CSR: members, chain_ptr):
+        num_chains = heads.shape[0]
+        self.members = np.lexsort((rank, self.chain_of))
+        self.chain_ptr = np.zeros(num_chains+1, dtype='int64')
+        np.cumsum(np.bincount(self.chain_of, minlength=num_chains), out=self.chain_ptr[1:])
+        member_length = length[self.members]
+        self.chain_length = np.bincount(self.chain_of, weights=length, minlength=num_chains)
+
+        # The contracted tree: Each chain flows into the chain of the segment
+        # below its last segment (or into the outlet, -1):
+        bottom = self.members[self.chain_ptr[1:]-1]
+        below = parent[bottom]
+        self.chain_parent = np.where(below >= 0, self.chain_of[np.maximum(below, 0)], -1)
+
+        # Distance to the outlet: Summed length within the chain (from the
+        # segment down to the end of the chain), plus the distance to the
+        # outlet of the segment below the chain ("base", per chain):
+        prefix = np.cumsum(member_length) - member_length
+        within_chain = np.empty(n, dtype='float64')
+        within_chain[self.members] = (self.chain_length[self.chain_of[self.members]]
+            - (prefix - prefix[self.chain_ptr[:-1]][self.chain_of[self.members]]))
+        base = np.zeros(num_chains, dtype='float64')
+        self.depth = np.full(num_chains, -1, dtype='int64')
+        layers, _, _ = basin_graph.layers_from_roots(self.chain_parent)
+        for depth, layer in enumerate(layers):
+            self.depth[layer] = depth
+            if depth > 0:
+                entry = below[layer]
+                base[layer] = base[self.chain_parent[layer]] + within_chain[entry]
+        self.dist_to_outlet = within_chain + base[self.chain_of]
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __repr__(self):
+        return f'<ContractedGraph> {len(self)} segments in {self.num_chains()} chains'
+
+    def num_chains(self):
+        return self.chain_length.shape[0]
+
+    def position(self, subc_id):
+        # Position of the segment, or None if it is not in the network (or in a cycle):
+        pos = int(np.searchsorted(self.ids, subc_id))
+        if pos < len(self) and self.ids[pos] == subc_id and self.depth[self.chain_of[pos]] >= 0:
+            return pos
+        return None
+
+    def chain_ids(self, chain):
+        # Member segments of a chain (subc_ids, in flow direction):
+        return self.ids[self.members[self.chain_ptr[chain]:self.chain_ptr[chain+1]]].tolist()
+
+    def path_ids(self, start_subc_id, end_subc_id):
+        # Segments (edges) on the path from start to end, as pgr_dijkstra
+        # returns them: From start up to the confluence (not incl.), and from
+        # there to end. The end may also be the outlet (a target that is not
+        # a segment). Returns None if there is no path.
+        positions = self._path_positions(start_subc_id, end_subc_id)
+        if positions is None:
+            return None
+        return self.ids[positions].tolist()
+
+    def distance(self, start_subc_id, end_subc_id):
+        # Length of the path from start to end (without expanding it), or
+        # None if there is no path.
+        route = self.route(start_subc_id, end_subc_id)
+        if route is None:
+            return None
+        kind, pos_a, pos_b, meeting = route
+        dist = self.dist_to_outlet
+        if kind == 'tree':
+            return float(dist[pos_a] + dist[pos_b] - 2*dist[meeting])
+        return float(sum(dist[pos] for pos in (pos_a, pos_b) if pos is not None))
+
+    def route(self, start_subc_id, end_subc_id):
+        # Where the path between start and end meets: ('tree', a, b, lca) if
+        # both are segments of the same tree, or ('outlet', a, b, None) if it
+        # goes through the outlet node (b is None if end is the outlet, a is
+        # None if start is). Positions, not subc_ids. None if there is no path.
+        pos_a = self.position(start_subc_id)
+        pos_b = self.position(end_subc_id)
+        if pos_a is None and pos_b is None:
+            return None
+        if pos_a is None:
+            route = self.route(end_subc_id, start_subc_id)
+            if route is None:
+                return None
+            kind, pos_b, pos_a, meeting = route
+            return kind, pos_a, pos_b, meeting
+        if pos_b is None:
+            # End is a node, not a segment: Only the outlet of start's tree.
+            if self.targets[self._root(pos_a)] == end_subc_id:
+                return 'outlet', pos_a, None, None
+            return None
+        meeting = self._lowest_common_ancestor(pos_a, pos_b)
+        if meeting is not None:
+            return 'tree', pos_a, pos_b, meeting
+        # Two trees that flow into the same outlet node:
+        if self.targets[self._root(pos_a)] == self.targets[self._root(pos_b)]:
+            return 'outlet', pos_a, pos_b, None
+        return None
+
+    def _lowest_common_ancestor(self, pos_a, pos_b):
+        # Walks up the contracted tree, always moving the deeper chain:
+        chain_a, rank_a = self.chain_of[pos_a], self.rank[pos_a]
+        chain_b, rank_b = self.chain_of[pos_b], self.rank[pos_b]
+        while chain_a != chain_b:
+            if self.depth[chain_a] >= self.depth[chain_b]:
+                chain_a, rank_a = self._chain_below(chain_a)
+                if chain_a < 0:
+                    return None
+            else:
+                chain_b, rank_b = self._chain_below(chain_b)
+                if chain_b < 0:
+                    return None
+        return self.members[self.chain_ptr[chain_a] + max(rank_a, rank_b)]
+
+    def _chain_below(self, chain):
+        # Chain (and position in it) of the segment below the chain's end:
+        below = self.parent[self.members[self.chain_ptr[chain+1]-1]]
+        if below < 0:
+            return -1, -1
+        return self.chain_of[below], self.rank[below]
+
+    def _root(self, pos):
+        # The last segment before the outlet:
+        chain = self.chain_of[pos]
+        while self.chain_parent[chain] >= 0:
+            chain = self.chain_parent[chain]
+        return self.members[self.chain_ptr[chain+1]-1]
+
+    def _path_positions(self, start_subc_id, end_subc_id):
+        route = self.route(start_subc_id, end_subc_id)
+        if route is None:
+            return None
+        kind, pos_a, pos_b, meeting = route
+        up_a = self.up_to(pos_a, meeting) if pos_a is not None else []
+        up_b = self.up_to(pos_b, meeting) if pos_b is not None else []
+        return np.concatenate(up_a + [part[::-1] for part in reversed(up_b)] + [np.empty(0, dtype='int64')])
+
+    def up_to(self, pos, stop):
+        # Positions from pos downstream until stop (not incl.), or until the
+        # outlet if stop is None. As list of slices of the chains' members.
+        parts = []
+        chain, rank = self.chain_of[pos], self.rank[pos]
+        stop_chain = None if stop is None else self.chain_of[stop]
+        while chain >= 0:
+            start = self.chain_ptr[chain] + rank
+            if chain == stop_chain:
+                parts.append(self.members[start:self.chain_ptr[chain] + self.rank[stop]])
+                break
+            parts.append(self.members[start:self.chain_ptr[chain+1]])
+            chain, rank = self._chain_below(chain)
+        return parts
+
+
+def _rank_chains(child, is_head):
+    # List ranking (pointer jumping, log(length) rounds): For each segment,
+    # the head of its chain (following the single upstream segment until a
+    # head), and the number of steps to it. Rank -1 for segments that do not
+    # reach a head (cycles).
+    n = child.shape[0]
+    head = np.where(is_head, np.arange(n), child)
+    rank = (~is_head).astype('int64')
+    for _ in range(max(n, 1).bit_length() + 1):
+        done = is_head[head]
+        if done.all():
+            return head, rank
+        rank = np.where(done, rank, rank + rank[head])
+        head = np.where(done, head, head[head])
+    done = is_head[head]
+    return head, np.where(done, rank, -1)
+
+
+def get_contracted_graph(conn, basin_id, reg_id):
+    # Returns the ContractedGraph of the basin, cached together with the BasinGraph.
+    graph = basin_graph.get_basin_graph(conn, basin_id, reg_id)
+    if graph.contracted is None:
+        graph.contracted = ContractedGraph(graph.subc_ids, graph.parent, graph.targets, graph.length)
+        LOGGER.debug(f'Basin {basin_id}: Made {graph.contracted}')
+    return graph.contracted
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    # Small network: 1 and 2 flow into 3, 3 into 4, 4 and 6 into 5, 5 into the outlet (-7):
+    contracted = ContractedGraph(
+        subc_ids=np.array([1, 2, 3, 4, 5, 6]),
+        parent=np.array([2, 2, 3, 4, -1, 4]),
+        targets=np.array([3, 3, 4, 5, -7, 5]),
+        length=np.array([10.0, 20.0, 30.0, 40.0, 100.0, 60.0]))
+    print(contracted, [contracted.chain_ids(chain) for chain in range(contracted.num_chains())])
+    print(contracted.path_ids(1, 6), contracted.distance(1, 6))
+    print(contracted.path_ids(1, -7), contracted.distance(1, -7))
+    print(contracted.path_ids(4, 1), contracted.distance(4, 1))
@@ -0,0 +1,385 @@
+import os
+import json
+import math
+import time
+import threading
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+    import aqua90m.geofresh.basic_queries as basic_queries
+    import aqua90m.geofresh.basin_graph as basin_graph
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+        import pygeoapi.process.aqua90m.geofresh.basin_graph as basin_graph
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+requests = lazy_import('requests')
+
+'''
+Cost estimates of process executions, before the heavy queries start.
+
+Whether get-upstream-dissolved for a point takes 50 ms or 5 minutes
+depends on the size of its upstream catchment, which we usually only know
+after computing it. Instead, the estimate uses cheap, precomputed numbers:
+
+* "upstream": The upstream catchment of one segment. Exact if the basin
+  graph is cached (see basin_graph), otherwise from the flow accumulation
+  of the segment (one indexed row of hydro.stream_segments), converted to
+  a number of segments with a ratio that is calibrated whenever both are
+  known.
+* "basin": All segments of a basin. Exact if the basin graph is cached,
+  otherwise the planner's row estimate (EXPLAIN, from the table
+  statistics, no rows are read).
+* "points": The number of points posted (inline), plus a fixed amount per
+  distinct region (if the points carry a reg_id), as every region is
+  queried separately. For points posted via URL (CSV or GeoJSON), the
+  number is estimated from the size of the file (Content-Length, from a
+  HEAD request), without downloading it.
+
+From the number of units, runtime and output size are predicted with
+seconds (and bytes) per unit. The seconds per unit are learned per process
+(moving average of finished executions, see observe()), the bytes per unit
+are given by the process.
+
+Based on the prediction, GeoFreshBaseProcessor rejects sync executions
+that take too long for a sync request ("cost_async_seconds", config), asking
+the client to send them as async job, and rejects executions that are too
+expensive even for async ("cost_reject_seconds", "cost_reject_mb"),
+with a message on how to make the request smaller.
+
+Usage:
+
+    estimate = cost_estimator.estimate(conn, 'get-upstream-dissolved', 'upstream', data)
+    ... run ...
+    cost_estimator.observe('get-upstream-dissolved', estimate, seconds)
+'''
+
+# Defaults, can be overridden in config:
+DEFAULT_ASYNC_SECONDS = 20
+DEFAULT_REJECT_SECONDS = 3600
+DEFAULT_REJECT_MB = 1000
+DEFAULT_SEGMENTS_PER_FLOW_ACCUM = 5.0
+DEFAULT_UNITS_PER_REGION = 1000
+
+# Typical size of one point in input files (a CSV row with site id, lon,
+# lat; a GeoJSON feature with a few properties), to estimate the number of
+# points from the file size:
+BYTES_PER_POINT = {'csv_url': 40, 'points_geojson_url': 150}
+URL_SIZE_TIMEOUT_SECONDS = 5
+URL_SIZE_CACHE_SECONDS = 300
+
+# Starting values, until executions have been observed:
+DEFAULT_SECONDS_PER_UNIT = {'upstream': 0.0005, 'basin': 0.0005, 'points': 0.005}
+DEFAULT_BYTES_PER_UNIT = {'upstream': 12, 'basin': 12, 'points': 200}
+BASE_SECONDS = 0.05
+
+# Weight of a new observation in the moving averages:
+SMOOTHING = 0.2
+
+# global variables:
+_SETTINGS = None
+_LOCK = threading.Lock()
+_SECONDS_PER_UNIT = {}
+_SEGMENTS_PER_FLOW_ACCUM = None
+_URL_SIZES = {} # url -> (time, bytes or None)
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Cost estimates not configured (config file not found), using defaults.")
+        return {}
+
+
+def get_settings():
+    global _SETTINGS
+    global _SEGMENTS_PER_FLOW_ACCUM
+    if _SETTINGS is None:
+        config = _read_config()
+        _SETTINGS = {
+            'async_seconds': float(config.get('cost_async_seconds', DEFAULT_ASYNC_SECONDS)),
+            'reject_seconds': float(config.get('cost_reject_seconds', DEFAULT_REJECT_SECONDS)),
+            'reject_mb': float(config.get('cost_reject_mb', DEFAULT_REJECT_MB))
+        }
+        _SEGMENTS_PER_FLOW_ACCUM = float(config.get('cost_segments_per_flow_accum', DEFAULT_SEGMENTS_PER_FLOW_ACCUM))
+    return _SETTINGS
+
+
+def estimate(conn, process_id, model, data, bytes_per_unit = None):
+    # Returns a dict: model, units (and what they are), predicted seconds and
+    # bytes. None if the inputs do not tell (e.g. points in a CSV file whose
+    # size the server does not tell).
+    get_settings()
+    if model == 'upstream':
+        result = _estimate_upstream(conn, data)
+    elif model == 'basin':
+        result = _estimate_basin(conn, data)
+    elif model == 'points':
+        result = _estimate_points(data)
+    else:
+        raise ValueError(f'Unknown cost model: {model}')
+    if result is None:
+        return None
+
+    if bytes_per_unit is None:
+        bytes_per_unit = DEFAULT_BYTES_PER_UNIT[model]
+    with _LOCK:
+        seconds_per_unit = _SECONDS_PER_UNIT.get(process_id, DEFAULT_SECONDS_PER_UNIT[model])
+    units = result['units']
+    result.update({
+        "model": model,
+        "predicted_seconds": round(BASE_SECONDS + units * seconds_per_unit, 3),
+        "predicted_bytes": int(units * bytes_per_unit)
+    })
+    LOGGER.debug(f'Cost estimate for {process_id}: {result}')
+    return result
+
+
+def _estimate_upstream(conn, data):
+    subc_id, basin_id, reg_id = _located_segment(conn, data)
+    if subc_id is None:
+        return None
+    min_strahler = data.get('min_strahler', None)
+
+    # Exact, if the basin is cached (and calibrates the flow accumulation):
+    graph = basin_graph.peek_basin_graph(basin_id, reg_id)
+    flow_accum = _get_flow_accum(conn, subc_id, basin_id, reg_id)
+    if graph is not None and graph.contains(subc_id):
+        num_upstream = _num_upstream(graph.level(min_strahler), subc_id)
+        if flow_accum:
+            _calibrate_flow_accum(_num_upstream(graph.level(), subc_id), flow_accum)
+        return {"units": num_upstream, "upstream_segments": num_upstream, "exact": True,
+            "subc_id": subc_id, "basin_id": basin_id, "reg_id": reg_id}
+
+    with _LOCK:
+        num_upstream = max(1, int((flow_accum or 0) * _SEGMENTS_PER_FLOW_ACCUM))
+    return {"units": num_upstream, "upstream_segments": num_upstream, "exact": False,
+        "subc_id": subc_id, "basin_id": basin_id, "reg_id": reg_id}
+
+
+def _num_upstream(level, subc_id):
+    # Size of the nested set, without listing the ids:
+    pos = level.position(subc_id)
+    return 0 if pos is None else int(level.size[pos])
+
+
+def _estimate_basin(conn, data):
+    # Basin given by id, or by a point / subc_id in it:
+    basin_id = data.get('basin_id', None)
+    reg_id = data.get('reg_id', None)
+    if basin_id is None:
+        _, basin_id, reg_id = _located_segment(conn, data)
+        if basin_id is None:
+            return None
+    elif reg_id is None:
+        reg_id = basic_queries.get_regid_from_basinid(conn, LOGGER, basin_id)
+
+    graph = basin_graph.peek_basin_graph(basin_id, reg_id)
+    if graph is not None:
+        num_segments = len(graph.level(data.get('min_strahler', None)))
+        exact = True
+    else:
+        num_segments = _planner_rows(conn, 'hydro.stream_segments',
+            'reg_id = %s AND basin_id = %s', [int(reg_id), int(basin_id)])
+        exact = False
+    limit = data.get('limit', None)
+    if limit is not None and str(limit).isdigit():
+        num_segments = min(num_segments, int(limit))
+    return {"units": num_segments, "basin_segments": num_segments, "exact": exact,
+        "basin_id": int(basin_id), "reg_id": int(reg_id)}
+
+
+def _estimate_points(data):
+    counted = count_points(data)
+    if counted is None:
+        return None
+    counted['units'] = counted['num_points'] + counted['num_regions'] * DEFAULT_UNITS_PER_REGION
+    return counted
+
+
+def count_points(data):
+    # Number of points of a plural process (and of distinct regions, if
+    # known), as dict, or None if unknown. Exact for points posted inline,
+    # estimated from the file size for points posted via URL.
+    points = data.get('points_geojson', None) or data.get('points', None)
+    if isinstance(points, dict):
+        features = points.get('features') or points.get('geometries') or points.get('coordinates') or []
+    elif isinstance(points, list):
+        features = points
+    else:
+        return _count_points_at_url(data)
+    reg_ids = set()
+    for feature in features:
+        if isinstance(feature, dict):
+            reg_ids.add((feature.get('properties') or {}).get('reg_id'))
+    return {"num_points": len(features), "num_regions": len(reg_ids - {None}) or 1, "exact": True}
+
+
+def _count_points_at_url(data):
+    for name, bytes_per_point in BYTES_PER_POINT.items():
+        url = data.get(name, None)
+        if url is None:
+            continue
+        size = _url_size(url)
+        if size is None:
+            return None
+        return {"num_points": math.ceil(size / bytes_per_point), "num_regions": 1,
+            "input_bytes": size, "exact": False}
+    return None
+
+
+def _url_size(url):
+    # Size of the file in bytes (local path, or Content-Length of the URL),
+    # or None if unknown. Cached for a while, as the admission control and
+    # the estimate both ask for it.
+    now = time.monotonic()
+    with _LOCK:
+        cached = _URL_SIZES.get(url)
+        if cached is not None and now - cached[0] < URL_SIZE_CACHE_SECONDS:
+            return cached[1]
+    size = None
+    try:
+        if not url.startswith('http'):
+            size = os.path.getsize(url)
+        else:
+            resp = requests.head(url, allow_redirects=True, timeout=URL_SIZE_TIMEOUT_SECONDS)
+            if resp.ok and 'Content-Length' in resp.headers:
+                size = int(resp.headers['Content-Length'])
+            else:
+                LOGGER.debug(f'No size for {url} (HTTP {resp.status_code}), no cost estimate.')
+    except Exception as e:
+        # Will fail again in the process, with the proper message:
+        LOGGER.debug(f'No size for {url}, no cost estimate: {repr(e)}')
+    with _LOCK:
+        for key in [key for key, (then, _) in _URL_SIZES.items() if now - then >= URL_SIZE_CACHE_SECONDS]:
+            del _URL_SIZES[key]
+        _URL_SIZES[url] = (now, size)
+    return size
+
+
+def _located_segment(conn, data):
+    # The segment of a singular process (point, lon/lat, or subc_id):
+    point = data.get('point', None)
+    lon = data.get('lon', None)
+    lat = data.get('lat', None)
+    subc_id = data.get('subc_id', None)
+    if point is not None:
+        lon, lat = point.get('coordinates') or point['geometry']['coordinates']
+    if subc_id is None and (lon is None or lat is None):
+        return None, None, None
+    try:
+        return basic_queries.get_subcid_basinid_regid(conn, LOGGER, lon, lat, subc_id)
+    except exc.UserInputException as e:
+        # Will fail again in the process, with the proper message:
+        LOGGER.debug(f'No cost estimate, could not locate the point: {e}')
+        return None, None, None
+
+
+def _get_flow_accum(conn, subc_id, basin_id, reg_id):
+    query = '''
+    SELECT flow_accum
+    FROM hydro.stream_segments
+    WHERE subc_id = %s AND basin_id = %s AND reg_id = %s
+    '''
+    cursor = conn.cursor()
+    cursor.execute(query, [int(subc_id), int(basin_id), int(reg_id)])
+    row = cursor.fetchone()
+    return None if row is None or row[0] is None else float(row[0])
+
+
+def _planner_rows(conn, table, where, where_params):
+    # The planner's estimate of the number of rows (from the table
+    # statistics), without running the query:
+    cursor = conn.cursor()
+    cursor.execute(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM {table} WHERE {where}', where_params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def _calibrate_flow_accum(num_upstream, flow_accum):
+    global _SEGMENTS_PER_FLOW_ACCUM
+    with _LOCK:
+        ratio = num_upstream / flow_accum
+        _SEGMENTS_PER_FLOW_ACCUM = (1-SMOOTHING) * _SEGMENTS_PER_FLOW_ACCUM + SMOOTHING * ratio
+        LOGGER.log(logging.TRACE, f'Segments per flow accumulation: {_SEGMENTS_PER_FLOW_ACCUM:.4f}')
+
+
+def observe(process_id, estimated, seconds):
+    # Learns the seconds per unit of a process from a finished execution:
+    if estimated is None or estimated['units'] <= 0:
+        return
+    with _LOCK:
+        seconds_per_unit = max(seconds - BASE_SECONDS, 0.0) / estimated['units']
+        previous = _SECONDS_PER_UNIT.get(process_id, DEFAULT_SECONDS_PER_UNIT[estimated['model']])
+        _SECONDS_PER_UNIT[process_id] = (1-SMOOTHING) * previous + SMOOTHING * seconds_per_unit
+    LOGGER.debug(f'{process_id}: Predicted {estimated["predicted_seconds"]} seconds, took {seconds:.3f}.')
+
+
+def decide(estimated, is_async):
+    # 'run', 'async' (a sync execution that should be sent as async job) or 'reject':
+    settings = get_settings()
+    if estimated is None:
+        return 'run'
+    if (estimated['predicted_seconds'] > settings['reject_seconds'] or
+            estimated['predicted_bytes'] > settings['reject_mb'] * 1024 * 1024):
+        return 'reject'
+    if not is_async and estimated['predicted_seconds'] > settings['async_seconds']:
+        return 'async'
+    return 'run'
+
+
+def explain(process_id, estimated, needs_async=False):
+    # Actionable message for the user (for rejected requests, or sync requests
+    # that should be sent as async job):
+    if 'upstream_segments' in estimated:
+        size = f"about {estimated['upstream_segments']} upstream subcatchments"
+        advice = "Please use a higher min_strahler, or a point further upstream."
+    elif 'basin_segments' in estimated:
+        size = f"about {estimated['basin_segments']} stream segments in the basin"
+        advice = "Please use a higher min_strahler, or fetch the basin in pages (limit, cursor)."
+    else:
+        approx = '' if estimated['exact'] else 'about '
+        size = f"{approx}{estimated['num_points']} points in {estimated['num_regions']} regions"
+        advice = "Please split the points into several requests."
+    prediction = (f"{size}, estimated {estimated['predicted_seconds']:.0f} seconds"
+        f" and {estimated['predicted_bytes']/1024/1024:.1f} MB")
+    if needs_async:
+        return (f"{process_id}: Expensive request ({prediction}), too long for a synchronous"
+            " request. Please send it again as asynchronous job (with the header"
+            " 'Prefer: respond-async'), and fetch the results from the job.")
+    return f"{process_id}: Request too large ({prediction}). {advice}"
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    estimated = estimate(None, 'get-snapped-points-plural', 'points',
+        {'points_geojson': {'type': 'MultiPoint', 'coordinates': [[9.9, 54.6]] * 50000}})
+    print(estimated, decide(estimated, False), decide(estimated, True))
+    observe('get-snapped-points-plural', estimated, 120.0)
+    print(estimate(None, 'get-snapped-points-plural', 'points',
+        {'points_geojson': {'type': 'MultiPoint', 'coordinates': [[9.9, 54.6]] * 50000}}))
+    print(explain('get-snapped-points-plural', estimated))
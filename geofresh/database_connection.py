@@ -1,7 +1,4 @@
-import psycopg2
 import sys
-import sshtunnel
-import geomet.wkt
 import os
 import json
 import logging
@@ -9,6 +6,25 @@ logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
 LOGGER = logging.getLogger(__name__)
 
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+# Only imported once we actually connect (sshtunnel only if we tunnel):
+psycopg2 = lazy_import('psycopg2')
+sshtunnel = lazy_import('sshtunnel')
+
 ###########################
 ### database connection ###
 ###########################
@@ -73,8 +89,10 @@ def get_connection_object_config(config):
         conn = get_connection_object(geofresh_server, geofresh_port,
             database_name, database_username, database_password, worker_name,
             use_tunnel=use_tunnel, ssh_username=ssh_username, ssh_password=ssh_password)
-    except sshtunnel.BaseSSHTunnelForwarderError as e1:
-        LOGGER.error('SSH Tunnel Error: %s' % str(e1))
+    except Exception as e1:
+        # Only look at sshtunnel if we used it, so it does not get imported otherwise:
+        if use_tunnel and isinstance(e1, sshtunnel.BaseSSHTunnelForwarderError):
+            LOGGER.error('SSH Tunnel Error: %s' % str(e1))
         raise e1
 
     return conn
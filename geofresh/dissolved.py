@@ -1,5 +1,4 @@
 import json
-import geomet.wkt
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -8,11 +7,17 @@ LOGGER = logging.getLogger(__name__)
 try:
     import aqua90m.geofresh.upstream_subcids as upstream_subcids
     import aqua90m.utils.exceptions as exc
+    import aqua90m.utils.geometry_decoding as geometry_decoding
+    import aqua90m.geofresh.geometry_simplification as geometry_simplification
+    import aqua90m.geofresh.query_capture as query_capture
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
         import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.utils.geometry_decoding as geometry_decoding
+        import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
+        import pygeoapi.process.aqua90m.geofresh.query_capture as query_capture
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -22,9 +27,11 @@ except ModuleNotFoundError as e1:
         LOGGER.debug(msg)
 
 
-def get_dissolved_feature(conn, subc_ids, basin_id, reg_id, add_subc_ids = False):
+def get_dissolved_feature(conn, subc_ids, basin_id, reg_id, add_subc_ids = False,
+        simplify_tolerance = None, coordinate_precision = None):
 
-    dissolved_simplegeom = get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id)
+    dissolved_simplegeom = get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id,
+        simplify_tolerance, coordinate_precision)
     # This geometry can be None/null, which is the valid value for unlocated Features in GeoJSON spec:
     # https://datatracker.ietf.org/doc/html/rfc7946#section-3.2
 
@@ -40,10 +47,15 @@ def get_dissolved_feature(conn, subc_ids, basin_id, reg_id, add_subc_ids = False
     if add_subc_ids:
         dissolved_feature["properties"]["subc_ids"] = subc_ids
 
+    # Size report belongs to the Feature, not to its geometry:
+    if dissolved_simplegeom is not None and "geometry_simplification" in dissolved_simplegeom:
+        dissolved_feature["geometry_simplification"] = dissolved_simplegeom.pop("geometry_simplification")
+
     return dissolved_feature
 
 
-def get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id):
+def get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id,
+        simplify_tolerance = None, coordinate_precision = None):
     """
     Example result:
     {"type": "Polygon", "coordinates": [[[9.916666666666668, 54.7025], [9.913333333333334, 54.7025], [9.913333333333334, 54.705], [9.915000000000001, 54.705], [9.915833333333333, 54.705], [9.915833333333333, 54.70583333333333], [9.916666666666668, 54.70583333333333], [9.916666666666668, 54.705], [9.918333333333335, 54.705], [9.918333333333335, 54.704166666666666], [9.919166666666667, 54.704166666666666], [9.919166666666667, 54.70333333333333], [9.920833333333334, 54.70333333333333], [9.920833333333334, 54.704166666666666], [9.924166666666668, 54.704166666666666], [9.925, 54.704166666666666], [9.925, 54.705], [9.926666666666668, 54.705], [9.9275, 54.705], [9.9275, 54.70583333333333], [9.928333333333335, 54.70583333333333], [9.928333333333335, 54.70333333333333], [9.929166666666667, 54.70333333333333], [9.929166666666667, 54.7025], [9.931666666666667, 54.7025], [9.931666666666667, 54.7], [9.930833333333334, 54.7], [9.930833333333334, 54.69833333333333], [9.930000000000001, 54.69833333333333], [9.929166666666667, 54.69833333333333], [9.929166666666667, 54.6975], [9.929166666666667, 54.696666666666665], [9.928333333333335, 54.696666666666665], [9.928333333333335, 54.695], [9.9275, 54.695], [9.9275, 54.693333333333335], [9.928333333333335, 54.693333333333335], [9.928333333333335, 54.69166666666666], [9.9275, 54.69166666666666], [9.9275, 54.69083333333333], [9.926666666666668, 54.69083333333333], [9.926666666666668, 54.69], [9.925833333333333, 54.69], [9.925, 54.69], [9.925, 54.68833333333333], [9.922500000000001, 54.68833333333333], [9.922500000000001, 54.69083333333333], [9.921666666666667, 54.69083333333333], [9.921666666666667, 54.69166666666666], [9.919166666666667, 54.69166666666666], [9.919166666666667, 54.692499999999995], [9.918333333333335, 54.692499999999995], [9.918333333333335, 54.693333333333335], [9.9175, 54.693333333333335], [9.9175, 54.695], [9.918333333333335, 54.695], [9.918333333333335, 54.69833333333333], [9.9175, 54.69833333333333], [9.9175, 54.700833333333335], [9.9175, 54.70166666666667], [9.916666666666668, 54.70166666666667], [9.916666666666668, 54.7025]]]}
@@ -70,21 +82,35 @@ def get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id):
 
     upstream_subcids.too_many_upstream_catchments(len(subc_ids), 'dissolved polygon')
 
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('dissolved',
+        (reg_id, basin_id, geometry_simplification.ids_key(subc_ids)),
+        simplify_tolerance, coordinate_precision,
+        lambda: _get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id,
+            simplify_tolerance, coordinate_precision))
+
+
+def _get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id, simplify_tolerance, coordinate_precision):
+
     ### Define query:
     relevant_ids = ", ".join([str(elem) for elem in subc_ids])
     # e.g. 506250459, 506251015, 506251126, 506251712
+    # (If requested, the dissolved polygon is simplified, not its parts.)
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
-    SELECT ST_AsText(ST_MemUnion(geom))
-    FROM sub_catchments
-    WHERE subc_id IN ({relevant_ids})
-        AND reg_id = {reg_id}
-        AND basin_id = {basin_id}
+    SELECT ST_AsBinary({sql['geom']}){sql['counts']}
+    FROM (
+        SELECT ST_MemUnion(geom) AS geom
+        FROM sub_catchments
+        WHERE subc_id IN ({relevant_ids})
+            AND reg_id = {reg_id}
+            AND basin_id = {basin_id}
+    ) AS dissolved{sql['lateral']}
     '''
 
     ### Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = query_capture.execute(conn.cursor(), query, stage='dissolving upstream catchment')
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results and construct GeoJSON:
@@ -97,11 +123,154 @@ def get_dissolved_simplegeom(conn, subc_ids, basin_id, reg_id):
         raise exc.GeoFreshUnexpectedResultException(err_msg)
 
     # Assemble GeoJSON to return:
-    dissolved_simplegeom = geomet.wkt.loads(row[0])
+    dissolved_simplegeom = geometry_decoding.wkb_to_geojson_one(row[0],
+        geometry_simplification.decimal_digits(coordinate_precision))
+
+    report = geometry_simplification.size_report([row], simplify_tolerance, coordinate_precision)
+    if report is not None and dissolved_simplegeom is not None:
+        dissolved_simplegeom["geometry_simplification"] = report
+
     return dissolved_simplegeom
 
 
 
+def get_dissolved_features_nested(conn, nested, basin_id, reg_id,
+        simplify_tolerance = None, coordinate_precision = None):
+    # Dissolved upstream catchments of many segments of one basin, in one
+    # query, from nested upstream catchments (see upstream_subcids.
+    # get_upstream_catchment_ids_nested()): Each segment's own part is
+    # dissolved once, and each upstream catchment is the union of its own
+    # part and the finished upstream catchments nested in it (level by
+    # level, see _nesting_levels()). So every polygon is read from the table
+    # only once, and unioned only once per level it is nested in, even if it
+    # is upstream of many of the points.
+    # Returns a dict: subc_id -> Feature (geometry null if nothing upstream).
+
+    # Each segment belongs to exactly one part (the part of the point next
+    # downstream of it):
+    segment_ids, part_ids = [], []
+    for subc_id, item in nested.items():
+        segment_ids.extend(item["upstream_ids"])
+        part_ids.extend([subc_id] * len(item["upstream_ids"]))
+    upstream_subcids.too_many_upstream_catchments(len(segment_ids), 'dissolved polygons')
+
+    geometries = {}
+    if len(segment_ids) > 0:
+        rows = _query_dissolved_nested(conn, segment_ids, part_ids, nested, _nesting_levels(nested),
+            basin_id, reg_id, simplify_tolerance, coordinate_precision)
+        decoded = geometry_decoding.wkb_to_geojson([row[1] for row in rows],
+            geometry_simplification.decimal_digits(coordinate_precision))
+        geometries = {int(row[0]): geometry for row, geometry in zip(rows, decoded)}
+
+    features = {}
+    for subc_id, item in nested.items():
+        features[subc_id] = {
+            "type": "Feature",
+            "geometry": geometries.get(subc_id),
+            "properties": {
+                "subc_id": subc_id,
+                "basin_id": basin_id,
+                "reg_id": reg_id,
+                "num_upstream_ids": item["num_upstream_ids"]
+            }
+        }
+    return features
+
+
+def _nesting_levels(nested):
+    # Level of each upstream catchment: 0 if none is nested in it, otherwise
+    # one more than the highest level nested in it. (Without recursion, as
+    # points along one river may be nested very deeply.)
+    levels = {}
+    for subc_id in nested.keys():
+        todo = [subc_id]
+        while todo:
+            current = todo[-1]
+            if current in levels:
+                todo.pop()
+                continue
+            included = nested[current]["includes_upstream_of"]
+            missing = [included_id for included_id in included if included_id not in levels]
+            if len(missing) > 0:
+                todo.extend(missing)
+                continue
+            levels[current] = 1 + max((levels[included_id] for included_id in included), default=-1)
+            todo.pop()
+    return levels
+
+
+def _query_dissolved_nested(conn, segment_ids, part_ids, nested, levels,
+        basin_id, reg_id, simplify_tolerance, coordinate_precision):
+
+    # One CTE per level: Level 0 are the parts themselves, every other level
+    # unions the own parts of its sites with the finished polygons of the
+    # sites nested in them (from the levels below, each computed once).
+    params = [segment_ids, part_ids]
+    ctes = ['''parts AS (
+        SELECT segments.part_id, ST_MemUnion(sub_catchments.geom) AS geom
+        FROM sub_catchments
+        JOIN unnest(%s::bigint[], %s::bigint[]) AS segments(subc_id, part_id)
+            ON sub_catchments.subc_id = segments.subc_id
+        WHERE sub_catchments.reg_id = {reg_id}
+            AND sub_catchments.basin_id = {basin_id}
+        GROUP BY segments.part_id
+    )'''.format(reg_id=int(reg_id), basin_id=int(basin_id))]
+    num_levels = max(levels.values()) + 1
+    for level in range(num_levels):
+        site_ids = [subc_id for subc_id, site_level in levels.items() if site_level == level]
+        params.append(site_ids)
+        if level == 0:
+            ctes.append('''level_0 AS (
+        SELECT part_id AS site_id, geom
+        FROM parts
+        WHERE part_id = ANY(%s::bigint[])
+    )''')
+            continue
+
+        including_ids, included_ids = [], []
+        for subc_id in site_ids:
+            for included_id in nested[subc_id]["includes_upstream_of"]:
+                including_ids.append(subc_id)
+                included_ids.append(included_id)
+        params.extend([including_ids, included_ids])
+        included_levels = sorted(set(levels[included_id] for included_id in included_ids))
+        finished = ' UNION ALL '.join(f'SELECT site_id, geom FROM level_{included_level}'
+            for included_level in included_levels)
+        ctes.append(f'''level_{level} AS (
+        SELECT members.site_id, ST_Union(members.geom) AS geom
+        FROM (
+            SELECT part_id AS site_id, geom
+            FROM parts
+            WHERE part_id = ANY(%s::bigint[])
+            UNION ALL
+            SELECT nesting.site_id, finished.geom
+            FROM unnest(%s::bigint[], %s::bigint[]) AS nesting(site_id, included_id)
+            JOIN ({finished}) AS finished ON finished.site_id = nesting.included_id
+        ) AS members
+        GROUP BY members.site_id
+    )''')
+
+    # (If requested, the dissolved polygons are simplified, not their parts.)
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
+    all_levels = ' UNION ALL '.join(f'SELECT site_id, geom FROM level_{level}' for level in range(num_levels))
+    query = f'''
+    WITH {', '.join(ctes)}
+    SELECT site_id, ST_AsBinary({sql['geom']}){sql['counts']}
+    FROM ({all_levels}) AS dissolved{sql['lateral']}
+    '''
+
+    ### Query database:
+    LOGGER.log(logging.TRACE, 'Querying database...')
+    cursor = query_capture.execute(conn.cursor(), query, params,
+        stage='dissolving upstream catchments (nested)')
+    LOGGER.log(logging.TRACE, 'Querying database... DONE.')
+    rows = cursor.fetchall()
+
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        LOGGER.debug(f'Dissolved {len(rows)} upstream catchments, simplified: {report}')
+    return rows
+
 
 
 
@@ -168,6 +337,11 @@ if __name__ == "__main__":
     res = get_dissolved_feature(conn, subc_ids, basin_id, reg_id, add_subc_ids = True)
     print('RESULT:\n%s' % res)
 
+    print('\nSTART RUNNING FUNCTION: get_dissolved_features_nested')
+    nested = upstream_subcids.get_upstream_catchment_ids_nested(conn, [506251126, 506250459], basin_id, reg_id)
+    res = get_dissolved_features_nested(conn, nested, basin_id, reg_id)
+    print('RESULT:\n%s' % res)
+
     #print('\nTEST CUSTOM EXCEPTION: get_dissolved_simplegeom...')
     #try:
         # Difficult to fake anything that causes the exception!
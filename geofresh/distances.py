@@ -4,7 +4,25 @@ logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
 LOGGER = logging.getLogger(__name__)
 
-import pandas as pd
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+    import aqua90m.geofresh.contracted_graph as contracted_graph
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+        import pygeoapi.process.aqua90m.geofresh.contracted_graph as contracted_graph
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
 '''
@@ -15,6 +33,11 @@ resulting into one path, or many point to many points resulting
 in a matrix of paths), or are interested in different outcomes
 (e.g. the length of the segments, or the segment ids).
 
+Exception: The one-to-one distance is not computed by pgr_dijkstra, but
+from the cached, chain-contracted stream network of the basin (see
+contracted_graph), which gives the same distance. The pgr_dijkstra version
+is still there (get_dijkstra_distance_one_to_one_pgrouting).
+
 Many of these could be run with the same query on the database,
 but to optimize for efficiency, each time, we will only request
 those fields that we actually need.
@@ -34,7 +57,19 @@ def get_dijkstra_distance_one_to_one(conn, start_subc_id, end_subc_id, reg_id, b
     # This simply returns one number!
     # INPUT:  Start and end (subc_id)
     # OUTPUT: The distance (one number), which is the accumulated "length" attribute.
+    #         None if there is no path, 0 if start and end are the same.
+    # Same distance as pgr_dijkstra, but from the cached contracted graph,
+    # see contracted_graph.
     LOGGER.debug(f'Compute distance between subc_id {start_subc_id} and {end_subc_id} (in basin {basin_id}, region {reg_id})')
+    contracted = contracted_graph.get_contracted_graph(conn, basin_id, reg_id)
+    return contracted.distance(start_subc_id, end_subc_id)
+
+
+def get_dijkstra_distance_one_to_one_pgrouting(conn, start_subc_id, end_subc_id, reg_id, basin_id):
+    # This simply returns one number!
+    # INPUT:  Start and end (subc_id)
+    # OUTPUT: The distance (one number), which is the accumulated "length" attribute.
+    LOGGER.debug(f'Compute distance between subc_id {start_subc_id} and {end_subc_id} (in basin {basin_id}, region {reg_id}, pgr_dijkstra)')
 
     '''
     The distance between two points (507291111, 507292222) is just a number.
@@ -90,7 +125,10 @@ def get_dijkstra_distance_one_to_one(conn, start_subc_id, end_subc_id, reg_id, b
 
 def get_dijkstra_distance_many_to_many(conn, subc_ids_start, subc_ids_end, reg_id, basin_id, result_format='json'):
     # INPUT:  Sets of subc_ids
-    # OUTPUT: Distance matrix (as JSON)
+    # OUTPUT: Distance matrix (as JSON), or as dataframe, or as 'arrays':
+    #         start_ids, end_ids and the distances as float32 array (NaN where
+    #         there is no path), for writing binary files, see to_npz() and
+    #         to_parquet_dataframe().
 
     LOGGER.debug(f'Compute distance matrix between {len(subc_ids_start | subc_ids_end)} subc_ids (in basin {basin_id}, region {reg_id})')
     # TODO What if not in one basin?
@@ -118,6 +156,8 @@ def get_dijkstra_distance_many_to_many(conn, subc_ids_start, subc_ids_end, reg_i
     ## Construct SQL query:
     nodes_start = ','.join(map(str, subc_ids_start))
     nodes_end   = ','.join(map(str, subc_ids_end))
+    ## Only the last row of each path (edge -1) has the distance (agg_cost), so
+    ## the database only has to send those rows, not every edge of every path.
     query = f'''
     SELECT 
         edge,
@@ -136,7 +176,8 @@ def get_dijkstra_distance_many_to_many(conn, subc_ids_start, subc_ids_end, reg_i
         ARRAY[{nodes_start}],
         ARRAY[{nodes_end}],
         directed := false
-    );
+    )
+    WHERE edge = -1;
     '''
     LOGGER.log(logging.TRACE, f"SQL query: {query}")
     
@@ -144,54 +185,127 @@ def get_dijkstra_distance_many_to_many(conn, subc_ids_start, subc_ids_end, reg_i
     cursor = conn.cursor()
     cursor.execute(query)
 
-    ## Extract results, first as a matrix (nested dict):
-    json_matrix = _result_to_matrix(cursor, subc_ids_start, subc_ids_end)
+    ## Extract results, as a 2D array (one row per start id):
+    if result_format == 'arrays':
+        return _result_to_array(cursor, subc_ids_start, subc_ids_end, dtype='float32', fill_value=float('nan'))
+    start_ids, end_ids, distance_array = _result_to_array(cursor, subc_ids_start, subc_ids_end)
 
-    ## Make a dataframe from this, if requested:
+    ## Make a matrix (nested dict) or a dataframe from this:
     if result_format == 'json':
-        return json_matrix
+        return _array_to_matrix(start_ids, end_ids, distance_array)
     elif result_format == 'dataframe':
-        output_df = _matrix_to_dataframe(json_matrix, subc_ids_start, subc_ids_end)
-        return output_df
+        return _array_to_dataframe(start_ids, end_ids, distance_array)
     else:
         raise ValueError(f'Unknown result format: {result_format}. Expected json or dataframe.')
 
 
-def _result_to_matrix(cursor, subc_ids_start, subc_ids_end):
-
-    ## Construct result matrix:
-    # TODO: JSON may not be the ideal type for returning a matrix!
-    # Note: Keys have to strings, otherwise pygeoapi will cause an
-    # error later on when serializing the results:
-    # "numpy.core._exceptions._UFuncNoLoopError: ufunc 'greater' did not contain a loop with signature matching types"
-    # Note: Values have to be native python numbers, not numpy numbers, otherwise
-    # pygeoapi will cause an error later on when serializing the results:
-    # "Object of type int64 is not JSON serializable"
-    # For some reason, this does not seem to be a problem here, so we don't
-    # have to cast, as we do in routing.py
-    result_matrix = {}
-    for start_id in subc_ids_start:
-        result_matrix[str(start_id)] = {}
-        for end_id in subc_ids_end:
-            result_matrix[str(start_id)][str(end_id)] = 0
-
-    ## Iterate over the result rows:
+def _result_to_array(cursor, subc_ids_start, subc_ids_end, dtype='float64', fill_value=0.0, chunk_rows=100000):
+    # Returns the (unique) start and end ids, in input order, as Python
+    # integers, and the distances as 2D array (one row per start id).
+    # Start-end-combinations without a path keep the fill_value.
+    start_ids = list(dict.fromkeys(int(start_id) for start_id in subc_ids_start))
+    end_ids   = list(dict.fromkeys(int(end_id) for end_id in subc_ids_end))
+    start_lookup = _IdLookup(start_ids)
+    end_lookup   = _IdLookup(end_ids)
+    distance_array = np.full((len(start_ids), len(end_ids)), fill_value, dtype=dtype)
+
+    ## Iterate over the result rows, a chunk at a time, straight into the array:
+    # We only look at the last edge of a path (edge is -1), as PostGIS returns
+    # agg_cost (the accumulated cost/length) for us!
+    num_filled = 0
     while True:
-        row = cursor.fetchone()
-        if row is None: break
-        
-        # We only look at the last edge of a path, as PostGIS returns agg_cost for us!
-        if row[0] == -1: # if edge is -1...
-            # Retrieve both nodes of the edge, and the accumulated cost/length:
-            start_id  = str(row[1])
-            end_id    = str(row[2])
-            agg_cost  = row[3]
-            # Add this subc_id (integer) to the result matrix
-            # (store the distance for this start-end-combination).
-            result_matrix[start_id][end_id] = agg_cost
-            LOGGER.log(logging.TRACE, f'Start {start_id} to end {end_id}, accumulated length {agg_cost}')
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        chunk = np.array(rows, dtype=np.float64).reshape(-1, 4)
+        chunk = chunk[chunk[:, 0] == -1]
+        rows_i = start_lookup.index(chunk[:, 1].astype(np.int64))
+        rows_j = end_lookup.index(chunk[:, 2].astype(np.int64))
+        distance_array[rows_i, rows_j] = chunk[:, 3]
+        num_filled += chunk.shape[0]
+    LOGGER.log(logging.TRACE, f'Filled {num_filled} of {distance_array.size} start-end-combinations.')
+
+    # pgr_dijkstra returns no path from a point to itself, its distance is 0:
+    same = np.isin(np.asarray(start_ids, dtype=np.int64), np.asarray(end_ids, dtype=np.int64))
+    rows_i = np.flatnonzero(same)
+    distance_array[rows_i, end_lookup.index(np.asarray(start_ids, dtype=np.int64)[rows_i])] = 0
+
+    return start_ids, end_ids, distance_array
+
+
+class _IdLookup:
+    # Index of subc_ids in a list of unique ids, for many ids at a time
+    # (binary search on the sorted ids, instead of a dict lookup per row).
+
+    def __init__(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        self.order = np.argsort(ids, kind='stable')
+        self.sorted_ids = ids[self.order]
+
+    def index(self, ids):
+        return self.order[np.searchsorted(self.sorted_ids, ids)]
+
+
+def to_npz(file_or_path, start_ids, end_ids, distance_array, sparse=False, max_distance=None):
+    # Writes the matrix as compressed NumPy file (.npz), with the arrays
+    # start_ids, end_ids (int64) and, if dense, distances (float32, one row
+    # per start id, NaN where there is no path). If sparse, only the pairs
+    # with a path (and at most max_distance): row, col (indices into
+    # start_ids and end_ids) and distance.
+    # Reading: data = numpy.load(path); data['distances'], data['start_ids'], ...
+    start_ids = np.asarray(start_ids, dtype=np.int64)
+    end_ids = np.asarray(end_ids, dtype=np.int64)
+    if sparse:
+        rows, cols, values = _to_sparse(distance_array, max_distance)
+        np.savez_compressed(file_or_path, start_ids=start_ids, end_ids=end_ids,
+            shape=np.array(distance_array.shape, dtype=np.int64), row=rows, col=cols, distance=values)
+    else:
+        np.savez_compressed(file_or_path, start_ids=start_ids, end_ids=end_ids, distances=distance_array)
+
+
+def to_parquet_dataframe(start_ids, end_ids, distance_array, sparse=False, max_distance=None):
+    # Dataframe to be written as Parquet: If dense, like the CSV matrix (first
+    # column "subc_ids" with the start ids, one float32 column per end id).
+    # If sparse, one row per pair with a path (start_id, end_id, distance).
+    if sparse:
+        rows, cols, values = _to_sparse(distance_array, max_distance)
+        return pd.DataFrame({
+            'start_id': np.asarray(start_ids, dtype=np.int64)[rows],
+            'end_id': np.asarray(end_ids, dtype=np.int64)[cols],
+            'distance': values
+        })
+    output_df = pd.DataFrame(distance_array, columns=[str(end_id) for end_id in end_ids], copy=False)
+    output_df.insert(0, 'subc_ids', np.asarray(start_ids, dtype=np.int64))
+    return output_df
+
 
-    return result_matrix
+def _to_sparse(distance_array, max_distance):
+    # Pairs with a path (and at most max_distance), as coordinates (row, col)
+    # and values:
+    keep = ~np.isnan(distance_array)
+    if max_distance is not None:
+        keep &= distance_array <= max_distance
+    rows, cols = np.nonzero(keep)
+    LOGGER.debug(f'Sparse distance matrix: Keeping {rows.shape[0]} of {distance_array.size} pairs.')
+    return rows.astype(np.int32), cols.astype(np.int32), distance_array[rows, cols]
+
+
+def _array_to_matrix(start_ids, end_ids, distance_array):
+    # TODO: JSON may not be the ideal type for returning a matrix!
+    # Note: Keys are strings, as pygeoapi sorts the keys when serializing
+    # the results, and we may add a (string) "comment" key at the top level.
+    # The rows stay NumPy arrays, they are serialized by utils/fast_json.py,
+    # so we don't have to convert every distance.
+    end_keys = [str(end_id) for end_id in end_ids]
+    return {str(start_id): dict(zip(end_keys, distance_row))
+        for start_id, distance_row in zip(start_ids, distance_array)}
+
+
+def _array_to_dataframe(start_ids, end_ids, distance_array):
+    # Column names are the end subc_ids, the first column contains the start subc_ids:
+    output_df = pd.DataFrame(distance_array, columns=[str(end_id) for end_id in end_ids])
+    output_df.insert(0, 'subc_ids', [str(start_id) for start_id in start_ids])
+    return output_df
 
 
 def _matrix_to_dataframe(result_matrix, subc_ids_start, subc_ids_end):
@@ -200,40 +314,12 @@ def _matrix_to_dataframe(result_matrix, subc_ids_start, subc_ids_end):
     #   Basically a matrix, as dataframe/table/csv:
     #   Column names will be the end subc_ids (first column contains the end subc_ids)
     #   Row names will be the start subc_ids (first row contains the start subc_ids)
-    all_rows = []
-
-    # Define column names for dataframe: end ids
-    # First column contains the subcids
-    colnames = ["subc_ids"]
-    for end_id in subc_ids_end:
-        colnames.append(str(end_id))
-
-    # Fill all dataframe rows with distances
-    for start_id in subc_ids_start:
-
-        # Get the row of the matrix with the distances from start id to all end ids:
-        start_id = str(start_id)
-        matrix_row = result_matrix[start_id]
-        #LOGGER.debug(f'Matrix row for {start_id}: {matrix_row}')
-
-        # First item in the dataframe row is the start id:
-        row_dataframe = [start_id]
-
-        # Now fill with the distances:
-        for end_id in colnames:
-
-            # First colname is not an end id, but the title for the first column...
-            if end_id == 'subc_ids':
-                continue
-
-            # Retrieve the distance and add to row:
-            distance = matrix_row[str(end_id)]
-            row_dataframe.append(distance)
-
-        all_rows.append(row_dataframe)
-
-    output_df = pd.DataFrame(all_rows, columns=colnames)
-    return output_df
+    start_keys = [str(start_id) for start_id in dict.fromkeys(subc_ids_start)]
+    end_keys   = [str(end_id) for end_id in dict.fromkeys(subc_ids_end)]
+    output_df = pd.DataFrame.from_dict(result_matrix, orient='index', columns=end_keys)
+    output_df = output_df.loc[start_keys]
+    output_df.insert(0, 'subc_ids', start_keys)
+    return output_df.reset_index(drop=True)
 
 
 
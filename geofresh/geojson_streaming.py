@@ -0,0 +1,202 @@
+import json
+import uuid
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.fast_json as fast_json
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.fast_json as fast_json
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+'''
+Server-side GeoJSON assembly ("pass-through mode").
+
+Instead of fetching the geometries, decoding them and building the GeoJSON
+in Python (one dict per feature), PostGIS builds each Feature (or Geometry)
+as JSON text (ST_AsGeoJSON, json_build_object), and we only stitch these
+texts together into a FeatureCollection (or GeometryCollection), without
+ever parsing them.
+
+The rows are read through a server-side (named) cursor, a few hundred at a
+time. The result is a generator of text chunks. Only when these are written
+straight to the download file (see pygeoapi_processes.utils.
+store_chunks_to_file()) does neither the database client nor Python hold
+the whole result. Results returned inline are joined into one text first
+(pygeoapi needs the whole response), which saves the parsing and decoding,
+but not the memory.
+
+The features are ordered by subc_id (the Python-built collections may be
+in a different order), otherwise the result is the same.
+
+Properties that do not come from the database (e.g. a site_id or a comment
+that should be added to every feature) are passed into the query as
+parameters (constant_properties), so they end up in the JSON text, too.
+Members of the collection itself (basin_id, comment, ...) are small, they
+are serialised in Python and appended after the features. A member that
+sums up the rows (e.g. the number of coordinates before and after
+simplification, see geometry_simplification.streaming_parts()) is computed
+from extra columns of the same rows while streaming, and appended last.
+
+Alternatively, the rows can be streamed as NDJSON (newline-delimited JSON,
+one Feature per line, see stream_ndjson()), which clients can process line
+by line, without parsing one huge document.
+
+Usage:
+
+    query, params = feature_query(
+        'hydro.stream_segments',
+        'basin_id = %s AND reg_id = %s',
+        [basin_id, reg_id],
+        properties={'subc_id': 'subc_id', 'strahler': 'strahler'})
+    chunks = stream_collection(conn, query, params, members={'basin_id': basin_id})
+'''
+
+# Same number of decimal digits as we get from ST_AsText / WKB decoding
+# (ST_AsGeoJSON's default would be 9):
+GEOJSON_MAX_DECIMAL_DIGITS = 15
+
+# Rows fetched from the server-side cursor at a time:
+DEFAULT_CHUNK_ROWS = 500
+
+
+def _geometry_sql(geom_column, max_decimal_digits):
+    return f'ST_AsGeoJSON({geom_column}, {int(max_decimal_digits)})'
+
+
+def _limit_sql(limit):
+    return '' if limit is None else f'\n    LIMIT {int(limit)}'
+
+
+def feature_query(table, where, where_params, properties, constant_properties=None,
+                  geom_column='geom', order_by='subc_id', max_decimal_digits=GEOJSON_MAX_DECIMAL_DIGITS,
+                  limit=None, counts='', lateral=''):
+    # Returns a query (and its parameters) that selects one row per feature,
+    # each containing the complete GeoJSON Feature as text.
+    # properties: Property name -> SQL expression (usually a column name).
+    # constant_properties: Property name -> value, added to every feature.
+    # limit: Only the first rows (for paging, see pagination).
+    # counts, lateral: More columns after the text, and a lateral subquery
+    # after the table (see geometry_simplification.sql_parts()).
+    pairs = []
+    params = []
+    for name, expression in properties.items():
+        pairs.append(f"'{name}', {expression}")
+    for name, value in (constant_properties or {}).items():
+        pairs.append(f"'{name}', %s::json")
+        params.append(json.dumps(value))
+
+    query = f'''
+    SELECT
+        json_build_object(
+            'type', 'Feature',
+            'geometry', {_geometry_sql(geom_column, max_decimal_digits)}::json,
+            'properties', json_build_object({", ".join(pairs)})
+        )::text{counts}
+    FROM {table}{lateral}
+    WHERE {where}
+    ORDER BY {order_by}{_limit_sql(limit)}
+    '''
+    return query, params + list(where_params)
+
+
+def geometry_query(table, where, where_params, geom_column='geom',
+                   order_by='subc_id', max_decimal_digits=GEOJSON_MAX_DECIMAL_DIGITS, limit=None,
+                   counts='', lateral=''):
+    # Returns a query (and its parameters) that selects one row per geometry,
+    # as GeoJSON text (or null, which is allowed in a GeometryCollection).
+    query = f'''
+    SELECT
+        COALESCE({_geometry_sql(geom_column, max_decimal_digits)}, 'null'){counts}
+    FROM {table}{lateral}
+    WHERE {where}
+    ORDER BY {order_by}{_limit_sql(limit)}
+    '''
+    return query, list(where_params)
+
+
+def stream_collection(conn, query, params, members=None, make_features=True, chunk_rows=DEFAULT_CHUNK_ROWS,
+                      count_member=None):
+    # Generator of text chunks, which together are a FeatureCollection (or
+    # GeometryCollection, if make_features is False). Each row of the query
+    # must be one Feature (or Geometry) as JSON text, see feature_query().
+    # count_member: (name, function): The rows have two more columns (counts),
+    # which are summed up, and function(sum_1, sum_2) is added as member.
+    # The chunks have to be consumed before the connection is closed.
+    if make_features:
+        yield '{"type": "FeatureCollection", "features": ['
+    else:
+        yield '{"type": "GeometryCollection", "geometries": ['
+
+    num_rows = 0
+    sums = [0, 0]
+    for rows in _fetch_chunks(conn, query, params, chunk_rows):
+        separator = ',' if num_rows > 0 else ''
+        num_rows += len(rows)
+        if count_member is not None:
+            sums[0] += sum(row[-2] or 0 for row in rows)
+            sums[1] += sum(row[-1] or 0 for row in rows)
+        yield separator + ','.join(row[0] for row in rows)
+    LOGGER.debug(f'Streamed {num_rows} GeoJSON items from the database.')
+
+    # Members of the collection (small, serialised here):
+    members = dict(members or {})
+    if count_member is not None:
+        name, make_member = count_member
+        members[name] = make_member(*sums)
+    tail = ']'
+    for key, value in members.items():
+        tail += f', {json.dumps(key)}: {fast_json.dumps(value).decode("utf-8")}'
+    yield tail + '}'
+
+
+def stream_ndjson(conn, query, params, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # Generator of text chunks, which together are NDJSON: One Feature (or
+    # whatever JSON text the query returns per row) per line.
+    # The chunks have to be consumed before the connection is closed.
+    num_rows = 0
+    for rows in _fetch_chunks(conn, query, params, chunk_rows):
+        num_rows += len(rows)
+        yield ''.join(row[0] + '\n' for row in rows)
+    LOGGER.debug(f'Streamed {num_rows} NDJSON lines from the database.')
+
+
+def _fetch_chunks(conn, query, params, chunk_rows):
+    # Named cursor: The rows stay on the server until we fetch them:
+    cursor = conn.cursor(name=f'geojson_{uuid.uuid4().hex}')
+    cursor.itersize = chunk_rows
+    try:
+        LOGGER.log(logging.TRACE, 'Querying database (server-side cursor)...')
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    query, params = feature_query(
+        'hydro.stream_segments',
+        'basin_id = %s AND reg_id = %s AND strahler >= %s',
+        [1292547, 58, 0],
+        properties={'subc_id': 'subc_id', 'length': 'length', 'strahler': 'strahler'},
+        constant_properties={'comment': 'schlei'})
+    print(query)
+    print(params)
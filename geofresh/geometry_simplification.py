@@ -0,0 +1,272 @@
+import os
+import json
+import hashlib
+import threading
+import collections
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+    import aqua90m.utils.fast_json as fast_json
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.utils.fast_json as fast_json
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+'''
+Simplified geometries and reduced coordinate precision for the GeoJSON
+outputs (subcatchments, stream segments, dissolved upstream catchments).
+
+The geometries in the database are 90 m stair-step polygons (and lines)
+with 15 decimal digits, e.g. 9.916666666666668, which is far more than a
+map needs. If the user passes "simplify_tolerance" (in degrees) and/or
+"coordinate_precision" (number of decimal digits), the geometries are
+simplified in the database, before they are sent to us:
+
+* ST_SimplifyPreserveTopology(geom, simplify_tolerance)
+* ST_ReducePrecision(geom, 10^-coordinate_precision), which snaps the
+  coordinates to a grid (and removes the duplicates that this creates)
+* and when decoding (or in ST_AsGeoJSON), the coordinates are written
+  with only coordinate_precision decimal digits.
+
+The number of coordinates before and after is counted in the same query
+that returns the geometries (also for server-side GeoJSON, see
+streaming_parts()) and reported in the result ("geometry_simplification"),
+see size_report().
+
+A coordinate_precision of 0 is not accepted: It would snap the coordinates
+to a grid of 1 degree (about 100 km), which collapses most geometries.
+
+Simplified results for tolerances on a fixed ladder ("simplify_tolerance_
+ladder" in config) are cached per worker (the mapclient always asks for
+the same few tolerances), as serialised JSON, up to "simplify_cache_mb"
+(config), see cached().
+
+Usage:
+
+    sql = sql_parts(simplify_tolerance, coordinate_precision)
+    query = f"SELECT ST_AsBinary({sql['geom']}), subc_id{sql['counts']}
+              FROM hydro.sub_catchments{sql['lateral']} WHERE ..."
+    rows = cursor.fetchall()
+    report = size_report(rows, simplify_tolerance, coordinate_precision)
+'''
+
+# Defaults, can be overridden in config:
+# Tolerances (in degrees, 90 m are about 0.00083 degrees) that are cached:
+DEFAULT_TOLERANCE_LADDER = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01]
+DEFAULT_CACHE_MB = 128
+MIN_COORDINATE_PRECISION = 1
+MAX_COORDINATE_PRECISION = 15
+
+# global variables:
+_CACHE = collections.OrderedDict()
+_CACHE_BYTES = 0
+_LOCK = threading.Lock()
+_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+_SETTINGS = None
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Geometry simplification not configured (config file not found), using defaults.")
+        return {}
+
+
+def _get_settings():
+    global _SETTINGS
+    if _SETTINGS is None:
+        config = _read_config()
+        _SETTINGS = {
+            'ladder': [float(tol) for tol in config.get('simplify_tolerance_ladder', DEFAULT_TOLERANCE_LADDER)],
+            'cache_bytes': int(config.get('simplify_cache_mb', DEFAULT_CACHE_MB))*1024*1024
+        }
+    return _SETTINGS
+
+
+def check_options(simplify_tolerance, coordinate_precision):
+    # Validates the user inputs. Returns them as float and int (or None).
+    if simplify_tolerance is not None:
+        try:
+            simplify_tolerance = float(simplify_tolerance)
+        except (ValueError, TypeError) as e:
+            err_msg = f"simplify_tolerance must be a number (in degrees), not '{simplify_tolerance}'."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        if simplify_tolerance < 0:
+            err_msg = f"simplify_tolerance must not be negative ({simplify_tolerance})."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        if simplify_tolerance == 0:
+            simplify_tolerance = None
+
+    if coordinate_precision is not None:
+        if isinstance(coordinate_precision, bool) or not str(coordinate_precision).isdigit():
+            err_msg = f"coordinate_precision must be a number of decimal digits ({MIN_COORDINATE_PRECISION} to {MAX_COORDINATE_PRECISION}), not '{coordinate_precision}'."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        if int(coordinate_precision) < MIN_COORDINATE_PRECISION:
+            err_msg = f"coordinate_precision must be at least {MIN_COORDINATE_PRECISION} (0 decimal digits would snap the coordinates to a 1 degree grid)."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        coordinate_precision = min(int(coordinate_precision), MAX_COORDINATE_PRECISION)
+
+    return simplify_tolerance, coordinate_precision
+
+
+def is_active(simplify_tolerance, coordinate_precision):
+    return simplify_tolerance is not None or coordinate_precision is not None
+
+
+def geometry_sql(geom_column, simplify_tolerance, coordinate_precision):
+    # SQL expression for the simplified geometry:
+    expression = geom_column
+    if simplify_tolerance is not None:
+        expression = f'ST_SimplifyPreserveTopology({expression}, {float(simplify_tolerance)!r})'
+    if coordinate_precision is not None:
+        expression = f'ST_ReducePrecision({expression}, {10.0**-int(coordinate_precision)!r})'
+    return expression
+
+
+def sql_parts(simplify_tolerance, coordinate_precision, geom_column='geom'):
+    # Snippets to insert into a query: 'geom' (the geometry to select), 'counts'
+    # (the number of coordinates before and after, as two more columns at the
+    # end of the row) and 'lateral' (after the table name). The simplified
+    # geometry is computed once per row, in the lateral subquery.
+    # Without simplification, the query stays as it is.
+    if not is_active(simplify_tolerance, coordinate_precision):
+        return {'geom': geom_column, 'counts': '', 'lateral': ''}
+    expression = geometry_sql(geom_column, simplify_tolerance, coordinate_precision)
+    return {
+        'geom': 'simplified.geom_out',
+        'counts': f', ST_NPoints({geom_column}), ST_NPoints(simplified.geom_out)',
+        'lateral': f' CROSS JOIN LATERAL (SELECT {expression} AS geom_out) AS simplified'
+    }
+
+
+def decimal_digits(coordinate_precision):
+    # Decimal digits to use when decoding the WKB (see geometry_decoding):
+    if coordinate_precision is None:
+        return MAX_COORDINATE_PRECISION
+    return coordinate_precision
+
+
+def size_report(rows, simplify_tolerance, coordinate_precision):
+    # Sums up the counts of coordinates (the last two columns of each row,
+    # see sql_parts()). Returns None if nothing was simplified.
+    if not is_active(simplify_tolerance, coordinate_precision):
+        return None
+    num_before = sum(row[-2] or 0 for row in rows)
+    num_after = sum(row[-1] or 0 for row in rows)
+    return make_report(num_before, num_after, simplify_tolerance, coordinate_precision)
+
+
+def make_report(num_before, num_after, simplify_tolerance, coordinate_precision):
+    num_before = int(num_before or 0)
+    num_after = int(num_after or 0)
+    reduction = 0.0 if num_before == 0 else round(100.0*(num_before-num_after)/num_before, 1)
+    report = {
+        "simplify_tolerance": simplify_tolerance,
+        "coordinate_precision": coordinate_precision,
+        "num_coordinates_original": num_before,
+        "num_coordinates": num_after,
+        "reduction_percent": reduction
+    }
+    LOGGER.debug(f'Simplified geometries: {num_before} -> {num_after} coordinates (-{reduction}%)')
+    return report
+
+
+def streaming_parts(simplify_tolerance, coordinate_precision, geom_column='geom'):
+    # For server-side GeoJSON (see geojson_streaming): The snippets of
+    # sql_parts(), the decimal digits for ST_AsGeoJSON, and 'count_member',
+    # which makes the size report from the summed up counts of the streamed
+    # rows (None if nothing is simplified). So the coordinates are counted
+    # while streaming, without a second query that simplifies again.
+    parts = sql_parts(simplify_tolerance, coordinate_precision, geom_column)
+    parts['digits'] = decimal_digits(coordinate_precision)
+    parts['count_member'] = None
+    if is_active(simplify_tolerance, coordinate_precision):
+        parts['count_member'] = ('geometry_simplification', lambda num_before, num_after:
+            make_report(num_before, num_after, simplify_tolerance, coordinate_precision))
+    return parts
+
+
+def ids_key(subc_ids):
+    # Short key for a (possibly long) list of ids, independent of the order:
+    joined = ','.join(str(subc_id) for subc_id in sorted(int(subc_id) for subc_id in subc_ids))
+    return hashlib.sha1(joined.encode('ascii')).hexdigest()
+
+
+def is_on_ladder(simplify_tolerance):
+    if simplify_tolerance is None:
+        return False
+    return any(abs(simplify_tolerance - tol) < 1e-12 for tol in _get_settings()['ladder'])
+
+
+def cached(name, key, simplify_tolerance, coordinate_precision, compute):
+    # Returns compute() (a JSON result), from the cache if the tolerance is on
+    # the ladder. The cached results are stored serialised, so the callers
+    # can modify what they get (e.g. add a comment).
+    if not is_on_ladder(simplify_tolerance):
+        return compute()
+
+    global _CACHE_BYTES
+    cache_key = (name, key, float(simplify_tolerance), coordinate_precision)
+    with _LOCK:
+        data = _CACHE.get(cache_key)
+        if data is not None:
+            _CACHE.move_to_end(cache_key)
+            _STATS['hits'] += 1
+    if data is not None:
+        LOGGER.debug(f'Simplified geometries: Cache hit for {name} {key}.')
+        return json.loads(data)
+
+    result = compute()
+    data = fast_json.dumps(result)
+    max_bytes = _get_settings()['cache_bytes']
+    with _LOCK:
+        _STATS['misses'] += 1
+        if len(data) <= max_bytes and not cache_key in _CACHE:
+            _CACHE[cache_key] = data
+            _CACHE_BYTES += len(data)
+            while _CACHE_BYTES > max_bytes:
+                _, evicted = _CACHE.popitem(last=False)
+                _CACHE_BYTES -= len(evicted)
+                _STATS['evictions'] += 1
+    return result
+
+
+def log_cache_stats(suffix = ''):
+    with _LOCK:
+        LOGGER.info(f'Simplified geometry cache{suffix}: {len(_CACHE)} results, {_CACHE_BYTES} bytes, '
+                    f'{_STATS["hits"]} hits, {_STATS["misses"]} misses, {_STATS["evictions"]} evictions.')
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    print(check_options("0.001", 5))
+    print(streaming_parts(0.001, 5))
+    print(sql_parts(0.001, 5))
+    rows = [(b'', 506250459, 120, 14), (b'', 506251015, 80, 9)]
+    print(size_report(rows, 0.001, 5))
+    print(cached('test', ids_key([2, 1]), 0.001, 5, lambda: {"type": "Point", "coordinates": [9.93156, 54.69507]}))
+    print(cached('test', ids_key([1, 2]), 0.001, 5, lambda: None))
+    log_cache_stats()
@@ -1,5 +1,4 @@
 import json
-import geomet.wkt
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -11,10 +10,22 @@ try:
     # For some reason, this fixed it, when this module was called from routing,
     # so it was not __main__, and this aqua90m was not added to local python PATH...
     import upstream_subcids as upstream_subcids
+    import aqua90m.utils.geometry_decoding as geometry_decoding
+    import aqua90m.geofresh.geojson_streaming as geojson_streaming
+    import aqua90m.geofresh.geometry_simplification as geometry_simplification
+    import aqua90m.geofresh.query_capture as query_capture
+    import aqua90m.geofresh.pagination as pagination
+    import aqua90m.geofresh.basin_graph as basin_graph
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+        import pygeoapi.process.aqua90m.utils.geometry_decoding as geometry_decoding
+        import pygeoapi.process.aqua90m.geofresh.geojson_streaming as geojson_streaming
+        import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
+        import pygeoapi.process.aqua90m.geofresh.query_capture as query_capture
+        import pygeoapi.process.aqua90m.geofresh.pagination as pagination
+        import pygeoapi.process.aqua90m.geofresh.basin_graph as basin_graph
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -24,7 +35,8 @@ except ModuleNotFoundError as e1:
         LOGGER.debug(msg)
 
 
-def get_streamsegment_linestrings_geometry_coll(conn, subc_ids, basin_id, reg_id):
+def get_streamsegment_linestrings_geometry_coll(conn, subc_ids, basin_id, reg_id,
+        simplify_tolerance=None, coordinate_precision=None):
 
     ### Define query:
     '''
@@ -44,7 +56,7 @@ def get_streamsegment_linestrings_geometry_coll(conn, subc_ids, basin_id, reg_id
     # If no subc_ids are given, return empty GeometryCollections:
     # GeometryCollections can have empty array according to GeoJSON spec:
     # https://datatracker.ietf.org/doc/html/rfc7946#section-3.1.8
-    if len(upstream_ids) == 0:
+    if len(subc_ids) == 0:
         geometry_coll = {
             "type": "GeometryCollection",
             "geometries": []
@@ -54,37 +66,45 @@ def get_streamsegment_linestrings_geometry_coll(conn, subc_ids, basin_id, reg_id
     # Check if too many catchments?
     upstream_subcids.too_many_upstream_catchments(len(subc_ids), 'individual stream segments')
 
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('streamsegment_linestrings_geometry_coll',
+        (reg_id, basin_id, geometry_simplification.ids_key(subc_ids)),
+        simplify_tolerance, coordinate_precision,
+        lambda: _get_streamsegment_linestrings_geometry_coll(
+            conn, subc_ids, basin_id, reg_id, simplify_tolerance, coordinate_precision))
+
+
+def _get_streamsegment_linestrings_geometry_coll(conn, subc_ids, basin_id, reg_id,
+        simplify_tolerance, coordinate_precision):
+
     # Construct query:
     relevant_ids = ", ".join([str(elem) for elem in subc_ids])
     # e.g. 506250459, 506251015, 506251126, 506251712
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT 
-        ST_AsText(geom), subc_id
-    FROM hydro.stream_segments
+        ST_AsBinary({sql['geom']}), subc_id{sql['counts']}
+    FROM hydro.stream_segments{sql['lateral']}
     WHERE subc_id IN ({relevant_ids})
         AND reg_id = {reg_id}
         AND basin_id = {basin_id}
     '''
 
     ### Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = query_capture.execute(conn.cursor(), query, stage='stream segment linestrings')
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results and construct GeoJSON:
     LOGGER.log(logging.TRACE, 'Iterating over the result rows, constructing GeoJSON...')
     linestrings_geojson = []
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
-
-        # Create GeoJSON geometry from each linestring:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
+
+        # GeoJSON geometry of each linestring (decoded above, all at once):
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error(f'Subcatchment {row[1]} has no geometry!') # for example: 506469602
@@ -99,10 +119,15 @@ def get_streamsegment_linestrings_geometry_coll(conn, subc_ids, basin_id, reg_id
         "geometries": linestrings_geojson
     }
 
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        geometry_coll["geometry_simplification"] = report
+
     return geometry_coll
 
 
-def get_streamsegment_linestrings_feature_coll(conn, subc_ids, basin_id, reg_id, add_target_streams=False):
+def get_streamsegment_linestrings_feature_coll(conn, subc_ids, basin_id, reg_id, add_target_streams=False,
+        simplify_tolerance=None, coordinate_precision=None):
 
     ### Define query:
     '''
@@ -137,22 +162,33 @@ def get_streamsegment_linestrings_feature_coll(conn, subc_ids, basin_id, reg_id,
     # Check if too many catchments?
     upstream_subcids.too_many_upstream_catchments(len(subc_ids), 'individual stream segments')
 
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('streamsegment_linestrings_feature_coll',
+        (reg_id, basin_id, geometry_simplification.ids_key(subc_ids), add_target_streams),
+        simplify_tolerance, coordinate_precision,
+        lambda: _get_streamsegment_linestrings_feature_coll(
+            conn, subc_ids, basin_id, reg_id, add_target_streams, simplify_tolerance, coordinate_precision))
+
+
+def _get_streamsegment_linestrings_feature_coll(conn, subc_ids, basin_id, reg_id, add_target_streams,
+        simplify_tolerance, coordinate_precision):
+
     # Construct query:
     relevant_ids = ','.join(map(str, subc_ids))
     # e.g. 506250459, 506251015, 506251126, 506251712
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT 
-        ST_AsText(geom), subc_id, strahler, length, target
-    FROM hydro.stream_segments
+        ST_AsBinary({sql['geom']}), subc_id, strahler, length, target{sql['counts']}
+    FROM hydro.stream_segments{sql['lateral']}
     WHERE subc_id IN ({relevant_ids})
         AND reg_id = {reg_id}
         AND basin_id = {basin_id}
     '''
 
     ### Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = query_capture.execute(conn.cursor(), query, stage='stream segment features')
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ### Get results and construct GeoJSON:
@@ -160,16 +196,13 @@ def get_streamsegment_linestrings_feature_coll(conn, subc_ids, basin_id, reg_id,
     features_geojson = []
     cum_length = 0
     cum_length_by_strahler = {}
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
-
-        # Create GeoJSON feature from each linestring:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
+
+        # Create GeoJSON feature from each linestring (geometries decoded above, all at once):
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error(f'Subcatchment {row[1]} has no linestring!') # for example: 506469602
@@ -211,18 +244,36 @@ def get_streamsegment_linestrings_feature_coll(conn, subc_ids, basin_id, reg_id,
         "cumulative_length_by_strahler": cum_length_by_strahler
     }
 
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        feature_coll["geometry_simplification"] = report
+
     return feature_coll
 
 
-def get_streamsegment_linestrings_geometry_coll_by_basin(conn, basin_id, reg_id, min_strahler=0):
+def get_streamsegment_linestrings_geometry_coll_by_basin(conn, basin_id, reg_id, min_strahler=0,
+        simplify_tolerance=None, coordinate_precision=None,
+        limit=None, after_subc_id=None):
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('streamsegment_linestrings_geometry_coll_by_basin',
+        (reg_id, basin_id, min_strahler, limit, after_subc_id), simplify_tolerance, coordinate_precision,
+        lambda: _get_streamsegment_linestrings_geometry_coll_by_basin(
+            conn, basin_id, reg_id, min_strahler, simplify_tolerance, coordinate_precision,
+            limit, after_subc_id))
 
+
+def _get_streamsegment_linestrings_geometry_coll_by_basin(conn, basin_id, reg_id, min_strahler,
+        simplify_tolerance, coordinate_precision, limit, after_subc_id):
+
+    page = pagination.sql_parts(limit, after_subc_id)
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT 
-        ST_AsText(geom), subc_id
-    FROM hydro.stream_segments
+        ST_AsBinary({sql['geom']}), subc_id{sql['counts']}
+    FROM hydro.stream_segments{sql['lateral']}
     WHERE basin_id = {basin_id}
         AND reg_id = {reg_id}
-        AND strahler >= {min_strahler}
+        AND strahler >= {min_strahler}{page['where']}{page['order']}
     '''
 
     ### Query database:
@@ -234,16 +285,13 @@ def get_streamsegment_linestrings_geometry_coll_by_basin(conn, basin_id, reg_id,
     ### Get results and construct GeoJSON:
     LOGGER.log(logging.TRACE, 'Iterating over the result rows, constructing GeoJSON...')
     linestrings_geojson = []
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
-
-        # Create GeoJSON geometry from each linestring:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
+
+        # GeoJSON geometry of each linestring (decoded above, all at once):
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error(f'Subcatchment {row[1]} has no geometry!') # for example: 506469602
@@ -258,10 +306,27 @@ def get_streamsegment_linestrings_geometry_coll_by_basin(conn, basin_id, reg_id,
         "geometries": linestrings_geojson
     }
 
+    pagination.add_page_info(geometry_coll, [row[1] for row in rows], limit, after_subc_id)
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        geometry_coll["geometry_simplification"] = report
+
     return geometry_coll
 
 
-def get_streamsegment_linestrings_feature_coll_by_basin(conn, basin_id, reg_id, min_strahler=0, add_target_streams=False):
+def get_streamsegment_linestrings_feature_coll_by_basin(conn, basin_id, reg_id, min_strahler=0, add_target_streams=False,
+        simplify_tolerance=None, coordinate_precision=None,
+        limit=None, after_subc_id=None):
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('streamsegment_linestrings_feature_coll_by_basin',
+        (reg_id, basin_id, min_strahler, add_target_streams, limit, after_subc_id), simplify_tolerance, coordinate_precision,
+        lambda: _get_streamsegment_linestrings_feature_coll_by_basin(
+            conn, basin_id, reg_id, min_strahler, add_target_streams, simplify_tolerance, coordinate_precision,
+            limit, after_subc_id))
+
+
+def _get_streamsegment_linestrings_feature_coll_by_basin(conn, basin_id, reg_id, min_strahler, add_target_streams,
+        simplify_tolerance, coordinate_precision, limit, after_subc_id):
 
     ### Define query:
     '''
@@ -271,13 +336,15 @@ def get_streamsegment_linestrings_feature_coll_by_basin(conn, basin_id, reg_id,
     '''
 
 
+    page = pagination.sql_parts(limit, after_subc_id)
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT
-        ST_AsText(geom), subc_id, strahler, length, target
-    FROM hydro.stream_segments
+        ST_AsBinary({sql['geom']}), subc_id, strahler, length, target{sql['counts']}
+    FROM hydro.stream_segments{sql['lateral']}
     WHERE basin_id = {basin_id}
         AND reg_id = {reg_id}
-        AND strahler >= {min_strahler}
+        AND strahler >= {min_strahler}{page['where']}{page['order']}
     '''
 
     ### Query database:
@@ -291,16 +358,13 @@ def get_streamsegment_linestrings_feature_coll_by_basin(conn, basin_id, reg_id,
     features_geojson = []
     cum_length = 0
     cum_length_by_strahler = {}
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
-
-        # Create GeoJSON feature from each linestring:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
+
+        # Create GeoJSON feature from each linestring (geometries decoded above, all at once):
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error('Subcatchment %s has no linestring!' % row[1]) # for example: 506469602
@@ -345,9 +409,92 @@ def get_streamsegment_linestrings_feature_coll_by_basin(conn, basin_id, reg_id,
         "cumulative_length_by_strahler": cum_length_by_strahler
     }
 
+    pagination.add_page_info(feature_coll, [row[1] for row in rows], limit, after_subc_id)
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        feature_coll["geometry_simplification"] = report
+
     return feature_coll
 
 
+def get_streamsegment_summary_by_basin(conn, basin_id, reg_id, min_strahler=0, add_segment_ids=False,
+        limit=None, after_subc_id=None):
+    # The members of the FeatureCollection of the basin's stream segments
+    # (see get_streamsegment_linestrings_feature_coll_by_basin()), computed
+    # from the cached basin graph (see basin_graph), without fetching the
+    # geometries. If paged, only of the segments of this page.
+    graph = basin_graph.get_basin_graph(conn, basin_id, reg_id)
+    by_strahler = graph.summary_by_strahler(min_strahler, limit, after_subc_id)
+
+    summary = {
+        "basin_id": basin_id,
+        "region_id": reg_id,
+        "number_stream_segments": sum(count for count, length in by_strahler.values()),
+        "cumulative_length": sum(length for count, length in by_strahler.values()),
+        "cumulative_length_by_strahler": {str(strahler): length for strahler, (count, length) in by_strahler.items()}
+    }
+
+    if add_segment_ids:
+        # Same order as the streamed features:
+        summary["segment_ids"] = graph.subc_ids_sorted(min_strahler, limit, after_subc_id)
+
+    return summary
+
+
+def stream_streamsegment_linestrings_by_basin(conn, basin_id, reg_id, min_strahler=0,
+        geometry_only=False, add_target_streams=False, add_segment_ids=False, comment=None,
+        simplify_tolerance=None, coordinate_precision=None, limit=None, after_subc_id=None, ndjson=False):
+    # Pass-through mode: Same features and members as get_streamsegment_linestrings_feature_coll_by_basin()
+    # (or ..._geometry_coll_by_basin(), if geometry_only), but ordered by subc_id,
+    # assembled by PostGIS and returned as generator of text chunks (see
+    # geojson_streaming).
+    # ndjson: One Feature per line instead (geometry_only and the members of
+    # the collection do not apply).
+    where = 'basin_id = %s AND reg_id = %s AND strahler >= %s'
+    where_params = [basin_id, reg_id, min_strahler]
+    if after_subc_id is not None:
+        where += ' AND subc_id > %s'
+        where_params.append(int(after_subc_id))
+
+    properties = {"subc_id": "subc_id", "length": "length", "strahler": "strahler"}
+    if add_target_streams:
+        properties["target"] = "target"
+
+    if ndjson:
+        geom = geometry_simplification.geometry_sql('geom', simplify_tolerance, coordinate_precision)
+        digits = geometry_simplification.decimal_digits(coordinate_precision)
+        query, params = geojson_streaming.feature_query(
+            'hydro.stream_segments', where, where_params, properties,
+            geom_column=geom, max_decimal_digits=digits, limit=limit)
+        return geojson_streaming.stream_ndjson(conn, query, params)
+
+    sql = geometry_simplification.streaming_parts(simplify_tolerance, coordinate_precision)
+    page = pagination.page_info(limit, after_subc_id, pagination.query_next_cursor(
+        conn, 'hydro.stream_segments', where, where_params, limit, None))
+
+    if geometry_only:
+        query, params = geojson_streaming.geometry_query(
+            'hydro.stream_segments', where, where_params, geom_column=sql['geom'], max_decimal_digits=sql['digits'],
+            limit=limit, counts=sql['counts'], lateral=sql['lateral'])
+        members = dict(page)
+        if comment is not None:
+            members["comment"] = comment
+        return geojson_streaming.stream_collection(conn, query, params, members, make_features=False,
+            count_member=sql['count_member'])
+
+    query, params = geojson_streaming.feature_query(
+        'hydro.stream_segments', where, where_params, properties,
+        geom_column=sql['geom'], max_decimal_digits=sql['digits'], limit=limit,
+        counts=sql['counts'], lateral=sql['lateral'])
+
+    members = get_streamsegment_summary_by_basin(conn, basin_id, reg_id, min_strahler, add_segment_ids,
+        limit, after_subc_id)
+    members.update(page)
+    if comment is not None:
+        members['comment'] = comment
+    return geojson_streaming.stream_collection(conn, query, params, members, count_member=sql['count_member'])
+
+
 if __name__ == "__main__":
 
     # Logging
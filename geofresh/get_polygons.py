@@ -1,5 +1,4 @@
 import json
-import geomet.wkt
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -8,10 +7,20 @@ LOGGER = logging.getLogger(__name__)
 try:
     # If the package is installed in local python PATH:
     import aqua90m.geofresh.upstream_subcids as upstream_subcids
+    import aqua90m.utils.geometry_decoding as geometry_decoding
+    import aqua90m.geofresh.geojson_streaming as geojson_streaming
+    import aqua90m.geofresh.geometry_simplification as geometry_simplification
+    import aqua90m.geofresh.query_capture as query_capture
+    import aqua90m.geofresh.pagination as pagination
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+        import pygeoapi.process.aqua90m.utils.geometry_decoding as geometry_decoding
+        import pygeoapi.process.aqua90m.geofresh.geojson_streaming as geojson_streaming
+        import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
+        import pygeoapi.process.aqua90m.geofresh.query_capture as query_capture
+        import pygeoapi.process.aqua90m.geofresh.pagination as pagination
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -21,7 +30,8 @@ except ModuleNotFoundError as e1:
         LOGGER.debug(msg)
 
 
-def get_subcatchment_polygons_feature_coll(conn, subc_ids, basin_id, reg_id, add_subc_ids = False):
+def get_subcatchment_polygons_feature_coll(conn, subc_ids, basin_id, reg_id, add_subc_ids = False,
+        simplify_tolerance = None, coordinate_precision = None):
 
     # No upstream ids: (TODO: This should be caught earlier, probably):
     # Feature Collections can have empty array according to GeoJSON spec::
@@ -33,7 +43,8 @@ def get_subcatchment_polygons_feature_coll(conn, subc_ids, basin_id, reg_id, add
             "features": []
         }
 
-    feature_list = _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features = True)
+    feature_list, report = _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features = True,
+        simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
 
     feature_coll = {
         "type": "FeatureCollection",
@@ -45,10 +56,14 @@ def get_subcatchment_polygons_feature_coll(conn, subc_ids, basin_id, reg_id, add
     if add_subc_ids:
         feature_coll["subc_ids"] = subc_ids
 
+    if report is not None:
+        feature_coll["geometry_simplification"] = report
+
     return feature_coll
 
 
-def get_subcatchment_polygons_geometry_coll(conn, subc_ids, basin_id, reg_id):
+def get_subcatchment_polygons_geometry_coll(conn, subc_ids, basin_id, reg_id,
+        simplify_tolerance = None, coordinate_precision = None):
 
     # No upstream ids: (TODO: This should be caught earlier, probably):
     # Geometry Collections can have empty array according to GeoJSON spec: ??? WIP TODO CHECK
@@ -61,28 +76,49 @@ def get_subcatchment_polygons_geometry_coll(conn, subc_ids, basin_id, reg_id):
         }
         return geometry_coll
 
-    geojson_items = _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features = False)
+    geojson_items, report = _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features = False,
+        simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
     geometry_coll = {
         "type": "GeometryCollection",
         "geometries": geojson_items
     }
+    if report is not None:
+        geometry_coll["geometry_simplification"] = report
     return geometry_coll
 
 
-def _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features = True):
+def _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features = True,
+        simplify_tolerance = None, coordinate_precision = None):
     # Private function. Should not be used outside this module, as it returns incomplete GeoJSON.
+    # Returns the GeoJSON items, and the size report (None if not simplified).
     LOGGER.debug(f'Querying for polygons for {len(subc_ids)} subc_ids...')
 
     upstream_subcids.too_many_upstream_catchments(len(subc_ids), 'individual polygons')
 
+    # Simplified results are cached (if the tolerance is on the ladder):
+    def compute():
+        items, report = _query_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features,
+            simplify_tolerance, coordinate_precision)
+        return {"items": items, "report": report}
+
+    result = geometry_simplification.cached('subcatchment_polygons',
+        (reg_id, basin_id, geometry_simplification.ids_key(subc_ids), make_features),
+        simplify_tolerance, coordinate_precision, compute)
+    return result["items"], result["report"]
+
+
+def _query_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features,
+        simplify_tolerance, coordinate_precision):
+
     ## Define query:
     relevant_ids = ", ".join([str(elem) for elem in subc_ids])
     # e.g. 506250459, 506251015, 506251126, 506251712
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT
-        ST_AsText(geom),
-        subc_id
-    FROM sub_catchments
+        ST_AsBinary({sql['geom']}),
+        subc_id{sql['counts']}
+    FROM sub_catchments{sql['lateral']}
     WHERE
         subc_id IN ({relevant_ids})
         AND basin_id = {basin_id}
@@ -90,33 +126,30 @@ def _get_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, make_features =
     '''
 
     ## Query database:
-    cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
-    cursor.execute(query)
+    cursor = query_capture.execute(conn.cursor(), query, stage='subcatchment polygons')
     LOGGER.log(logging.TRACE, 'Querying database... DONE.')
 
     ## Get results and construct individual GeoJSON geometries:
     ## (This is not a complete GeometryCollection or FeatureCollection yet!)
-    geojson_items = _package_query_result(cursor, make_features)
-    return geojson_items
+    rows = cursor.fetchall()
+    geojson_items = _package_query_result(rows, make_features, coordinate_precision)
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    return geojson_items, report
 
 
-def _package_query_result(cursor, make_features):
+def _package_query_result(rows, make_features, coordinate_precision = None):
 
     ## Iterate over database query results and construct
     ## GeoJSON geometries from it.
     LOGGER.log(logging.TRACE, 'Iterating over the result rows, constructing GeoJSON...')
     geojson_items = []
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
 
-        # Create GeoJSON geometry from each result row:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+        # GeoJSON geometry of each result row (decoded above, all at once):
+        if geometry is None:
             LOGGER.error(f'Subcatchment {row[1]} has no polygon!') # for example: 506469602
 
         if make_features:
@@ -138,7 +171,7 @@ def get_basin_polygon(conn, basin_id, reg_id, make_feature=False):
     ## Define query:
     query = f'''
     SELECT
-        ST_AsText(geom),
+        ST_AsBinary(geom),
         basin_id
     FROM basins
     WHERE
@@ -164,7 +197,7 @@ def get_basin_polygon(conn, basin_id, reg_id, make_feature=False):
 
         # Create GeoJSON geometry from the result row:
         if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
+            geometry = geometry_decoding.wkb_to_geojson_one(row[0])
         else:
             raise ValueError(f'Basin {row[1]} has no polygon!')
 
@@ -189,14 +222,28 @@ def get_basin_polygon(conn, basin_id, reg_id, make_feature=False):
         return gcoll
 
 
-def get_subcatchment_polygons_geometry_coll_by_basin(conn, basin_id, reg_id):
+def get_subcatchment_polygons_geometry_coll_by_basin(conn, basin_id, reg_id,
+        simplify_tolerance=None, coordinate_precision=None,
+        limit=None, after_subc_id=None):
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('subcatchment_polygons_geometry_coll_by_basin',
+        (reg_id, basin_id, limit, after_subc_id), simplify_tolerance, coordinate_precision,
+        lambda: _get_subcatchment_polygons_geometry_coll_by_basin(
+            conn, basin_id, reg_id, simplify_tolerance, coordinate_precision,
+            limit, after_subc_id))
 
+
+def _get_subcatchment_polygons_geometry_coll_by_basin(conn, basin_id, reg_id,
+        simplify_tolerance, coordinate_precision, limit, after_subc_id):
+
+    page = pagination.sql_parts(limit, after_subc_id)
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT
-        ST_AsText(geom), subc_id
-    FROM hydro.sub_catchments
+        ST_AsBinary({sql['geom']}), subc_id{sql['counts']}
+    FROM hydro.sub_catchments{sql['lateral']}
     WHERE basin_id = {basin_id}
-        AND reg_id = {reg_id}
+        AND reg_id = {reg_id}{page['where']}{page['order']}
     '''
 
     ### Query database:
@@ -208,16 +255,13 @@ def get_subcatchment_polygons_geometry_coll_by_basin(conn, basin_id, reg_id):
     ### Get results and construct GeoJSON:
     LOGGER.log(logging.TRACE, 'Iterating over the result rows, constructing GeoJSON...')
     subcatchments_geojson = []
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
 
-        # Create GeoJSON geometry from each linestring:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+        # Create GeoJSON geometry from each polygon (geometries decoded above, all at once):
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error(f'Subcatchment {row[1]} has no geometry!') # for example: 506469602
@@ -232,17 +276,36 @@ def get_subcatchment_polygons_geometry_coll_by_basin(conn, basin_id, reg_id):
         "geometries": subcatchments_geojson
     }
 
+    pagination.add_page_info(geometry_coll, [row[1] for row in rows], limit, after_subc_id)
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        geometry_coll["geometry_simplification"] = report
+
     return geometry_coll
 
 
-def get_subcatchment_polygons_feature_coll_by_basin(conn, basin_id, reg_id):
+def get_subcatchment_polygons_feature_coll_by_basin(conn, basin_id, reg_id,
+        simplify_tolerance=None, coordinate_precision=None,
+        limit=None, after_subc_id=None):
+    # Simplified results are cached (if the tolerance is on the ladder):
+    return geometry_simplification.cached('subcatchment_polygons_feature_coll_by_basin',
+        (reg_id, basin_id, limit, after_subc_id), simplify_tolerance, coordinate_precision,
+        lambda: _get_subcatchment_polygons_feature_coll_by_basin(
+            conn, basin_id, reg_id, simplify_tolerance, coordinate_precision,
+            limit, after_subc_id))
+
 
+def _get_subcatchment_polygons_feature_coll_by_basin(conn, basin_id, reg_id,
+        simplify_tolerance, coordinate_precision, limit, after_subc_id):
+
+    page = pagination.sql_parts(limit, after_subc_id)
+    sql = geometry_simplification.sql_parts(simplify_tolerance, coordinate_precision)
     query = f'''
     SELECT
-        ST_AsText(geom), subc_id, area_sqm
-    FROM hydro.sub_catchments
+        ST_AsBinary({sql['geom']}), subc_id, area_sqm{sql['counts']}
+    FROM hydro.sub_catchments{sql['lateral']}
     WHERE basin_id = {basin_id}
-        AND reg_id = {reg_id}
+        AND reg_id = {reg_id}{page['where']}{page['order']}
     '''
 
     ### Query database:
@@ -254,16 +317,13 @@ def get_subcatchment_polygons_feature_coll_by_basin(conn, basin_id, reg_id):
     ### Get results and construct GeoJSON:
     LOGGER.log(logging.TRACE, 'Iterating over the result rows, constructing GeoJSON...')
     features_geojson = []
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows],
+        geometry_simplification.decimal_digits(coordinate_precision))
+    for row, geometry in zip(rows, geometries):
 
-        # Create GeoJSON feature from each linestring:
-        geometry = None
-        if row[0] is not None:
-            geometry = geomet.wkt.loads(row[0])
-        else:
+        # Create GeoJSON feature from each polygon (geometries decoded above, all at once):
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error(f'Subcatchment {row[1]} has no polygon!') # for example: 506469602
@@ -289,9 +349,108 @@ def get_subcatchment_polygons_feature_coll_by_basin(conn, basin_id, reg_id):
         "number_stream_segments": len(features_geojson)
     }
 
+    pagination.add_page_info(feature_coll, [row[1] for row in rows], limit, after_subc_id)
+    report = geometry_simplification.size_report(rows, simplify_tolerance, coordinate_precision)
+    if report is not None:
+        feature_coll["geometry_simplification"] = report
+
     return feature_coll
 
 
+def stream_subcatchment_polygons(conn, subc_ids, basin_id, reg_id, geometry_only=False, members=None,
+        simplify_tolerance=None, coordinate_precision=None):
+    # Pass-through mode: Same features and members as get_subcatchment_polygons_feature_coll()
+    # (or ..._geometry_coll(), if geometry_only), but ordered by subc_id,
+    # assembled by PostGIS and returned as generator of text chunks (see
+    # geojson_streaming).
+    # members: Added to the FeatureCollection (e.g. reg_id, basin_id, comment).
+    LOGGER.debug(f'Querying for polygons for {len(subc_ids)} subc_ids (server-side GeoJSON)...')
+    upstream_subcids.too_many_upstream_catchments(len(subc_ids), 'individual polygons')
+
+    where = 'subc_id = ANY(%s) AND basin_id = %s AND reg_id = %s'
+    where_params = [[int(subc_id) for subc_id in subc_ids], basin_id, reg_id]
+    sql = geometry_simplification.streaming_parts(simplify_tolerance, coordinate_precision)
+
+    if geometry_only:
+        query, params = geojson_streaming.geometry_query(
+            'sub_catchments', where, where_params, geom_column=sql['geom'], max_decimal_digits=sql['digits'],
+            counts=sql['counts'], lateral=sql['lateral'])
+        return geojson_streaming.stream_collection(conn, query, params, members, make_features=False,
+            count_member=sql['count_member'])
+
+    query, params = geojson_streaming.feature_query(
+        'sub_catchments', where, where_params, {"subc_id": "subc_id"},
+        geom_column=sql['geom'], max_decimal_digits=sql['digits'], counts=sql['counts'], lateral=sql['lateral'])
+    return geojson_streaming.stream_collection(conn, query, params, members, count_member=sql['count_member'])
+
+
+def stream_subcatchment_polygons_by_basin(conn, basin_id, reg_id, geometry_only=False,
+        add_segment_ids=False, comment=None, simplify_tolerance=None, coordinate_precision=None,
+        limit=None, after_subc_id=None, ndjson=False):
+    # Pass-through mode: Same features and members as get_subcatchment_polygons_feature_coll_by_basin()
+    # (or ..._geometry_coll_by_basin(), if geometry_only), but ordered by subc_id,
+    # assembled by PostGIS and returned as generator of text chunks (see
+    # geojson_streaming).
+    # ndjson: One Feature per line instead (geometry_only and the members of
+    # the collection do not apply).
+    where = 'basin_id = %s AND reg_id = %s'
+    where_params = [basin_id, reg_id]
+    if after_subc_id is not None:
+        where += ' AND subc_id > %s'
+        where_params.append(int(after_subc_id))
+    properties = {"subc_id": "subc_id", "area_sqm": "area_sqm"}
+
+    if ndjson:
+        geom = geometry_simplification.geometry_sql('geom', simplify_tolerance, coordinate_precision)
+        digits = geometry_simplification.decimal_digits(coordinate_precision)
+        query, params = geojson_streaming.feature_query(
+            'hydro.sub_catchments', where, where_params, properties,
+            geom_column=geom, max_decimal_digits=digits, limit=limit)
+        return geojson_streaming.stream_ndjson(conn, query, params)
+
+    sql = geometry_simplification.streaming_parts(simplify_tolerance, coordinate_precision)
+    page = pagination.page_info(limit, after_subc_id, pagination.query_next_cursor(
+        conn, 'hydro.sub_catchments', where, where_params, limit, None))
+
+    if geometry_only:
+        query, params = geojson_streaming.geometry_query(
+            'hydro.sub_catchments', where, where_params, geom_column=sql['geom'], max_decimal_digits=sql['digits'],
+            limit=limit, counts=sql['counts'], lateral=sql['lateral'])
+        members = dict(page)
+        if comment is not None:
+            members["comment"] = comment
+        return geojson_streaming.stream_collection(conn, query, params, members, make_features=False,
+            count_member=sql['count_member'])
+
+    query, params = geojson_streaming.feature_query(
+        'hydro.sub_catchments', where, where_params, properties,
+        geom_column=sql['geom'], max_decimal_digits=sql['digits'], limit=limit,
+        counts=sql['counts'], lateral=sql['lateral'])
+
+    # Members of the FeatureCollection, without fetching the geometries:
+    page_table, page_where = pagination.page_table('hydro.sub_catchments', where, limit)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+    SELECT count(*), array_agg(subc_id ORDER BY subc_id)
+    FROM {page_table}
+    WHERE {page_where}
+    ''', where_params)
+    num_subcatchments, subc_ids = cursor.fetchone()
+    members = {
+        "basin_id": basin_id,
+        "region_id": reg_id,
+        "number_stream_segments": num_subcatchments
+    }
+    if add_segment_ids:
+        members["segment_ids"] = subc_ids or []
+    members.update(page)
+    if comment is not None:
+        members["comment"] = comment
+
+    return geojson_streaming.stream_collection(conn, query, params, members, count_member=sql['count_member'])
+
+
+
 if __name__ == "__main__":
     # Logging
     verbose = True
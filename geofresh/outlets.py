@@ -1,6 +1,4 @@
 import json
-import geomet.wkt
-import geomet.wkb
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -9,10 +7,14 @@ LOGGER = logging.getLogger(__name__)
 try:
     # If the package is installed in local python PATH:
     import aqua90m.geofresh.upstream_subcids as upstream_subcids
+    import aqua90m.utils.geometry_decoding as geometry_decoding
+    import aqua90m.geofresh.partition_pruning as partition_pruning
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+        import pygeoapi.process.aqua90m.utils.geometry_decoding as geometry_decoding
+        import pygeoapi.process.aqua90m.geofresh.partition_pruning as partition_pruning
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -30,18 +32,23 @@ def get_outlet_subcids_in_polygon(conn, polygon_geojson, min_strahler=1):
     polygon_geojson_str = f'{polygon_geojson}'
     polygon_geojson_str = polygon_geojson_str.replace("'", '"')
 
+    ### Regional units of the polygon, so only their partitions are searched:
+    reg_ids = partition_pruning.regids_for_geometry(conn, polygon_geojson_str)
+
     ### Define query:
     query = f'''
     SELECT subc_id, basin_id
     FROM stream_segments
     WHERE target = -basin_id
         AND strahler >= {min_strahler}
+        AND {partition_pruning.predicate(reg_ids=reg_ids)}
         AND ST_WITHIN(stream_segments.geom, ST_GeomFromGeoJSON(
             '{polygon_geojson_str}'
         ));
     '''
 
     ### Query database:
+    partition_pruning.verify(conn, query, [], 'hydro.stream_segments', len(reg_ids))
     cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
     cursor.execute(query)
@@ -77,18 +84,23 @@ def get_outlet_streamsegments_in_polygon(conn, polygon_geojson, min_strahler=1):
     polygon_geojson_str = f'{polygon_geojson}'
     polygon_geojson_str = polygon_geojson_str.replace("'", '"')
 
+    ### Regional units of the polygon, so only their partitions are searched:
+    reg_ids = partition_pruning.regids_for_geometry(conn, polygon_geojson_str)
+
     ### Define query:
     query = f'''
-    SELECT subc_id, basin_id, geom
+    SELECT subc_id, basin_id, ST_AsEWKB(geom)
     FROM stream_segments
     WHERE target = -basin_id
         AND strahler >= {min_strahler}
+        AND {partition_pruning.predicate(reg_ids=reg_ids)}
         AND ST_WITHIN(stream_segments.geom, ST_GeomFromGeoJSON(
             '{polygon_geojson_str}'
         ));
     '''
 
     ### Query database:
+    partition_pruning.verify(conn, query, [], 'hydro.stream_segments', len(reg_ids))
     cursor = conn.cursor()
     LOGGER.log(logging.TRACE, 'Querying database...')
     cursor.execute(query)
@@ -100,14 +112,20 @@ def get_outlet_streamsegments_in_polygon(conn, polygon_geojson, min_strahler=1):
         "type": "FeatureCollection",
         "features": []
     }
-    while (True):
-        row = cursor.fetchone()
-        if row is None:
-            break
+    # Decode all geometries at once. They are EWKB (with SRID), and not
+    # rounded, as before when we parsed the hex EWKB with geomet:
+    rows = cursor.fetchall()
+    try:
+        geometries = geometry_decoding.wkb_to_geojson([row[2] for row in rows], decimal_digits=None, add_srid=True)
+    except ValueError as e:
+        err_msg = f'Failed to parse geometry for stream segments (in basins {set(row[1] for row in rows)}): {e}'
+        LOGGER.error(err_msg)
+        raise ValueError(err_msg) from e
+
+    for row, geometry in zip(rows, geometries):
 
         subc_id = None
         basin_id = None
-        geometry = None
 
         if row[0] is not None:
             subc_id = row[0]
@@ -115,18 +133,7 @@ def get_outlet_streamsegments_in_polygon(conn, polygon_geojson, min_strahler=1):
         if row[1] is not None:
           basin_id = row[1]
 
-        if row[2] is not None:
-            LOGGER.debug(f'GEOM ROW {row[2]}')
-            try:
-                #geometry = geomet.wkt.loads(row[2])
-                geometry = geomet.wkb.loads(bytes.fromhex(row[2]))
-                LOGGER.debug(f'GEOMETRY {geometry}')
-            except ValueError as e:
-                err_msg = f'Failed to parse geometry for stream segment {subc_id} (in basin {basin_id}): {e}'
-                LOGGER.error(err_msg)
-                raise ValueError(err_msg) from e
-
-        else:
+        if geometry is None:
             # Geometry errors that happen when two segments flow into one outlet (Vanessa, 17 June 2024)
             # For example, subc_id 506469602, when routing from 507056424 to outlet -1294020
             LOGGER.error(f'Subcatchment {subc_id} has no geometry!') # for example: 506469602
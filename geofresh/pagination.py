@@ -0,0 +1,147 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+'''
+Paged access to basin-wide results (all subcatchments or stream segments
+of a basin), so large basins can be fetched in pages of bounded size,
+instead of in one result that has to fit into the worker's memory.
+
+Pages are defined by a keyset cursor on subc_id: The rows are ordered by
+subc_id, and a page contains the first "limit" rows after the cursor (the
+last subc_id of the previous page). Unlike OFFSET, the database does not
+have to skip over all previous rows, and pages stay consistent.
+
+The result of a page contains "next_cursor" (the last subc_id of the page),
+to be passed as "cursor" to get the next page, or null if it was the last
+page.
+
+Usage:
+
+    limit, cursor = pagination.check_paging(limit, cursor)
+    sql = pagination.sql_parts(limit, cursor)
+    query = f"SELECT ... FROM ... WHERE basin_id = 123{sql['where']}{sql['order']}"
+    ...
+    pagination.add_page_info(result, subc_ids, limit, cursor)
+'''
+
+# Largest page:
+MAX_LIMIT = 100000
+
+
+def check_paging(limit, cursor, max_limit=MAX_LIMIT):
+    # Validates the user inputs. Returns them as int (or None).
+    if limit is not None:
+        if isinstance(limit, bool) or not str(limit).isdigit() or int(limit) == 0:
+            err_msg = f"limit must be a positive number of rows, not '{limit}'."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        limit = int(limit)
+        if limit > max_limit:
+            err_msg = f"limit must not be larger than {max_limit} (requested: {limit})."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except (ValueError, TypeError) as e:
+            err_msg = f"cursor must be a subc_id (the next_cursor of the previous page), not '{cursor}'."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+
+    return limit, cursor
+
+
+def is_paged(limit, cursor):
+    return limit is not None or cursor is not None
+
+
+def sql_parts(limit, after_subc_id, id_column='subc_id'):
+    # Snippets to insert into a query: 'where' (to be appended to the WHERE
+    # clause) and 'order' (at the very end of the query). Without paging,
+    # the query stays as it is.
+    if not is_paged(limit, after_subc_id):
+        return {'where': '', 'order': ''}
+    where = '' if after_subc_id is None else f' AND {id_column} > {int(after_subc_id)}'
+    order = f' ORDER BY {id_column}'
+    if limit is not None:
+        order += f' LIMIT {int(limit)}'
+    return {'where': where, 'order': order}
+
+
+def next_cursor(subc_ids, limit):
+    # The cursor for the next page, or None if this was the last one:
+    if limit is None or len(subc_ids) < limit:
+        return None
+    return int(subc_ids[-1])
+
+
+def add_page_info(result, subc_ids, limit, after_subc_id):
+    # Adds the paging info to a result (dict), if it was paged:
+    result.update(page_info(limit, after_subc_id, next_cursor(subc_ids, limit)))
+    return result
+
+
+def query_next_cursor(conn, table, where, where_params, limit, after_subc_id, id_column='subc_id'):
+    # For results that are streamed (see geojson_streaming), we do not see the
+    # ids, so the next cursor (the id of the page's last row) is looked up in
+    # the index, before streaming the page.
+    if limit is None:
+        return None
+    if after_subc_id is not None:
+        where = f'{where} AND {id_column} > {int(after_subc_id)}'
+    query = f'''
+    SELECT {id_column}
+    FROM {table}
+    WHERE {where}
+    ORDER BY {id_column}
+    OFFSET {int(limit)-1} LIMIT 1
+    '''
+    cursor = conn.cursor()
+    cursor.execute(query, where_params)
+    row = cursor.fetchone()
+    return None if row is None else int(row[0])
+
+
+def page_table(table, where, limit, id_column='subc_id'):
+    # One page of a table, as subquery, for queries that aggregate over the
+    # rows (e.g. counting the rows), so they only see this page.
+    # Returns the table expression and the WHERE clause to use with it (the
+    # parameters of the WHERE clause stay the same).
+    if limit is None:
+        return table, where
+    return f'(SELECT * FROM {table} WHERE {where} ORDER BY {id_column} LIMIT {int(limit)}) AS page', 'TRUE'
+
+
+def page_info(limit, after_subc_id, next_cursor):
+    # The paging members of a result (empty if it was not paged):
+    if not is_paged(limit, after_subc_id):
+        return {}
+    return {"limit": limit, "cursor": after_subc_id, "next_cursor": next_cursor}
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    limit, cursor = check_paging("1000", 506250459)
+    print(sql_parts(limit, cursor))
+    print(add_page_info({}, list(range(1000)), limit, cursor))
+    print(add_page_info({}, list(range(10)), limit, cursor))
@@ -0,0 +1,220 @@
+import os
+import json
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+'''
+Predicates on reg_id / basin_id for queries on the hydro tables, in a form
+that lets PostgreSQL skip the partitions (regional units) that cannot
+contain any matching rows.
+
+The hydro tables (stream_segments, sub_catchments, ...) are partitioned by
+reg_id. The planner can only leave out partitions if the query compares
+reg_id with constants: "reg_id = 58" or "reg_id IN (58, 59)" (which is the
+same as "reg_id = ANY(ARRAY[58, 59])"). Spatial conditions alone (e.g.
+ST_Intersects, or ORDER BY <->) do not prune, so without a reg_id predicate
+every partition's index is searched. Conditions on a subquery or a join
+(e.g. "reg_id IN (SELECT ...)") are not pruned at planning time either, so
+the reg_ids are looked up first (e.g. regids_for_geometry()) and then
+written into the query as constants. The basin_id predicate is added, too,
+as it narrows down the rows within the partition.
+
+The values are validated as integers before they are written into the SQL
+text. An empty set of reg_ids selects nothing ("FALSE"), instead of being a
+syntax error.
+
+To check the pruning, check_partitions() runs EXPLAIN on a query and raises
+an exception if it would scan more partitions than expected. With
+"partition_pruning_verify": true in config, the queries built here are
+checked like this before they run (meant for testing against a local
+PostGIS database, not for production). The __main__ block runs the checks
+for the common lookup queries.
+
+Usage:
+
+    where = partition_pruning.predicate(reg_ids=[58], basin_ids=[1292547], alias='seg')
+    query = f'SELECT ... FROM hydro.stream_segments seg WHERE {where} AND ...'
+    partition_pruning.verify(conn, query, params, 'hydro.stream_segments', 1)
+'''
+
+# Defaults, can be overridden in config:
+DEFAULT_VERIFY = False
+
+# global variables:
+_VERIFY = None
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Partition pruning checks not configured (config file not found), using default (%s)." % DEFAULT_VERIFY)
+        return {}
+
+
+def is_verify_on():
+    global _VERIFY
+    if _VERIFY is None:
+        _VERIFY = bool(_read_config().get('partition_pruning_verify', DEFAULT_VERIFY))
+    return _VERIFY
+
+
+def _int_values(values, name):
+    # Accepts a single value or an iterable of values (incl. NumPy), returns
+    # the sorted distinct ints:
+    if isinstance(values, (str, bytes)) or not hasattr(values, '__iter__'):
+        values = [values]
+    try:
+        return sorted(set(int(value) for value in values))
+    except (ValueError, TypeError) as e:
+        err_msg = f'{name} must be integers, not: {values}'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+
+def _column_predicate(column, values):
+    if len(values) == 0:
+        return 'FALSE'
+    if len(values) == 1:
+        return f'{column} = {values[0]}'
+    return f'{column} IN ({", ".join(str(value) for value in values)})'
+
+
+def predicate(reg_ids=None, basin_ids=None, alias=None):
+    # The tightest predicate for what we know (None: unknown, no predicate
+    # on this column). Returns SQL text, "TRUE" if nothing is known.
+    prefix = '' if alias is None else f'{alias}.'
+    parts = []
+    if reg_ids is not None:
+        parts.append(_column_predicate(f'{prefix}reg_id', _int_values(reg_ids, 'reg_ids')))
+    else:
+        LOGGER.log(logging.TRACE, 'No reg_id known for query, cannot prune partitions.')
+    if basin_ids is not None:
+        parts.append(_column_predicate(f'{prefix}basin_id', _int_values(basin_ids, 'basin_ids')))
+    if len(parts) == 0:
+        return 'TRUE'
+    return ' AND '.join(parts)
+
+
+def regids_for_geometry(conn, geometry_geojson_str):
+    # Regional units that intersect a geometry (GeoJSON text, e.g. a polygon
+    # posted by the user). A small table, so this is cheap:
+    query = '''
+    SELECT reg_id
+    FROM regional_units
+    WHERE ST_Intersects(geom, ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326))
+    '''
+    cursor = conn.cursor()
+    cursor.execute(query, [geometry_geojson_str])
+    reg_ids = sorted(row[0] for row in cursor.fetchall())
+    LOGGER.debug(f'Regional units intersecting the geometry: {reg_ids}')
+    return reg_ids
+
+
+##########################
+### Checking the plans ###
+##########################
+
+def _partition_names(conn, table):
+    # Names of the partitions (leaves) of a partitioned table:
+    cursor = conn.cursor()
+    cursor.execute('''
+    SELECT c.relname
+    FROM pg_partition_tree(%s::regclass) AS tree
+    JOIN pg_class c ON c.oid = tree.relid
+    WHERE tree.isleaf
+    ''', [table])
+    return set(row[0] for row in cursor.fetchall())
+
+
+def _scanned_relations(plan_node, found):
+    if 'Relation Name' in plan_node:
+        found.add(plan_node['Relation Name'])
+    for child in plan_node.get('Plans', []):
+        _scanned_relations(child, found)
+    return found
+
+
+def scanned_partitions(conn, query, params, table):
+    # The partitions of the table that the plan of the query scans (after
+    # pruning at planning time), as set of names:
+    cursor = conn.cursor()
+    # (no parameters: None, so a "%" in the query is not taken as placeholder)
+    cursor.execute(f'EXPLAIN (FORMAT JSON) {query}', params or None)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scanned = _scanned_relations(plan[0]['Plan'], set())
+    return scanned & _partition_names(conn, table)
+
+
+def check_partitions(conn, query, params, table, max_partitions):
+    # Raises an exception if the query would scan more than max_partitions
+    # partitions of the table. Returns the partitions it scans.
+    partitions = scanned_partitions(conn, query, params, table)
+    if len(partitions) > max_partitions:
+        err_msg = (f'Query scans {len(partitions)} partitions of {table}, expected at most'
+            f' {max_partitions}: {sorted(partitions)}')
+        LOGGER.error(err_msg)
+        raise exc.GeoFreshUnexpectedResultException(err_msg)
+    LOGGER.debug(f'Query scans {len(partitions)} partitions of {table} (at most {max_partitions} expected).')
+    return partitions
+
+
+def verify(conn, query, params, table, max_partitions):
+    # Only checks if switched on in config (testing mode):
+    if is_verify_on():
+        check_partitions(conn, query, params, table, max_partitions)
+
+
+if __name__ == "__main__":
+
+    # Checks the pruning of the common queries, against a (local) PostGIS
+    # database with the partitioned hydro tables (connection details from
+    # ./config.json), e.g.:
+    # python aqua90m/geofresh/partition_pruning.py
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    print(predicate(reg_ids=[58], basin_ids=1292547, alias='seg'))
+    print(predicate(reg_ids={59, 58}))
+    print(predicate(reg_ids=[]))
+    print(predicate())
+
+    from database_connection import get_connection_object_config
+    with open("./config.json", 'r') as config_file:
+        config = json.load(config_file)
+    conn = get_connection_object_config(config)
+
+    checks = [
+        ('hydro.stream_segments', 1,
+            f'SELECT strahler FROM hydro.stream_segments WHERE subc_id = 506251252 AND {predicate(58, 1292547)}'),
+        ('hydro.sub_catchments', 2,
+            f'SELECT subc_id FROM hydro.sub_catchments WHERE {predicate([58, 59])}'),
+        ('hydro.stream_segments', 1,
+            f'''SELECT subc_id FROM hydro.stream_segments seg WHERE {predicate([58], alias='seg')}
+            ORDER BY seg.geog <-> ST_SetSRID(ST_MakePoint(9.931555, 54.695070), 4326)::geography LIMIT 1''')
+    ]
+    for table, max_partitions, query in checks:
+        print(check_partitions(conn, query, [], table, max_partitions))
+    conn.close()
@@ -0,0 +1,190 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+
+'''
+Compact encoding of many paths on the stream network ("path trie"), for
+the path matrix (many-to-many) and the paths to the outlet (plural).
+
+On a river network, paths share long parts: All paths to the outlet end
+with the same segments, and the paths between many points run through the
+same main stem. Listing every path in full makes the result grow with the
+number of pairs times the path length. Instead, every segment on any of
+the paths is listed once, with its parent (the next segment downstream,
+as index into the same list, or -1), i.e. a parent table:
+
+    "subc_ids": [506250459, 506251015, 506251713, ...],
+    "parents":  [1, 2, -1, ...]
+
+and each path is given by three nodes (indices into that list): start_node,
+end_node, and lca_node (the lowest common ancestor, i.e. the segment where
+the path turns from going downstream to going upstream). The path is:
+
+    from start_node downstream until lca_node (not incl.),
+    then from lca_node upstream to end_node (i.e. end_node downstream
+    until lca_node, reversed),
+    with the start segment added in front if it is not the first.
+
+A node that is null means: start or end is the outlet, and lca_node null
+means the path goes through the outlet (downstream until parent -1). This
+gives exactly the same paths as the dense result (see routing).
+
+Clients expand the paths with expand_path() (pure Python, no NumPy, can be
+copied to the client), or get the dense matrix back with to_dense_matrix().
+
+Usage:
+
+    trie = path_trie.PathTrie()
+    refs = trie.add_routes(contracted, [(start_subc_id, end_subc_id), ...])
+    result = trie.to_json()
+    result['pairs'] = [...refs...]
+'''
+
+ENCODING = 'path_trie'
+
+
+class PathTrie:
+    # Collects the segments of many routes (possibly of several basins) in
+    # one parent table. Nodes are indices into subc_ids/parents.
+
+    def __init__(self):
+        self.subc_ids = []
+        self.parents = []
+
+    def __len__(self):
+        return len(self.subc_ids)
+
+    def add_routes(self, contracted, routes):
+        # routes: List of (start_subc_id, end_subc_id) in the basin of the
+        # ContractedGraph (see contracted_graph). Returns, per route, a dict
+        # with start_node, end_node, lca_node (all None if there is no path).
+        # All segments of a basin are added at once, with NumPy.
+        meetings = [contracted.route(start, end) for start, end in routes]
+        pieces = [np.empty(0, dtype='int64')]
+        for meeting in meetings:
+            if meeting is None:
+                continue
+            _, pos_a, pos_b, lca = meeting
+            for pos in (pos_a, pos_b):
+                if pos is not None:
+                    pieces.append(np.array([pos], dtype='int64'))
+                    pieces.extend(contracted.up_to(pos, lca))
+            if lca is not None:
+                pieces.append(np.array([lca], dtype='int64'))
+
+        # Each segment once, with its parent (if that is in the table, too):
+        nodes = np.unique(np.concatenate(pieces))
+        parent = contracted.parent[nodes]
+        idx = np.minimum(np.searchsorted(nodes, parent), max(nodes.shape[0]-1, 0))
+        in_table = (parent >= 0) & (nodes.shape[0] > 0)
+        in_table[in_table] = nodes[idx[in_table]] == parent[in_table]
+        offset = len(self.subc_ids)
+        self.subc_ids.extend(contracted.ids[nodes].tolist())
+        self.parents.extend(np.where(in_table, idx + offset, -1).tolist())
+        LOGGER.debug(f'Path trie: Added {nodes.shape[0]} segments for {len(routes)} routes.')
+
+        def _node(pos):
+            return None if pos is None else offset + int(np.searchsorted(nodes, pos))
+
+        refs = []
+        for meeting in meetings:
+            if meeting is None:
+                refs.append({"start_node": None, "end_node": None, "lca_node": None})
+            else:
+                _, pos_a, pos_b, lca = meeting
+                refs.append({"start_node": _node(pos_a), "end_node": _node(pos_b), "lca_node": _node(lca)})
+        return refs
+
+    def to_json(self):
+        return {
+            "encoding": ENCODING,
+            "num_segments": len(self.subc_ids),
+            "subc_ids": self.subc_ids,
+            "parents": self.parents
+        }
+
+
+########################################
+### Client side: Expanding the paths ###
+########################################
+
+def expand_path(trie, start, start_node, end_node, lca_node):
+    # The full path (list of subc_ids, incl. start), as in the dense result.
+    # trie: The result (dict with "subc_ids" and "parents").
+    # start: The start subc_id (added in front if the path does not start
+    # with it, e.g. if start is the lowest common ancestor).
+    subc_ids = trie['subc_ids']
+    down = _walk(trie['parents'], start_node, lca_node)
+    up = _walk(trie['parents'], end_node, lca_node)
+    path = [subc_ids[node] for node in down] + [subc_ids[node] for node in reversed(up)]
+    if len(path) == 0 or path[0] != start:
+        path = [start] + path
+    return path
+
+
+def _walk(parents, node, stop):
+    # Nodes from node downstream until stop (not incl.), or the outlet:
+    nodes = []
+    while node is not None and node != -1 and node != stop:
+        nodes.append(node)
+        node = parents[node]
+    return nodes
+
+
+def lowest_common_ancestor(trie, node_a, node_b):
+    # The node where the paths downstream from node_a and node_b meet (or
+    # None, if only at the outlet, or not in this table):
+    parents = trie['parents']
+    downstream_of_a = set(_walk(parents, node_a, None))
+    for node in _walk(parents, node_b, None):
+        if node in downstream_of_a:
+            return node
+    return None
+
+
+def to_dense_matrix(trie):
+    # The dense (legacy) path matrix of a many-to-many result, as nested dict
+    # (start -> end -> path), see routing.get_dijkstra_ids_many_to_many().
+    matrix = {}
+    for pair in trie['pairs']:
+        matrix.setdefault(str(pair['start']), {})[str(pair['end'])] = expand_path(
+            trie, pair['start'], pair['start_node'], pair['end_node'], pair['lca_node'])
+    return matrix
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    # Small network: 1 and 2 flow into 3, 3 into 4, 4 and 6 into 5, 5 into the outlet (-7):
+    import contracted_graph
+    contracted = contracted_graph.ContractedGraph(
+        subc_ids=np.array([1, 2, 3, 4, 5, 6]),
+        parent=np.array([2, 2, 3, 4, -1, 4]),
+        targets=np.array([3, 3, 4, 5, -7, 5]),
+        length=np.array([10.0, 20.0, 30.0, 40.0, 100.0, 60.0]))
+    trie = PathTrie()
+    routes = [(1, 6), (2, 6), (1, -7), (4, 1)]
+    refs = trie.add_routes(contracted, routes)
+    result = trie.to_json()
+    result['pairs'] = [{"start": start, "end": end, **ref} for (start, end), ref in zip(routes, refs)]
+    print(result)
+    print(to_dense_matrix(result))
@@ -0,0 +1,268 @@
+import os
+import re
+import json
+import time
+import weakref
+import threading
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+'''
+Prepared statements for the hot lookup queries (point -> reg_id, point ->
+subc_id/basin_id, basin_id -> reg_id, subc_id -> basin_id/reg_id, Strahler
+order of a segment).
+
+These run for every single-point request, and once per point in loops, so
+PostgreSQL parsing and planning the same query text again and again adds
+up. Instead, a statement is PREPAREd on a connection, and then run with
+EXECUTE and bound parameters. The values are passed as parameters (never
+pasted into the SQL text), so malformed inputs fail as invalid values.
+
+A prepared statement only lives as long as its connection, and the
+processes open a new connection for every request. Preparing a statement
+that then runs once or twice costs an extra round trip and saves nothing.
+So a statement is only prepared once it has run "prepare_threshold" times
+(config, default 5, like psycopg 3) on the same connection, e.g. in a loop
+over points. Before that, it runs unprepared. With a threshold of 1, every
+statement is prepared on first use (for long-lived connections).
+
+Statements are defined with $1, $2, ... placeholders (see STATEMENTS). The
+same text (with %s placeholders) is used when preparing is switched off
+("prepared_statements": false in config), to compare the lookup latency
+with and without preparation, see get_stats().
+
+Usage:
+
+    cursor = prepared_statements.execute(conn, 'regid_from_lonlat', [lon, lat])
+    row = cursor.fetchone()
+'''
+
+# Prefix of the statement names in the database session:
+NAME_PREFIX = 'aqua90m_'
+
+# Name -> query, with positional parameters ($1, $2, ... in this order):
+STATEMENTS = {
+    'regid_from_lonlat': '''
+        SELECT reg_id
+        FROM regional_units
+        WHERE st_intersects(ST_SetSRID(ST_MakePoint($1::float8, $2::float8), 4326), geom)
+    ''',
+    'subcid_basinid_from_lonlat_regid': '''
+        SELECT subc_id, basin_id
+        FROM sub_catchments
+        WHERE st_intersects(ST_SetSRID(ST_MakePoint($1::float8, $2::float8), 4326), geom)
+            AND reg_id = $3
+    ''',
+    'basinid_regid_from_subcid': '''
+        SELECT basin_id, reg_id
+        FROM sub_catchments
+        WHERE subc_id = $1
+    ''',
+    'regid_from_basinid': '''
+        SELECT reg_id
+        FROM hydro.basins
+        WHERE basin_id = $1
+    ''',
+    'strahler_order': '''
+        SELECT strahler
+        FROM hydro.stream_segments
+        WHERE subc_id = $1
+            AND reg_id = $2
+            AND basin_id = $3
+    '''
+}
+
+# Defaults, can be overridden in config:
+DEFAULT_ENABLED = True
+DEFAULT_PREPARE_THRESHOLD = 5
+
+# SQLSTATE invalid_sql_statement_name: The statement is gone (e.g. after
+# DISCARD ALL by a connection pooler), we have to prepare it again:
+PGCODE_STATEMENT_GONE = '26000'
+
+# global variables:
+_ENABLED = None
+_PREPARE_THRESHOLD = None
+_LOCK = threading.Lock()
+# Connection -> names of the statements prepared in its session:
+_PREPARED = weakref.WeakKeyDictionary()
+# Connection -> how often each statement ran on it (unprepared):
+_USES = weakref.WeakKeyDictionary()
+_STATS = {}
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Prepared statements not configured (config file not found), using default (%s)." % DEFAULT_ENABLED)
+        return {}
+
+
+def is_enabled():
+    global _ENABLED
+    if _ENABLED is None:
+        _ENABLED = bool(_read_config().get('prepared_statements', DEFAULT_ENABLED))
+    return _ENABLED
+
+
+def get_prepare_threshold():
+    global _PREPARE_THRESHOLD
+    if _PREPARE_THRESHOLD is None:
+        _PREPARE_THRESHOLD = max(1, int(_read_config().get('prepare_threshold', DEFAULT_PREPARE_THRESHOLD)))
+    return _PREPARE_THRESHOLD
+
+
+def _num_params(query):
+    return max([int(number) for number in re.findall(r'\$(\d+)', query)], default=0)
+
+
+def _plain_query(query):
+    # Same query with psycopg2 placeholders, for running it unprepared
+    # (so each parameter may appear only once, in order):
+    return re.sub(r'\$\d+', '%s', query)
+
+
+def _prepared_set(conn):
+    # Names prepared on this connection (None if we cannot keep track of
+    # the connection, then we do not prepare):
+    with _LOCK:
+        try:
+            return _PREPARED.setdefault(conn, set())
+        except TypeError:
+            return None
+
+
+def _count_use(conn, name):
+    # How often the statement has run on this connection, including now:
+    with _LOCK:
+        uses = _USES.setdefault(conn, {})
+        uses[name] = uses.get(name, 0) + 1
+        return uses[name]
+
+
+def _stats_for(name):
+    return _STATS.setdefault(name, {
+        'prepares': 0, 'hits': 0, 'unprepared': 0,
+        'seconds_prepared': 0.0, 'seconds_unprepared': 0.0
+    })
+
+
+def execute(conn, name, params):
+    # Runs the statement (preparing it first, if this connection has not
+    # got it yet). Returns the cursor, for fetching the rows.
+    query = STATEMENTS[name]
+    # NumPy scalars (e.g. ids from a dataframe) cannot be adapted by psycopg2:
+    params = [param.item() if hasattr(param, 'item') else param for param in params]
+    cursor = conn.cursor()
+    prepared = _prepared_set(conn) if is_enabled() else None
+    start = time.monotonic()
+
+    # Not worth preparing (yet), if it has not run often on this connection:
+    if prepared is not None and not name in prepared and _count_use(conn, name) < get_prepare_threshold():
+        prepared = None
+
+    if prepared is None:
+        LOGGER.log(logging.TRACE, f'Querying database ({name}, not prepared)...')
+        cursor.execute(_plain_query(query), params)
+        with _LOCK:
+            stats = _stats_for(name)
+            stats['unprepared'] += 1
+            stats['seconds_unprepared'] += time.monotonic() - start
+        return cursor
+
+    statement_name = NAME_PREFIX + name
+    is_hit = name in prepared
+    if not is_hit:
+        LOGGER.log(logging.TRACE, f'Preparing statement {statement_name}...')
+        cursor.execute(f'PREPARE {statement_name} AS {query}')
+        prepared.add(name)
+
+    LOGGER.log(logging.TRACE, f'Querying database ({name}, prepared)...')
+    placeholders = ', '.join(['%s'] * _num_params(query))
+    try:
+        cursor.execute(f'EXECUTE {statement_name} ({placeholders})', params)
+    except Exception as e:
+        if getattr(e, 'pgcode', None) == PGCODE_STATEMENT_GONE:
+            prepared.discard(name)
+        raise
+
+    with _LOCK:
+        stats = _stats_for(name)
+        stats['hits' if is_hit else 'prepares'] += 1
+        stats['seconds_prepared'] += time.monotonic() - start
+    return cursor
+
+
+def forget_connection(conn):
+    # E.g. after DISCARD ALL, or when a connection is handed to someone else:
+    with _LOCK:
+        _PREPARED.pop(conn, None)
+        _USES.pop(conn, None)
+
+
+def server_plan_stats(conn):
+    # Plan cache of this session, as seen by PostgreSQL (14 and later): How
+    # often each statement ran with a generic (cached) or a custom plan.
+    cursor = conn.cursor()
+    cursor.execute('''
+    SELECT name, generic_plans, custom_plans
+    FROM pg_prepared_statements
+    WHERE name LIKE %s
+    ''', [NAME_PREFIX + '%'])
+    return {name: {'generic_plans': generic, 'custom_plans': custom}
+        for name, generic, custom in cursor.fetchall()}
+
+
+def get_stats():
+    # Per statement: How often it was prepared, run prepared (hits) and run
+    # unprepared (also below the threshold), and the mean latency with and
+    # without preparation.
+    with _LOCK:
+        result = {}
+        for name, stats in _STATS.items():
+            result[name] = dict(stats)
+            num_prepared = stats['prepares'] + stats['hits']
+            result[name]['ms_mean_prepared'] = round(1000 * stats['seconds_prepared'] / num_prepared, 3) if num_prepared else None
+            result[name]['ms_mean_unprepared'] = round(1000 * stats['seconds_unprepared'] / stats['unprepared'], 3) if stats['unprepared'] else None
+        return result
+
+
+def log_stats():
+    for name, stats in get_stats().items():
+        LOGGER.info(f'Statement {name}: {stats["prepares"]} prepares, {stats["hits"]} hits'
+            f' ({stats["ms_mean_prepared"]} ms), {stats["unprepared"]} unprepared'
+            f' ({stats["ms_mean_unprepared"]} ms).')
+
+
+if __name__ == "__main__":
+
+    # Compares the lookup latency with and without preparing, on a real
+    # database (connection details from ./config.json), e.g.:
+    # python aqua90m/geofresh/prepared_statements.py
+
+    logging.basicConfig(level=logging.INFO)
+
+    from database_connection import get_connection_object_config
+    with open("./config.json", 'r') as config_file:
+        config = json.load(config_file)
+    conn = get_connection_object_config(config)
+
+    lon, lat = 9.931555, 54.695070
+    for enabled in [False, True]:
+        _ENABLED = enabled
+        for i in range(200):
+            reg_id = execute(conn, 'regid_from_lonlat', [lon, lat]).fetchone()[0]
+            subc_id, basin_id = execute(conn, 'subcid_basinid_from_lonlat_regid', [lon, lat, reg_id]).fetchone()
+            execute(conn, 'basinid_regid_from_subcid', [subc_id]).fetchone()
+            execute(conn, 'regid_from_basinid', [basin_id]).fetchone()
+            execute(conn, 'strahler_order', [subc_id, reg_id, basin_id]).fetchone()
+
+    log_stats()
+    print(server_plan_stats(conn))
+    conn.close()
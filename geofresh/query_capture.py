@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+'''
+Capture of the query plans of slow queries, per job.
+
+When a job is slow, the timing alone (see log_query_time()) does not tell
+why, and the plan depends on the data of that job, so it cannot be
+reproduced afterwards. In capture mode, a query that took longer than
+"slow_query_capture_seconds" (config) is run once more with EXPLAIN
+(ANALYZE, BUFFERS, FORMAT JSON), and the plan (with actual row counts,
+timings and buffer usage), the query, its parameters and the original
+timing are written to a JSON file:
+
+    <download_dir>/queryplan-<process_id>-<job_id>-<stage>-<n>.json
+
+The stage is the name of the step of the job (e.g. "adding nearest
+neighbours"). The query is re-run inside a savepoint that is rolled back,
+so queries that write (e.g. UPDATE on a temporary table) have no effect
+the second time. Note that the second run usually finds the data in the
+cache, so compare the timing of the plan with the original timing.
+
+To cap the overhead, only a fraction of the slow queries is captured
+("slow_query_capture_sample_rate"), and at most
+"slow_query_capture_max_per_job" plans are stored per job (failed
+attempts do not count). Capture is off unless "slow_query_capture_seconds"
+is configured.
+
+Only queries that EXPLAIN can run are captured (SELECT, INSERT, UPDATE,
+DELETE, also with WITH). Other statements (e.g. CREATE TABLE, CREATE INDEX)
+are skipped, even if slow.
+
+The job is set by GeoFreshBaseProcessor for the thread that executes it.
+Queries outside of a job are not captured.
+
+Usage:
+
+    cursor = query_capture.execute(conn.cursor(), query, params, 'dissolving upstream catchment')
+
+    # or, for already timed queries:
+    query_capture.capture_if_slow(cursor, query, params, seconds, stage)
+'''
+
+# Defaults, can be overridden in config:
+DEFAULT_THRESHOLD_SECONDS = None # off
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_MAX_PER_JOB = 5
+
+SAVEPOINT_NAME = 'aqua90m_query_capture'
+
+# Statements that EXPLAIN can run:
+EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE|VALUES|TABLE)\b', re.IGNORECASE)
+
+# global variables:
+_SETTINGS = None
+_JOB = threading.local()
+_STATS = {'slow_queries': 0, 'captured': 0, 'skipped_sampling': 0, 'skipped_max_per_job': 0,
+    'skipped_not_explainable': 0, 'failed': 0}
+_STATS_LOCK = threading.Lock()
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Slow query capture not configured (config file not found), using defaults (off).")
+        return {}
+
+
+def get_settings():
+    global _SETTINGS
+    if _SETTINGS is None:
+        config = _read_config()
+        threshold = config.get('slow_query_capture_seconds', DEFAULT_THRESHOLD_SECONDS)
+        _SETTINGS = {
+            'threshold_seconds': None if threshold is None else float(threshold),
+            'sample_rate': float(config.get('slow_query_capture_sample_rate', DEFAULT_SAMPLE_RATE)),
+            'max_per_job': int(config.get('slow_query_capture_max_per_job', DEFAULT_MAX_PER_JOB)),
+            'capture_dir': config.get('slow_query_capture_dir', config.get('download_dir', None))
+        }
+    return _SETTINGS
+
+
+def set_job(job_id, process_id):
+    # Queries run by this thread from now on belong to this job:
+    _JOB.job_id = job_id
+    _JOB.process_id = process_id
+    _JOB.num_captured = 0
+
+
+def clear_job():
+    _JOB.job_id = None
+
+
+def _current_job():
+    return getattr(_JOB, 'job_id', None)
+
+
+def execute(cursor, query, params=None, stage='query'):
+    # Runs the query, and captures its plan if it was slow. Returns the cursor.
+    start = time.time()
+    cursor.execute(query, params)
+    capture_if_slow(cursor, query, params, time.time() - start, stage)
+    return cursor
+
+
+def capture_if_slow(cursor, query, params, seconds, stage):
+    settings = get_settings()
+    if settings['threshold_seconds'] is None or seconds < settings['threshold_seconds']:
+        return None
+    if _current_job() is None or settings['capture_dir'] is None:
+        return None
+
+    with _STATS_LOCK:
+        _STATS['slow_queries'] += 1
+        if not EXPLAINABLE.match(query):
+            _STATS['skipped_not_explainable'] += 1
+            return None
+        if _JOB.num_captured >= settings['max_per_job']:
+            _STATS['skipped_max_per_job'] += 1
+            return None
+        if random.random() >= settings['sample_rate']:
+            _STATS['skipped_sampling'] += 1
+            return None
+
+    LOGGER.info(f'Slow query ({seconds:.1f} seconds, stage "{stage}", job {_JOB.job_id}), capturing plan...')
+    try:
+        plan = _explain_analyze(cursor.connection, query, params)
+    except Exception as e:
+        with _STATS_LOCK:
+            _STATS['failed'] += 1
+        LOGGER.warning(f'Could not capture plan of slow query (stage "{stage}"): {repr(e)}')
+        return None
+
+    # Only successful captures use up the slots of the job (the job's
+    # queries run in this thread, one after the other):
+    _JOB.num_captured += 1
+    path = _store(plan, query, params, seconds, stage, _JOB.num_captured, settings['capture_dir'])
+    with _STATS_LOCK:
+        _STATS['captured'] += 1
+    LOGGER.info(f'Slow query ({seconds:.1f} seconds, stage "{stage}", job {_JOB.job_id}), plan stored: {path}')
+    return path
+
+
+def _explain_analyze(conn, query, params):
+    # Runs the query again (in a savepoint that is rolled back), returns
+    # the plan. A new cursor, so the rows of the original one stay intact.
+    cursor = conn.cursor()
+    in_transaction = not getattr(conn, 'autocommit', False)
+    if not in_transaction and not re.match(r'\s*(SELECT|WITH)\b', query, re.IGNORECASE):
+        raise ValueError('Not re-running a writing query outside of a transaction.')
+    if in_transaction:
+        cursor.execute(f'SAVEPOINT {SAVEPOINT_NAME}')
+    try:
+        cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}', params)
+        plan = cursor.fetchone()[0]
+    finally:
+        if in_transaction:
+            cursor.execute(f'ROLLBACK TO SAVEPOINT {SAVEPOINT_NAME}')
+            cursor.execute(f'RELEASE SAVEPOINT {SAVEPOINT_NAME}')
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan
+
+
+def _store(plan, query, params, seconds, stage, num, capture_dir):
+    stage_slug = re.sub(r'[^A-Za-z0-9]+', '_', stage).strip('_') or 'query'
+    filename = f'queryplan-{_JOB.process_id}-{_JOB.job_id}-{stage_slug}-{num}.json'
+    path = os.path.join(capture_dir, filename)
+    captured = {
+        "job_id": _JOB.job_id,
+        "process_id": _JOB.process_id,
+        "stage": stage,
+        "seconds": round(seconds, 3),
+        "captured_at": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "query": query,
+        "params": params,
+        "plan": plan
+    }
+    with open(path, 'w') as plan_file:
+        # Parameters may be arrays, NumPy numbers etc.:
+        json.dump(captured, plan_file, indent=1, default=str)
+    return path
+
+
+def get_stats():
+    with _STATS_LOCK:
+        return dict(_STATS)
+
+
+def log_stats():
+    stats = get_stats()
+    LOGGER.info(f'Slow queries: {stats["slow_queries"]}, plans captured: {stats["captured"]}'
+        f' (skipped: {stats["skipped_sampling"]} sampling, {stats["skipped_max_per_job"]} per-job limit,'
+        f' {stats["skipped_not_explainable"]} not explainable;'
+        f' failed: {stats["failed"]}).')
+    return stats
+
+
+if __name__ == "__main__":
+
+    # Captures the plan of a deliberately slow query, against a real
+    # database (connection details from ./config.json), e.g.:
+    # python aqua90m/geofresh/query_capture.py
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    from database_connection import get_connection_object_config
+    with open("./config.json", 'r') as config_file:
+        config = json.load(config_file)
+    conn = get_connection_object_config(config)
+
+    _SETTINGS = {'threshold_seconds': 0.1, 'sample_rate': 1.0, 'max_per_job': 5, 'capture_dir': '/tmp'}
+    set_job('test-job', 'query-capture-demo')
+    cursor = execute(conn.cursor(), 'SELECT pg_sleep(%s), count(*) FROM hydro.basins WHERE reg_id = %s', [0.2, 58], 'demo')
+    print(cursor.fetchone())
+    clear_job()
+    log_stats()
+    conn.close()
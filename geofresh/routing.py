@@ -4,7 +4,26 @@ logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
 LOGGER = logging.getLogger(__name__)
 
-import pandas as pd
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+    import aqua90m.geofresh.contracted_graph as contracted_graph
+    import aqua90m.geofresh.path_trie as path_trie
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+        import pygeoapi.process.aqua90m.geofresh.contracted_graph as contracted_graph
+        import pygeoapi.process.aqua90m.geofresh.path_trie as path_trie
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+pd = lazy_import('pandas')
 
 
 '''
@@ -15,6 +34,15 @@ resulting into one path, or many point to many points resulting
 in a matrix of paths), or are interested in different outcomes
 (e.g. the length of the segments, or the segment ids).
 
+Exception: The one-to-one route is not computed by pgr_dijkstra, but by
+walking the cached, chain-contracted stream network of the basin (see
+contracted_graph), which returns the same path. The pgr_dijkstra version
+is still there (get_dijkstra_ids_one_to_one_pgrouting).
+
+The plural results (path matrix, paths to outlet) can also be returned in
+a compact encoding, where every segment is listed once (see path_trie),
+instead of listing every path in full (path_encoding='trie').
+
 Many of these could be run with the same query on the database,
 but to optimize for efficiency, each time, we will only request
 those fields that we actually need.
@@ -36,12 +64,40 @@ RETURNS SET OF (seq, path_seq, node, edge, cost, agg_cost)
 #    get_shortest_path_between_points.py
 #    get_shortest_path_to_outlet.py
 def get_dijkstra_ids_one_to_one(conn, start_subc_id, end_subc_id, reg_id, basin_id, silent=False):
-    # INPUT:  subc_ids (start and end)
+    # INPUT:  subc_ids (start and end, or the outlet, -basin_id)
     # OUTPUT: subc_ids (the entire path, incl. start and end, as a list)
+    # Same path as pgr_dijkstra, but from the cached contracted graph, see
+    # contracted_graph. No path: Only the start.
 
     if not silent:
         LOGGER.debug(f'Compute route between subc_id {start_subc_id} and {end_subc_id} (in basin {basin_id}, region {reg_id})')
 
+    contracted = contracted_graph.get_contracted_graph(conn, basin_id, reg_id)
+    all_ids = _path_incl_start(contracted, start_subc_id, end_subc_id)
+    if all_ids is None:
+        LOGGER.debug(f'No route between subc_id {start_subc_id} and {end_subc_id} (in basin {basin_id}).')
+        return [start_subc_id]
+    return all_ids
+
+
+def _path_incl_start(contracted, start_subc_id, end_subc_id):
+    # The path as pgr_dijkstra returns it (edges), plus the start segment,
+    # unless the path starts with it anyway. None if there is no path.
+    segment_ids = contracted.path_ids(start_subc_id, end_subc_id)
+    if segment_ids is None:
+        return None
+    if len(segment_ids) > 0 and segment_ids[0] == start_subc_id:
+        return segment_ids
+    return [start_subc_id] + segment_ids
+
+
+def get_dijkstra_ids_one_to_one_pgrouting(conn, start_subc_id, end_subc_id, reg_id, basin_id, silent=False):
+    # INPUT:  subc_ids (start and end)
+    # OUTPUT: subc_ids (the entire path, incl. start and end, as a list)
+
+    if not silent:
+        LOGGER.debug(f'Compute route between subc_id {start_subc_id} and {end_subc_id} (in basin {basin_id}, region {reg_id}, pgr_dijkstra)')
+
     ## Construct SQL query:
     ## Inner SELECT: Returns what the pgr_dijkstra needs: (id, source, target, cost).
     ## We run pgr_routing as one-to-one here.
@@ -89,28 +145,115 @@ def get_dijkstra_ids_one_to_one(conn, start_subc_id, end_subc_id, reg_id, basin_
     return all_ids
 
 
+# Called by plural process (pairs mode):
+#    get_shortest_path_between_points_plural.py
+def get_dijkstra_ids_pairs(conn, pairs_df, result_format):
+    # We don't want a matrix, we want one path per pair of points (origin ->
+    # destination), for many pairs, possibly in many basins.
+    # INPUT:  Dataframe with one row per pair: pair_id, subc_id_start,
+    #         basin_id_start, reg_id_start, subc_id_end, basin_id_end, reg_id_end
+    # OUTPUT: JSON or dataframe, with one item/row per pair, in input order.
+    # Pairs that cannot be routed (points not on the stream network, or start
+    # and end in different basins) are flagged in "status", instead of failing.
+
+    if not result_format in ['json', 'dataframe', 'csv']:
+        raise ValueError(f'Unknown result format: {result_format}')
+
+    # Group the pairs by region and basin, so each basin's network is only
+    # loaded once (see contracted_graph):
+    results = [None] * pairs_df.shape[0]
+    pairs_by_basin = {}
+    for i, row in enumerate(pairs_df.itertuples(index=False)):
+        if any(pd.isna(value) for value in [row.subc_id_start, row.basin_id_start, row.reg_id_start,
+                                            row.subc_id_end, row.basin_id_end, row.reg_id_end]):
+            results[i] = _pair_result(row, None, None, None, 'not_found',
+                'Start or end is not on the stream network.')
+        elif not (row.reg_id_start == row.reg_id_end and row.basin_id_start == row.basin_id_end):
+            results[i] = _pair_result(row, None, None, None, 'different_basins',
+                f'Start is in basin {row.basin_id_start} (region {row.reg_id_start}), '
+                f'end in basin {row.basin_id_end} (region {row.reg_id_end}).')
+        else:
+            key = (int(row.reg_id_start), int(row.basin_id_start))
+            pairs_by_basin.setdefault(key, []).append(i)
+
+    # Route all pairs of a basin on the same graph:
+    for (reg_id, basin_id), indices in pairs_by_basin.items():
+        LOGGER.debug(f'Basin: {basin_id} (in regional unit {reg_id}): Routing {len(indices)} pairs')
+        contracted = contracted_graph.get_contracted_graph(conn, basin_id, reg_id)
+        for i in indices:
+            row = pairs_df.iloc[i]
+            segment_ids = _path_incl_start(contracted, int(row['subc_id_start']), int(row['subc_id_end']))
+            if segment_ids is None:
+                results[i] = _pair_result(row, reg_id, basin_id, None, 'no_path',
+                    'No path between start and end.')
+            else:
+                results[i] = _pair_result(row, reg_id, basin_id, segment_ids, 'ok')
+
+    num_routed = sum(1 for result in results if result['status'] == 'ok')
+    LOGGER.info(f'Routed {num_routed} of {len(results)} pairs, in {len(pairs_by_basin)} basins.')
+
+    # Return result (can be both dataframe or JSON list)
+    if result_format == 'dataframe' or result_format == 'csv':
+        # Output CSV: We need to make one string out of the segment ids!
+        for result in results:
+            segment_ids = result.pop('segment_ids')
+            result['segment_ids'] = None if segment_ids is None else '+'.join(map(str, segment_ids))
+        return pd.DataFrame(results,
+            columns=['pair_id', 'subc_id_start', 'subc_id_end', 'reg_id', 'basin_id',
+                     'status', 'note', 'num_segments', 'segment_ids']
+        ).astype({
+            'subc_id_start': 'Int64', # nullable int
+            'subc_id_end':   'Int64', # nullable int
+            'reg_id':        'Int64', # nullable int
+            'basin_id':      'Int64', # nullable int
+            'num_segments':  'Int64', # nullable int
+            'segment_ids':   'string'
+        })
+
+    return {
+        "num_pairs": len(results),
+        "num_routed": num_routed,
+        "pairs": results
+    }
+
+
+def _pair_result(row, reg_id, basin_id, segment_ids, status, note=None):
+    # One item of the pairs result (row can be a namedtuple or a Series):
+    def _int_or_none(value):
+        return None if pd.isna(value) else int(value)
+    pair_id = getattr(row, 'pair_id')
+    return {
+        "pair_id": None if pd.isna(pair_id) else pair_id,
+        "subc_id_start": _int_or_none(getattr(row, 'subc_id_start')),
+        "subc_id_end": _int_or_none(getattr(row, 'subc_id_end')),
+        "reg_id": reg_id,
+        "basin_id": basin_id,
+        "status": status,
+        "note": note,
+        "num_segments": None if segment_ids is None else len(segment_ids),
+        "segment_ids": segment_ids
+    }
+
+
 # Called by plural process:
 #    get_shortest_path_to_outlet_plural.py
-def get_dijkstra_ids_to_outlet_plural(conn, input_df_or_fcoll, colname_site_id, result_format):
+def get_dijkstra_ids_to_outlet_plural(conn, input_df_or_fcoll, colname_site_id, result_format, path_encoding='dense'):
     # We don't want a matrix, we want one path per pair of points - but for many!
     # INPUT:  Dataframe or GeoJSON FeatureCollection
     # OUTPUT: JSON or CSV (but ugly CSV... as we have to store entire paths in one column.)
+    #         With path_encoding 'trie': Compact JSON, see path_trie.
 
     if not result_format in ['json', 'dataframe', 'csv']:
         raise ValueError(f'Unknown result format: {result_format}')
+    _check_path_encoding(path_encoding, result_format)
 
     # Get departing points from inputs (can be both dataframe or GeoJSON feature collection)
-    if isinstance(input_df_or_fcoll, pd.DataFrame):
-        departing_points = _collect_departing_points_by_region_and_basin_from_dataframe(input_df_or_fcoll, colname_site_id)
-    elif isinstance(input_df_or_fcoll, dict):
-        departing_points = _collect_departing_points_by_region_and_basin_from_fcoll(input_df_or_fcoll, colname_site_id)
-    else:
-        err_msg = "Need a dataframe or a FeatureCollection as input."
-        LOGGER.error(err_msg)
-        raise ValueError(err_msg)
+    departing_points = collect_departing_points_by_region_and_basin(input_df_or_fcoll, colname_site_id)
 
     # Return result (can be both dataframe or ugly JSON matrix)
-    if result_format == 'dataframe' or result_format == 'csv':
+    if path_encoding == 'trie':
+        return _iterate_outlets_to_trie(conn, departing_points)
+    elif result_format == 'dataframe' or result_format == 'csv':
         return _iterate_outlets_to_dataframe(conn, departing_points)
     elif result_format == 'json':
         return _iterate_outlets_to_json(conn, departing_points)
@@ -120,6 +263,20 @@ def get_dijkstra_ids_to_outlet_plural(conn, input_df_or_fcoll, colname_site_id,
         raise ValueError(err_msg)
 
 
+def collect_departing_points_by_region_and_basin(input_df_or_fcoll, colname_site_id):
+    # Groups the points by region and basin: reg_id -> basin_id -> subc_id -> set
+    # of site_ids. Points without subc_id (e.g. in the ocean) are collected under
+    # None -> None -> None. Also used for the upstream catchments (plural).
+    if isinstance(input_df_or_fcoll, pd.DataFrame):
+        return _collect_departing_points_by_region_and_basin_from_dataframe(input_df_or_fcoll, colname_site_id)
+    elif isinstance(input_df_or_fcoll, dict):
+        return _collect_departing_points_by_region_and_basin_from_fcoll(input_df_or_fcoll, colname_site_id)
+    else:
+        err_msg = "Need a dataframe or a FeatureCollection as input."
+        LOGGER.error(err_msg)
+        raise ValueError(err_msg)
+
+
 def _collect_departing_points_by_region_and_basin_from_dataframe(input_df, colname_site_id):
 
     # First, collect all departing points by iterating over an input dataframe.
@@ -357,6 +514,62 @@ def _iterate_outlets_to_json(conn, departing_points):
     return everything
 
 
+def _iterate_outlets_to_trie(conn, departing_points):
+    # Like _iterate_outlets_to_json, but every segment is listed only once,
+    # in one parent table for all basins, and each path refers to its start
+    # node in that table (the path goes downstream from there to the outlet).
+    trie = path_trie.PathTrie()
+    everything = {}
+
+    for reg_id, all_basins in departing_points.items():
+
+        # Add empty item for ocean case:
+        if reg_id is None:
+            all_site_ids = all_basins[None][None]
+            LOGGER.debug(f'Compute paths to outlet for these sites not possible: {all_site_ids}')
+            everything[None] = {
+                "subc_id": None,
+                "basin_id": None,
+                "outlet_id": None,
+                "reg_id": None,
+                "start_node": None,
+                "end_node": None,
+                "lca_node": None,
+                "site_ids": list(all_site_ids)
+            }
+            continue
+
+        # For each basin, all paths on the same (cached) graph:
+        reg_id = int(reg_id)
+        for basin_id, all_subcids in all_basins.items():
+            LOGGER.debug(f'Basin: {basin_id} (in regional unit {reg_id})')
+            basin_id = int(basin_id)
+            outlet_id = -basin_id
+            start_ids = [int(start_id) for start_id in all_subcids.keys()]
+            contracted = contracted_graph.get_contracted_graph(conn, basin_id, reg_id)
+            refs = trie.add_routes(contracted, [(start_id, outlet_id) for start_id in start_ids])
+            for start_id, site_ids, ref in zip(start_ids, all_subcids.values(), refs):
+                everything[start_id] = {
+                    "subc_id": start_id,
+                    "basin_id": basin_id,
+                    "outlet_id": outlet_id,
+                    "reg_id": reg_id,
+                    **ref,
+                    "site_ids": list(site_ids)
+                }
+
+    result = trie.to_json()
+    result['paths'] = everything
+    return result
+
+
+def _check_path_encoding(path_encoding, result_format):
+    if not path_encoding in ['dense', 'trie']:
+        raise ValueError(f"Unknown path encoding: '{path_encoding}'. Expected 'dense' or 'trie'.")
+    if path_encoding == 'trie' and not result_format == 'json':
+        raise ValueError(f"Path encoding 'trie' is only available as JSON, not as '{result_format}'.")
+
+
 # Only called inside this module, by: get_dijkstra_ids_to_outlet_plural
 def get_dijkstra_ids_one_to_many(conn, start_subc_ids, end_subc_id, reg_id, basin_id):
     # INPUT:  Set of subc_ids (in one basin)
@@ -433,9 +646,10 @@ def get_dijkstra_ids_one_to_many(conn, start_subc_ids, end_subc_id, reg_id, basi
 
 # Called by plural process:
 #    get_shortest_path_between_points_plural.py
-def get_dijkstra_ids_many_to_many(conn, subc_ids_start, subc_ids_end, reg_id, basin_id, result_format):
+def get_dijkstra_ids_many_to_many(conn, subc_ids_start, subc_ids_end, reg_id, basin_id, result_format, path_encoding='dense'):
     # INPUT:  Sets of subc_ids (have to be inside one basin!)
     # OUTPUT: Route matrix (as JSON)
+    #         With path_encoding 'trie': Compact JSON, see path_trie.
     #
     # Note: All subc_ids have to be in one basin, because basins are disconnected,
     # there are no routes between basins. We would have to return one matrix per
@@ -443,10 +657,14 @@ def get_dijkstra_ids_many_to_many(conn, subc_ids_start, subc_ids_end, reg_id, ba
 
     if not result_format in ['json', 'dataframe', 'csv']:
         raise ValueError(f'Unknown result format: {result_format}')
+    _check_path_encoding(path_encoding, result_format)
 
     subc_ids_start = set(subc_ids_start)
     subc_ids_end = set(subc_ids_end)
 
+    if path_encoding == 'trie':
+        return _many_to_many_trie(conn, subc_ids_start, subc_ids_end, reg_id, basin_id)
+
     LOGGER.debug(f'Compute path matrix between {len(subc_ids_start | subc_ids_end)} subc_ids (in basin {basin_id}, region {reg_id})')
     # TODO What happens if they are not in one basin? Anyway, it has to
     # be checked before calling this method.
@@ -507,43 +725,58 @@ def get_dijkstra_ids_many_to_many(conn, subc_ids_start, subc_ids_end, reg_id, ba
         raise ValueError(err_msg)
 
 
+def _many_to_many_trie(conn, subc_ids_start, subc_ids_end, reg_id, basin_id):
+    # All start x end paths, on the cached graph of the basin, as path trie:
+    # One item per pair, referring to start, end and lowest common ancestor
+    # in the parent table (see path_trie).
+    start_ids = list(dict.fromkeys(int(start_id) for start_id in subc_ids_start))
+    end_ids   = list(dict.fromkeys(int(end_id) for end_id in subc_ids_end))
+    LOGGER.debug(f'Compute path trie between {len(start_ids)} x {len(end_ids)} subc_ids (in basin {basin_id}, region {reg_id})')
+    routes = [(start_id, end_id) for start_id in start_ids for end_id in end_ids]
+
+    contracted = contracted_graph.get_contracted_graph(conn, basin_id, reg_id)
+    trie = path_trie.PathTrie()
+    refs = trie.add_routes(contracted, routes)
+
+    result = trie.to_json()
+    result['basin_id'] = int(basin_id)
+    result['reg_id'] = int(reg_id)
+    result['pairs'] = [{"start": start_id, "end": end_id, **ref} for (start_id, end_id), ref in zip(routes, refs)]
+    return result
+
+
 def _result_to_matrix(cursor, subc_ids_start, subc_ids_end):
 
     ## Construct result matrix:
     # TODO: JSON may not be the ideal type for returning a matrix!
-    # Note: Keys have to strings, otherwise pygeoapi will cause an
-    # error later on when serializing the results:
-    # numpy.core._exceptions._UFuncNoLoopError: ufunc 'greater' did not contain a loop with signature matching types
-    # Note: Values have to be native python integers, not numpy integers, otherwise
-    # pygeoapi will cause an error later on when serializing the results:
-    # Object of type int64 is not JSON serializable
+    # Note: Keys are strings, as pygeoapi sorts the keys when serializing
+    # the results, and we may add a (string) "comment" key at the top level.
+    # The paths are collected in lists per (start, end) tuple of Python
+    # integers, and the nested dict refers to the same lists, so the ids
+    # are converted only once each, not for every path or every edge.
+    # NumPy integers in the result are fine, see utils/fast_json.py.
+    start_ids = list(dict.fromkeys(int(start_id) for start_id in subc_ids_start))
+    end_ids   = list(dict.fromkeys(int(end_id) for end_id in subc_ids_end))
+    end_keys  = [str(end_id) for end_id in end_ids]
+    paths = {}
     result_matrix = {}
-    for start_id in subc_ids_start:
-        result_matrix[str(start_id)] = {}
-        for end_id in subc_ids_end:
-            result_matrix[str(start_id)][str(end_id)] = [int(start_id)] # TODO: check: Have to add start id?
+    for start_id in start_ids:
+        result_matrix[str(start_id)] = matrix_row = {}
+        for end_id, end_key in zip(end_ids, end_keys):
+            paths[(start_id, end_id)] = matrix_row[end_key] = [start_id] # TODO: check: Have to add start id?
 
     ## Iterating over the result rows:
-    LOGGER.log(logging.TRACE, f"Result matrix to be filled: {result_matrix}")
+    # Each path is defined by start and end, and consists of many edges/stream segments.
+    # An edge of -1 marks the end of a path.
     LOGGER.log(logging.TRACE, "Iterating over results...")
-    while True:
-        row = cursor.fetchone()
-        if row is None: break
-        
-        # Collect all the ids along the paths:
-        # Each path is defined by start and end, and consists of many edges/stream segments.
-        start_id  = str(row[0]) # start
-        end_id    = str(row[1]) # end
-        this_id   = int(row[2]) # current edge/stream segment as integer
-        if this_id == -1:
-            pass
-        else:
-            # Add this subc_id (integer) to the matrix
-            # (to the list of stream segments for this start-end-combination).
-            result_matrix[start_id][end_id].append(this_id)
-            LOGGER.log(logging.TRACE, 'Start {start_id} to end {end_id}, add this id {this_id}')
-
-    LOGGER.log(logging.TRACE, "Iterating over results... DONE.")
+    num_rows = 0
+    for start_id, end_id, this_id in cursor:
+        num_rows += 1
+        if this_id != -1:
+            # Add this subc_id to the list of stream segments for this start-end-combination:
+            paths[(start_id, end_id)].append(this_id)
+
+    LOGGER.log(logging.TRACE, f"Iterating over results... DONE ({num_rows} rows).")
     #LOGGER.log(logging.TRACE, f"JSON result: {result_matrix}") # quite big!
 
     return result_matrix
@@ -555,40 +788,15 @@ def _matrix_to_dataframe(result_matrix, subc_ids_start, subc_ids_end):
     #   Basically a matrix, as dataframe/table/csv:
     #   Column names will be the end subc_ids (first column contains the end subc_ids)
     #   Row names will be the start subc_ids (first row contains the start subc_ids)
+    #   Each cell contains the path, as subc_ids joined by "+".
+    start_keys = [str(start_id) for start_id in dict.fromkeys(int(start_id) for start_id in subc_ids_start)]
+    end_keys   = [str(end_id) for end_id in dict.fromkeys(int(end_id) for end_id in subc_ids_end)]
     all_rows = []
+    for start_key in start_keys:
+        matrix_row = result_matrix[start_key]
+        all_rows.append([start_key] + ['+'.join(map(str, matrix_row[end_key])) for end_key in end_keys])
 
-    # Define column names for dataframe: end ids
-    # First column contains the subcids
-    colnames = ["subc_ids"]
-    for end_id in subc_ids_end:
-        colnames.append(str(end_id))
-
-    # Fill all dataframe rows with distances
-    for start_id in subc_ids_start:
-
-        # Get the row of the matrix with the paths from start id to all end ids:
-        start_id = str(start_id)
-        matrix_row = result_matrix[start_id]
-        LOGGER.debug(f'Matrix row for {start_id}: {matrix_row}')
-
-        # First item in the dataframe row is the start id:
-        row_dataframe = [start_id]
-
-        # Now fill with the distances:
-        for end_id in colnames:
-
-            # First colname is not an end id, but the title for the first column...
-            if end_id == 'subc_ids':
-                continue
-
-            # Retrieve the distance and add to row:
-            path_list = matrix_row[str(end_id)]
-            path_list_str = '+'.join(map(str, path_list))
-            row_dataframe.append(path_list_str)
-
-        all_rows.append(row_dataframe)
-
-    output_df = pd.DataFrame(all_rows, columns=colnames)
+    output_df = pd.DataFrame(all_rows, columns=["subc_ids"] + end_keys)
     return output_df
 
 
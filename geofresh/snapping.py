@@ -1,8 +1,6 @@
 import json
 import uuid
 import time
-import geomet.wkt
-import pandas as pd
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -12,15 +10,23 @@ try:
     # If the package is installed in local python PATH:
     import aqua90m.utils.geojson_helpers as geojson_helpers
     import aqua90m.utils.exceptions as exc
+    import aqua90m.utils.point_table as point_table
     import aqua90m.geofresh.temp_table_for_queries as temp_table_for_queries
+    import aqua90m.geofresh.partition_pruning as partition_pruning
     from aqua90m.geofresh.temp_table_for_queries import log_query_time as log_query_time
+    import aqua90m.utils.geometry_decoding as geometry_decoding
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
         import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.utils.point_table as point_table
         import pygeoapi.process.aqua90m.geofresh.temp_table_for_queries as temp_table_for_queries
+        import pygeoapi.process.aqua90m.geofresh.partition_pruning as partition_pruning
         from pygeoapi.process.aqua90m.geofresh.temp_table_for_queries import log_query_time as log_query_time
+        import pygeoapi.process.aqua90m.utils.geometry_decoding as geometry_decoding
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -29,6 +35,8 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+pd = lazy_import('pandas')
+
 # TODO: FUTURE: If we ever snap to stream segments outside of the immediate subcatchment,
 # need to adapt some stuff in this process...
 
@@ -74,11 +82,11 @@ def _get_snapped_point_plus(conn, lon, lat, subc_id, basin_id, reg_id, make_feat
     """
     query = f'''
     SELECT
-        ST_AsText(ST_LineInterpolatePoint(
+        ST_AsBinary(ST_LineInterpolatePoint(
             geom,
             ST_LineLocatePoint(geom, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))
         )),
-        ST_AsText(geom),
+        ST_AsBinary(geom),
         strahler
     FROM hydro.stream_segments
     WHERE
@@ -92,7 +100,7 @@ def _get_snapped_point_plus(conn, lon, lat, subc_id, basin_id, reg_id, make_feat
     cursor = conn.cursor()
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'basic snapping (one point)')
+    log_query_time(querystart, 'basic snapping (one point)', cursor, query)
 
     ### Get results and construct GeoJSON:
 
@@ -108,8 +116,7 @@ def _get_snapped_point_plus(conn, lon, lat, subc_id, basin_id, reg_id, make_feat
         # https://datatracker.ietf.org/doc/html/rfc7946#section-3.2
 
     # Assemble GeoJSON to return:
-    snappedpoint_simplegeom = geomet.wkt.loads(row[0])
-    streamsegment_simplegeom = geomet.wkt.loads(row[1])
+    snappedpoint_simplegeom, streamsegment_simplegeom = geometry_decoding.wkb_to_geojson(row[0:2])
     strahler = row[2]
 
     # Extract snapped coordinates:
@@ -205,7 +212,7 @@ def get_snapped_point_feature(conn, lon, lat, subc_id, basin_id, reg_id):
     """
     query = f'''
     SELECT
-        ST_AsText(ST_LineInterpolatePoint(
+        ST_AsBinary(ST_LineInterpolatePoint(
             geom,
             ST_LineLocatePoint(geom, ST_SetSRID(ST_MakePoint({lon}, {lat}),4326))
         )),
@@ -223,7 +230,7 @@ def get_snapped_point_feature(conn, lon, lat, subc_id, basin_id, reg_id):
     cursor = conn.cursor()
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'basic snapping (one point)')
+    log_query_time(querystart, 'basic snapping (one point)', cursor, query)
 
     ### Get results and construct GeoJSON:
 
@@ -239,8 +246,7 @@ def get_snapped_point_feature(conn, lon, lat, subc_id, basin_id, reg_id):
         # https://datatracker.ietf.org/doc/html/rfc7946#section-3.2
 
     # Assemble GeoJSON to return:
-    snappedpoint_simplegeom = geomet.wkt.loads(row[0])
-    #streamsegment_simplegeom = geomet.wkt.loads(row[1])
+    snappedpoint_simplegeom = geometry_decoding.wkb_to_geojson_one(row[0])
     strahler = row[2]
 
     snappedpoint_feature = {
@@ -286,7 +292,7 @@ def get_snapped_point_simplegeom(conn, lon, lat, subc_id, basin_id, reg_id):
     """
     query = f'''
     SELECT
-    ST_AsText(ST_LineInterpolatePoint(
+    ST_AsBinary(ST_LineInterpolatePoint(
         geom,
         ST_LineLocatePoint(geom, ST_SetSRID(ST_MakePoint({lon}, {lat}),4326))
     ))
@@ -302,7 +308,7 @@ def get_snapped_point_simplegeom(conn, lon, lat, subc_id, basin_id, reg_id):
     cursor = conn.cursor()
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'basic snapping')
+    log_query_time(querystart, 'basic snapping', cursor, query)
 
     ### Get results and construct GeoJSON:
 
@@ -318,7 +324,7 @@ def get_snapped_point_simplegeom(conn, lon, lat, subc_id, basin_id, reg_id):
         # https://datatracker.ietf.org/doc/html/rfc7946#section-3.2
 
     # Assemble GeoJSON to return:
-    snappedpoint_simplegeom = geomet.wkt.loads(row[0])
+    snappedpoint_simplegeom = geometry_decoding.wkb_to_geojson_one(row[0])
     return snappedpoint_simplegeom
 
 
@@ -330,15 +336,16 @@ def get_snapped_point_simplegeom(conn, lon, lat, subc_id, basin_id, reg_id):
 def get_snapped_points_json2json(conn, points_geojson, colname_site_id = None):
     # INPUT: GeoJSON (Multipoint)
     # OUTPUT: FeatureCollection (Point)
-    return get_snapped_point_xy(conn, geojson = points_geojson, colname_site_id = colname_site_id, result_format="geojson")
+    points = point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
+    return get_snapped_point_xy(conn, points, colname_site_id = colname_site_id, result_format="geojson")
 
 
 # Just a wrapper
 def get_snapped_points_csv2csv(conn, input_df, colname_lon, colname_lat, colname_site_id):
     # INPUT: Pandas dataframe
     # OUTPUT: Pandas dataframe
-    return get_snapped_point_xy(conn,
-        dataframe = input_df,
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return get_snapped_point_xy(conn, points,
         colname_lon = colname_lon,
         colname_lat = colname_lat,
         colname_site_id = colname_site_id,
@@ -349,8 +356,8 @@ def get_snapped_points_csv2csv(conn, input_df, colname_lon, colname_lat, colname
 def get_snapped_points_csv2json(conn, input_df, colname_lon, colname_lat, colname_site_id):
     # INPUT: Pandas dataframe
     # OUTPUT: FeatureCollection (Point)
-    return get_snapped_point_xy(conn,
-        dataframe = input_df,
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return get_snapped_point_xy(conn, points,
         colname_lon = colname_lon,
         colname_lat = colname_lat,
         colname_site_id = colname_site_id,
@@ -361,28 +368,20 @@ def get_snapped_points_csv2json(conn, input_df, colname_lon, colname_lat, colnam
 def get_snapped_points_json2csv(conn, points_geojson, colname_lon, colname_lat, colname_site_id):
     # INPUT: GeoJSON (Multipoint)
     # OUTPUT: Pandas dataframe
-    return get_snapped_point_xy(conn,
-        geojson = points_geojson,
+    points = point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
+    return get_snapped_point_xy(conn, points,
         colname_site_id = colname_site_id,
         colname_lon = colname_lon,
         colname_lat = colname_lat,
         result_format="csv")
 
 
-def get_snapped_point_xy(conn, geojson=None, dataframe=None, colname_lon=None, colname_lat=None, colname_site_id=None, result_format="geojson"):
+def get_snapped_point_xy(conn, points, colname_lon=None, colname_lat=None, colname_site_id=None, result_format="geojson"):
+    # INPUT: PointTable (see utils/point_table.py), read by the process from
+    # GeoJSON or CSV. The column names are only used for the output.
 
-    if dataframe is not None:
-        LOGGER.debug('Basic snapping plural, based on input dataframe...')
-        list_of_insert_rows = temp_table_for_queries.make_insertion_rows_from_dataframe(
-            dataframe, colname_lon, colname_lat, colname_site_id)
-    elif geojson is not None:
-        LOGGER.debug('Basic snapping plural, based on input GeoJSON...')
-        list_of_insert_rows = temp_table_for_queries.make_insertion_rows_from_geojson(
-            geojson, colname_site_id)
-    else:
-        err_msg = 'Cannot recognize input object!'
-        LOGGER.error(err_msg)
-        raise exc.UserInputException(err_msg)
+    LOGGER.debug(f'Basic snapping plural, {len(points)} points...')
+    list_of_insert_rows = temp_table_for_queries.make_insertion_rows_from_points(points)
 
     # A temporary table is created and populated with the lines above.
     cursor = conn.cursor()
@@ -400,7 +399,6 @@ def get_snapped_point_xy(conn, geojson=None, dataframe=None, colname_lon=None, c
 def _run_snapping_query(cursor, tablename, reg_id_set, result_format, colname_lon, colname_lat, colname_site_id):
     ## This does not write anything into the database:
     LOGGER.debug('Performing the basic snapping on the temp table...')
-    reg_ids_string = ','.join(map(str, reg_id_set))
     query = f'''
     SELECT
         poi.lon,
@@ -409,7 +407,7 @@ def _run_snapping_query(cursor, tablename, reg_id_set, result_format, colname_lo
         poi.basin_id,
         poi.reg_id,
         seg.strahler,
-        ST_AsText(ST_LineInterpolatePoint(
+        ST_AsBinary(ST_LineInterpolatePoint(
             seg.geom,
             ST_LineLocatePoint(seg.geom, poi.geom_user)
         )),
@@ -417,14 +415,15 @@ def _run_snapping_query(cursor, tablename, reg_id_set, result_format, colname_lo
     FROM hydro.stream_segments seg, {tablename} poi
     WHERE
         seg.subc_id = poi.subc_id
-        AND seg.reg_id IN ({reg_ids_string});
+        AND {partition_pruning.predicate(reg_ids=reg_id_set, alias='seg')};
     '''
 
     ### Query database:
     LOGGER.log(logging.TRACE, "SQL query: {query}")
+    partition_pruning.verify(cursor.connection, query, [], 'hydro.stream_segments', len(reg_id_set))
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'basic snapping (many points)')
+    log_query_time(querystart, 'basic snapping (many points)', cursor, query)
 
     return _package_result(cursor, result_format, colname_lon, colname_lat, colname_site_id)
 
@@ -450,10 +449,10 @@ def _package_result_in_geojson(cursor, colname_site_id):
     # Create list to be filled with the GeoJSON Features:
     features = []
 
-    # Iterating over database results:
-    while (True):
-        row = cursor.fetchone()
-        if row is None: break
+    # Iterating over database results (the snapped points are decoded all at once):
+    rows = cursor.fetchall()
+    snappedpoints = geometry_decoding.wkb_to_geojson([row[6] for row in rows])
+    for row, snappedpoint_simplegeom in zip(rows, snappedpoints):
 
         # Extract values from row:
         lon = float(row[0])
@@ -462,12 +461,8 @@ def _package_result_in_geojson(cursor, colname_site_id):
         basin_id = row[3]
         reg_id = row[4]
         strahler = row[5]
-        snappedpoint_wkt = row[6]
         site_id = row[7]
 
-        # Convert to GeoJSON:
-        snappedpoint_simplegeom = geomet.wkt.loads(snappedpoint_wkt)
-
         # Construct Feature, incl. ids, strahler and original lonlat:
         # TODO: SMALL: If all are in same reg_id and basin, we could remove those
         # attributes from here...
@@ -521,10 +516,10 @@ def _package_result_in_dataframe(cursor, colname_lon, colname_lat, colname_site_
         colname_lat+'_original'
     ]
 
-    # Iterating over database results:
-    while (True):
-        row = cursor.fetchone()
-        if row is None: break
+    # Iterating over database results (the snapped points are decoded all at once):
+    rows = cursor.fetchall()
+    snappedpoints = geometry_decoding.wkb_to_geojson([row[6] for row in rows])
+    for row, snappedpoint_simplegeom in zip(rows, snappedpoints):
 
         # Extract values from row:
         lon = float(row[0])
@@ -533,31 +528,22 @@ def _package_result_in_dataframe(cursor, colname_lon, colname_lat, colname_site_
         basin_id = row[3]
         reg_id = row[4]
         strahler = row[5]
-        snappedpoint_wkt = row[6]
         site_id = row[7]
 
         # Catch geometry problems, e.g. stream segment is NULL, then snapping will return None:
         # This happened for point  23.12695,37.8368 (subc_id 561594812, basin 1271669, region 66)
-        if snappedpoint_wkt is None:
+        if snappedpoint_simplegeom is None:
             err_msg = f"Point could not be snapped: lon lat = {lon}, {lat} ({colname_site_id} {site_id}, subcatchment {subc_id} in basin {basin_id}, region {reg_id})."
             LOGGER.error(err_msg)
             #raise ValueError(err_msg)
+            lon_snapped = None
+            lat_snapped = None
 
-        # Convert to GeoJSON:
-        try:
-            snappedpoint_simplegeom = geomet.wkt.loads(snappedpoint_wkt)
+        else:
             # Extract snapped coordinates:
             lon_snapped = snappedpoint_simplegeom['coordinates'][0]
             lat_snapped = snappedpoint_simplegeom['coordinates'][1]
 
-        except StopIteration as e:
-            err_msg = f"Failed to load geometry: {snappedpoint_wkt} (in row: {row})"
-            LOGGER.error(f"{type(e).__name__}: {err_msg}")
-            LOGGER.error(f"Error details: {type(e).__name__}: {e.args}")
-            #raise ValueError(err_msg)
-            lon_snapped = None
-            lat_snapped = None
-
 
         # Append the line to dataframe:
         everything.append([site_id, subc_id, basin_id, reg_id, strahler, lon_snapped, lon, lat_snapped, lat])
@@ -1,8 +1,6 @@
 import json
 import uuid
 import time
-import geomet.wkt
-import pandas as pd
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -12,15 +10,23 @@ try:
     # If the package is installed in local python PATH:
     import aqua90m.utils.geojson_helpers as geojson_helpers
     import aqua90m.utils.exceptions as exc
+    import aqua90m.utils.point_table as point_table
     import aqua90m.geofresh.temp_table_for_queries as temp_table_for_queries
+    import aqua90m.geofresh.partition_pruning as partition_pruning
     from aqua90m.geofresh.temp_table_for_queries import log_query_time as log_query_time
+    import aqua90m.utils.geometry_decoding as geometry_decoding
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
         import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.utils.point_table as point_table
         import pygeoapi.process.aqua90m.geofresh.temp_table_for_queries as temp_table_for_queries
+        import pygeoapi.process.aqua90m.geofresh.partition_pruning as partition_pruning
         from pygeoapi.process.aqua90m.geofresh.temp_table_for_queries import log_query_time as log_query_time
+        import pygeoapi.process.aqua90m.utils.geometry_decoding as geometry_decoding
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -29,6 +35,8 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+pd = lazy_import('pandas')
+
 ###########################
 ### One point at a time ###
 ###########################
@@ -106,11 +114,11 @@ def _get_snapped_point_plus(conn, lon, lat, strahler, basin_id, reg_id, make_fea
     buffer_size_in_degrees = 5
     query = f'''
     SELECT 
-        ST_AsText(ST_LineInterpolatePoint(
+        ST_AsBinary(ST_LineInterpolatePoint(
             closest.geog::geometry,
             ST_LineLocatePoint(closest.geog::geometry, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))
         )),
-        ST_AsText(closest.geog),
+        ST_AsBinary(closest.geog),
         closest.strahler,
         closest.subc_id
     FROM (
@@ -139,7 +147,7 @@ def _get_snapped_point_plus(conn, lon, lat, strahler, basin_id, reg_id, make_fea
     cursor = conn.cursor()
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'snapping-strahler-plus for one point')
+    log_query_time(querystart, 'snapping-strahler-plus for one point', cursor, query)
 
     ### Get results and construct GeoJSON:
 
@@ -156,8 +164,7 @@ def _get_snapped_point_plus(conn, lon, lat, strahler, basin_id, reg_id, make_fea
 
     LOGGER.debug("ROW: %s" % str(row))
     # Assemble GeoJSON to return:
-    snappedpoint_simplegeom = geomet.wkt.loads(row[0])
-    streamsegment_simplegeom = geomet.wkt.loads(row[1])
+    snappedpoint_simplegeom, streamsegment_simplegeom = geometry_decoding.wkb_to_geojson(row[0:2])
     strahler = row[2]
     subc_id = row[3]
 
@@ -244,15 +251,16 @@ def _get_snapped_point_plus(conn, lon, lat, strahler, basin_id, reg_id, make_fea
 def get_snapped_points_json2json(conn, points_geojson, min_strahler, colname_site_id=None, add_distance=None):
     # INPUT: GeoJSON (Multipoint)
     # OUTPUT: FeatureCollection (Point)
-    return get_snapped_points_xy(conn, geojson = points_geojson, min_strahler = min_strahler, colname_site_id = colname_site_id, result_format="geojson", add_distance=add_distance)
+    points = point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
+    return get_snapped_points_xy(conn, points, min_strahler = min_strahler, colname_site_id = colname_site_id, result_format="geojson", add_distance=add_distance)
 
 
 # Just a wrapper!
 def get_snapped_points_csv2csv(conn, input_df, min_strahler, colname_lon, colname_lat, colname_site_id, add_distance=None):
     # INPUT: Pandas dataframe
     # OUTPUT: Pandas dataframe
-    return get_snapped_points_xy(conn,
-        dataframe = input_df,
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return get_snapped_points_xy(conn, points,
         colname_lon = colname_lon,
         colname_lat = colname_lat,
         colname_site_id = colname_site_id,
@@ -265,8 +273,8 @@ def get_snapped_points_csv2csv(conn, input_df, min_strahler, colname_lon, colnam
 def get_snapped_points_csv2json(conn, input_df, min_strahler, colname_lon, colname_lat, colname_site_id, add_distance=None):
     # INPUT: Pandas dataframe
     # OUTPUT: FeatureCollection (Point)
-    return get_snapped_points_xy(conn,
-        dataframe = input_df,
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return get_snapped_points_xy(conn, points,
         colname_lon = colname_lon,
         colname_lat = colname_lat,
         colname_site_id = colname_site_id,
@@ -279,8 +287,8 @@ def get_snapped_points_csv2json(conn, input_df, min_strahler, colname_lon, colna
 def get_snapped_points_json2csv(conn, points_geojson, min_strahler, colname_lon, colname_lat, colname_site_id, add_distance=None):
     # INPUT: GeoJSON (Multipoint)
     # OUTPUT: Pandas dataframe
-    return get_snapped_points_xy(conn,
-        geojson = points_geojson,
+    points = point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
+    return get_snapped_points_xy(conn, points,
         colname_site_id = colname_site_id,
         colname_lon = colname_lon,
         colname_lat = colname_lat,
@@ -294,7 +302,9 @@ def get_snapped_points_json2csv(conn, points_geojson, min_strahler, colname_lon,
 ### Functions that do the work ###
 ##################################
 
-def get_snapped_points_xy(conn, geojson=None, dataframe=None, colname_lon=None, colname_lat=None, colname_site_id=None, min_strahler=1, add_distance=True, result_format="geojson"):
+def get_snapped_points_xy(conn, points, colname_lon=None, colname_lat=None, colname_site_id=None, min_strahler=1, add_distance=True, result_format="geojson"):
+    # INPUT: PointTable (see utils/point_table.py), read by the process from
+    # GeoJSON or CSV. The column names are only used for the output.
 
     if min_strahler is None:
         raise ValueError('Must provide min_strahler')
@@ -302,20 +312,10 @@ def get_snapped_points_xy(conn, geojson=None, dataframe=None, colname_lon=None,
         raise ValueError('Must provide add_distance')
     LOGGER.debug(f'Snapping to min strahler order: "{min_strahler}".')
 
-    # The input passed by the user is converted to SQL rows
-    # that can be inserted into a temporary table:
-    if dataframe is not None:
-        LOGGER.debug('Strahler-snapping plural, based on input dataframe...')
-        list_of_insert_rows = temp_table_for_queries.make_insertion_rows_from_dataframe(
-            dataframe, colname_lon, colname_lat, colname_site_id)
-    elif geojson is not None:
-        LOGGER.debug('Strahler-snapping plural, based on input GeoJSON...')
-        list_of_insert_rows = temp_table_for_queries.make_insertion_rows_from_geojson(
-            geojson, colname_site_id)
-    else:
-        err_msg = 'Cannot recognize input object!'
-        LOGGER.error(err_msg)
-        raise exc.UserInputException(err_msg)
+    # The points are converted to SQL rows that can be inserted into a
+    # temporary table:
+    LOGGER.debug(f'Strahler-snapping plural, {len(points)} points...')
+    list_of_insert_rows = temp_table_for_queries.make_insertion_rows_from_points(points)
 
     # A temporary table is created and populated with the lines above.
     cursor = conn.cursor()
@@ -399,7 +399,7 @@ def _add_nearest_neighours_to_temptable(cursor, tablename, min_strahler):
     LOGGER.log(logging.TRACE, "SQL query: {query}")
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'finding neighbouring regions using buffer...')
+    log_query_time(querystart, 'finding neighbouring regions using buffer...', cursor, query)
     LOGGER.debug(f'First, finding neighbouring regions to restrict nearest neighbour search (temp table "{tablename}")... done.')
 
     # Use the result for next query:
@@ -419,7 +419,7 @@ def _add_nearest_neighours_to_temptable(cursor, tablename, min_strahler):
         SELECT seg.geog, seg.strahler, seg.subc_id
         FROM stream_segments seg
         WHERE seg.strahler >= {min_strahler}
-        AND reg_id = ANY (ARRAY[{reg_ids_string}])
+        AND {partition_pruning.predicate(reg_ids=reg_ids, alias='seg')}
         ORDER BY seg.geog <-> temp2.geom_user::geography
         LIMIT 1
     ) AS closest
@@ -429,9 +429,10 @@ def _add_nearest_neighours_to_temptable(cursor, tablename, min_strahler):
     # Query database:
     LOGGER.debug(f'Second, sorting segments by distance and adding closest to temporary table "{tablename}"...')
     LOGGER.log(logging.TRACE, "SQL query: {query}")
+    partition_pruning.verify(cursor.connection, query, [], 'hydro.stream_segments', len(reg_ids))
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'adding nearest neighbours')
+    log_query_time(querystart, 'adding nearest neighbours', cursor, query)
     LOGGER.debug(f'Second, sorting segments by distance and adding closest to temporary table "{tablename}"... done.')
     LOGGER.debug(f'Adding nearest neighbours to temporary table "{tablename}"... done.')
 
@@ -460,7 +461,7 @@ def _snapping_with_distances(cursor, tablename, result_format, colname_lon, coln
     LOGGER.log(logging.TRACE, "SQL query: {query}")
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'computing snapped points and store in table')
+    log_query_time(querystart, 'computing snapped points and store in table', cursor, query)
     LOGGER.debug(f'Adding snapped points to temporary table "{tablename}"... done.')
 
     # Compute the distance, retrieve the snapped points:
@@ -473,7 +474,7 @@ def _snapping_with_distances(cursor, tablename, result_format, colname_lon, coln
         temp.lon,
         temp.lat,
         temp.site_id,
-        ST_AsText(temp.geom_snapped),
+        ST_AsBinary(temp.geom_snapped),
         temp.strahler_closest,
         temp.subcid_closest,
         ST_Distance(
@@ -487,7 +488,7 @@ def _snapping_with_distances(cursor, tablename, result_format, colname_lon, coln
     LOGGER.log(logging.TRACE, "SQL query: {query}")
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'computing distances and retrieve results')
+    log_query_time(querystart, 'computing distances and retrieve results', cursor, query)
     return _package_result(cursor, result_format, colname_lon, colname_lat, colname_site_id)
 
 
@@ -506,7 +507,7 @@ def _snapping_without_distances(cursor, tablename, result_format, colname_lon, c
         temp.lon,
         temp.lat,
         temp.site_id,
-        ST_AsText(
+        ST_AsBinary(
             ST_LineInterpolatePoint(
                 temp.geog_closest::geometry,
                 ST_LineLocatePoint(temp.geog_closest::geometry, temp.geom_user)
@@ -521,7 +522,7 @@ def _snapping_without_distances(cursor, tablename, result_format, colname_lon, c
     LOGGER.log(logging.TRACE, "SQL query: {query}")
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'snapping without distances')
+    log_query_time(querystart, 'snapping without distances', cursor, query)
     return _package_result(cursor, result_format, colname_lon, colname_lat, colname_site_id)
 
 
@@ -546,16 +547,15 @@ def _package_result_in_geojson(cursor, colname_site_id):
     # Create list to be filled with the GeoJSON Features:
     features = []
 
-    # Iterating over database results:
-    while (True):
-        row = cursor.fetchone()
-        if row is None: break
+    # Iterating over database results (the snapped points are decoded all at once):
+    rows = cursor.fetchall()
+    snappedpoints = geometry_decoding.wkb_to_geojson([row[3] for row in rows])
+    for row, snappedpoint_simplegeom in zip(rows, snappedpoints):
 
         # Extract values from row:
         lon = row[0]
         lat = row[1]
         site_id = row[2]
-        snappedpoint_wkt = row[3]
         strahler = row[4]
         subc_id = row[5]
         try:
@@ -579,13 +579,9 @@ def _package_result_in_geojson(cursor, colname_site_id):
                 err_msg = f'Could not parse lon and lat: {e}'
                 raise ValueError(err_msg)
 
-        # Convert to GeoJSON:
-        if snappedpoint_wkt is None:
+        if snappedpoint_simplegeom is None:
             # If point is in the ocean...
             LOGGER.debug(f'This point has no ids assigned, so it may be off the coast: site_id={site_id}, lon={lon}, lat={lat}.')
-            snappedpoint_simplegeom = None
-        else:
-            snappedpoint_simplegeom = geomet.wkt.loads(snappedpoint_wkt)
 
         # Construct Feature:
         feature = {
@@ -639,16 +635,15 @@ def _package_result_in_dataframe(cursor, colname_lon, colname_lat, colname_site_
         'distance_metres'
     ]
 
-    # Iterating over database results:
-    while (True):
-        row = cursor.fetchone()
-        if row is None: break
+    # Iterating over database results (the snapped points are decoded all at once):
+    rows = cursor.fetchall()
+    snappedpoints = geometry_decoding.wkb_to_geojson([row[3] for row in rows])
+    for row, snappedpoint_simplegeom in zip(rows, snappedpoints):
 
         # Extract values from row:
         lon = row[0]
         lat = row[1]
         site_id = row[2]
-        snappedpoint_wkt = row[3]
         strahler = row[4]
         subc_id = row[5]
 
@@ -673,15 +668,12 @@ def _package_result_in_dataframe(cursor, colname_lon, colname_lat, colname_site_
         # For debugging, add any attribute to the last SELECT statement, and look at all of them here:
         LOGGER.log(logging.TRACE, f'Result row: {row}')
 
-        # Convert to GeoJSON:
-        if snappedpoint_wkt is None:
+        if snappedpoint_simplegeom is None:
             # If point is in the ocean...
             LOGGER.debug(f'This point has no ids assigned, so it may be off the coast: site_id={site_id}, lon={lon}, lat={lat}.')
-            snappedpoint_simplegeom = None
             lon_snapped = None
             lat_snapped = None
         else:
-            snappedpoint_simplegeom = geomet.wkt.loads(snappedpoint_wkt)
             # Extract snapped coordinates:
             lon_snapped = snappedpoint_simplegeom['coordinates'][0]
             lat_snapped = snappedpoint_simplegeom['coordinates'][1]
@@ -795,8 +787,7 @@ if __name__ == "__main__" and True:
     }
 
     res = get_snapped_points_xy(conn,
-        geojson=input_points_geojson,
-        dataframe=None,
+        point_table.from_geojson(input_points_geojson, colname_site_id="my_site"),
         colname_lon=None,
         colname_lat=None,
         colname_site_id="my_site",
@@ -807,8 +798,7 @@ if __name__ == "__main__" and True:
     print(res)
 
     res = get_snapped_points_xy(conn,
-        geojson=input_points_geojson,
-        dataframe=None,
+        point_table.from_geojson(input_points_geojson, colname_site_id="my_site"),
         colname_lon="lon",
         colname_lat="lat",
         colname_site_id="my_site",
@@ -1,8 +1,6 @@
 import json
 import uuid
 import time
-import geomet.wkt
-import pandas as pd
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -12,11 +10,19 @@ try:
     # If the package is installed in local python PATH:
     import aqua90m.utils.geojson_helpers as geojson_helpers
     import aqua90m.utils.exceptions as exc
+    import aqua90m.utils.point_table as point_table
+    import aqua90m.geofresh.partition_pruning as partition_pruning
+    import aqua90m.geofresh.query_capture as query_capture
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
         import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.utils.point_table as point_table
+        import pygeoapi.process.aqua90m.geofresh.partition_pruning as partition_pruning
+        import pygeoapi.process.aqua90m.geofresh.query_capture as query_capture
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -25,6 +31,10 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+geomet = lazy_import('geomet')
+
 
 
 def drop_temp_table(cursor, tablename):
@@ -40,60 +50,10 @@ def make_insertion_rows_from_geojson(geojson, colname_site_id=None):
     to populate a temporary table with site_id, lon, lat and a geom.
     '''
     LOGGER.debug(f'Preparing to insert data from GeoJSON into PostGIS database...')
-    list_of_insert_rows = []
     # TODO: How to deal with missing site_ids? Maybe fill with NULL values, or
     # not create that column if it is not needed?
-
-    if geojson['type'] == 'MultiPoint':
-        LOGGER.debug('Found MultiPoint...')
-        for lon, lat in geojson["coordinates"]:
-
-            # If values are NaN, we need to manually make them "NULL" before filling:
-            # TODO: Probably isna() is not the right one.
-            lon = lon if not pd.isna(lon) else 'NULL'
-            lat = lat if not pd.isna(lat) else 'NULL'
-
-            row = f"(NULL, {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
-            list_of_insert_rows.append(row)
-
-    elif geojson['type'] == 'GeometryCollection':
-        LOGGER.debug('Found GeometryCollection...')
-        for point in geojson['geometries']:
-            lon, lat = point['coordinates']
-
-            # If values are NaN, we need to manually make them "NULL" before filling:
-            # TODO: Probably isna() is not the right one.
-            lon = lon if not pd.isna(lon) else 'NULL'
-            lat = lat if not pd.isna(lat) else 'NULL'
-
-            row = f"(NULL, {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
-            list_of_insert_rows.append(row)
-
-    elif geojson['type'] == 'FeatureCollection':
-        LOGGER.debug('Found FeatureCollection...')
-        for point in geojson['features']:
-            lon, lat = point['geometry']['coordinates']
-
-            # If values are NaN, we need to manually make them "NULL" before filling:
-            # TODO: Probably isna() is not the right one.
-            lon = lon if not pd.isna(lon) else 'NULL'
-            lat = lat if not pd.isna(lat) else 'NULL'
-
-            if colname_site_id is None:
-                row = f"(NULL, {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
-            else:
-                site_id = point['properties'][colname_site_id]
-                row = f"('{site_id}', {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
-            list_of_insert_rows.append(row)
-
-    else:
-        err_msg = 'Cannot recognize GeoJSON object!'
-        LOGGER.error(err_msg)
-        raise exc.UserInputException(err_msg)
-
-    LOGGER.debug(f'Created list of {len(list_of_insert_rows)} insert rows...')
-    LOGGER.debug(f'First insert row: {list_of_insert_rows[0]}')
-    return list_of_insert_rows
+    points = point_table.from_geojson(geojson, colname_site_id=colname_site_id)
+    return make_insertion_rows_from_points(points)
 
 
 def make_insertion_rows_from_dataframe(input_df, colname_lon, colname_lat, colname_site_id=None):
@@ -101,44 +61,40 @@ def make_insertion_rows_from_dataframe(input_df, colname_lon, colname_lat, colna
     From an input dataframe, make SQL rows that can be used as INSERT statements,
     to populate a temporary table with site_id, lon, lat and a geom.
     '''
-    list_of_insert_rows = []
     LOGGER.debug(f'Preparing to insert data from a dataframe into PostGIS database...')
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id)
+    return make_insertion_rows_from_points(points)
 
-    # Retrieve using column index, not colname - this is faster:
-
-    if colname_site_id is None:
-        colidx_lon = input_df.columns.get_loc(colname_lon)
-        colidx_lat = input_df.columns.get_loc(colname_lat)
-        for row in input_df.itertuples(index=False):
-            lon = row[colidx_lon]
-            lat = row[colidx_lat]
 
-            # If values are NaN, we need to manually make them "NULL" before filling:
-            lon = lon if not pd.isna(lon) else 'NULL'
-            lat = lat if not pd.isna(lat) else 'NULL'
-
-            row = f"(NULL, {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
-            list_of_insert_rows.append(row)
+def make_insertion_rows_from_points(points):
+    '''
+    From a PointTable (see utils/point_table.py), make SQL rows that can be used
+    as INSERT statements, to populate a temporary table with site_id, lon, lat
+    and a geom.
+    '''
+    points.check_coordinates()
+
+    # If values are NaN, we need to manually make them "NULL" before filling
+    # (all at once, on the arrays):
+    lons = np.where(np.isnan(points.lons), 'NULL', points.lons.astype(str)).tolist()
+    lats = np.where(np.isnan(points.lats), 'NULL', points.lats.astype(str)).tolist()
+    if points.site_ids is None:
+        site_ids = ['NULL'] * len(points)
     else:
-        colidx_lon = input_df.columns.get_loc(colname_lon)
-        colidx_lat = input_df.columns.get_loc(colname_lat)
-        colidx_site_id = input_df.columns.get_loc(colname_site_id)
-        for row in input_df.itertuples(index=False):
-            lon = row[colidx_lon]
-            lat = row[colidx_lat]
-            site_id = row[colidx_site_id]
+        # Quote, and escape quotes inside the site ids:
+        site_ids = ["'" + str(site_id).replace("'", "''") + "'" for site_id in points.site_ids.tolist()]
 
-            # If values are NaN, we need to manually make them "NULL" before filling:
-            lon = lon if not pd.isna(lon) else 'NULL'
-            lat = lat if not pd.isna(lat) else 'NULL'
-
-            row = f"('{site_id}', {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
-            list_of_insert_rows.append(row)
+    list_of_insert_rows = [
+        f"({site_id}, {lon}, {lat}, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326))"
+        for site_id, lon, lat in zip(site_ids, lons, lats)
+    ]
 
     LOGGER.debug(f'Created list of {len(list_of_insert_rows)} insert rows...')
-    LOGGER.debug(f'First insert row: {list_of_insert_rows[0]}')
+    if len(list_of_insert_rows) > 0:
+        LOGGER.debug(f'First insert row: {list_of_insert_rows[0]}')
     return list_of_insert_rows
 
+
 # add_subcids: If we enable omitting that, we could query for only reg_ids...
 def create_and_populate_temp_table(cursor, list_of_insert_rows, add_subcids=True):
     '''
@@ -212,7 +168,7 @@ def _fill_temp_table(cursor, tablename, list_of_insert_rows):
     LOGGER.log(logging.TRACE, "SQL query: {query}")
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'inserting into temp table')
+    log_query_time(querystart, 'inserting into temp table', cursor, query)
     LOGGER.debug(f'Inserting into temporary table "{tablename}"... done.')
 
 
@@ -249,7 +205,7 @@ def _update_temp_table_regid(cursor, tablename):
     LOGGER.log(logging.TRACE, "SQL query: {query}")
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'updating temp table with reg_id')
+    log_query_time(querystart, 'updating temp table with reg_id', cursor, query)
 
     LOGGER.debug(f'Update reg_id (st_intersects) in temporary table "{tablename}"... done')
 
@@ -269,7 +225,6 @@ def _update_temp_table_regid(cursor, tablename):
 def _add_subcids(cursor, tablename, reg_ids):
 
     LOGGER.debug(f'Update subc_id, basin_id (st_intersects) in temporary table "{tablename}"...')
-    reg_ids_string = ", ".join([str(elem) for elem in reg_ids])
     query = f'''
     UPDATE {tablename}
     SET
@@ -278,20 +233,27 @@ def _add_subcids(cursor, tablename, reg_ids):
     FROM sub_catchments sub
     WHERE
         st_intersects({tablename}.geom_user, sub.geom)
-        AND sub.reg_id IN ({reg_ids_string});
+        AND {partition_pruning.predicate(reg_ids=reg_ids, alias='sub')};
     '''
 
     ### Query database:
     LOGGER.log(logging.TRACE, "SQL query: {query}")
+    partition_pruning.verify(cursor.connection, query, [], 'hydro.sub_catchments', len(reg_ids))
     querystart = time.time()
     cursor.execute(query)
-    log_query_time(querystart, 'updating temp table with subc_id and basin_id')
+    log_query_time(querystart, 'updating temp table with subc_id and basin_id', cursor, query)
     LOGGER.debug(f'Update subc_id, basin_id (st_intersects) in temporary table "{tablename}"... done.')
 
 
-def log_query_time(start, comment):
+def log_query_time(start, comment, cursor=None, query=None, params=None):
+    # If cursor and query are passed, slow queries are captured, too (see
+    # query_capture.py), with the comment as stage name. Only pass them for
+    # queries that EXPLAIN can run (SELECT, INSERT, UPDATE, DELETE), not for
+    # CREATE TABLE, CREATE INDEX or ALTER TABLE:
     end = time.time()
     LOGGER.log(logging.TRACE, f'**** TIME ************ query: {(end - start)} ({comment})')
+    if cursor is not None and query is not None:
+        query_capture.capture_if_slow(cursor, query, params, end - start, comment)
 
 
 
@@ -1,6 +1,5 @@
 import json
 import os
-import geomet.wkt
 import logging
 logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
@@ -10,11 +9,15 @@ try:
     # If the package is installed in local python PATH:
     import aqua90m.utils.exceptions as exc
     import aqua90m.geofresh.basic_queries as basic_queries
+    import aqua90m.geofresh.basin_graph as basin_graph
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.utils.exceptions as exc
         import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+        import pygeoapi.process.aqua90m.geofresh.basin_graph as basin_graph
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -23,6 +26,9 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
 # global variable:
 MAX_NUM_UPSTREAM_CATCHMENTS = None
 
@@ -67,6 +73,184 @@ def too_many_upstream_catchments(num, func_name, config_file_path = None, fake =
 
 def get_upstream_catchment_ids_incl_itself(conn, subc_id, basin_id, reg_id, min_strahler = None):
 
+    # Computed on the cached basin graph, already pruned to min_strahler
+    # (see basin_graph), instead of in the database:
+    graph = basin_graph.get_basin_graph(conn, basin_id, reg_id)
+
+    # Same as below, if the database did not return anything:
+    if not graph.contains(subc_id):
+        LOGGER.info('No upstream catchment returned. Assuming this is a headwater. Returning just the local catchment itself.')
+        return [subc_id]
+
+    # If the catchment itself does not reach min_strahler, this is []:
+    return graph.upstream_ids(subc_id, min_strahler)
+
+
+def get_upstream_catchment_ids_nested(conn, subc_ids, basin_id, reg_id, min_strahler = None):
+    # Upstream catchments of many segments of one basin, all from the same
+    # (cached) basin graph, in one pass over the pre-order (see basin_graph).
+    # Upstream catchments are nested: If one of the segments is upstream of
+    # another, its upstream catchment is part of the other one. It is not
+    # repeated, the other one refers to it instead.
+    # Returns a dict, per subc_id (in the order given):
+    #   "upstream_ids": The segments upstream (incl. itself), except those in
+    #       the upstream catchments of the segments in "includes_upstream_of",
+    #   "includes_upstream_of": The next ones of subc_ids upstream,
+    #   "num_upstream_ids": Size of the whole upstream catchment.
+    # Same segments as get_upstream_catchment_ids_incl_itself() for each one.
+    graph = basin_graph.get_basin_graph(conn, basin_id, reg_id)
+    level = graph.level(min_strahler)
+
+    result = {}
+    found_ids = []
+    found_positions = []
+    for subc_id in dict.fromkeys(int(subc_id) for subc_id in subc_ids):
+        pos = level.position(subc_id)
+        if not graph.contains(subc_id):
+            LOGGER.info(f'Subcatchment {subc_id} not in basin graph. Assuming this is a headwater. Returning just the local catchment itself.')
+            result[subc_id] = _nested_item([subc_id], [], 1)
+        elif pos is None:
+            # Does not reach min_strahler:
+            result[subc_id] = _nested_item([], [], 0)
+        else:
+            result[subc_id] = None # filled below, keeps the order
+            found_ids.append(subc_id)
+            found_positions.append(pos)
+
+    for subc_id, pos, (own, includes) in zip(found_ids, found_positions, _nest(level, found_positions)):
+        result[subc_id] = _nested_item(
+            level.ids[own].tolist(),
+            [found_ids[k] for k in includes],
+            int(level.size[pos]))
+
+    LOGGER.debug(f'Upstream catchments of {len(result)} subcatchments in basin {basin_id}: {sum(len(item["upstream_ids"]) for item in result.values())} segments listed.')
+    return result
+
+
+def _nested_item(upstream_ids, includes_upstream_of, num_upstream_ids):
+    return {
+        "num_upstream_ids": num_upstream_ids,
+        "upstream_ids": upstream_ids,
+        "includes_upstream_of": includes_upstream_of
+    }
+
+
+def _nest(level, positions):
+    # positions: Distinct positions in the TopologyLevel. In pre-order, the
+    # upstream catchment of each one is an interval [pre, pre+size), and two
+    # intervals are either disjoint or nested. Sweeping through them in
+    # pre-order with a stack gives, for each one, the next ones nested in it.
+    # Returns, per position, its own part of the pre-order (its interval minus
+    # the nested ones, as positions) and the indices of the nested ones.
+    start = level.pre[np.asarray(positions, dtype='int64')].tolist()
+    end = [begin + int(level.size[pos]) for begin, pos in zip(start, positions)]
+    nested = [[] for _ in positions]
+    stack = []
+    for k in sorted(range(len(positions)), key=start.__getitem__):
+        while stack and start[k] >= end[stack[-1]]:
+            stack.pop()
+        if stack:
+            nested[stack[-1]].append(k)
+        stack.append(k)
+
+    parts = []
+    for k in range(len(positions)):
+        bounds = [start[k]]
+        for j in nested[k]:
+            bounds.extend([start[j], end[j]])
+        bounds.append(end[k])
+        own = np.concatenate([level.order[begin:until] for begin, until in zip(bounds[::2], bounds[1::2])])
+        parts.append((own, nested[k]))
+    return parts
+
+
+def get_upstream_catchment_ids_plural(conn, departing_points, min_strahler = None):
+    # Upstream catchments of many points, grouped by basin (see
+    # routing.collect_departing_points_by_region_and_basin()), so each basin
+    # is loaded and traversed once, see get_upstream_catchment_ids_nested().
+    # Returns a dict, by subc_id. Points without subc_id are under None.
+    everything = {}
+    for reg_id, all_basins in departing_points.items():
+
+        # Add empty item for ocean case:
+        if reg_id is None:
+            all_site_ids = all_basins[None][None]
+            LOGGER.debug(f'Compute upstream catchment for these sites not possible: {all_site_ids}')
+            everything[None] = {
+                "subc_id": None,
+                "basin_id": None,
+                "reg_id": None,
+                **_nested_item(None, None, None),
+                "site_ids": list(all_site_ids)
+            }
+            continue
+
+        reg_id = int(reg_id)
+        for basin_id, all_subcids in all_basins.items():
+            LOGGER.debug(f'Basin: {basin_id} (in regional unit {reg_id})')
+            basin_id = int(basin_id)
+            nested = get_upstream_catchment_ids_nested(conn, all_subcids.keys(), basin_id, reg_id, min_strahler)
+            for subc_id, site_ids in all_subcids.items():
+                everything[int(subc_id)] = {
+                    "subc_id": int(subc_id),
+                    "basin_id": basin_id,
+                    "reg_id": reg_id,
+                    **nested[int(subc_id)],
+                    "site_ids": list(site_ids)
+                }
+
+    return everything
+
+
+def expand_upstream_ids(upstream, subc_id):
+    # Client side: The whole upstream catchment of subc_id (list of subc_ids),
+    # from a result of get_upstream_catchment_ids_plural() (or _nested()),
+    # following the references to the nested catchments.
+    # Works with both int and str keys (the latter after JSON).
+    def item(key):
+        return upstream[key] if key in upstream else upstream[str(key)]
+    subc_ids = []
+    todo = [subc_id]
+    while todo:
+        current = item(todo.pop())
+        subc_ids.extend(current["upstream_ids"])
+        todo.extend(current["includes_upstream_of"])
+    return subc_ids
+
+
+def upstream_plural_to_dataframe(upstream):
+    # Long format: One row per subc_id and segment upstream (upstream_id).
+    # Instead of repeating the upstream catchments nested in it, there is one
+    # row per nested catchment, with its subc_id in "includes_upstream_of"
+    # (and upstream_id empty).
+    everything = []
+    for item in upstream.values():
+        site_ids_str = '+'.join(map(str, item['site_ids']))
+        if item['subc_id'] is None:
+            everything.append([None, None, None, None, None, site_ids_str])
+            continue
+        keys = [item['reg_id'], item['basin_id'], item['subc_id']]
+        for upstream_id in item['upstream_ids']:
+            everything.append(keys + [upstream_id, None, site_ids_str])
+        for nested_id in item['includes_upstream_of']:
+            everything.append(keys + [None, nested_id, site_ids_str])
+
+    return pd.DataFrame(everything,
+        columns=['reg_id', 'basin_id', 'subc_id', 'upstream_id', 'includes_upstream_of', 'site_ids']
+    ).astype({
+        'reg_id':   'Int64', # nullable int
+        'basin_id': 'Int64', # nullable int
+        'subc_id':  'Int64', # nullable int
+        'upstream_id': 'Int64',
+        'includes_upstream_of': 'Int64',
+        'site_ids': 'string'
+    })
+
+
+def get_upstream_catchment_ids_incl_itself_pgrouting(conn, subc_id, basin_id, reg_id, min_strahler = None):
+    # Same as get_upstream_catchment_ids_incl_itself(), computed in the
+    # database with pgr_connectedComponents (not used anymore).
+
     ### Define query:
     # Getting info from database:
     """
@@ -256,3 +440,8 @@ if __name__ == "__main__":
     print('\nSTART RUNNING FUNCTION: get_upstream_catchment_ids_incl_itself (returns three)')
     res = get_upstream_catchment_ids_incl_itself(conn, 506251126, basin_id, reg_id)
     print('RESULT:\n%s' % res)
+
+    print('\nSTART RUNNING FUNCTION: get_upstream_catchment_ids_nested (headwater nested in the other)')
+    res = get_upstream_catchment_ids_nested(conn, [506251126, 506250459], basin_id, reg_id)
+    print('RESULT:\n%s' % res)
+    print('EXPANDED:\n%s' % expand_upstream_ids(res, 506251126))
@@ -0,0 +1,288 @@
+import os
+import math
+import json
+import uuid
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+'''
+Mapbox Vector Tiles (MVT) of the stream segments and subcatchments, so
+the map only has to load what is visible, instead of whole basins as
+GeoJSON.
+
+The tiles (z/x/y, Web Mercator, as in any slippy map) are made by
+PostGIS (ST_TileEnvelope, ST_AsMVTGeom, ST_AsMVT), one layer per table:
+
+* "stream_segments": subc_id, strahler, target. At low zooms, only the
+  larger streams are included (Strahler-based thinning, see
+  MIN_STRAHLER_BY_ZOOM), otherwise the tiles would contain millions of
+  tiny segments.
+* "sub_catchments": subc_id, basin_id. Only from zoom
+  MIN_ZOOM_SUBCATCHMENTS on (below that, they are smaller than a pixel).
+
+The data do not change, so every tile is stored in an on-disk cache
+(<tile_cache_dir>/<layers>/<z>/<x>/<y>.mvt) once it was made, and read
+from there afterwards. Empty tiles are cached, too (as empty files).
+If the cache is inside the download directory, the web server can also
+serve the cached tiles directly (see tile_url()).
+
+Tiles of popular regions can be made in advance ("seeded"), for the
+regions in "tile_seed_regions" (config), e.g.:
+
+    "tile_seed_regions": [
+        {"name": "schlei", "bbox": [9.5, 54.4, 10.1, 54.8], "min_zoom": 6, "max_zoom": 12}
+    ]
+
+by running this module (see __main__), or by calling seed_tiles().
+
+Usage:
+
+    tile = vector_tiles.get_tile(conn, z, x, y, ['stream_segments'], cache_dir)
+'''
+
+LAYERS = ['stream_segments', 'sub_catchments']
+
+# Defaults, can be overridden in config:
+DEFAULT_MAX_ZOOM = 16
+DEFAULT_TILE_CACHE_SUBDIR = 'tiles/'
+
+# Tile resolution and buffer (in tile coordinates), as usual for MVT:
+EXTENT = 4096
+BUFFER = 64
+
+# Strahler-based thinning: Minimum Strahler order of the stream segments
+# included in tiles of zoom <= z (zooms above the last entry: all):
+MIN_STRAHLER_BY_ZOOM = [
+    (3, 8),
+    (5, 7),
+    (7, 6),
+    (8, 5),
+    (9, 4),
+    (10, 3),
+    (11, 2)
+]
+MIN_ZOOM_SUBCATCHMENTS = 11
+
+
+def min_strahler_for_zoom(z):
+    for max_zoom, min_strahler in MIN_STRAHLER_BY_ZOOM:
+        if z <= max_zoom:
+            return min_strahler
+    return 0
+
+
+def check_tile(z, x, y, layers, max_zoom=DEFAULT_MAX_ZOOM):
+    # Validates the user inputs. Returns z, x, y as int, and the layers as list.
+    try:
+        z, x, y = int(z), int(x), int(y)
+    except (ValueError, TypeError) as e:
+        err_msg = f'Tile coordinates must be integers (z/x/y), not {z}/{x}/{y}.'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+    if z < 0 or z > max_zoom:
+        err_msg = f'Zoom level must be between 0 and {max_zoom}, not {z}.'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+    num_tiles = 2**z
+    if x < 0 or x >= num_tiles or y < 0 or y >= num_tiles:
+        err_msg = f'Tile {z}/{x}/{y} does not exist (x and y must be between 0 and {num_tiles-1} at zoom {z}).'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+    if layers is None:
+        layers = LAYERS
+    if isinstance(layers, str):
+        layers = [layers]
+    for layer in layers:
+        if not layer in LAYERS:
+            err_msg = f"Unknown layer '{layer}', please use one of: {LAYERS}."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+
+    # Same order as in LAYERS, so the cache path does not depend on the order:
+    return z, x, y, [layer for layer in LAYERS if layer in layers]
+
+
+def lonlat_to_tile(lon, lat, z):
+    # Slippy map tile that contains the point (Web Mercator, clipped to +-85.05 degrees):
+    lat = max(min(lat, 85.0511), -85.0511)
+    num_tiles = 2**z
+    x = int((lon + 180.0) / 360.0 * num_tiles)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * num_tiles)
+    return min(max(x, 0), num_tiles-1), min(max(y, 0), num_tiles-1)
+
+
+def tiles_in_bbox(bbox, min_zoom, max_zoom):
+    # Generator of (z, x, y) of all tiles that touch the bbox (west, south, east, north):
+    west, south, east, north = bbox
+    for z in range(min_zoom, max_zoom+1):
+        x_min, y_min = lonlat_to_tile(west, north, z)
+        x_max, y_max = lonlat_to_tile(east, south, z)
+        for x in range(x_min, x_max+1):
+            for y in range(y_min, y_max+1):
+                yield z, x, y
+
+
+def _layer_query(layer, z):
+    # Returns the SQL (with the tile as parameters z, x, y) for one layer, and
+    # any further parameters. Returns None if the layer is empty at this zoom.
+    if layer == 'stream_segments':
+        return f'''
+        SELECT ST_AsMVT(tile, 'stream_segments', {EXTENT}, 'geom') FROM (
+            SELECT
+                ST_AsMVTGeom(ST_Transform(seg.geom, 3857), bounds.envelope, {EXTENT}, {BUFFER}, true) AS geom,
+                seg.subc_id, seg.strahler, seg.target
+            FROM hydro.stream_segments AS seg, bounds
+            WHERE seg.geom && bounds.envelope_4326
+                AND seg.strahler >= %(min_strahler)s
+        ) AS tile
+        ''', {'min_strahler': min_strahler_for_zoom(z)}
+
+    if layer == 'sub_catchments':
+        if z < MIN_ZOOM_SUBCATCHMENTS:
+            return None, {}
+        return f'''
+        SELECT ST_AsMVT(tile, 'sub_catchments', {EXTENT}, 'geom') FROM (
+            SELECT
+                ST_AsMVTGeom(ST_Transform(sub.geom, 3857), bounds.envelope, {EXTENT}, {BUFFER}, true) AS geom,
+                sub.subc_id, sub.basin_id
+            FROM hydro.sub_catchments AS sub, bounds
+            WHERE sub.geom && bounds.envelope_4326
+        ) AS tile
+        ''', {}
+
+
+def query_tile(conn, z, x, y, layers):
+    # Makes the tile in the database. Returns bytes (may be empty).
+    # Several layers are simply concatenated (that is valid MVT).
+    parts = []
+    params = {'z': z, 'x': x, 'y': y}
+    for layer in layers:
+        layer_query, layer_params = _layer_query(layer, z)
+        if layer_query is not None:
+            parts.append(f'COALESCE(({layer_query}), \'\'::bytea)')
+            params.update(layer_params)
+    if len(parts) == 0:
+        return b''
+
+    query = f'''
+    WITH bounds AS (
+        SELECT
+            ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS envelope,
+            ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s, margin => {BUFFER/EXTENT}), 4326) AS envelope_4326
+    )
+    SELECT {' || '.join(parts)}
+    '''
+
+    ### Query database:
+    cursor = conn.cursor()
+    LOGGER.log(logging.TRACE, f'Querying database for tile {z}/{x}/{y}...')
+    cursor.execute(query, params)
+    LOGGER.log(logging.TRACE, f'Querying database for tile {z}/{x}/{y}... DONE.')
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return b''
+    return bytes(row[0])
+
+
+def tile_path(cache_dir, z, x, y, layers):
+    return os.path.join(cache_dir, '-'.join(layers), str(z), str(x), f'{y}.mvt')
+
+
+def tile_url(cache_url, z, x, y, layers):
+    return f'{cache_url}{"-".join(layers)}/{z}/{x}/{y}.mvt'
+
+
+def get_tile(conn, z, x, y, layers, cache_dir=None):
+    # Returns the tile (bytes), from the on-disk cache if possible.
+    if cache_dir is None:
+        return query_tile(conn, z, x, y, layers)
+
+    path = tile_path(cache_dir, z, x, y, layers)
+    try:
+        with open(path, 'rb') as tile_file:
+            LOGGER.debug(f'Tile {z}/{x}/{y} ({"-".join(layers)}): From cache.')
+            return tile_file.read()
+    except FileNotFoundError:
+        pass
+
+    tile = query_tile(conn, z, x, y, layers)
+    LOGGER.debug(f'Tile {z}/{x}/{y} ({"-".join(layers)}): {len(tile)} bytes, storing to cache.')
+    _store_tile(path, tile)
+    return tile
+
+
+def _store_tile(path, tile):
+    # Written to a temporary file first, and then moved, so no other worker
+    # can read a half-written tile:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as tile_file:
+        tile_file.write(tile)
+    os.replace(tmp_path, path)
+
+
+def seed_tiles(conn, bbox, min_zoom, max_zoom, layers, cache_dir):
+    # Makes all tiles of the bbox that are not in the cache yet.
+    num_made = 0
+    num_cached = 0
+    for z, x, y in tiles_in_bbox(bbox, min_zoom, max_zoom):
+        if os.path.exists(tile_path(cache_dir, z, x, y, layers)):
+            num_cached += 1
+            continue
+        get_tile(conn, z, x, y, layers, cache_dir)
+        num_made += 1
+    LOGGER.info(f'Seeded tiles for bbox {bbox}, zoom {min_zoom}-{max_zoom}: {num_made} made, {num_cached} were cached.')
+    return num_made, num_cached
+
+
+def get_cache_dir(config):
+    # Tile cache directory (and its URL), by default inside the download directory:
+    cache_dir = config.get('tile_cache_dir', config['download_dir'] + DEFAULT_TILE_CACHE_SUBDIR)
+    cache_url = config.get('tile_cache_url', config['download_url'] + DEFAULT_TILE_CACHE_SUBDIR)
+    return cache_dir, cache_url
+
+
+if __name__ == "__main__":
+
+    # Seeds the tile cache for the regions in config:
+    # python aqua90m/geofresh/vector_tiles.py
+    logging.basicConfig(level=logging.INFO, format='%(name)s:%(lineno)s - %(levelname)5s - %(message)s')
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+    from database_connection import get_connection_object_config
+
+    config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    with open(config_file_path, 'r') as config_file:
+        config = json.load(config_file)
+
+    cache_dir, cache_url = get_cache_dir(config)
+    conn = get_connection_object_config(config)
+    try:
+        for region in config.get('tile_seed_regions', []):
+            LOGGER.info(f'Seeding tiles for region: {region.get("name", region["bbox"])}')
+            layers = check_tile(0, 0, 0, region.get('layers'))[3]
+            seed_tiles(conn, region['bbox'], region.get('min_zoom', 0),
+                region.get('max_zoom', MIN_ZOOM_SUBCATCHMENTS), layers, cache_dir)
+    finally:
+        conn.close()
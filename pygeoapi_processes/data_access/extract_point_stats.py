@@ -6,9 +6,15 @@ import argparse
 import os
 import sys
 import traceback
+import io
 import json
 import subprocess
-import pandas as pd
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+import pygeoapi.process.aqua90m.utils.raster_cache as raster_cache
+import pygeoapi.process.aqua90m.utils.raster_helpers as raster_helpers
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
 
 '''
 # Input points: lonlatstring
@@ -100,9 +106,7 @@ curl -X POST "http://localhost:5000/processes/extract-point-stats/execution" \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class ExtractPointStatsProcessor(BaseProcessor):
@@ -118,6 +122,9 @@ class ExtractPointStatsProcessor(BaseProcessor):
         with open(config_file_path, 'r') as config_file:
             self.config = json.load(config_file)
 
+        # Configure GDAL caches (only the first time in this worker):
+        raster_cache.configure_gdal(self.config)
+
 
     def set_job_id(self, job_id: str):
         self.job_id = job_id
@@ -180,10 +187,6 @@ class ExtractPointStatsProcessor(BaseProcessor):
         ### Points layer ###
         ####################
 
-        # Write user-provided points to tmp
-        # (as input for gdallocation info):
-        coord_tmp_path = '/tmp/inputcoordinates_%s.txt' % self.job_id
-
         # User provided URL to GeoJSON points:
         if points_geojson_url is not None:
             resp = requests.get(points_geojson_url)
@@ -194,21 +197,20 @@ class ExtractPointStatsProcessor(BaseProcessor):
         if points_geojson is not None:
             LOGGER.debug('Client provided a GeoJSON FeatureCollection...')
             # TODO Should we validate it?
-            with open(coord_tmp_path, 'w') as myfile:
-                colname_lon = 'lon'
-                colname_lat = 'lat'
-                myfile.write('lon lat\n')
-                for item in points_geojson['features']:
-                    coord_pair = item['geometry']['coordinates']
-                    myfile.write('%s %s\n' % (coord_pair[0], coord_pair[1]))
+            colname_lon = 'lon'
+            colname_lat = 'lat'
+            coords = [item['geometry']['coordinates'] for item in points_geojson['features']]
+            input_df = pd.DataFrame({
+                colname_lon: [coord_pair[0] for coord_pair in coords],
+                colname_lat: [coord_pair[1] for coord_pair in coords]
+            })
 
         # User provided points as space-separated string:
         elif lonlatstring is not None:
             LOGGER.debug('Client provided coordinates in a string...')
-            with open(coord_tmp_path, 'w') as myfile:
-                myfile.write(lonlatstring)
+            input_df = pd.read_csv(io.StringIO(lonlatstring), sep=r'\s+')
 
-        LOGGER.debug('Written user input lon lat to file: %s' % coord_tmp_path)
+        LOGGER.debug('Read %s input points.' % input_df.shape[0])
 
         ####################
         ### Raster layer ###
@@ -242,16 +244,22 @@ class ExtractPointStatsProcessor(BaseProcessor):
 
         # Where to store results:
         out_dir = self.config['download_dir'].rstrip('/')
-        out_path_txt = out_dir+'/outputs_%s_%s_%s.txt' % (self.metadata['id'], variable_name, self.job_id)
         out_path_csv = out_dir+'/outputs_%s_%s_%s.csv' % (self.metadata['id'], variable_name, self.job_id)
-        LOGGER.debug('Will write final result here: %s' % out_path_txt)
-
-        # Run bash script
-        path_bash_scripts = self.config['hydrographr_bash_files']
-        args = [coord_tmp_path, colname_lon, colname_lat, var_layer, variable_name, out_dir, out_path_txt]
-        returncode, stdouttext, stderrtext, err_msg = call_bash_script(LOGGER, "extract_point_stats.sh", path_bash_scripts, args)
-        if not returncode == 0:
-            raise ProcessorExecuteError(user_msg = err_msg)
+        LOGGER.debug('Will write final result here: %s' % out_path_csv)
+
+        # Extract the values: In-process using rasterio (reading every raster
+        # block only once), or by calling gdallocationinfo via bash (fallback):
+        method = self.config.get('extract_point_stats_method', 'rasterio')
+        if method == 'rasterio':
+            try:
+                df = extract_values_rasterio(input_df, colname_lon, colname_lat, var_layer, variable_name)
+                raster_cache.log_cache_stats(' (after %s)' % self.job_id)
+            except ModuleNotFoundError as e:
+                LOGGER.warning('Cannot extract values in-process (%s), falling back to bash.' % e)
+                method = 'bash'
+
+        if method == 'bash':
+            df = self.extract_values_bash(input_df, colname_lon, colname_lat, var_layer, variable_name, out_dir)
 
         ################
         ### Results: ###
@@ -264,21 +272,21 @@ class ExtractPointStatsProcessor(BaseProcessor):
 
             # TODO: Add properties of original feature collection?
 
-            # Make GeoJSON from it:
-            df = pd.read_csv(out_path_txt, sep=" ")
-            def create_geojson_feature(row):
-                return {
+            # Make GeoJSON from it (points outside the raster have NaN, which is no valid JSON):
+            geojson_features = []
+            values = df[variable_name].astype(object).where(df[variable_name].notna(), None)
+            for lon, lat, value in zip(df[colname_lon].tolist(), df[colname_lat].tolist(), values.tolist()):
+                geojson_features.append({
                     "type": "Feature",
                     "geometry": {
                         "type": "Point",
-                        "coordinates": [row['lon'], row['lat']]
+                        "coordinates": [lon, lat]
                     },
                     "properties": {
-                        variable_name: row[variable_name]
+                        variable_name: value
                     }
-                }
+                })
 
-            geojson_features = df.apply(create_geojson_feature, axis=1).tolist()
             geojson = {
                 "type": "FeatureCollection",
                 "features": geojson_features
@@ -304,11 +312,8 @@ class ExtractPointStatsProcessor(BaseProcessor):
 
             if self.return_hyperlink(output_name, requested_outputs):
 
-                # Transform from space-separated to semicolon-separated:
-                with open(out_path_txt, 'r') as txtfile:
-                    with open(out_path_csv, 'w') as csvfile:
-                        line = txtfile.read().replace(' ', ';')
-                        csvfile.write(line)
+                # Store as semicolon-separated:
+                df.to_csv(out_path_csv, sep=';', index=False, na_rep='NA')
 
                 # Make and return download link:
                 downloadlink = out_path_csv.replace(
@@ -324,12 +329,8 @@ class ExtractPointStatsProcessor(BaseProcessor):
 
             else:
 
-                resultstring = ''
-                # Transform from space-separated to semicolon-separated:
-                with open(out_path_txt, 'r') as txtfile:
-                    with open(out_path_csv, 'w') as csvfile:
-                        line = txtfile.read().replace(' ', ';')
-                        resultstring += line+'\n'
+                # Return as semicolon-separated:
+                resultstring = df.to_csv(sep=';', index=False, na_rep='NA')
 
                 outputs[output_name] = {
                     "title": self.metadata['outputs'][output_name]['title'],
@@ -343,6 +344,25 @@ class ExtractPointStatsProcessor(BaseProcessor):
         return 'application/json', outputs
 
 
+    def extract_values_bash(self, input_df, colname_lon, colname_lat, var_layer, variable_name, out_dir):
+
+        # Write user-provided points to tmp
+        # (as input for gdallocation info):
+        coord_tmp_path = '/tmp/inputcoordinates_%s.txt' % self.job_id
+        input_df.to_csv(coord_tmp_path, sep=' ', index=False)
+        LOGGER.debug('Written user input lon lat to file: %s' % coord_tmp_path)
+        out_path_txt = out_dir+'/outputs_%s_%s_%s.txt' % (self.metadata['id'], variable_name, self.job_id)
+
+        # Run bash script
+        path_bash_scripts = self.config['hydrographr_bash_files']
+        args = [coord_tmp_path, colname_lon, colname_lat, var_layer, variable_name, out_dir, out_path_txt]
+        returncode, stdouttext, stderrtext, err_msg = call_bash_script(LOGGER, "extract_point_stats.sh", path_bash_scripts, args)
+        if not returncode == 0:
+            raise ProcessorExecuteError(user_msg = err_msg)
+
+        return pd.read_csv(out_path_txt, sep=" ")
+
+
     def return_hyperlink(self, output_name, requested_outputs):
 
         # No requested outputs: Returning reference per default (against specs!)
@@ -406,6 +426,20 @@ class ExtractPointStatsProcessor(BaseProcessor):
 
 
 
+def extract_values_rasterio(input_df, colname_lon, colname_lat, var_layer, variable_name):
+    # Like extract_point_stats.sh, but in-process: No temp files, no subprocess,
+    # and each raster block is read only once, no matter how many points it contains.
+    # var_layer can be a local path or a URL to a COG or VRT.
+    LOGGER.debug('Extracting values for %s points from %s (in-process)...' % (input_df.shape[0], var_layer))
+    output_df = input_df.copy()
+    output_df[variable_name] = raster_helpers.sample_raster_at_points(
+        var_layer,
+        input_df[colname_lon].to_numpy(),
+        input_df[colname_lat].to_numpy()
+    )
+    return output_df
+
+
 def call_bash_script(LOGGER, bash_file_name, path_bash_scripts, args):
     # TODO: Move function to some module, same in all processes
 
@@ -5,6 +5,7 @@ import os
 import json
 import uuid
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 
 
 '''
@@ -22,9 +23,7 @@ LOGGER = logging.getLogger(__name__)
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class HelferleinProcessor(BaseProcessor):
@@ -1,9 +1,3 @@
-
-####################################
-### This process currently fails ###
-### due to import gdal issues!   ###
-####################################
-
 import logging
 import json
 import traceback
@@ -12,19 +6,12 @@ import os
 # pygeoapi-related modules:
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 
-# geo-related modules:
-import rasterio
-from rasterio import warp
-#import rasterio
-#import rasterio.mask
-
-# We need one of these: # TODO FIXME, does not currently work on our server due to
-# dependency hell, ever since I had to reinstall gdal when installing hydrographr.
-from osgeo import gdal # May cause: ModuleNotFoundError: No module named '_gdal'
-import gdal as gdal    # May cause: ModuleNotFoundError: No module named 'gdal'
-
 # our own helpers:
-from pygeoapi.process.aqua90m.utils.raster_helpers import compress_tiff
+import pygeoapi.process.aqua90m.utils.raster_helpers as raster_helpers
+from pygeoapi.process.aqua90m.utils.raster_helpers import import_gdal
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+import pygeoapi.process.aqua90m.utils.raster_cache as raster_cache
+import pygeoapi.process.aqua90m.utils.tile_index as tile_index
 
 
 
@@ -48,9 +35,11 @@ LOGGER = logging.getLogger(__name__)
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+# Defaults, can be overridden in config:
+DEFAULT_MAX_SUBSET_SIZE_MB = 500
+DEFAULT_SUBSET_THREADS = 4
 
 
 class SubsetterBbox(BaseProcessor):
@@ -66,6 +55,9 @@ class SubsetterBbox(BaseProcessor):
         with open(config_file_path, 'r') as config_file:
             self.config = json.load(config_file)
 
+        # Configure GDAL caches (only the first time in this worker):
+        raster_cache.configure_gdal(self.config)
+
     def set_job_id(self, job_id: str):
         self.job_id = job_id
 
@@ -100,39 +92,50 @@ class SubsetterBbox(BaseProcessor):
         east_lon = float(data.get('east'))
         west_lon = float(data.get('west'))
 
-        # Check if inside our boundaries:
+        # Check if the bbox makes sense at all:
         _check_boundaries(north_lat, south_lat, east_lon, west_lon)
 
-        # Where to find input data
+        # Where to find input data: Only the tiles that the bbox touches
         input_raster_basedir = self.config['base_dir_subsetting_tiffs']
-        input_raster_filepath = input_raster_basedir.rstrip('/')+'/sub_catchment_h18v00.cog.tiff' # TODO this is just one small file!
-
-        # Where to store output data
-        result_filepath_uncompressed = r'/tmp/subset_%s_%s_uncompressed.tiff' % (self.metadata['id'], self.job_id)
+        tiles = tile_index.get_tile_index(input_raster_basedir, self.config.get('subset_tile_index'),
+            self.config.get('subset_tile_pattern'))
+        tiles = tile_index.find_tiles(tiles, west_lon, south_lat, east_lon, north_lat)
+        if len(tiles) == 0:
+            raise ProcessorExecuteError('No data available for this bbox: {west}, {south}, {east}, {north}'.format(
+                west = west_lon, south = south_lat, east = east_lon, north = north_lat))
+        LOGGER.debug('Bbox touches %s tiles: %s' % (len(tiles), [tile['tile_id'] for tile in tiles]))
+        input_raster_filepaths = [tile['path'] for tile in tiles]
+
+        # Check the size of the result (instead of fixed coordinates):
+        grid = raster_helpers.mosaic_grid(input_raster_filepaths[0], west_lon, south_lat, east_lon, north_lat)
+        max_size_mb = self.config.get('max_subset_size_mb', DEFAULT_MAX_SUBSET_SIZE_MB)
+        _check_size(grid, max_size_mb)
+
+        # Where to store output data (only if a reference is requested,
+        # otherwise it is written to memory and returned as bytes):
         downloadfilename = 'outputs-%s-%s.tiff' % (self.metadata['id'], self.job_id)
-        #result_filepath_compressed = r'/var/www/nginx/download'+os.sep+downloadfilename
-        result_filepath_compressed = r'%s%s' % (self.config['download_url'], downloadfilename) # TODO Test!
-        # TODO: Must delete result files!
+        result_filepath = None
+        return_reference = self.return_hyperlink('subset', requested_outputs)
+        if return_reference:
+            result_filepath = self.config['download_dir'].rstrip('/')+os.sep+downloadfilename
 
         LOGGER.info('Subsetting by window (bbox)')
-        _subset_by_window(input_raster_filepath, result_filepath_uncompressed, north_lat, south_lat, east_lon, west_lon)
+        max_threads = self.config.get('subset_threads', DEFAULT_SUBSET_THREADS)
+        result_bytes = _subset_by_window(input_raster_filepaths, grid, result_filepath, max_threads)
 
         #LOGGER.info('Subsetting by polygon (bbox)') # Note: This is slower!
         #polygon = _make_bbox_geojson(north_lat, south_lat, east_lon, west_lon)
-        #_subset_by_polygon(polygon, input_raster_filepath, result_filepath_uncompressed) # same function as subset_by_polygon
-
-        compress_tiff(result_filepath_uncompressed, result_filepath_compressed, LOGGER)
-
-        # Read bytestream from disk and return to user as application/octet-stream:
-        with open(result_filepath_compressed, 'r+b') as myraster:
-            resultfile = myraster.read()
+        #_subset_by_polygon(polygon, input_raster_filepath, result_filepath) # same function as subset_by_polygon
 
         mimetype = 'application/octet-stream' # TODO: Probably a more specific type for GeoTIFF?
 
-        if self.return_hyperlink('subset', requested_outputs):
+        raster_cache.log_cache_stats(' (after %s)' % self.job_id)
+
+        if return_reference:
             return 'application/json', self.get_download_link('subset', downloadfilename, mimetype)
         else:
-            return mimetype, resultfile
+            # The GeoTIFF, as bytes:
+            return mimetype, result_bytes
 
 
     def return_hyperlink(self, output_name, requested_outputs):
@@ -171,18 +174,14 @@ class SubsetterBbox(BaseProcessor):
 
 
 def _check_boundaries(north_lat, south_lat, east_lon, west_lon):
+    # Only checks whether the bbox is valid. How large it may be depends on
+    # the size of the result, see _check_size().
 
-    if north_lat > 85 or south_lat > 85:
-        raise ProcessorExecuteError('Cannot process latitudes above 85 degrees north! You specified: {north}, {south}'.format(
-            north = north_lat, south = south_lat))
-    if south_lat < 65 or north_lat < 65:
-        raise ProcessorExecuteError('Cannot (currently) process latitudes under 65 degrees north! You specified: {north}, {south}'.format(
+    if north_lat > 90 or south_lat < -90:
+        raise ProcessorExecuteError('Latitudes must be between -90 and 90 degrees! You specified: {north}, {south}'.format(
             north = north_lat, south = south_lat))
-    if east_lon > 20 or west_lon > 20:
-        raise ProcessorExecuteError('Cannot (currently) process longitudes above 20 degrees east! You specified: {west}, {east}.'.format(
-            west = west_lon, east = east_lon))
-    if west_lon < 0 or east_lon < 0:
-        raise ProcessorExecuteError('Cannot (currently) process longitudes under 0 degrees east! You specified: {west}, {east}.'.format(
+    if east_lon > 180 or west_lon < -180:
+        raise ProcessorExecuteError('Longitudes must be between -180 and 180 degrees! You specified: {west}, {east}.'.format(
             west = west_lon, east = east_lon))
     if north_lat <= south_lat:
         raise ProcessorExecuteError('North latitude must be greater than south latitude! You specified: {north}, {south}'.format(
@@ -192,6 +191,14 @@ def _check_boundaries(north_lat, south_lat, east_lon, west_lon):
             west = west_lon, east = east_lon))
 
 
+def _check_size(grid, max_size_mb):
+    size_mb = raster_helpers.grid_size_bytes(grid)/1024/1024
+    LOGGER.debug('Result will be %sx%s pixels (%.1f MB uncompressed).' % (grid['width'], grid['height'], size_mb))
+    if size_mb > max_size_mb:
+        raise ProcessorExecuteError('The bbox is too large: The result would be {width}x{height} pixels ({size:.0f} MB), but at most {max} MB are allowed. Please request a smaller bbox.'.format(
+            width = grid['width'], height = grid['height'], size = size_mb, max = max_size_mb))
+
+
 def _make_bbox_geojson(north_lat, south_lat, east_lon, west_lon):
 
     NE_corner = [east_lon, north_lat]
@@ -207,58 +214,20 @@ def _make_bbox_geojson(north_lat, south_lat, east_lon, west_lon):
     return polygon
 
 
-def _subset_by_window(input_raster_filepath, result_filepath_uncompressed, north_lat, south_lat, east_lon, west_lon):
-
-    # Make windows in col/row/pixels instead of WGS84
-    win = _win_rows_cols(input_raster_filepath, west_lon, east_lon, south_lat, north_lat)
-
-    # Subset raster
-    window = rasterio.windows.Window(win["col_off"], win["row_off"], win["width"], win["height"])
-    with rasterio.open(input_raster_filepath) as src:
-        subset = src.read(1, window=window)
-        result_metadata = src.meta.copy()
-
-    # Prepare writing raster to GeoTIFF:
-    subset_transform = rasterio.transform.from_bounds(
-        west_lon,
-        south_lat,
-        east_lon,
-        north_lat,
-        width=subset.shape[0],
-        height=subset.shape[1]
-    )
-
-    result_metadata.update({'driver':'GTiff',
-        'width':subset.shape[0],
-        'height':subset.shape[1],
-        'transform':subset_transform,
-        'nodata':0})
-
-    # Write raster to disk as GeoTIFF:
-    with rasterio.open(fp=result_filepath_uncompressed, mode='w',**result_metadata) as dst:
-        dst.write(subset, 1)
-
-
-# Function to return a window in rows and cols
-def _win_rows_cols(file_path, west_lon, east_lon, south_lat, north_lat):
-
-    # Get crs and transform from COG file
-    with rasterio.open(file_path) as src:
-        src_crs = src.crs
-        src_transform = src.transform
-        print('CRS: "%s" -> "%s"' % (src_crs, src_transform))
-
-    # Projected coordinates
-    X, Y = rasterio.warp.transform({'init': 'EPSG:4326'}, src_crs, [west_lon, east_lon], [south_lat, north_lat])
-    print('X "%s" Y "%s"' % (X, Y))
-
-    # Transform in row, col
-    (rows, cols) = rasterio.transform.rowcol(src_transform, X, Y)
-    print('Rows "%s" cols "%s"' % (rows, cols))
-    ncols = cols[1]-cols[0]
+def _subset_by_window(input_raster_filepaths, grid, result_filepath, max_threads=4):
+    # Reads the window of the bbox from each tile (in parallel) into one
+    # mosaic, then writes it straight into a tiled, compressed GeoTIFF: To
+    # result_filepath, or (if None) to memory, then returns its bytes.
+    subset = raster_helpers.read_mosaic(input_raster_filepaths, grid, max_threads=max_threads)
 
-    nrows = rows[0]-rows[1] # ! rows[0] > rows[1]
-    return {"col_off": cols[0], "row_off": rows[1], "width": ncols, "height": nrows}
+    # Write raster as tiled, compressed GeoTIFF (the transform is snapped
+    # to the tiles' grid, so pixels stay exactly aligned with the input):
+    result_profile = raster_helpers.make_output_profile(grid['profile'],
+        height=grid['height'],
+        width=grid['width'],
+        transform=grid['transform'],
+        nodata=grid['nodata'])
+    return raster_helpers.write_output(subset, result_profile, result_filepath)
 
 
 
@@ -266,21 +235,20 @@ if __name__ == "__main__":
 
     print('Testing subsetting by bbox...')
 
+    gdal = import_gdal()
     gdal.UseExceptions()
 
     with open('config.json') as myfile:
         config = json.load(myfile)
 
     input_raster_basedir = config['base_dir_subsetting_tiffs']
-    input_raster_filepath = input_raster_basedir.rstrip('/')+'/sub_catchment_h18v00.cog.tiff'
-    result_filepath_uncompressed = r'/tmp/processresult_uncompressed.tif'
-    result_filepath_compressed   = r'/tmp/processresult.tif'
+    result_filepath = r'/tmp/processresult.tif'
 
     # Test the checks
     north_lat = 50
     south_lat = 95
     west_lon = -5
-    east_lon = 99
+    east_lon = 199
     try:
         _check_boundaries(north_lat, south_lat, east_lon, west_lon)
         print('Wait, we expected a ProcessorExecuteError')
@@ -294,8 +262,11 @@ if __name__ == "__main__":
     east_lon = 4
 
     print('Run the subsetting...')
-    _subset_by_window(input_raster_filepath, result_filepath_uncompressed, north_lat, south_lat, east_lon, west_lon)
-    print('Run the compression...')
-    _compress_tiff(result_filepath_uncompressed, result_filepath_compressed)
+    tiles = tile_index.get_tile_index(input_raster_basedir, config.get('subset_tile_index'),
+        config.get('subset_tile_pattern'))
+    tiles = tile_index.find_tiles(tiles, west_lon, south_lat, east_lon, north_lat)
+    input_raster_filepaths = [tile['path'] for tile in tiles]
+    grid = raster_helpers.mosaic_grid(input_raster_filepaths[0], west_lon, south_lat, east_lon, north_lat)
+    _subset_by_window(input_raster_filepaths, grid, result_filepath)
     print('FINISHED RUNNING!')
-    print('Written to: %s' % result_filepath_compressed)
+    print('Written to: %s' % result_filepath)
@@ -1,29 +1,20 @@
-
-####################################
-### This process currently fails ###
-### due to import gdal issues!   ###
-####################################
-
 import logging
 import json
 import traceback
 import os
-import requests
 
 # pygeoapi-related modules:
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 
-# geo-related modules:
-import rasterio
-import rasterio.mask
-
-# We need one of these: # TODO FIXME, does not currently work on our server due to
-# dependency hell, ever since I had to reinstall gdal when installing hydrographr.
-from osgeo import gdal # May cause: ModuleNotFoundError: No module named '_gdal'
-import gdal as gdal    # May cause: ModuleNotFoundError: No module named 'gdal'
+# geo-related modules (only imported once the process is actually run):
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+requests = lazy_import('requests')
 
 # our own helpers:
-from pygeoapi.process.aqua90m.utils.raster_helpers import compress_tiff
+import pygeoapi.process.aqua90m.utils.raster_helpers as raster_helpers
+from pygeoapi.process.aqua90m.utils.raster_helpers import import_gdal
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+import pygeoapi.process.aqua90m.utils.raster_cache as raster_cache
 
 
 '''
@@ -67,9 +58,10 @@ LOGGER = logging.getLogger(__name__)
 
 #: Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir!
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+# Default, can be overridden in config:
+DEFAULT_SUBSET_THREADS = 4
 
 
 class SubsetterPolygon(BaseProcessor):
@@ -85,6 +77,9 @@ class SubsetterPolygon(BaseProcessor):
         with open(config_file_path, 'r') as config_file:
             self.config = json.load(config_file)
 
+        # Configure GDAL caches (only the first time in this worker):
+        raster_cache.configure_gdal(self.config)
+
     def set_job_id(self, job_id: str):
         self.job_id = job_id
 
@@ -166,27 +161,27 @@ class SubsetterPolygon(BaseProcessor):
         input_raster_basedir = self.config['base_dir_subsetting_tiffs']
         input_raster_filepath = input_raster_basedir.rstrip('/')+'/sub_catchment_h18v00.cog.tiff' # TODO this is just one small file!
 
-        # Where to store output data
-        result_filepath_uncompressed = r'/tmp/subset_%s_%s_uncompressed.tiff' % (self.metadata['id'], self.job_id)
+        # Where to store output data (only if a reference is requested,
+        # otherwise it is written to memory and returned as bytes):
         downloadfilename = 'outputs-%s-%s.tiff' % (self.metadata['id'], self.job_id)
-        #result_filepath_compressed = r'/var/www/nginx/download'+os.sep+downloadfilename
-        result_filepath_compressed = r'%s%s' % (self.config['download_url'], downloadfilename) # TODO Test!
-        # TODO: Must delete result files!
+        result_filepath = None
+        return_reference = self.return_hyperlink('subset', requested_outputs)
+        if return_reference:
+            result_filepath = self.config['download_dir'].rstrip('/')+os.sep+downloadfilename
 
         # Run it:
-        _subset_by_polygon(polygon, input_raster_filepath, result_filepath_uncompressed)
-        compress_tiff(result_filepath_uncompressed, result_filepath_compressed, LOGGER)
-
-        # Read bytestream from disk and return to user as application/octet-stream:
-        with open(result_filepath_compressed, 'r+b') as myraster:
-            resultfile = myraster.read()
+        max_threads = self.config.get('subset_threads', DEFAULT_SUBSET_THREADS)
+        result_bytes = _subset_by_polygon(polygon, input_raster_filepath, result_filepath, max_threads)
 
         mimetype = 'application/octet-stream' # TODO: Probably a more specific type for GeoTIFF?
 
-        if self.return_hyperlink('subset', requested_outputs):
+        raster_cache.log_cache_stats(' (after %s)' % self.job_id)
+
+        if return_reference:
             return 'application/json', self.get_download_link('subset', downloadfilename, mimetype)
         else:
-            return mimetype, resultfile
+            # The GeoTIFF, as bytes:
+            return mimetype, result_bytes
 
 
     def return_hyperlink(self, output_name, requested_outputs):
@@ -222,33 +217,24 @@ class SubsetterPolygon(BaseProcessor):
 
         return outputs_dict
 
-def _subset_by_polygon(shape, input_raster_filepath, result_filepath_uncompressed):
+def _subset_by_polygon(shape, input_raster_filepath, result_filepath, max_threads=4):
+    # Writes the subset straight into a tiled, compressed GeoTIFF: To
+    # result_filepath, or (if None) to memory, then returns its bytes.
 
     # Subset raster
     # The values must be a GeoJSON-like dict or an object that implements the Python geo interface protocol (such as a Shapely Polygon).
     # https://gis.stackexchange.com/questions/459126/clipping-a-raster-with-a-multipolygon-using-rasterio-in-python
     #shape = { "type": "Polygon", "coordinates": [ [ [ 15.081460166988848, 66.296144397828058 ], [ 13.809362140071178, 66.465757468083737 ], [ 13.809362140071178, 66.465757468083737 ], [ 13.809362140071178, 66.465757468083737 ], [ 14.948192754645092, 67.683337008133506 ], [ 15.711451570795695, 66.859502095463029 ], [ 14.493872030745925, 66.84738687615905 ], [ 15.081460166988848, 66.296144397828058 ] ] ] }
 
-    with rasterio.open(input_raster_filepath) as src:
-        subset, subset_transform = rasterio.mask.mask(src, [shape], crop=True)
-        result_metadata = src.meta.copy()
-
-    result_metadata.update({
-        "driver": "GTiff",
-        "height": subset.shape[1],
-        "width": subset.shape[2],
-        "transform": subset_transform})
-
-    # Write raster to disk as GeoTIFF:
-    with rasterio.open(fp=result_filepath_uncompressed, mode='w',**result_metadata) as dst:
-        dst.write(subset)
-
-
+    # Same result as rasterio.mask.mask(src, [shape], crop=True), but only
+    # the raster blocks that the polygon touches are read (and written):
+    return raster_helpers.mask_by_polygon(input_raster_filepath, [shape], result_filepath, max_threads)
 
 
 
 if __name__ == "__main__":
 
+    gdal = import_gdal()
     gdal.UseExceptions()
 
     with open('config.json') as myfile:
@@ -256,13 +242,12 @@ if __name__ == "__main__":
 
     input_raster_basedir = config['base_dir_subsetting_tiffs']
     input_raster_filepath = input_raster_basedir.rstrip('/')+'/sub_catchment_h18v00.cog.tiff'
-    result_filepath_uncompressed = r'/tmp/processresult_uncompressed.tif'
     result_filepath = r'/tmp/processresult.tif'
     polygon = { "type": "Polygon", "coordinates": [ [ [ 15.081460166988848, 66.296144397828058 ], [ 13.809362140071178, 66.465757468083737 ], [ 13.809362140071178, 66.465757468083737 ], [ 13.809362140071178, 66.465757468083737 ], [ 14.948192754645092, 67.683337008133506 ], [ 15.711451570795695, 66.859502095463029 ], [ 14.493872030745925, 66.84738687615905 ], [ 15.081460166988848, 66.296144397828058 ] ] ] }
 
 
     print('RUN IT:')
-    _execute(polygon, input_raster_filepath, result_filepath_uncompressed, result_filepath)
+    _subset_by_polygon(polygon, input_raster_filepath, result_filepath)
     print('FINISHED RUNNING IT!')
     print('Written to: %s' % result_filepath)
 
@@ -3,21 +3,43 @@ logging.TRACE = 5
 logging.addLevelName(5, "TRACE")
 LOGGER = logging.getLogger(__name__)
 
+import io
 import os
+import time
+import threading
+import multiprocessing.dummy
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+import pygeoapi.process.aqua90m.utils.fast_json as fast_json
+import pygeoapi.process.aqua90m.utils.exceptions as exc
+import pygeoapi.process.aqua90m.utils.admission as admission
+import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
+import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+import pygeoapi.process.aqua90m.utils.point_table as point_table
+import pygeoapi.process.aqua90m.geofresh.routing as routing
+import pygeoapi.process.aqua90m.geofresh.cost_estimator as cost_estimator
+import pygeoapi.process.aqua90m.geofresh.query_capture as query_capture
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 # for updating process status, only for TinyDB manager...
 from pygeoapi.util import JobStatus as JobStatus
 from pygeoapi.config import get_config as get_config
-import tinydb
-from filelock import FileLock
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+# Only needed once a process was started, no need to pay for it at startup:
+psycopg2 = lazy_import('psycopg2')
+tinydb = lazy_import('tinydb')
+filelock = lazy_import('filelock')
+pd = lazy_import('pandas')
 
 class GeoFreshBaseProcessor(BaseProcessor):
 
+    # How to estimate the cost before executing (see geofresh/cost_estimator.py):
+    # 'upstream', 'basin' or 'points', or None (no estimate). BYTES_PER_UNIT is
+    # the output size per unit (e.g. per upstream segment), None for the default.
+    COST_MODEL = None
+    BYTES_PER_UNIT = None
+
     def __init__(self, processor_def: dict, process_metadata: dict):
         super().__init__(processor_def, process_metadata)
         self.supports_outputs = True
@@ -83,7 +105,7 @@ class GeoFreshBaseProcessor(BaseProcessor):
         if progress is not None:
             status_dict['progress'] = progress
 
-        with FileLock(f"{self.tinydb_job_status_file}.lock"):
+        with filelock.FileLock(f"{self.tinydb_job_status_file}.lock"):
             mydb = tinydb.TinyDB(self.tinydb_job_status_file)
             mydb.update(status_dict, tinydb.where('identifier') == self.job_id)
             mydb.close()
@@ -96,11 +118,21 @@ class GeoFreshBaseProcessor(BaseProcessor):
         LOGGER.debug(f'Inputs: {data}')
         LOGGER.log(logging.TRACE, 'Requested outputs: {outputs}')
         conn = None # Needed in case exceptino is raised during get_connection_object_config()
+        admitted = False
 
         try:
+            # Wait for a free slot before opening a connection (see utils/admission.py):
+            admission.get_controller().admit(self.process_id, self.estimate_cost(data), self.is_async_execution())
+            admitted = True
             conn = get_connection_object_config(self.config)
+            estimated = self.estimate(conn, data)
+            self.check_estimate(estimated)
             self.update_status('Started job execution', 6)
+            # Slow queries of this job are captured next to its outputs (see geofresh/query_capture.py):
+            query_capture.set_job(self.job_id, self.process_id)
+            start = time.monotonic()
             res = self._execute(data, outputs, conn)
+            cost_estimator.observe(self.process_id, estimated, time.monotonic() - start)
             LOGGER.debug(f'Finished execution: {self.process_id} (job {self.job_id})')
             LOGGER.log(logging.TRACE, 'Closing connection...')
             conn.close()
@@ -164,6 +196,20 @@ class GeoFreshBaseProcessor(BaseProcessor):
             err_msg_user = f"Database error: {err_msg_user}"
             raise ProcessorExecuteError(user_msg = err_msg_user)
 
+        except exc.TooManyRequestsException as ebusy:
+            # Note: pygeoapi's manager marks the job as failed, whatever the
+            # exception, so the client gets HTTP 400 (sync) or a failed job
+            # (async), with this message ("Server busy ... retry"):
+            raise ProcessorExecuteError(user_msg = str(ebusy))
+
+        except ProcessorExecuteError as eexec:
+            # Already has a message for the user (e.g. rejected by
+            # check_estimate()), which must not be lost by wrapping it again:
+            if conn is not None:
+                conn.close()
+            LOGGER.error(f'During process execution, this happened: {repr(eexec)}')
+            raise
+
         except KeyError as ekey:
             if conn is not None:
                 conn.close()
@@ -180,6 +226,73 @@ class GeoFreshBaseProcessor(BaseProcessor):
             raise ProcessorExecuteError(e) # TODO: Can we feed e into ProcessExecuteError?
             #TODO OR: raise ProcessorExecuteError(e, user_msg=e.message)
 
+        finally:
+            query_capture.clear_job()
+            if admitted:
+                admission.get_controller().release(self.process_id)
+
+
+    def estimate_cost(self, data):
+        # Rough cost of an execution, for the admission queue: The number of
+        # points (posted inline, or estimated from the size of the file at
+        # csv_url or points_geojson_url), or of the pairs or ids posted, at
+        # least 1. Processes may override this with a better estimate.
+        cost = 1
+        counted = cost_estimator.count_points(data)
+        if counted is not None:
+            cost = max(cost, counted['num_points'])
+        for name in ['pairs', 'subc_ids', 'subc_ids_start', 'subc_ids_end']:
+            value = data.get(name, None)
+            if isinstance(value, list):
+                cost = max(cost, len(value))
+        return cost
+
+
+    def estimate(self, conn, data):
+        # Predicted runtime and output size (or None), see geofresh/cost_estimator.py:
+        if self.COST_MODEL is None:
+            return None
+        return cost_estimator.estimate(conn, self.process_id, self.COST_MODEL, data, self.BYTES_PER_UNIT)
+
+
+    def check_estimate(self, estimated):
+        # Rejects executions that are too expensive, and expensive sync
+        # executions that could run as async job. (Within execute(), we
+        # cannot turn a sync request into an async one: pygeoapi decides
+        # about status code and Location header before and after.)
+        decision = cost_estimator.decide(estimated, self.is_async_execution())
+        if decision == 'reject':
+            err_msg = cost_estimator.explain(self.process_id, estimated)
+            LOGGER.warning(f'Rejected (job {self.job_id}): {err_msg}')
+            raise ProcessorExecuteError(user_msg=err_msg)
+
+        if decision == 'async':
+            if not self.can_run_async():
+                LOGGER.warning(f'{self.process_id}: Expensive request, but cannot run it async, running it sync.')
+                return
+            err_msg = cost_estimator.explain(self.process_id, estimated, needs_async=True)
+            LOGGER.warning(f'Rejected sync request (job {self.job_id}): {err_msg}')
+            raise ProcessorExecuteError(user_msg=err_msg)
+
+
+    def can_run_async(self):
+        # Whether the client could send this request as async job: The
+        # process supports it, and the job manager of this instance does.
+        if 'async-execute' not in self.metadata.get('jobControlOptions', []):
+            return False
+        try:
+            from pygeoapi.process.manager import get_manager
+            return get_manager(get_config()).is_async
+        except Exception as e:
+            LOGGER.error(f'{self.process_id}: Could not check the job manager: {repr(e)}')
+            return False
+
+
+    def is_async_execution(self):
+        # pygeoapi runs async jobs in a thread of its own (multiprocessing.dummy),
+        # sync jobs in the thread of the request:
+        return isinstance(threading.current_thread(), multiprocessing.dummy.DummyProcess)
+
 
     def _execute(self, data, requested_outputs, conn):
         LOGGER.error('To be implemented by derived classes...')
@@ -188,6 +301,71 @@ class GeoFreshBaseProcessor(BaseProcessor):
 
 
 
+    def points_by_region_and_basin(self, conn, data):
+        # For plural processes: Reads the points from the inputs (GeoJSON
+        # FeatureCollection posted or via URL, or CSV via URL), gets their
+        # subc_id, basin_id and reg_id (unless present already), and groups
+        # them by region and basin (see routing.collect_departing_points_by_region_and_basin()).
+        # Returns the grouped points and the input format ('json' or 'csv').
+        points_geojson = data.get('points_geojson', None)
+        points_geojson_url = data.get('points_geojson_url', None)
+        csv_url = data.get('csv_url', None)
+        colname_lon = data.get('colname_lon', 'lon')
+        colname_lat = data.get('colname_lat', 'lat')
+        colname_site_id = data.get('colname_site_id', None)
+
+        utils.mandatory_parameters(dict(colname_site_id=colname_site_id))
+        utils.exactly_one_param(dict(points_geojson=points_geojson,
+            points_geojson_url=points_geojson_url, csv_url=csv_url))
+
+        if points_geojson_url is not None:
+            points_geojson = utils.download_geojson(points_geojson_url)
+
+        if points_geojson is not None:
+
+            # Check if FeatureCollection:
+            if not points_geojson['type'] == 'FeatureCollection':
+                err_msg = f"Input GeoJSON has to be a FeatureCollection, not '{points_geojson['type']}'."
+                raise ProcessorExecuteError(err_msg)
+
+            # Check if every feature has id:
+            geojson_helpers.check_feature_collection_property(points_geojson, colname_site_id)
+
+            try:
+                geojson_helpers.check_feature_collection_property(points_geojson, "subc_id")
+                geojson_helpers.check_feature_collection_property(points_geojson, "basin_id")
+                geojson_helpers.check_feature_collection_property(points_geojson, "reg_id")
+                LOGGER.info('Input FeatureCollection already contains required properties (subc_id, basin_id, reg_id), using that...')
+                points = points_geojson
+            except exc.UserInputException as e:
+                points = basic_queries.get_subcid_basinid_regid__points_to_dataframe(
+                    conn, point_table.from_geojson(points_geojson, colname_site_id=colname_site_id))
+                # Now that a dataframe was created from Database output,
+                # the column name for the site_ids has changed:
+                colname_site_id = 'site_id'
+            return routing.collect_departing_points_by_region_and_basin(points, colname_site_id), 'json'
+
+        input_df = utils.access_csv_as_dataframe(csv_url)
+        if not (colname_site_id in input_df.columns):
+            err_msg = f"Please add a column '{colname_site_id}' to your input dataframe."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+        if all(colname in input_df.columns for colname in ['subc_id', 'basin_id', 'reg_id']):
+            LOGGER.debug('Input dataframe already contains required columns (subc_id, basin_id, reg_id) for each point, using that...')
+            temp_df = input_df
+        elif 'subc_id' in input_df.columns:
+            LOGGER.debug('Input dataframe already contains column subc_id, querying basin_id and reg_id for them...')
+            subc_ids = input_df['subc_id'].astype(int).tolist()
+            temp_df = basic_queries.get_basinid_regid_from_subcid_plural(conn, subc_ids)
+            temp_df = pd.merge(input_df, temp_df, on="subc_id")
+        else:
+            LOGGER.debug('Querying required columns (subc_id, basin_id, reg_id) for each point...')
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(
+                conn, point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id))
+        return routing.collect_departing_points_by_region_and_basin(temp_df, colname_site_id), 'csv'
+
+
     def return_results(self, resultname, requested_outputs, output_df=None, output_json=None, comment=None):
 
         do_return_link = utils.return_hyperlink(resultname, requested_outputs)
@@ -223,7 +401,83 @@ class GeoFreshBaseProcessor(BaseProcessor):
                 return 'application/json', output_dict_with_url
 
             else:
-                return 'application/json', output_json
+                # pygeoapi serialises this itself, and cannot handle NumPy types:
+                return 'application/json', fast_json.to_native(output_json)
+
+
+    def return_streamed_results(self, resultname, requested_outputs, chunks, mimetype='application/geo+json', extension='json'):
+        # For results that are already serialised, e.g. GeoJSON assembled by
+        # the database (see geofresh/geojson_streaming.py): The text chunks
+        # are written to the download file as they come, or joined (so the
+        # whole result is in memory) and passed through to the client,
+        # without parsing them. Must be called within
+        # _execute(), as the chunks are read from the open connection.
+        # (pygeoapi only serialises results of type application/json itself,
+        # so here we have to pass a different mimetype.)
+        # For NDJSON, pass mimetype 'application/x-ndjson' and extension 'ndjson'.
+
+        if utils.return_hyperlink(resultname, requested_outputs):
+            output_dict_with_url = utils.store_chunks_to_file(resultname, chunks,
+                self.metadata, self.job_id,
+                self.download_dir,
+                self.download_url,
+                extension = extension)
+            return 'application/json', output_dict_with_url
+
+        else:
+            return mimetype, ''.join(chunks).encode('utf-8')
+
+
+    def return_binary_results(self, resultname, requested_outputs, write_file, mimetype, extension, comment=None):
+        # For binary results (e.g. a distance matrix as NumPy or Parquet file):
+        # write_file is called with a path or a file object, and writes the
+        # result to it. Stored to the download file, or passed through to the
+        # client as bytes.
+
+        if utils.return_hyperlink(resultname, requested_outputs):
+            output_dict_with_url = utils.store_to_binary_file(resultname, write_file,
+                self.metadata, self.job_id,
+                self.download_dir,
+                self.download_url,
+                extension = extension)
+            if comment is not None:
+                output_dict_with_url['comment'] = comment
+            return 'application/json', output_dict_with_url
+
+        else:
+            buffer = io.BytesIO()
+            write_file(buffer)
+            return mimetype, buffer.getvalue()
+
+
+
+
+
+if __name__ == '__main__':
+
+    # Checks that a request rejected by check_estimate() reaches the client
+    # with its message (user_msg), without a database (config from
+    # AQUA90M_CONFIG_FILE, for download_dir), e.g.:
+    # python -m pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor
 
+    class FakeConnection:
+        def close(self):
+            pass
 
+    class TooExpensiveProcessor(GeoFreshBaseProcessor):
+        COST_MODEL = 'points'
+        def estimate(self, conn, data):
+            return {'num_points': 10**9, 'num_regions': 50, 'exact': True,
+                'predicted_seconds': 10**9, 'predicted_bytes': 10**12}
 
+    get_connection_object_config = lambda config: FakeConnection()
+    processor = TooExpensiveProcessor({'name': 'test'}, {'id': 'test-process'})
+    print('TEST CASE 1: Rejected request keeps its user_msg...', end="", flush=True)  # no newline
+    try:
+        processor.execute({})
+        raise ValueError('NOT OK: Not rejected.')
+    except ProcessorExecuteError as e:
+        expected = cost_estimator.explain('test-process', processor.estimate(None, {}))
+        if not e.user_msg == expected:
+            raise ValueError(f' NOT OK: user_msg is {e.user_msg!r}, expected {expected!r}.')
+        print(' OK.')
@@ -7,8 +7,6 @@ import os
 import sys
 import traceback
 import json
-import pandas as pd
-import requests
 import tempfile
 import urllib
 import pygeoapi.process.aqua90m.utils.exceptions as exc
@@ -33,9 +31,7 @@ curl -X POST https://${PYSERVER}/processes/filter-attribute-by-list/execution \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class FilterAttributeByListProcessor(BaseProcessor):
@@ -7,16 +7,14 @@ import os
 import sys
 import traceback
 import json
-import pandas as pd
-import requests
 import tempfile
 import urllib
 import pygeoapi.process.aqua90m.utils.exceptions as exc
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
-import pygeoapi.process.aqua90m.utils.dataframe_utils as dataframe_utils
-import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
+import pygeoapi.process.aqua90m.utils.filter_engine as filter_engine
 import pygeoapi.process.aqua90m.utils.conversion as conversion
+import pygeoapi.process.aqua90m.utils.fast_json as fast_json
 
 '''
 # Filter occurrences by site_id:
@@ -63,6 +61,22 @@ curl -X POST https://${PYSERVER}/processes/filter-by-attribute/execution \
     }
 }'
 
+# Filter occurrences by site_id or longitude:
+curl -X POST https://${PYSERVER}/processes/filter-by-attribute/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+        "keep": {"site_id": ["FP1", "FP10", "FP20"]},
+        "conditions": {"longitude": "x<20.8"},
+        "combine": "or",
+        "comment": "barbus sites"
+    },
+    "outputs": {
+        "transmissionMode": "reference"
+    }
+}'
+
 # Filtering by species name:
 curl -X POST https://${PYSERVER}/processes/filter-by-attribute/execution \
 --data '{
@@ -179,9 +193,7 @@ curl -X POST https://${PYSERVER}/processes/filter-by-attribute/execution \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class FilterByAttributeProcessor(BaseProcessor):
@@ -246,6 +258,8 @@ class FilterByAttributeProcessor(BaseProcessor):
         keep = data.get('keep', None)
         conditions = data.get('conditions', None)
         # TODO: With the dictionary format, users cannot pass several conditions for one attribute, e.g. x>10 and x>5...
+        # Keep rows that match all conditions ("and"), or any of them ("or"):
+        combine = data.get('combine', 'and')
 
         ## Check user inputs:
         #if csv_url is not None and colname_site_id is None:
@@ -274,6 +288,10 @@ class FilterByAttributeProcessor(BaseProcessor):
         ### Actual ... ###
         ##################
 
+        # All values to keep and all conditions are compiled into one filter,
+        # which is then evaluated in one pass:
+        compiled_filter = filter_engine.compile_filter(keep, conditions, combine)
+
         ## Potential outputs:
         output_json = None
         output_df = None
@@ -293,29 +311,9 @@ class FilterByAttributeProcessor(BaseProcessor):
             else:
                 err_msg = "Need a FeatureCollection to be able to filter."
 
-            # Filter geojson by value-list, iteratively:
-            if keep is not None:
-                for keep_attribute, keep_values in keep.items():
-                    LOGGER.debug(f'Filtering based on property {keep_attribute}, keeping values {keep_values}')
-                    geojson_helpers.check_feature_collection_property(points_geojson, keep_attribute)
-                    points_geojson = geojson_helpers.filter_geojson(points_geojson, keep_attribute, keep_values)
-                    LOGGER.debug(f'Filtering based on property {keep_attribute}: kept {len(points_geojson["features"])} features.')
-                LOGGER.debug(f'Filtering... DONE. Kept {len(points_geojson["features"])} features.')
-                output_json = points_geojson
-
-
-            # Filter geojson by numeric condition, iteratively:
-            if conditions is not None:
-                for keep_attribute, condition in conditions.items():
-                    LOGGER.debug(f'Filtering based on property {keep_attribute}, keeping values {condition}')
-                    geojson_helpers.check_feature_collection_property(points_geojson, keep_attribute)
-                    condition_dict = dataframe_utils.parse_filter_condition(condition, var="x")
-                    LOGGER.debug(f'FILTER CONDITION: {condition_dict}')
-                    points_geojson = geojson_helpers.filter_geojson_by_condition(
-                        points_geojson, keep_attribute, condition_dict)
-                    LOGGER.debug(f'Filtering based on property {keep_attribute}: kept {len(points_geojson["features"])} features.')
-                LOGGER.debug(f'Filtering... DONE. Kept {len(points_geojson["features"])} features.')
-                output_json = points_geojson
+            # Filter geojson by values and conditions, all at once:
+            output_json = filter_engine.filter_feature_collection(points_geojson, compiled_filter)
+            LOGGER.debug(f'Filtering... DONE. Kept {len(output_json["features"])} features.')
 
 
         ## Handle CSV case:
@@ -332,25 +330,9 @@ class FilterByAttributeProcessor(BaseProcessor):
                     dict(colname_lat=colname_lat, colname_lon=colname_lon),
                     additional_message=msg)
 
-            # Filter dataframe by value-list, iteratively:
-            if keep is not None:
-                for keep_attribute, keep_values in keep.items():
-                    LOGGER.debug(f'Filtering based on column {keep_attribute}, keeping values {keep_values}')
-                    input_df = dataframe_utils.filter_dataframe(input_df, keep_attribute, keep_values)
-                    LOGGER.debug(f'Filtering based on column {keep_attribute} kept {input_df.shape[0]} rows.')
-                LOGGER.debug(f'Filtering... DONE. Kept {input_df.shape[0]} rows.')
-                output_df = input_df
-
-            # Filter dataframe by numeric condition, iteratively:
-            if conditions is not None:
-                for keep_attribute, condition in conditions.items():
-                    LOGGER.debug(f'Filtering based on column {keep_attribute}, keeping values {condition}')
-                    condition_dict = dataframe_utils.parse_filter_condition(condition, var="x")
-                    input_df = dataframe_utils.filter_dataframe_by_condition(
-                        input_df, keep_attribute, condition_dict)
-                    LOGGER.debug(f'Filtering based on column {keep_attribute}: kept {input_df.shape[0]} rows.')
-                LOGGER.debug(f'Filtering... DONE. Kept {input_df.shape[0]} rows.')
-                output_df = input_df
+            # Filter dataframe by values and conditions, all at once:
+            output_df = filter_engine.filter_dataframe(input_df, compiled_filter)
+            LOGGER.debug(f'Filtering... DONE. Kept {output_df.shape[0]} rows.')
 
 
         #####################
@@ -417,7 +399,8 @@ class FilterByAttributeProcessor(BaseProcessor):
                 return 'application/json', output_dict_with_url
 
             else:
-                return 'application/json', output_json
+                # pygeoapi serialises this itself, and cannot handle NumPy types:
+                return 'application/json', fast_json.to_native(output_json)
 
 
 if __name__ == '__main__':
@@ -7,7 +7,6 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
@@ -48,13 +47,14 @@ curl -X POST https://${PYSERVER}/processes/get-basin-polygon/execution \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class BasinPolygonGetter(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'basin'
+    BYTES_PER_UNIT = 100
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
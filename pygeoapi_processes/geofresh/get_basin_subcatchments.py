@@ -7,11 +7,12 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.geofresh.get_polygons as get_polygons
+import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
+import pygeoapi.process.aqua90m.geofresh.pagination as pagination
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -75,13 +76,14 @@ curl -X POST "https://$PYSERVER/processes/get-basin-subcatchments/execution" \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class BasinSubcatchmentsGetter(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'basin'
+    BYTES_PER_UNIT = 2000
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -99,14 +101,30 @@ class BasinSubcatchmentsGetter(GeoFreshBaseProcessor):
         #min_strahler = data.get('min_strahler', 0) # Not in database # TODO do we need it?
         geometry_only = data.get('geometry_only', False)
         add_segment_ids = data.get('add_segment_ids', False)
+        server_side_geojson = data.get('server_side_geojson', False)
+        result_format = data.get('result_format', 'geojson')
         comment = data.get('comment') # optional
 
         # Check type:
         utils.is_bool_parameters(dict(
             geometry_only=geometry_only,
-            add_segment_ids=add_segment_ids
+            add_segment_ids=add_segment_ids,
+            server_side_geojson=server_side_geojson
         ))
 
+        # Check simplification options (may be None):
+        simplify_tolerance, coordinate_precision = geometry_simplification.check_options(
+            data.get('simplify_tolerance', None), data.get('coordinate_precision', None))
+
+        # Check paging options (may be None):
+        limit, cursor = pagination.check_paging(data.get('limit', None), data.get('cursor', None))
+
+        # Check result format
+        if not result_format == 'geojson' and not result_format == 'ndjson':
+            err_msg = f"Malformed parameter 'result_format': Format '{result_format}' not supported. Please specify 'geojson' or 'ndjson'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
         # Check presence:
         utils.at_least_one_param({
             "basin_id": basin_id,
@@ -131,15 +149,49 @@ class BasinSubcatchmentsGetter(GeoFreshBaseProcessor):
         elif basin_id is not None:
             reg_id = basic_queries.get_regid_from_basinid(conn, LOGGER, basin_id)
 
+        ## NDJSON: One Feature per line, always streamed from the database:
+        if result_format == 'ndjson':
+            LOGGER.debug(f'Now, streaming subcatchments (NDJSON) for basin_id: {basin_id}')
+            chunks = get_polygons.stream_subcatchment_polygons_by_basin(
+                conn, basin_id, reg_id,
+                geometry_only = geometry_only,
+                add_segment_ids = add_segment_ids,
+                comment = comment,
+                simplify_tolerance = simplify_tolerance,
+                coordinate_precision = coordinate_precision,
+                limit = limit,
+                after_subc_id = cursor,
+                ndjson = True)
+            return self.return_streamed_results('subcatchments', requested_outputs, chunks,
+                mimetype='application/x-ndjson', extension='ndjson')
+
+        ## Pass-through mode: GeoJSON assembled by PostGIS, streamed to the result:
+        if server_side_geojson:
+            LOGGER.debug(f'Now, streaming subcatchments for basin_id: {basin_id}')
+            chunks = get_polygons.stream_subcatchment_polygons_by_basin(
+                conn, basin_id, reg_id,
+                geometry_only = geometry_only,
+                add_segment_ids = add_segment_ids,
+                comment = comment,
+                simplify_tolerance = simplify_tolerance,
+                coordinate_precision = coordinate_precision,
+                limit = limit,
+                after_subc_id = cursor)
+            return self.return_streamed_results('subcatchments', requested_outputs, chunks)
+
         ## Get GeoJSON geometry:
         LOGGER.debug(f'Now, getting subcatchments for basin_id: {basin_id}')
         geojson_collection = None
         if geometry_only:
             geojson_collection = get_polygons.get_subcatchment_polygons_geometry_coll_by_basin(
-                conn, basin_id, reg_id)
+                conn, basin_id, reg_id,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision,
+                limit = limit, after_subc_id = cursor)
         else:
             geojson_collection = get_polygons.get_subcatchment_polygons_feature_coll_by_basin(
-                conn, basin_id, reg_id)
+                conn, basin_id, reg_id,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision,
+                limit = limit, after_subc_id = cursor)
 
             if add_segment_ids:
                 segment_ids = []
@@ -7,11 +7,11 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.geofresh.get_linestrings as get_linestrings
+import pygeoapi.process.aqua90m.geofresh.pagination as pagination
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -72,17 +72,42 @@ curl -X POST https://$PYSERVER/processes/get-basin-subcids/execution \
         "transmissionMode": "reference"
     }
 }'
+
+# Request a list, based on a basin_id, in pages of 10000 subc_ids
+# (pass the "next_cursor" of the result as "cursor" to get the next page):
+curl -X POST https://$PYSERVER/processes/get-basin-subcids/execution \
+--header "Content-Type: application/json" \
+--data '{
+    "inputs": {
+        "basin_ids": [1293500],
+        "limit": 10000,
+        "cursor": 506319029
+    }
+}'
+
+# Request NDJSON (one line per subcatchment), streamed to a file:
+curl -X POST https://$PYSERVER/processes/get-basin-subcids/execution \
+--header "Content-Type: application/json" \
+--data '{
+    "inputs": {
+        "basin_ids": [1293500],
+        "result_format": "ndjson"
+    },
+    "outputs": {
+        "transmissionMode": "reference"
+    }
+}'
 '''
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class BasinSubcidsGetter(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'basin'
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -109,8 +134,18 @@ class BasinSubcidsGetter(GeoFreshBaseProcessor):
         lat = data.get('lat', None)
         # Other params:
         min_strahler = data.get('min_strahler', None)
+        result_format = data.get('result_format', 'json')
         comment = data.get('comment') # optional
 
+        # Check paging options (may be None):
+        limit, cursor = pagination.check_paging(data.get('limit', None), data.get('cursor', None))
+
+        # Check result format
+        if not result_format == 'json' and not result_format == 'ndjson':
+            err_msg = f"Malformed parameter 'result_format': Format '{result_format}' not supported. Please specify 'json' or 'ndjson'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
         # Check presence:
         utils.at_least_one_param({
             "basin_ids": basin_ids,
@@ -270,6 +305,25 @@ class BasinSubcidsGetter(GeoFreshBaseProcessor):
                     })
 
 
+        # Pages are defined per basin:
+        if pagination.is_paged(limit, cursor) and len(final_list) > 1:
+            err_msg = f'Paging (limit, cursor) is only possible for one basin, not {len(final_list)}.'
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+        ###########################
+        ### NDJSON: Stream them ###
+        ###########################
+
+        if result_format == 'ndjson':
+            LOGGER.debug(f'Now, streaming subc_ids (NDJSON) for {len(final_list)} basins.')
+            chunks = (chunk for item in final_list
+                for chunk in basic_queries.stream_subcids_from_basinid(
+                    conn, item["basin_id"], item["reg_id"], min_strahler=min_strahler,
+                    limit=limit, after_subc_id=cursor))
+            return self.return_streamed_results('basin_subcatchment_ids', requested_outputs, chunks,
+                mimetype='application/x-ndjson', extension='ndjson')
+
         ########################
         ### Get all subc_ids ###
         ########################
@@ -283,9 +337,11 @@ class BasinSubcidsGetter(GeoFreshBaseProcessor):
             # TODO: This throws exceptions if basin has no subc_ids at that min_strahler!
             # Just return []...
             all_subcids = basic_queries.get_all_subcids_from_basinid(
-                    conn, LOGGER, basin_id, reg_id, min_strahler=min_strahler)
+                    conn, LOGGER, basin_id, reg_id, min_strahler=min_strahler,
+                    limit=limit, after_subc_id=cursor)
             item["num_subcatchments"] = len(all_subcids)
             item["subc_ids"] = all_subcids
+            pagination.add_page_info(item, all_subcids, limit, cursor)
 
 
         # Note: This is not GeoJSON (on purpose), as we did not look for geometry:
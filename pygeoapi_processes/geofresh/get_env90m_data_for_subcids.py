@@ -7,12 +7,13 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.geofresh.get_env90m as get_env90m
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+psycopg2 = lazy_import('psycopg2')
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
 '''
@@ -31,9 +32,7 @@ curl -X POST --location 'http://localhost:5000/processes/get-local-subcids-plura
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class Env90mGetter(BaseProcessor):
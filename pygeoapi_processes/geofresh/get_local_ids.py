@@ -7,7 +7,6 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 import pygeoapi.process.aqua90m.utils.exceptions as exc
@@ -101,9 +100,7 @@ curl -X POST https://${PYSERVER}/processes/get-local-ids/execution \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class LocalIdGetter(GeoFreshBaseProcessor):
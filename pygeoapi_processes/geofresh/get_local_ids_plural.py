@@ -7,16 +7,16 @@ import os
 import sys
 import traceback
 import json
-import pandas as pd
-import psycopg2
-import requests
 import tempfile
 import urllib
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
 import pygeoapi.process.aqua90m.utils.exceptions as exc
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -230,13 +230,13 @@ curl -X POST https://${PYSERVER}/processes/get-local-ids-plural/execution \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class LocalIdGetterPlural(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'points'
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -346,8 +346,8 @@ class LocalIdGetterPlural(GeoFreshBaseProcessor):
             if 'subc_id' in which_ids or 'basin_id' in which_ids:
 
                 if result_format == 'csv':
-                    output_df = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(
-                        conn, points_geojson, colname_site_id=None)
+                    output_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(
+                        conn, point_table.from_geojson(points_geojson, colname_site_id=None))
 
                 elif result_format == 'json':
                     # This returns just plain JSON, not GeoJSON!
@@ -363,7 +363,7 @@ class LocalIdGetterPlural(GeoFreshBaseProcessor):
             elif 'reg_id' in which_ids:
 
                 if result_format == 'csv':
-                    output_df = basic_queries.get_regid__geojson_to_dataframe(conn, points_geojson, colname_site_id=None)
+                    output_df = basic_queries.get_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson, colname_site_id=None))
 
                 else:
                     err_msg = "Currently not allowed: (geo)json output, when getting reg_id only." # TODO
@@ -403,8 +403,8 @@ class LocalIdGetterPlural(GeoFreshBaseProcessor):
                 n = 0
                 for chunk_df in input_df_generator:
                     n += 1
-                    output_df_chunk = basic_queries.get_subcid_basinid_regid__dataframe_to_dataframe(
-                        conn, chunk_df, colname_lon, colname_lat, colname_site_id=colname_site_id)
+                    output_df_chunk = basic_queries.get_subcid_basinid_regid__points_to_dataframe(
+                        conn, point_table.from_dataframe(chunk_df, colname_lon, colname_lat, colname_site_id))
                     output_df_list.append(output_df_chunk)
                     self.update_status_chunks(n, num_rows_per_chunk, num_rows)
                 output_df = pd.concat(output_df_list, ignore_index=True)
@@ -416,8 +416,8 @@ class LocalIdGetterPlural(GeoFreshBaseProcessor):
                 n = 0
                 for chunk_df in input_df_generator:
                     n += 1
-                    output_df_chunk = basic_queries.get_regid__dataframe_to_dataframe(
-                        conn, chunk_df, colname_lon, colname_lat, colname_site_id=colname_site_id)
+                    output_df_chunk = basic_queries.get_regid__points_to_dataframe(
+                        conn, point_table.from_dataframe(chunk_df, colname_lon, colname_lat, colname_site_id))
                     output_df_list.append(output_df_chunk)
                     self.update_status_chunks(n, num_rows_per_chunk, num_rows)
                 output_df = pd.concat(output_df_list, ignore_index=True)
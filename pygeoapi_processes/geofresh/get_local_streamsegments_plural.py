@@ -7,10 +7,10 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.geofresh.get_linestrings as get_linestrings
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
@@ -53,9 +53,7 @@ curl -X POST https://${PYSERVER}/processes/get-local-streamsegments-plural/execu
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class LocalStreamSegmentsGetterPlural(GeoFreshBaseProcessor):
@@ -171,7 +169,7 @@ class LocalStreamSegmentsGetterPlural(GeoFreshBaseProcessor):
 
             LOGGER.debug('Querying subc_id etc. for each point in input GeoJSON...')
             #points_geojson = get_subcid_basinid_regid_for_all_2json(conn, LOGGER, points_geojson_with_siteid, colname_site_id)
-            temp_df = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson, colname_site_id=colname_site_id)
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson, colname_site_id=colname_site_id))
             all_subc_ids, reg_id, basin_id = self._get_ids_and_check(temp_df)
 
         ## Handle CSV case:
@@ -187,7 +185,7 @@ class LocalStreamSegmentsGetterPlural(GeoFreshBaseProcessor):
                 LOGGER.debug('Input dataframe already contains subc_id for each point, using that...')
             else:
                 LOGGER.debug('Querying subc_id etc. for each point in input dataframe...')
-                temp_df = basic_queries.get_subcid_basinid_regid__dataframe_to_dataframe(conn, input_df, colname_lon, colname_lat, colname_site_id)
+                temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id))
             all_subc_ids, reg_id, basin_id = self._get_ids_and_check(temp_df)
 
         ## Next, for all subc_ids, get the stream segments!
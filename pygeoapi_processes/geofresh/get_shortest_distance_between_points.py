@@ -8,10 +8,10 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.geofresh.distances as distances
 import pygeoapi.process.aqua90m.geofresh.get_linestrings as get_linestrings
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
@@ -126,13 +126,36 @@ curl -X POST https://${PYSERVER}/processes/get-shortest-distance-between-points/
   }
 }'
 
+# Input: One set of subc_ids
+# Output: Binary matrix (float32, compressed NumPy file, or Parquet), only
+# the pairs that are at most 50 km apart (sparse):
+# Reading: data = numpy.load('...npz'); data['row'], data['col'], data['distance'], data['start_ids'], ...
+curl -X POST https://${PYSERVER}/processes/get-shortest-distance-between-points/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+    "subc_ids": [506251712, 506251713, 506252055],
+    "result_format": "npz",
+    "sparse": true,
+    "max_distance": 50000,
+    "comment": "located in schlei area"
+  },
+  "outputs": {
+    "transmissionMode": "reference"
+  }
+}'
+
 '''
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+# Binary formats of the distance matrix: result_format -> (mimetype, file extension)
+BINARY_FORMATS = {
+    'npz': ('application/octet-stream', 'npz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
 
 
 class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
@@ -179,6 +202,9 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
         #colname_site_id = data.get('colname_site_id', None)
         # Output format (can be csv or json):
         result_format = data.get('result_format', 'json')
+        # Binary matrix (npz, parquet): Only pairs with a path (and at most max_distance):
+        sparse = data.get('sparse', False)
+        max_distance = data.get('max_distance', None)
         # Comment:
         comment = data.get('comment') # optional
 
@@ -211,8 +237,22 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
         ### Validate input parameters ###
         #################################
 
-        if not result_format == 'json' and not result_format == 'csv':
-            err_msg = f"Malformed parameter 'result_format': Format '{result_format}' not supported. Please specify 'csv' or 'json'."
+        if not result_format in ['json', 'csv'] + list(BINARY_FORMATS.keys()):
+            err_msg = f"Malformed parameter 'result_format': Format '{result_format}' not supported. Please specify 'csv', 'json', 'npz' or 'parquet'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+        utils.is_bool_parameters(dict(sparse=sparse))
+        if max_distance is not None:
+            try:
+                max_distance = float(max_distance)
+            except (ValueError, TypeError) as e:
+                err_msg = f"Malformed parameter 'max_distance': Must be a number (in meters), not '{max_distance}'."
+                LOGGER.error(err_msg)
+                raise ProcessorExecuteError(err_msg)
+            sparse = True
+        if sparse and not result_format in BINARY_FORMATS:
+            err_msg = f"Parameters 'sparse' and 'max_distance' are only supported for result_format 'npz' or 'parquet', not '{result_format}'."
             LOGGER.error(err_msg)
             raise ProcessorExecuteError(err_msg)
 
@@ -257,7 +297,7 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
         if singular:
             return self.singular_case(conn, lon_start, lat_start, subc_id_start, lon_end, lat_end, subc_id_end, requested_outputs, comment, result_format)
         else:
-            return self.plural_case(conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format)
+            return self.plural_case(conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format, sparse, max_distance)
 
 
     def singular_case(self, conn, lon_start, lat_start, subc_id_start, lon_end, lat_end, subc_id_end, requested_outputs, comment, result_format):
@@ -318,7 +358,7 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
         return self.return_results('distances_matrix', requested_outputs, output_df=None, output_json=json_result, comment=comment)
 
 
-    def plural_case(self, conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format):
+    def plural_case(self, conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format, sparse=False, max_distance=None):
 
         # Symmetric or asymmetric matrix? I.e. are the start and end points
         # the same, or different sets?
@@ -346,7 +386,19 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
             all_subc_ids_start, all_subc_ids_end, reg_id, basin_id = self.plural_asymmetric(conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end)
 
         # Get distance:
-        if result_format == "csv":
+        if result_format in BINARY_FORMATS:
+            # As float32 array, written to a binary file (no JSON, no strings):
+            start_ids, end_ids, distance_array = distances.get_dijkstra_distance_many_to_many(
+                conn, all_subc_ids_start, all_subc_ids_end, reg_id, basin_id, "arrays")
+            if result_format == 'npz':
+                write_file = lambda file_or_path: distances.to_npz(
+                    file_or_path, start_ids, end_ids, distance_array, sparse, max_distance)
+            else:
+                output_df = distances.to_parquet_dataframe(start_ids, end_ids, distance_array, sparse, max_distance)
+                write_file = lambda file_or_path: self._write_parquet(output_df, file_or_path)
+            mimetype, extension = BINARY_FORMATS[result_format]
+            return self.return_binary_results('distances_matrix', requested_outputs, write_file, mimetype, extension, comment=comment)
+        elif result_format == "csv":
             output_df = distances.get_dijkstra_distance_many_to_many(
                 conn, all_subc_ids_start, all_subc_ids_end, reg_id, basin_id, "dataframe")
             return self.return_results('distances_matrix', requested_outputs, output_df=output_df, comment=comment)
@@ -357,12 +409,22 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
             return self.return_results('distances_matrix', requested_outputs, output_json=json_result, comment=comment)
 
 
+    def _write_parquet(self, output_df, file_or_path):
+        # Needs pyarrow (optional dependency):
+        try:
+            output_df.to_parquet(file_or_path, compression='zstd', index=False)
+        except ImportError as e:
+            err_msg = f"result_format 'parquet' is not available on this server ({e}). Please use 'npz'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+
     def plural_symmetric(self, conn, points_geojson, subc_ids, input_df, colname_lon, colname_lat):
 
         # Collect reg_id, basin_id, subc_id in a temporary dataframe
         if points_geojson is not None:
             LOGGER.debug('START: Getting dijkstra shortest distance between a number of points (start and end points are the same)...')
-            temp_df = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson, colname_site_id=None)
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson, colname_site_id=None))
             # TODO does this return NAs?
         elif subc_ids is not None:
             LOGGER.debug('START: Getting dijkstra shortest distance between a number of subcatchments (start and end points are the same)...')
@@ -371,7 +433,7 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
             # TODO does this return NAs?
         elif input_df is not None:
             LOGGER.debug('START: Getting dijkstra shortest distance between a number of points (start and end points are the same)...')
-            temp_df = basic_queries.get_subcid_basinid_regid__dataframe_to_dataframe(conn, input_df, colname_lon, colname_lat, colname_site_id=None)
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id=None))
             # TODO does this return NAs?
 
         # Retrieve subc_ids from the dataframe, and check if basins and regions match:
@@ -387,7 +449,7 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
 
         # Collect reg_id, basin_id, subc_id of set of start subcatchments:
         if points_geojson_start is not None:
-            temp_df_start = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson_start, colname_site_id=None)
+            temp_df_start = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson_start, colname_site_id=None))
             # TODO does this return NAs?
         elif subc_ids_start is not None:
             all_subc_ids_start = set(subc_ids_start)
@@ -400,7 +462,7 @@ class ShortestDistanceBetweenPointsGetter(GeoFreshBaseProcessor):
 
         # Collect reg_id, basin_id, subc_id of set of end subcatchments:
         if points_geojson_end is not None:
-            temp_df_end   = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson_end, colname_site_id=None)
+            temp_df_end   = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson_end, colname_site_id=None))
             # TODO does this return NAs?
         elif subc_ids_end is not None:
             all_subc_ids_end = set(subc_ids_end)
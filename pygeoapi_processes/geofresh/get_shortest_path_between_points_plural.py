@@ -8,14 +8,15 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
-import pandas as pd
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.geofresh.routing as routing
 import pygeoapi.process.aqua90m.geofresh.get_linestrings as get_linestrings
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -121,6 +122,58 @@ curl -X POST https://${PYSERVER}/processes/get-shortest-path-between-points-plur
   }
 }'
 
+## Pairs mode: One path per pair (start -> end), not a matrix.
+## Pairs may be in different basins (those are flagged, not routed).
+## INPUT:  pairs (subc_ids or lon/lat)
+## OUTPUT: Plain JSON directly
+curl -X POST https://${PYSERVER}/processes/get-shortest-path-between-points-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "pairs": [
+            [506251712, 506252055],
+            {"pair_id": "b", "subc_id_start": 506251712, "subc_id_end": 506251713},
+            {"pair_id": "c", "lon_start": 9.9217, "lat_start": 54.6917, "lon_end": 9.9312, "lat_end": 54.6933}
+        ],
+        "comment": "not sure where"
+  }
+}'
+
+## Pairs mode, from CSV (one row per pair):
+## INPUT:  CSV File with start and end coordinates
+## OUTPUT: CSV File
+curl -X POST https://${PYSERVER}/processes/get-shortest-path-between-points-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "csv_url": "https://example.com/pairs.csv",
+        "colname_lon": "lon_start",
+        "colname_lat": "lat_start",
+        "colname_lon_end": "lon_end",
+        "colname_lat_end": "lat_end",
+        "colname_pair_id": "pair_id",
+        "result_format": "csv",
+        "comment": "not sure where"
+  },
+  "outputs": {
+    "transmissionMode": "reference"
+  }
+}'
+
+## Compact path encoding: Each segment listed once, with its parent (see
+## geofresh/path_trie.py for expanding the paths on the client side):
+## INPUT:  subc_ids
+## OUTPUT: Plain JSON directly
+curl -X POST https://${PYSERVER}/processes/get-shortest-path-between-points-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "subc_ids": [506251712, 506252055, 506251712, 506251713],
+        "path_encoding": "trie",
+        "comment": "not sure where"
+  }
+}'
+
 ## Not Implemented yet:
 curl -X POST https://${PYSERVER}/processes/get-shortest-path-between-points-plural/execution \
 --header "Content-Type: application/json" \
@@ -136,9 +189,7 @@ curl -X POST https://${PYSERVER}/processes/get-shortest-path-between-points-plur
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
@@ -180,9 +231,16 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
         csv_url = data.get('csv_url', None)
         colname_lon = data.get('colname_lon', 'lon')
         colname_lat = data.get('colname_lat', 'lat')
+        # Pairs mode: List of pairs, or CSV with start and end per row:
+        pairs = data.get('pairs', None)
+        colname_lon_end = data.get('colname_lon_end', None)
+        colname_lat_end = data.get('colname_lat_end', None)
+        colname_pair_id = data.get('colname_pair_id', None)
         #colname_site_id = data.get('colname_site_id', None)
         # Output format (can be csv or json):
         result_format = data.get('result_format', 'json')
+        # Paths listed in full ('dense'), or each segment only once ('trie', JSON only):
+        path_encoding = data.get('path_encoding', 'dense')
         # Comment:
         comment = data.get('comment') # optional
 
@@ -221,6 +279,16 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
             LOGGER.error(err_msg)
             raise ProcessorExecuteError(err_msg)
 
+        # Check path encoding
+        if not path_encoding in ['dense', 'trie']:
+            err_msg = f"Malformed parameter 'path_encoding': Encoding '{path_encoding}' not supported. Please specify 'dense' or 'trie'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+        if path_encoding == 'trie' and not result_format == 'json':
+            err_msg = f"Malformed parameter 'path_encoding': Encoding 'trie' can only be returned as 'json', not '{result_format}'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
         # If GeoJSON point is given, get coordinates:
         if point_start is not None:
             lon_start, lat_start = point_start.get('coordinates') or point_start['geometry']['coordinates']
@@ -233,6 +301,16 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
         if points_geojson_end is not None:
             geojson_helpers.check_is_geojson(points_geojson_end)
 
+        ##################
+        ### Pairs mode ###
+        ##################
+
+        # One path per pair (not a matrix), pairs may be in different basins:
+        if pairs is not None or (input_df is not None and colname_lon_end is not None):
+            LOGGER.debug('Pairs case...')
+            return self.pairs_case(conn, pairs, input_df, colname_lon, colname_lat,
+                colname_lon_end, colname_lat_end, colname_pair_id, requested_outputs, comment, result_format)
+
         ###########################
         ### Plural or singular? ###
         ###########################
@@ -266,7 +344,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
         if singular:
             return self.singular_case(conn, lon_start, lat_start, subc_id_start, lon_end, lat_end, subc_id_end, requested_outputs, comment, result_format)
         else:
-            return self.plural_case(conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format)
+            return self.plural_case(conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format, path_encoding)
 
 
     def singular_case(self, conn, lon_start, lat_start, subc_id_start, lon_end, lat_end, subc_id_end, requested_outputs, comment, result_format):
@@ -332,7 +410,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
         '''
 
 
-    def plural_case(self, conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format):
+    def plural_case(self, conn, points_geojson, points_geojson_end, subc_ids, subc_ids_end, input_df, colname_lon, colname_lat, requested_outputs, comment, result_format, path_encoding='dense'):
 
         # Symmetric or asymmetric matrix? I.e. are the start and end points
         # the same, or different sets?
@@ -359,7 +437,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
 
         # Get shortest paths:
         output_df_or_json = routing.get_dijkstra_ids_many_to_many(
-            conn, all_subc_ids_start, all_subc_ids_end, reg_id, basin_id, result_format)
+            conn, all_subc_ids_start, all_subc_ids_end, reg_id, basin_id, result_format, path_encoding)
 
         #####################
         ### Return result ###
@@ -374,6 +452,129 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
         return self.return_results('paths_matrix', requested_outputs, output_df=output_df, output_json=output_json, comment=comment)
 
 
+    def pairs_case(self, conn, pairs, input_df, colname_lon, colname_lat, colname_lon_end, colname_lat_end, colname_pair_id, requested_outputs, comment, result_format):
+
+        # Make one dataframe with one row per pair, and find the subcatchments:
+        if pairs is not None:
+            pairs_df = self._pairs_to_dataframe(pairs)
+        else:
+            pairs_df = self._csv_pairs_to_dataframe(input_df, colname_lon, colname_lat, colname_lon_end, colname_lat_end, colname_pair_id)
+        pairs_df = self._resolve_pairs(conn, pairs_df)
+
+        # Get shortest paths, one per pair, grouped by basin:
+        output_df_or_json = routing.get_dijkstra_ids_pairs(conn, pairs_df, result_format)
+
+        #####################
+        ### Return result ###
+        #####################
+
+        output_df = output_json = None
+        if isinstance(output_df_or_json, pd.DataFrame):
+            output_df = output_df_or_json
+        elif isinstance(output_df_or_json, dict):
+            output_json = output_df_or_json
+
+        return self.return_results('paths_pairs', requested_outputs, output_df=output_df, output_json=output_json, comment=comment)
+
+
+    def _pairs_to_dataframe(self, pairs):
+        # Each pair is [subc_id_start, subc_id_end], or an object with
+        # subc_id_start and subc_id_end, or lon_start, lat_start, lon_end,
+        # lat_end (and optionally pair_id). Pairs without pair_id get their
+        # index in the list.
+        if not isinstance(pairs, list) or len(pairs) == 0:
+            err_msg = "Malformed parameter 'pairs': Please provide a list of pairs."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+        rows = []
+        for i, pair in enumerate(pairs):
+            if isinstance(pair, list) and len(pair) == 2:
+                pair = {'subc_id_start': pair[0], 'subc_id_end': pair[1]}
+            if not isinstance(pair, dict):
+                err_msg = f"Malformed pair {i}: Please provide [subc_id_start, subc_id_end] or an object, not '{pair}'."
+                LOGGER.error(err_msg)
+                raise ProcessorExecuteError(err_msg)
+            for which in ['start', 'end']:
+                if pair.get(f'subc_id_{which}') is None and (pair.get(f'lon_{which}') is None or pair.get(f'lat_{which}') is None):
+                    err_msg = f"Malformed pair {i}: Please provide 'subc_id_{which}' or 'lon_{which}' and 'lat_{which}'."
+                    LOGGER.error(err_msg)
+                    raise ProcessorExecuteError(err_msg)
+            rows.append({
+                'pair_id': pair.get('pair_id', i),
+                'subc_id_start': pair.get('subc_id_start'),
+                'subc_id_end': pair.get('subc_id_end'),
+                'lon_start': pair.get('lon_start'),
+                'lat_start': pair.get('lat_start'),
+                'lon_end': pair.get('lon_end'),
+                'lat_end': pair.get('lat_end')
+            })
+        return pd.DataFrame(rows).astype({'subc_id_start': 'Int64', 'subc_id_end': 'Int64'})
+
+
+    def _csv_pairs_to_dataframe(self, input_df, colname_lon, colname_lat, colname_lon_end, colname_lat_end, colname_pair_id):
+        for colname in [colname_lon, colname_lat, colname_lon_end, colname_lat_end, colname_pair_id]:
+            if colname is not None and not colname in input_df.columns:
+                err_msg = f"Column '{colname}' not found in the input CSV (columns: {list(input_df.columns)})."
+                LOGGER.error(err_msg)
+                raise ProcessorExecuteError(err_msg)
+        if colname_lat_end is None:
+            err_msg = "Please specify 'colname_lat_end' (and 'colname_lon_end') for pairs from CSV."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+        return pd.DataFrame({
+            'pair_id': input_df[colname_pair_id] if colname_pair_id is not None else input_df.index,
+            'subc_id_start': pd.Series([pd.NA]*input_df.shape[0], dtype='Int64'),
+            'subc_id_end': pd.Series([pd.NA]*input_df.shape[0], dtype='Int64'),
+            'lon_start': input_df[colname_lon],
+            'lat_start': input_df[colname_lat],
+            'lon_end': input_df[colname_lon_end],
+            'lat_end': input_df[colname_lat_end]
+        }).reset_index(drop=True)
+
+
+    def _resolve_pairs(self, conn, pairs_df):
+        # Adds subc_id, basin_id, reg_id of start and end to every pair, with
+        # one database query for all subc_ids, and one for all coordinates.
+        pairs_df = pairs_df.reset_index(drop=True)
+        ids_by_subc_id = {}
+        ids_by_point = {}
+
+        # Subcatchments given as subc_id:
+        all_subc_ids = pd.concat([pairs_df['subc_id_start'], pairs_df['subc_id_end']]).dropna().unique()
+        if len(all_subc_ids) > 0:
+            temp_df = basic_queries.get_basinid_regid_from_subcid_plural(conn, [int(subc_id) for subc_id in all_subc_ids])
+            for row in temp_df.itertuples(index=False):
+                ids_by_subc_id[int(row.subc_id)] = (int(row.subc_id), int(row.basin_id), int(row.reg_id))
+
+        # Subcatchments given as lon, lat (one point per pair end, the pair's
+        # row and start/end as site_id):
+        points = []
+        for which in ['start', 'end']:
+            needs_lookup = pairs_df[f'subc_id_{which}'].isna()
+            for i in pairs_df.index[needs_lookup]:
+                points.append((f'{i}_{which}', pairs_df.at[i, f'lon_{which}'], pairs_df.at[i, f'lat_{which}']))
+        if len(points) > 0:
+            points_df = pd.DataFrame(points, columns=['site_id', 'lon', 'lat'])
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_dataframe(points_df, 'lon', 'lat', 'site_id'))
+            for row in temp_df.itertuples(index=False):
+                if not pd.isna(row.subc_id):
+                    ids_by_point[row.site_id] = (int(row.subc_id), int(row.basin_id), int(row.reg_id))
+
+        # Add to each pair (None if not found):
+        for which in ['start', 'end']:
+            found = []
+            for i, subc_id in zip(pairs_df.index, pairs_df[f'subc_id_{which}']):
+                if pd.isna(subc_id):
+                    found.append(ids_by_point.get(f'{i}_{which}', (None, None, None)))
+                else:
+                    found.append(ids_by_subc_id.get(int(subc_id), (int(subc_id), None, None)))
+            pairs_df[f'subc_id_{which}'] = pd.array([ids[0] for ids in found], dtype='Int64')
+            pairs_df[f'basin_id_{which}'] = pd.array([ids[1] for ids in found], dtype='Int64')
+            pairs_df[f'reg_id_{which}'] = pd.array([ids[2] for ids in found], dtype='Int64')
+        return pairs_df
+
+
     def plural_symmetric(self, conn, points_geojson, subc_ids, input_df, colname_lon, colname_lat):
 
         # Collect reg_id, basin_id, subc_id
@@ -381,7 +582,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
         # TODO: Must match site_id of CSV/GeoJSON to subc_id!!! But how to return it... Where would the user see the match?
         if points_geojson is not None:
             LOGGER.debug('START: Getting dijkstra shortest path between a number of points (start and end points are the same)...')
-            temp_df = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson, colname_site_id=None)
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson, colname_site_id=None))
             # TODO does this return NAs?
         elif subc_ids is not None:
             LOGGER.debug('START: Getting dijkstra shortest path between a number of subcatchments (start and end points are the same)...')
@@ -390,7 +591,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
             # TODO does this return NAs?
         elif input_df is not None:
             LOGGER.debug('START: Getting dijkstra shortest distance between a number of points (start and end points are the same)...')
-            temp_df = basic_queries.get_subcid_basinid_regid__dataframe_to_dataframe(conn, input_df, colname_lon, colname_lat, colname_site_id=None)
+            temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id=None))
             # TODO does this return NAs?
 
         # Retrieve subc_ids from the dataframe, and check if basins and regions match:
@@ -405,7 +606,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
 
         # Collect reg_id, basin_id, subc_id of set of start subcatchments:
         if points_geojson_start is not None:
-            temp_df_start = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson_start, colname_site_id=None)
+            temp_df_start = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson_start, colname_site_id=None))
             # TODO does this return NAs?
         elif subc_ids_start is not None and subc_ids_end is not None:
             all_subc_ids_start = set(subc_ids_start)
@@ -414,7 +615,7 @@ class ShortestPathBetweenPointsGetterPlural(GeoFreshBaseProcessor):
 
         # Collect reg_id, basin_id, subc_id of set of end subcatchments:
         if points_geojson_end is not None:
-            temp_df_end   = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(conn, points_geojson_end, colname_site_id=None)
+            temp_df_end   = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, point_table.from_geojson(points_geojson_end, colname_site_id=None))
             # TODO does this return NAs?
         elif subc_ids_start is not None and subc_ids_end is not None:
             all_subc_ids_end = set(subc_ids_end)
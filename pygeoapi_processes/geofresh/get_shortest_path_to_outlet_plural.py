@@ -8,18 +8,18 @@ import sys
 import traceback
 import json
 import urllib
-import requests
-import pandas as pd
 import tempfile
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.utils.exceptions as exc
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
 import pygeoapi.process.aqua90m.geofresh.routing as routing
 import pygeoapi.process.aqua90m.geofresh.get_linestrings as get_linestrings
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
 
@@ -86,13 +86,13 @@ curl -X POST https://${PYSERVER}/processes/get-shortest-path-to-outlet-plural/ex
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'points'
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -122,6 +122,8 @@ class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
         downstream_ids_only = data.get('downstream_ids_only', False)
         add_downstream_ids = data.get('add_downstream_ids', False)
         result_format = data.get('result_format', None)
+        # Paths listed in full ('dense'), or each segment only once ('trie', JSON only):
+        path_encoding = data.get('path_encoding', 'dense')
         comment = data.get('comment', None)
 
         ##############################
@@ -198,6 +200,16 @@ class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
             elif points is not None:
                 result_format = "json"
 
+        # Check path encoding:
+        if not path_encoding in ['dense', 'trie']:
+            err_msg = f"Malformed parameter: path_encoding can only be 'dense' or 'trie', not '{path_encoding}'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+        if path_encoding == 'trie' and not result_format == 'json':
+            err_msg = f"Malformed parameter: path_encoding 'trie' can only be returned as 'json', not '{result_format}'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
 
         ##########################
         ### Actual computation ###
@@ -226,7 +238,8 @@ class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
                     conn,
                     points_geojson,
                     colname_site_id,
-                    result_format
+                    result_format,
+                    path_encoding
                 )
 
             # This is the normal case: "subc_id", "basin_id" and
@@ -235,10 +248,9 @@ class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
                 # For each feature, retrieve the required ids "subc_id", "basin_id", "reg_id":
                 # (Note: Instead, we could use "add_subcid_basinid_regid_to_featurecoll" which
                 # outputs a FeatureCollection, that is easier to understand, but slower.)
-                temp_df = basic_queries.get_subcid_basinid_regid__geojson_to_dataframe(
+                temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(
                     conn,
-                    points_geojson,
-                    colname_site_id=colname_site_id
+                    point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
                 )
                 # Now that a dataframe was created from Database output,
                 # the column name for the site_ids has changed:
@@ -249,7 +261,8 @@ class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
                     conn,
                     temp_df,
                     colname_site_id,
-                    result_format
+                    result_format,
+                    path_encoding
                 )
 
         ## Handle CSV case:
@@ -272,15 +285,16 @@ class ShortestPathToOutletGetterPlural(GeoFreshBaseProcessor):
                 temp_df = pd.merge(input_df, temp_df, on="subc_id")
             else:
                 LOGGER.debug('Querying required columns (subc_id, basin_id, reg_id) for each point...')
-                temp_df = basic_queries.get_subcid_basinid_regid__dataframe_to_dataframe(
-                    conn, input_df, colname_lon, colname_lat, colname_site_id)
+                temp_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(
+                    conn, point_table.from_dataframe(input_df, colname_lon, colname_lat, colname_site_id))
 
             # Actual routing: For each row, get the downstream ids!
             output_df_or_json = routing.get_dijkstra_ids_to_outlet_plural(
                 conn,
                 temp_df,
                 colname_site_id,
-                result_format
+                result_format,
+                path_encoding
             )
 
         #####################
@@ -7,15 +7,16 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
-import pandas as pd
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
 import pygeoapi.process.aqua90m.utils.exceptions as exc
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.geofresh.snapping as snapping
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
 
@@ -184,13 +185,13 @@ curl -X POST "https://$PYSERVER/processes/get-snapped-points-plural/execution" \
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class SnappedPointsGetterPlural(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'points'
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -279,13 +280,16 @@ class SnappedPointsGetterPlural(GeoFreshBaseProcessor):
         ## Handle GeoJSON case:
         if points_geojson is not None:
 
+            # Read the points once, the query functions take them as arrays:
+            points = point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
+
             # Query database:
             if result_format == 'geojson':
-                LOGGER.debug('Requesting geojson (get_snapped_points_json2json)')
-                output_json = snapping.get_snapped_points_json2json(conn, points_geojson, colname_site_id = colname_site_id)
+                LOGGER.debug('Requesting geojson (get_snapped_point_xy)')
+                output_json = snapping.get_snapped_point_xy(conn, points, colname_site_id=colname_site_id, result_format="geojson")
             elif result_format == 'csv':
-                LOGGER.debug('Requesting csv (get_snapped_points_json2csv)')
-                output_df = snapping.get_snapped_points_json2csv(conn, points_geojson, colname_lon, colname_lat, colname_site_id)
+                LOGGER.debug('Requesting csv (get_snapped_point_xy)')
+                output_df = snapping.get_snapped_point_xy(conn, points, colname_lon, colname_lat, colname_site_id, result_format="csv")
 
         ## Handle CSV case:
         elif csv_url is not None:
@@ -293,23 +297,25 @@ class SnappedPointsGetterPlural(GeoFreshBaseProcessor):
 
             # Query database:
             if result_format == 'geojson':
-                LOGGER.debug('Requesting geojson (get_snapped_points_csv2json)')
+                LOGGER.debug('Requesting geojson (get_snapped_point_xy, from csv)')
                 input_df_generator = utils.access_csv_as_dataframe_iterator(csv_url, num_rows_per_chunk)
                 output_json = {
                     "type": "FeatureCollection",
                     "features": []
                 }
                 for chunk_df in input_df_generator:
-                    output_json_chunk = snapping.get_snapped_points_csv2json(conn, chunk_df, colname_lon, colname_lat, colname_site_id)
+                    points = point_table.from_dataframe(chunk_df, colname_lon, colname_lat, colname_site_id)
+                    output_json_chunk = snapping.get_snapped_point_xy(conn, points, colname_lon, colname_lat, colname_site_id, result_format="geojson")
                     output_json["features"].append(output_json_chunk["features"])
 
 
             elif result_format == 'csv':
-                LOGGER.debug('Requesting csv (get_snapped_points_csv2csv)')
+                LOGGER.debug('Requesting csv (get_snapped_point_xy, from csv)')
                 input_df_generator = utils.access_csv_as_dataframe_iterator(csv_url, num_rows_per_chunk)
                 output_df_list = []
                 for chunk_df in input_df_generator:
-                    output_df_chunk = snapping.get_snapped_points_csv2csv(conn, chunk_df, colname_lon, colname_lat, colname_site_id)
+                    points = point_table.from_dataframe(chunk_df, colname_lon, colname_lat, colname_site_id)
+                    output_df_chunk = snapping.get_snapped_point_xy(conn, points, colname_lon, colname_lat, colname_site_id, result_format="csv")
                     output_df_list.append(output_df_chunk)
                     # WIP: TODO: If we want to append to a CSV:
                     #for i, chunk in enumerate(split_df(df, 100_000)):
@@ -7,15 +7,16 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
-import pandas as pd
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
 import pygeoapi.process.aqua90m.utils.exceptions as exc
+import pygeoapi.process.aqua90m.utils.point_table as point_table
 import pygeoapi.process.aqua90m.geofresh.snapping_strahler as snapping_strahler
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
 
@@ -261,9 +262,7 @@ curl -X POST https://${PYSERVER}/processes/get-snapped-points-strahler-plural/ex
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class SnappedPointsStrahlerGetterPlural(GeoFreshBaseProcessor):
@@ -387,13 +386,18 @@ class SnappedPointsStrahlerGetterPlural(GeoFreshBaseProcessor):
             if points_geojson['type'] == 'FeatureCollection':
                 geojson_helpers.check_feature_collection_property(points_geojson, colname_site_id)
 
+            # Read the points once, the query functions take them as arrays:
+            points = point_table.from_geojson(points_geojson, colname_site_id=colname_site_id)
+
             # Query database:
             if result_format == 'geojson':
-                LOGGER.debug('Requesting geojson (get_snapped_points_json2json)')
-                output_json = snapping_strahler.get_snapped_points_json2json(conn, points_geojson, min_strahler, colname_site_id = colname_site_id, add_distance=add_distance)
+                LOGGER.debug('Requesting geojson (get_snapped_points_xy)')
+                output_json = snapping_strahler.get_snapped_points_xy(conn, points, colname_site_id=colname_site_id,
+                    min_strahler=min_strahler, add_distance=add_distance, result_format="geojson")
             elif result_format == 'csv':
-                LOGGER.debug('Requesting csv (get_snapped_points_json2csv)')
-                output_df = snapping_strahler.get_snapped_points_json2csv(conn, points_geojson, min_strahler, colname_lon, colname_lat, colname_site_id, add_distance=add_distance)
+                LOGGER.debug('Requesting csv (get_snapped_points_xy)')
+                output_df = snapping_strahler.get_snapped_points_xy(conn, points, colname_lon, colname_lat, colname_site_id,
+                    min_strahler=min_strahler, add_distance=add_distance, result_format="csv")
 
         ## Handle CSV case:
         elif csv_url is not None:
@@ -402,7 +406,7 @@ class SnappedPointsStrahlerGetterPlural(GeoFreshBaseProcessor):
             # Query database:
             LOGGER.info(f'PYGEOAPI USER PASSED STRAHLER {min_strahler}')
             if result_format == 'geojson':
-                LOGGER.debug('Requesting geojson (get_snapped_points_csv2json)')
+                LOGGER.debug('Requesting geojson (get_snapped_points_xy, from csv)')
                 input_df_generator, num_rows = utils.access_csv_as_dataframe_iterator(csv_url, num_rows_per_chunk)
                 output_json = {
                     "type": "FeatureCollection",
@@ -412,19 +416,23 @@ class SnappedPointsStrahlerGetterPlural(GeoFreshBaseProcessor):
                 n = 0
                 for chunk_df in input_df_generator:
                     n += 1
-                    output_json_chunk = snapping_strahler.get_snapped_points_csv2json(conn, chunk_df, min_strahler, colname_lon, colname_lat, colname_site_id, add_distance=add_distance)
+                    points = point_table.from_dataframe(chunk_df, colname_lon, colname_lat, colname_site_id)
+                    output_json_chunk = snapping_strahler.get_snapped_points_xy(conn, points, colname_lon, colname_lat, colname_site_id,
+                        min_strahler=min_strahler, add_distance=add_distance, result_format="geojson")
                     output_json["features"].append(output_json_chunk["features"])
                     self.update_status_chunks(n, num_rows_per_chunk, num_rows)
 
             elif result_format == 'csv':
-                LOGGER.debug('Requesting csv (get_snapped_points_csv2csv)')
+                LOGGER.debug('Requesting csv (get_snapped_points_xy, from csv)')
                 input_df_generator, num_rows = utils.access_csv_as_dataframe_iterator(csv_url, num_rows_per_chunk)
                 output_df_list = []
                 self.update_status(f'Start to work on chunks of size {num_rows_per_chunk} rows')
                 n = 0
                 for chunk_df in input_df_generator:
                     n += 1
-                    output_df_chunk = output_df = snapping_strahler.get_snapped_points_csv2csv(conn, chunk_df, min_strahler, colname_lon, colname_lat, colname_site_id, add_distance=add_distance)
+                    points = point_table.from_dataframe(chunk_df, colname_lon, colname_lat, colname_site_id)
+                    output_df_chunk = snapping_strahler.get_snapped_points_xy(conn, points, colname_lon, colname_lat, colname_site_id,
+                        min_strahler=min_strahler, add_distance=add_distance, result_format="csv")
                     output_df_list.append(output_df_chunk)
                     self.update_status_chunks(n, num_rows_per_chunk, num_rows)
                     # WIP: TODO: If we want to append to a CSV:
@@ -7,12 +7,12 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
 import pygeoapi.process.aqua90m.geofresh.dissolved as dissolved
+import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -51,12 +51,13 @@ curl -X POST https://${PYSERVER}/processes/get-upstream-dissolved-cont/execution
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 class UpstreamDissolvedGetter(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'upstream'
+    BYTES_PER_UNIT = 100
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -78,6 +79,10 @@ class UpstreamDissolvedGetter(GeoFreshBaseProcessor):
             geometry_only=geometry_only
         ))
 
+        # Check simplification options (may be None):
+        simplify_tolerance, coordinate_precision = geometry_simplification.check_options(
+            data.get('simplify_tolerance', None), data.get('coordinate_precision', None))
+
         # Check if either point or subc_id or both lon and lat are provided:
         utils.params_point_or_lonlat_or_subcid(point, lon, lat, subc_id)
 
@@ -107,7 +112,8 @@ class UpstreamDissolvedGetter(GeoFreshBaseProcessor):
         if geometry_only:
 
             dissolved_simplegeom = dissolved.get_dissolved_simplegeom(
-                conn, upstream_ids, basin_id, reg_id)
+                conn, upstream_ids, basin_id, reg_id,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
 
             # Return link to result (wrapped in JSON) if requested, or directly the JSON object:
             return self.return_results('polygon', requested_outputs, output_df=None, output_json=dissolved_simplegeom, comment=comment)
@@ -117,7 +123,8 @@ class UpstreamDissolvedGetter(GeoFreshBaseProcessor):
         if not geometry_only:
 
             dissolved_feature = dissolved.get_dissolved_feature(
-                conn, upstream_ids, basin_id, reg_id, add_subc_ids = add_upstream_ids)
+                conn, upstream_ids, basin_id, reg_id, add_subc_ids = add_upstream_ids,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
 
             # Add some info to Feature:
             # TODO: Should we include the requested lon and lat? Maybe as a point? Then FeatureCollection?
@@ -0,0 +1,138 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+import os
+import sys
+import traceback
+import json
+from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
+from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+import pygeoapi.process.aqua90m.geofresh.dissolved as dissolved
+import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
+
+
+'''
+Dissolved upstream catchments of many points at once, as FeatureCollection
+(one Feature per subc_id, with the site_ids that fall into it). The points
+are grouped by basin, and each basin is traversed and queried once: If one
+point is upstream of another, its part is dissolved only once, and reused
+for the other (see geofresh/dissolved.py, get_dissolved_features_nested()).
+
+## INPUT:  CSV file
+## OUTPUT: GeoJSON FeatureCollection
+curl -X POST https://${PYSERVER}/processes/get-upstream-dissolved-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+        "colname_lon": "longitude",
+        "colname_lat": "latitude",
+        "colname_site_id": "site_id",
+        "simplify_tolerance": 0.001,
+        "comment": "barbus"
+    },
+    "outputs": {
+        "transmissionMode": "reference"
+    }
+}'
+'''
+
+# Process metadata and description
+# Has to be in a JSON file of the same name, in the same dir! 
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+
+class UpstreamDissolvedPluralGetter(GeoFreshBaseProcessor):
+
+    COST_MODEL = 'points'
+    BYTES_PER_UNIT = 20000
+
+    def __init__(self, processor_def):
+        super().__init__(processor_def, PROCESS_METADATA)
+
+    def _execute(self, data, requested_outputs, conn):
+
+        # User inputs (and the points, see points_by_region_and_basin())
+        min_strahler = data.get('min_strahler', None)
+        comment = data.get('comment', None)
+
+        # Check simplification options (may be None):
+        simplify_tolerance, coordinate_precision = geometry_simplification.check_options(
+            data.get('simplify_tolerance', None), data.get('coordinate_precision', None))
+
+        # Get the points, grouped by basin:
+        departing_points, _ = self.points_by_region_and_basin(conn, data)
+
+        # Overall goal: Get the upstream polygons (each one dissolved)!
+        features = []
+        for reg_id, all_basins in departing_points.items():
+
+            # Add empty Feature for ocean case:
+            if reg_id is None:
+                features.append({
+                    "type": "Feature",
+                    "geometry": None,
+                    "properties": {"subc_id": None, "site_ids": list(all_basins[None][None])}
+                })
+                continue
+
+            for basin_id, all_subcids in all_basins.items():
+                reg_id, basin_id = int(reg_id), int(basin_id)
+                nested = upstream_subcids.get_upstream_catchment_ids_nested(
+                    conn, all_subcids.keys(), basin_id, reg_id, min_strahler)
+                dissolved_features = dissolved.get_dissolved_features_nested(
+                    conn, nested, basin_id, reg_id,
+                    simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
+                for subc_id, site_ids in all_subcids.items():
+                    feature = dissolved_features[int(subc_id)]
+                    feature["properties"]["site_ids"] = list(site_ids)
+                    features.append(feature)
+
+        ################
+        ### Results: ###
+        ################
+
+        output_json = {
+            "type": "FeatureCollection",
+            "features": features,
+            "description": "Dissolved upstream catchments"
+        }
+        if min_strahler is not None:
+            output_json['min_strahler'] = min_strahler
+
+        # Return link to result (wrapped in JSON) if requested, or directly the JSON object:
+        return self.return_results('polygons', requested_outputs, output_df=None, output_json=output_json, comment=comment)
+
+
+
+if __name__ == '__main__':
+
+    import os
+    import requests
+    PYSERVER = f'https://{os.getenv("PYSERVER")}'
+    # For this to work, please define the PYSERVER before running python:
+    # export PYSERVER="https://.../pygeoapi-dev"
+    print('_____________________________________________________')
+    process_id = 'get-upstream-dissolved-plural'
+    print(f'TESTING {process_id} at {PYSERVER}')
+    from pygeoapi.process.aqua90m.mapclient.test_requests import make_sync_request
+    from pygeoapi.process.aqua90m.mapclient.test_requests import sanity_checks_geojson
+
+
+    print('TEST CASE 1: Input CSV file, output FeatureCollection...', end="", flush=True)  # no newline
+    payload = {
+        "inputs": {
+            "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+            "colname_lon": "longitude",
+            "colname_lat": "latitude",
+            "colname_site_id": "site_id",
+            "comment": "test1"
+        }
+    }
+    resp = make_sync_request(PYSERVER, process_id, payload)
+    sanity_checks_geojson(resp)
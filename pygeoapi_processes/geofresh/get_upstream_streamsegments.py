@@ -8,12 +8,12 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries
 import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
 import pygeoapi.process.aqua90m.geofresh.get_linestrings as get_linestrings
+import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -54,13 +54,14 @@ curl -X POST https://${PYSERVER}/processes/get-upstream-streamsegments/execution
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 class UpstreamStreamSegmentsGetter(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'upstream'
+    BYTES_PER_UNIT = 600
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -84,6 +85,10 @@ class UpstreamStreamSegmentsGetter(GeoFreshBaseProcessor):
             add_upstream_ids=add_upstream_ids
         ))
 
+        # Check simplification options (may be None):
+        simplify_tolerance, coordinate_precision = geometry_simplification.check_options(
+            data.get('simplify_tolerance', None), data.get('coordinate_precision', None))
+
         # Check if either point or subc_id or both lon and lat are provided:
         utils.params_point_or_lonlat_or_subcid(point, lon, lat, subc_id)
 
@@ -118,7 +123,8 @@ class UpstreamStreamSegmentsGetter(GeoFreshBaseProcessor):
         # Get geometry only:
         if geometry_only:
             LOGGER.debug(f'... Getting upstream catchment line segments for subc_id: {subc_id}')
-            geometry_coll = get_linestrings.get_streamsegment_linestrings_geometry_coll(conn, upstream_ids, basin_id, reg_id)
+            geometry_coll = get_linestrings.get_streamsegment_linestrings_geometry_coll(conn, upstream_ids, basin_id, reg_id,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
 
             # Return link to result (wrapped in JSON) if requested, or directly the JSON object:
             return self.return_results('upstream_stream_segments', requested_outputs, output_df=None, output_json=geometry_coll, comment=comment)
@@ -130,7 +136,8 @@ class UpstreamStreamSegmentsGetter(GeoFreshBaseProcessor):
             # Note: The feature collection contains the strahler order for each feature (each stream segment)
             LOGGER.debug(f'... Getting upstream catchment line segments for subc_id: {subc_id}')
             feature_coll = get_linestrings.get_streamsegment_linestrings_feature_coll(
-                conn, upstream_ids, basin_id, reg_id, add_target_streams=add_target_streams)
+                conn, upstream_ids, basin_id, reg_id, add_target_streams=add_target_streams,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
 
             # Add some info to the FeatureCollection:
             feature_coll["part_of_upstream_catchment_of"] = subc_id
@@ -8,12 +8,12 @@ import os
 import sys
 import traceback
 import json
-import psycopg2
 from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 import pygeoapi.process.aqua90m.geofresh.basic_queries as basic_queries 
 import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
 import pygeoapi.process.aqua90m.geofresh.get_polygons as get_polygons
+import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
 import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
 from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
 
@@ -68,14 +68,15 @@ curl -X POST https://${PYSERVER}/processes/get-upstream-subcatchments/execution
 
 # Process metadata and description
 # Has to be in a JSON file of the same name, in the same dir! 
-script_title_and_path = __file__
-metadata_title_and_path = script_title_and_path.replace('.py', '.json')
-PROCESS_METADATA = json.load(open(metadata_title_and_path))
+PROCESS_METADATA = utils.load_process_metadata(__file__)
 
 
 
 class UpstreamSubcatchmentGetter(GeoFreshBaseProcessor):
 
+    COST_MODEL = 'upstream'
+    BYTES_PER_UNIT = 2000
+
     def __init__(self, processor_def):
         super().__init__(processor_def, PROCESS_METADATA)
 
@@ -90,13 +91,19 @@ class UpstreamSubcatchmentGetter(GeoFreshBaseProcessor):
         comment = data.get('comment') # optional
         geometry_only = data.get('geometry_only', False)
         add_upstream_ids = data.get('add_upstream_ids', False)
+        server_side_geojson = data.get('server_side_geojson', False)
 
         # Check if boolean:
         utils.is_bool_parameters(dict(
             add_upstream_ids=add_upstream_ids,
-            geometry_only=geometry_only
+            geometry_only=geometry_only,
+            server_side_geojson=server_side_geojson
         ))
 
+        # Check simplification options (may be None):
+        simplify_tolerance, coordinate_precision = geometry_simplification.check_options(
+            data.get('simplify_tolerance', None), data.get('coordinate_precision', None))
+
         # Check if either point or subc_id or both lon and lat are provided:
         utils.params_point_or_lonlat_or_subcid(point, lon, lat, subc_id)
 
@@ -120,11 +127,29 @@ class UpstreamSubcatchmentGetter(GeoFreshBaseProcessor):
         upstream_ids = upstream_subcids.get_upstream_catchment_ids_incl_itself(
             conn, subc_id, basin_id, reg_id)
 
+        # Pass-through mode: GeoJSON assembled by PostGIS, streamed to the result:
+        if server_side_geojson:
+            LOGGER.debug(f'...Streaming upstream catchment polygons for subc_id: {subc_id}')
+            members = {}
+            if not geometry_only:
+                members = {"reg_id": reg_id, "basin_id": basin_id}
+                if add_upstream_ids:
+                    members["subc_ids"] = upstream_ids
+                members["description"] = f"Upstream subcatchments of subcatchment {subc_id}."
+                members["upstream_catchment_of"] = subc_id
+            if comment is not None:
+                members["comment"] = comment
+            chunks = get_polygons.stream_subcatchment_polygons(
+                conn, upstream_ids, basin_id, reg_id, geometry_only, members,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
+            return self.return_streamed_results('polygons', requested_outputs, chunks)
+
         # Get geometry only:
         if geometry_only:
             LOGGER.debug(f'...Getting upstream catchment polygons for subc_id: {subc_id}')
             geometry_coll = get_polygons.get_subcatchment_polygons_geometry_coll(
-                conn, upstream_ids, basin_id, reg_id)
+                conn, upstream_ids, basin_id, reg_id,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
             LOGGER.debug('END: Received GeometryCollection: %s' % str(geometry_coll)[0:50])
 
             # Return link to result (wrapped in JSON) if requested, or directly the JSON object:
@@ -134,7 +159,8 @@ class UpstreamSubcatchmentGetter(GeoFreshBaseProcessor):
         if not geometry_only:
             LOGGER.debug(f'...Getting upstream catchment polygons for subc_id: {subc_id}')
             feature_coll = get_polygons.get_subcatchment_polygons_feature_coll(
-                conn, upstream_ids, basin_id, reg_id, add_upstream_ids)
+                conn, upstream_ids, basin_id, reg_id, add_upstream_ids,
+                simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
             LOGGER.debug('END: Received FeatureCollection: %s' % str(feature_coll)[0:50])
 
             feature_coll['description'] = f"Upstream subcatchments of subcatchment {subc_id}."
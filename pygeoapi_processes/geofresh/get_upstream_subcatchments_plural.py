@@ -0,0 +1,149 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+import os
+import sys
+import traceback
+import json
+from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
+from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+import pygeoapi.process.aqua90m.geofresh.get_polygons as get_polygons
+import pygeoapi.process.aqua90m.geofresh.geometry_simplification as geometry_simplification
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
+
+
+'''
+Upstream subcatchments (individual polygons) of many points at once, as
+one FeatureCollection. The points are grouped by basin, and each basin is
+traversed and queried once. Every polygon is returned only once, even if it
+is upstream of many points: Its property "part_of" is the subc_id of the
+next point downstream of it. The member "upstream" lists, per subc_id, the
+points nested in its upstream catchment ("includes_upstream_of"), so the
+upstream catchment of a point are all polygons whose "part_of" is the point
+itself or (recursively) one of those.
+
+## INPUT:  CSV file
+## OUTPUT: GeoJSON FeatureCollection
+curl -X POST https://${PYSERVER}/processes/get-upstream-subcatchments-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+        "colname_lon": "longitude",
+        "colname_lat": "latitude",
+        "colname_site_id": "site_id",
+        "comment": "barbus"
+    },
+    "outputs": {
+        "transmissionMode": "reference"
+    }
+}'
+'''
+
+# Process metadata and description
+# Has to be in a JSON file of the same name, in the same dir! 
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+
+class UpstreamSubcatchmentPluralGetter(GeoFreshBaseProcessor):
+
+    COST_MODEL = 'points'
+    BYTES_PER_UNIT = 50000
+
+    def __init__(self, processor_def):
+        super().__init__(processor_def, PROCESS_METADATA)
+
+    def _execute(self, data, requested_outputs, conn):
+
+        # User inputs (and the points, see points_by_region_and_basin())
+        min_strahler = data.get('min_strahler', None)
+        comment = data.get('comment', None)
+
+        # Check simplification options (may be None):
+        simplify_tolerance, coordinate_precision = geometry_simplification.check_options(
+            data.get('simplify_tolerance', None), data.get('coordinate_precision', None))
+
+        # Get the points, grouped by basin, and their (nested) upstream catchments:
+        departing_points, _ = self.points_by_region_and_basin(conn, data)
+        upstream = upstream_subcids.get_upstream_catchment_ids_plural(conn, departing_points, min_strahler)
+
+        # Overall goal: Get the upstream polygons, each one once!
+        features = []
+        reports = []
+        for reg_id, all_basins in departing_points.items():
+            if reg_id is None:
+                continue # no polygons (ocean case), still listed in "upstream"
+            for basin_id, all_subcids in all_basins.items():
+                reg_id, basin_id = int(reg_id), int(basin_id)
+
+                # Each segment is in the part of exactly one point:
+                part_of = {}
+                for subc_id in all_subcids.keys():
+                    for upstream_id in upstream[int(subc_id)]['upstream_ids']:
+                        part_of[upstream_id] = int(subc_id)
+
+                feature_coll = get_polygons.get_subcatchment_polygons_feature_coll(
+                    conn, list(part_of.keys()), basin_id, reg_id,
+                    simplify_tolerance = simplify_tolerance, coordinate_precision = coordinate_precision)
+                for feature in feature_coll['features']:
+                    feature['properties']['basin_id'] = basin_id
+                    feature['properties']['reg_id'] = reg_id
+                    feature['properties']['part_of'] = part_of[feature['properties']['subc_id']]
+                features.extend(feature_coll['features'])
+                if 'geometry_simplification' in feature_coll:
+                    reports.append(feature_coll['geometry_simplification'])
+
+        # The nesting (without the ids, they are in the features):
+        for item in upstream.values():
+            del item['upstream_ids']
+
+        ################
+        ### Results: ###
+        ################
+
+        output_json = {
+            "type": "FeatureCollection",
+            "features": features,
+            "upstream": upstream,
+            "description": "Upstream subcatchments"
+        }
+        if min_strahler is not None:
+            output_json['min_strahler'] = min_strahler
+        if len(reports) > 0:
+            output_json['geometry_simplification'] = reports
+
+        # Return link to result (wrapped in JSON) if requested, or directly the JSON object:
+        return self.return_results('polygons', requested_outputs, output_df=None, output_json=output_json, comment=comment)
+
+
+
+if __name__ == '__main__':
+
+    import os
+    import requests
+    PYSERVER = f'https://{os.getenv("PYSERVER")}'
+    # For this to work, please define the PYSERVER before running python:
+    # export PYSERVER="https://.../pygeoapi-dev"
+    print('_____________________________________________________')
+    process_id = 'get-upstream-subcatchments-plural'
+    print(f'TESTING {process_id} at {PYSERVER}')
+    from pygeoapi.process.aqua90m.mapclient.test_requests import make_sync_request
+    from pygeoapi.process.aqua90m.mapclient.test_requests import sanity_checks_geojson
+
+
+    print('TEST CASE 1: Input CSV file, output FeatureCollection...', end="", flush=True)  # no newline
+    payload = {
+        "inputs": {
+            "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+            "colname_lon": "longitude",
+            "colname_lat": "latitude",
+            "colname_site_id": "site_id",
+            "comment": "test1"
+        }
+    }
+    resp = make_sync_request(PYSERVER, process_id, payload)
+    sanity_checks_geojson(resp)
@@ -0,0 +1,181 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+import os
+import sys
+import traceback
+import json
+from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
+import pygeoapi.process.aqua90m.geofresh.upstream_subcids as upstream_subcids
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
+
+
+'''
+Upstream catchments (subc_ids) of many points at once: The points are
+grouped by basin, and each basin is traversed once. If one point is
+upstream of another, its upstream catchment is not repeated: The other
+one lists it in "includes_upstream_of" (see geofresh/upstream_subcids.py,
+expand_upstream_ids(), for getting the whole upstream catchment).
+
+## INPUT:  CSV file
+## OUTPUT: CSV file (long format: one row per subc_id and upstream segment)
+curl -X POST https://${PYSERVER}/processes/get-upstream-subcids-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+        "colname_lon": "longitude",
+        "colname_lat": "latitude",
+        "colname_site_id": "site_id",
+        "result_format": "csv"
+    },
+    "outputs": {
+        "transmissionMode": "reference"
+    }
+}'
+
+## INPUT:  GeoJSON FeatureCollection
+## OUTPUT: Plain JSON (by subc_id)
+curl -X POST https://${PYSERVER}/processes/get-upstream-subcids-plural/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+        "points_geojson": {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": { "type": "Point", "coordinates": [9.931555, 54.695070]},
+                    "properties": {"my_site": "bla1"}
+                },
+                {
+                    "type": "Feature",
+                    "geometry": { "type": "Point", "coordinates": [9.921555, 54.295070]},
+                    "properties": {"my_site": "bla2"}
+                }
+            ]
+        },
+        "colname_site_id": "my_site",
+        "min_strahler": 2,
+        "comment": "schlei"
+    }
+}'
+'''
+
+# Process metadata and description
+# Has to be in a JSON file of the same name, in the same dir! 
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+
+class UpstreamSubcidPluralGetter(GeoFreshBaseProcessor):
+
+    COST_MODEL = 'points'
+
+    def __init__(self, processor_def):
+        super().__init__(processor_def, PROCESS_METADATA)
+
+    def _execute(self, data, requested_outputs, conn):
+
+        # User inputs (and the points, see points_by_region_and_basin())
+        min_strahler = data.get('min_strahler', None)
+        result_format = data.get('result_format', None)
+        comment = data.get('comment', None)
+
+        # Check result format
+        if not (result_format is None or result_format == 'json' or result_format == 'csv'):
+            err_msg = f"Malformed parameter: result_format can only be 'csv' or 'json', not '{result_format}'."
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+        # Get the points, grouped by basin:
+        departing_points, input_format = self.points_by_region_and_basin(conn, data)
+
+        # If user specified no output format, will use the input format:
+        if result_format is None:
+            result_format = input_format
+
+        # Overall goal: Get the upstream subc_ids, one traversal per basin!
+        LOGGER.info(f'START: Getting upstream subc_ids for points in {sum(len(basins) for basins in departing_points.values())} basins')
+        upstream = upstream_subcids.get_upstream_catchment_ids_plural(conn, departing_points, min_strahler)
+
+        ################
+        ### Results: ###
+        ################
+
+        if result_format == 'csv':
+            output_df = upstream_subcids.upstream_plural_to_dataframe(upstream)
+            return self.return_results('upstream_ids', requested_outputs, output_df=output_df, comment=comment)
+
+        # Note: This is not GeoJSON (on purpose), as we did not look for geometry yet.
+        output_json = {
+            "num_subc_ids": len(upstream),
+            "upstream": upstream
+        }
+        if min_strahler is not None:
+            output_json['min_strahler'] = min_strahler
+
+        # Return link to result (wrapped in JSON) if requested, or directly the JSON object:
+        return self.return_results('upstream_ids', requested_outputs, output_df=None, output_json=output_json, comment=comment)
+
+
+
+if __name__ == '__main__':
+
+    import os
+    import requests
+    PYSERVER = f'https://{os.getenv("PYSERVER")}'
+    # For this to work, please define the PYSERVER before running python:
+    # export PYSERVER="https://.../pygeoapi-dev"
+    print('_____________________________________________________')
+    process_id = 'get-upstream-subcids-plural'
+    print(f'TESTING {process_id} at {PYSERVER}')
+    from pygeoapi.process.aqua90m.mapclient.test_requests import make_sync_request
+    from pygeoapi.process.aqua90m.mapclient.test_requests import sanity_checks_basic
+
+
+    print('TEST CASE 1: Input CSV file, output CSV file...', end="", flush=True)  # no newline
+    payload = {
+        "inputs": {
+            "csv_url": "https://aqua.igb-berlin.de/referencedata/aqua90m/spdata_barbus.csv",
+            "colname_lon": "longitude",
+            "colname_lat": "latitude",
+            "colname_site_id": "site_id",
+            "result_format": "csv",
+            "comment": "test1"
+        },
+        "outputs": {
+            "transmissionMode": "reference"
+        }
+    }
+    resp = make_sync_request(PYSERVER, process_id, payload)
+    sanity_checks_basic(resp)
+
+
+    print('TEST CASE 2: Input FeatureCollection, output JSON...', end="", flush=True)  # no newline
+    payload = {
+        "inputs": {
+            "points_geojson": {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "geometry": { "type": "Point", "coordinates": [9.931555, 54.695070]},
+                        "properties": {"my_site": "bla1"}
+                    },
+                    {
+                        "type": "Feature",
+                        "geometry": { "type": "Point", "coordinates": [9.921555, 54.295070]},
+                        "properties": {"my_site": "bla2"}
+                    }
+                ]
+            },
+            "colname_site_id": "my_site",
+            "comment": "test2"
+        }
+    }
+    resp = make_sync_request(PYSERVER, process_id, payload)
+    sanity_checks_basic(resp)
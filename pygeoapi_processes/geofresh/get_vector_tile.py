@@ -0,0 +1,121 @@
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+import os
+import sys
+import traceback
+import json
+from pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.GeoFreshBaseProcessor import GeoFreshBaseProcessor
+from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+import pygeoapi.process.aqua90m.geofresh.vector_tiles as vector_tiles
+import pygeoapi.process.aqua90m.pygeoapi_processes.utils as utils
+from pygeoapi.process.aqua90m.geofresh.database_connection import get_connection_object_config
+
+
+'''
+
+# Request a tile (stream segments and subcatchments), as binary MVT:
+curl -X POST https://${PYSERVER}/processes/get-vector-tile/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+    "z": 12,
+    "x": 2160,
+    "y": 1301
+    }
+}' --output 2160_1301.mvt
+
+# Request a tile (stream segments only), as link to the cached tile:
+curl -X POST https://${PYSERVER}/processes/get-vector-tile/execution \
+--header "Content-Type: application/json" \
+--data '{
+  "inputs": {
+    "z": 8,
+    "x": 135,
+    "y": 81,
+    "layers": ["stream_segments"]
+    },
+  "outputs": {
+    "transmissionMode": "reference"
+  }
+}'
+
+# Once a tile is cached, the web server can serve it directly, e.g.:
+# ${download_url}tiles/stream_segments-sub_catchments/12/2160/1301.mvt
+
+'''
+
+# Process metadata and description
+# Has to be in a JSON file of the same name, in the same dir! 
+PROCESS_METADATA = utils.load_process_metadata(__file__)
+
+
+class VectorTileGetter(GeoFreshBaseProcessor):
+
+    def __init__(self, processor_def):
+        super().__init__(processor_def, PROCESS_METADATA)
+        self.tile_cache_dir, self.tile_cache_url = vector_tiles.get_cache_dir(self.config)
+        self.tile_max_zoom = self.config.get('tile_max_zoom', vector_tiles.DEFAULT_MAX_ZOOM)
+
+    def _execute(self, data, requested_outputs, conn):
+
+        # User inputs
+        z = data.get('z', None)
+        x = data.get('x', None)
+        y = data.get('y', None)
+        layers = data.get('layers', None) # optional, default: all layers
+
+        # Check presence:
+        if z is None or x is None or y is None:
+            err_msg = 'Please provide the tile coordinates z, x and y.'
+            LOGGER.error(err_msg)
+            raise ProcessorExecuteError(err_msg)
+
+        # Check values:
+        z, x, y, layers = vector_tiles.check_tile(z, x, y, layers, self.tile_max_zoom)
+
+        # Get tile (from cache, or made by the database):
+        LOGGER.debug(f'Now, getting tile {z}/{x}/{y} ({layers})')
+        tile = vector_tiles.get_tile(conn, z, x, y, layers, self.tile_cache_dir)
+
+        # Return link to the cached tile if requested, or directly the tile:
+        if utils.return_hyperlink('tile', requested_outputs):
+            outputs_dict = {
+                'title': self.metadata['outputs']['tile']['title'],
+                'description': self.metadata['outputs']['tile']['description'],
+                'href': vector_tiles.tile_url(self.tile_cache_url, z, x, y, layers)
+            }
+            return 'application/json', outputs_dict
+
+        return 'application/vnd.mapbox-vector-tile', tile
+
+
+if __name__ == '__main__':
+
+    import os
+    import requests
+    PYSERVER = f'https://{os.getenv("PYSERVER")}'
+    # For this to work, please define the PYSERVER before running python:
+    # export PYSERVER="https://.../pygeoapi-dev"
+    print('_____________________________________________________')
+    process_id = 'get-vector-tile'
+    print(f'TESTING {process_id} at {PYSERVER}')
+    from pygeoapi.process.aqua90m.mapclient.test_requests import make_sync_request
+    from pygeoapi.process.aqua90m.mapclient.test_requests import sanity_checks_basic
+
+
+    print('TEST CASE 1: Request tile as reference...', end="", flush=True)  # no newline
+    payload = {
+        "inputs": {
+            "z": 12,
+            "x": 2160,
+            "y": 1301
+        },
+        "outputs": {
+            "transmissionMode": "reference"
+        }
+    }
+    resp = make_sync_request(PYSERVER, process_id, payload)
+    sanity_checks_basic(resp)
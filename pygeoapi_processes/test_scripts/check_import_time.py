@@ -0,0 +1,124 @@
+import os
+import sys
+import glob
+import argparse
+import subprocess
+
+'''
+This is a little script to check how long it takes to import our
+process modules, i.e. how much each of them adds to the startup of a
+pygeoapi worker (pygeoapi imports all configured process modules when
+it starts and when it lists the processes).
+
+Every module is imported in a fresh interpreter using "python -X importtime".
+The pygeoapi modules that every process needs anyway are imported first, so
+their cost is not counted. If any module takes longer than the budget, or if
+it pulls in one of the heavy modules at import time (they are supposed to be
+imported on first use, see utils/lazy_imports.py), the script exits with
+code 1, so it can be used to fail a build.
+
+Has to be run in the virtual env of the pygeoapi instance, as the modules
+are imported as "pygeoapi.process.aqua90m...":
+
+    python check_import_time.py
+    python check_import_time.py --budget-ms 300
+    AQUA90M_IMPORT_BUDGET_MS=300 python check_import_time.py
+    python check_import_time.py pygeoapi.process.aqua90m.pygeoapi_processes.geofresh.get_local_ids
+'''
+
+# Imported by pygeoapi itself, so not counted:
+FRAMEWORK_MODULES = ['pygeoapi.process.base', 'pygeoapi.util', 'pygeoapi.config']
+
+# These must not be imported when a process module is imported:
+HEAVY_MODULES = ['pandas', 'numpy', 'psycopg2', 'geomet', 'tinydb', 'sshtunnel',
+    'rasterio', 'osgeo', 'gdal', 'requests', 'shapely', 'pyarrow']
+
+DEFAULT_BUDGET_MS = 250
+PACKAGE_PREFIX = 'pygeoapi.process.aqua90m.pygeoapi_processes'
+
+
+def find_process_modules():
+    here = os.path.dirname(os.path.abspath(__file__))
+    process_dir = os.path.dirname(here)
+    module_names = []
+    for subdir in ['geofresh', 'data_access']:
+        for path in sorted(glob.glob(os.path.join(process_dir, subdir, '*.py'))):
+            # Only those that are processes (they have a JSON file with metadata):
+            if os.path.isfile(path.replace('.py', '.json')):
+                name = os.path.basename(path).removesuffix('.py')
+                module_names.append(f'{PACKAGE_PREFIX}.{subdir}.{name}')
+    return module_names
+
+
+def measure_import_time(module_name):
+    # Returns the cumulative import time in microseconds and the names of
+    # all modules that were imported along with the module.
+    code = '; '.join([f'import {name}' for name in FRAMEWORK_MODULES + [module_name]])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'Could not import {module_name}: {proc.stderr.strip().splitlines()[-1]}')
+
+    # Lines look like: "import time:       412 |       6421 |   pygeoapi.process.base"
+    # The framework is imported before our module, so everything after
+    # the framework lines was imported because of our module:
+    cumulative_us = None
+    imported = []
+    framework_done = False
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line.removeprefix('import time:').split('|')
+        name_stripped = name.strip()
+        if name_stripped == FRAMEWORK_MODULES[-1]:
+            framework_done = True
+            continue
+        if not framework_done:
+            continue
+        imported.append(name_stripped)
+        if name_stripped == module_name:
+            cumulative_us = int(cumulative.strip())
+
+    if cumulative_us is None:
+        # Was already imported by the framework modules:
+        cumulative_us = 0
+    return cumulative_us, imported
+
+
+def check(module_names, budget_ms):
+    failed = []
+    for module_name in module_names:
+        cumulative_us, imported = measure_import_time(module_name)
+        cumulative_ms = cumulative_us/1000
+        heavy = sorted(set(name.split('.')[0] for name in imported) & set(HEAVY_MODULES))
+
+        status = 'ok'
+        if cumulative_ms > budget_ms:
+            status = 'TOO SLOW'
+        if len(heavy) > 0:
+            status = f'IMPORTS {", ".join(heavy)}'
+        if not status == 'ok':
+            failed.append(module_name)
+        print(f'{cumulative_ms:8.1f} ms  {module_name.removeprefix(PACKAGE_PREFIX+".")} ({status})')
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the import time of the process modules.')
+    parser.add_argument('modules', nargs='*', help='Module names (default: all process modules)')
+    parser.add_argument('--budget-ms', type=float,
+        default=float(os.environ.get('AQUA90M_IMPORT_BUDGET_MS', DEFAULT_BUDGET_MS)),
+        help='Maximum import time per module, in milliseconds (default: %(default)s)')
+    args = parser.parse_args()
+
+    module_names = args.modules if len(args.modules) > 0 else find_process_modules()
+    print(f'Import time budget: {args.budget_ms} ms per module ({len(module_names)} modules)')
+    failed = check(module_names, args.budget_ms)
+
+    if len(failed) > 0:
+        print(f'{len(failed)} of {len(module_names)} modules exceed the import time budget or import heavy modules.')
+        sys.exit(1)
+
+    print(f'All {len(module_names)} modules within the import time budget.')
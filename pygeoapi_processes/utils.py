@@ -1,11 +1,15 @@
+import os
 import json
-import requests
 import urllib
 import tempfile
-import pandas as pd
+import functools
 from pygeoapi.process.base import ProcessorExecuteError
 import pygeoapi.process.aqua90m.utils.exceptions as exc
 import pygeoapi.process.aqua90m.utils.geojson_helpers as geojson_helpers
+import pygeoapi.process.aqua90m.utils.fast_json as fast_json
+from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
 
 import logging
 logging.TRACE = 5
@@ -13,6 +17,20 @@ logging.addLevelName(logging.TRACE, "TRACE")
 LOGGER = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _load_metadata_file(metadata_path):
+    LOGGER.log(logging.TRACE, f'Loading process metadata from: {metadata_path}')
+    with open(metadata_path, 'r', encoding='utf-8') as metadata_file:
+        return json.load(metadata_file)
+
+
+def load_process_metadata(script_path):
+    # The process metadata has to be in a JSON file of the same name, in the same dir!
+    # It is parsed only once per worker, even if pygeoapi loads the plugin
+    # (and instantiates the processor) again for every request.
+    return _load_metadata_file(os.path.abspath(script_path.replace('.py', '.json')))
+
+
 def params_lonlat_or_subcid(lon, lat, subc_id, additional_message=""):
 
     # subc_id takes precedence:
@@ -223,8 +241,56 @@ def store_to_json_file(output_name, json_object, job_metadata, job_id, download_
     downloadfilename = f'outputs-{output_name}-{process_id}-{job_id}.json'
     downloadfilepath = download_dir+downloadfilename
     LOGGER.debug(f'Writing process result to json file: {downloadfilepath}')
-    with open(downloadfilepath, 'w', encoding='utf-8') as downloadfile:
-        json.dump(json_object, downloadfile, ensure_ascii=False, indent=4)
+    # Written compact (no indentation), NumPy numbers and arrays are allowed:
+    fast_json.dump_to_file(json_object, downloadfilepath)
+
+    # Create download link:
+    downloadlink = download_url + downloadfilename
+
+    # Create output to pass back to user
+    outputs_dict = {
+        'title': job_metadata['outputs'][output_name]['title'],
+        'description': job_metadata['outputs'][output_name]['description'],
+        'href': downloadlink
+    }
+
+    return outputs_dict
+
+
+def store_chunks_to_file(output_name, chunks, job_metadata, job_id, download_dir, download_url, extension='json'):
+
+    # Store to file, chunk by chunk (text that is already serialised, e.g. GeoJSON
+    # assembled by the database, see geofresh/geojson_streaming.py):
+    process_id = job_metadata['id']
+    downloadfilename = f'outputs-{output_name}-{process_id}-{job_id}.{extension}'
+    downloadfilepath = download_dir+downloadfilename
+    LOGGER.debug(f'Writing process result to {extension} file (streamed): {downloadfilepath}')
+    with open(downloadfilepath, 'w', encoding='utf-8') as outfile:
+        for chunk in chunks:
+            outfile.write(chunk)
+
+    # Create download link:
+    downloadlink = download_url + downloadfilename
+
+    # Create output to pass back to user
+    outputs_dict = {
+        'title': job_metadata['outputs'][output_name]['title'],
+        'description': job_metadata['outputs'][output_name]['description'],
+        'href': downloadlink
+    }
+
+    return outputs_dict
+
+
+def store_to_binary_file(output_name, write_file, job_metadata, job_id, download_dir, download_url, extension):
+
+    # Store to file, for binary results (e.g. NumPy or Parquet): write_file
+    # is called with the path and writes the file itself.
+    process_id = job_metadata['id']
+    downloadfilename = f'outputs-{output_name}-{process_id}-{job_id}.{extension}'
+    downloadfilepath = download_dir+downloadfilename
+    LOGGER.debug(f'Writing process result to {extension} file: {downloadfilepath}')
+    write_file(downloadfilepath)
 
     # Create download link:
     downloadlink = download_url + downloadfilename
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+'''
+Admission control for process executions (per worker), so that a few
+expensive jobs (e.g. snapping 50k points) cannot make the cheap requests
+(e.g. a click on the map) time out behind them.
+
+* Concurrency limits: At most "admission_max_concurrent" executions of
+  the same process at a time (a number, or a dict by process id, with
+  "default"), and at most "admission_max_concurrent_total" of all processes.
+* Weighted-fair queue: Executions that cannot start right away wait in a
+  queue, ordered by virtual finish time (cost / weight, per process and
+  mode), so a flow of expensive jobs cannot starve the cheap ones. Sync
+  executions have a higher weight than async ones ("admission_weight_sync",
+  "admission_weight_async"), so they get ahead, but async jobs still move.
+  The cost is estimated by the process (e.g. the number of points), see
+  GeoFreshBaseProcessor.estimate_cost().
+* Early rejection: If the queue is full ("admission_max_queued"), or the
+  cost already waiting plus this one exceeds "admission_max_queued_cost"
+  (only if others are waiting, so a single expensive job can still queue
+  for a free slot), or an execution waited longer than "admission_max_wait_seconds_sync"
+  (or ..._async), it is rejected with exc.TooManyRequestsException. (The
+  processes cannot return HTTP 429, as pygeoapi reports any exception as
+  failed job, i.e. HTTP 400 for sync requests. The message says "Server
+  busy" and when to retry.)
+
+All limits and queues are per worker process (the state is kept in memory):
+With e.g. 4 gunicorn workers, up to 4 times "admission_max_concurrent_total"
+executions run on the server at a time.
+
+Metrics (queue depth, wait times, rejections) are available from get_stats(),
+and written in Prometheus text format to "admission_metrics_file" (config,
+"{pid}" is replaced by the process id of the worker) after every execution.
+
+Usage:
+
+    with admission.admitted(process_id, cost, is_async):
+        ... run the process ...
+'''
+
+# Defaults, can be overridden in config:
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_MAX_CONCURRENT_TOTAL = 8
+DEFAULT_MAX_QUEUED = 32
+DEFAULT_MAX_QUEUED_COST = 1000000
+DEFAULT_MAX_WAIT_SECONDS = {'sync': 30, 'async': 600}
+DEFAULT_WEIGHTS = {'sync': 4.0, 'async': 1.0}
+
+# global variables:
+_CONTROLLER = None
+_LOCK = threading.Lock()
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Admission control not configured (config file not found), using defaults.")
+        return {}
+
+
+class _Waiter:
+
+    def __init__(self, tag, seq, process_id, mode, cost):
+        self.tag = tag
+        self.seq = seq
+        self.process_id = process_id
+        self.mode = mode
+        self.cost = cost
+        self.enqueued = time.monotonic()
+
+    def key(self):
+        return (self.tag, self.seq)
+
+
+class AdmissionController:
+
+    def __init__(self, config):
+        max_concurrent = config.get('admission_max_concurrent', DEFAULT_MAX_CONCURRENT)
+        if not isinstance(max_concurrent, dict):
+            max_concurrent = {'default': max_concurrent}
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_total = int(config.get('admission_max_concurrent_total', DEFAULT_MAX_CONCURRENT_TOTAL))
+        self.max_queued = int(config.get('admission_max_queued', DEFAULT_MAX_QUEUED))
+        self.max_queued_cost = float(config.get('admission_max_queued_cost', DEFAULT_MAX_QUEUED_COST))
+        self.max_wait = {mode: float(config.get(f'admission_max_wait_seconds_{mode}', seconds))
+            for mode, seconds in DEFAULT_MAX_WAIT_SECONDS.items()}
+        self.weights = {mode: float(config.get(f'admission_weight_{mode}', weight))
+            for mode, weight in DEFAULT_WEIGHTS.items()}
+        self.metrics_file = config.get('admission_metrics_file', None)
+
+        self._cond = threading.Condition()
+        self._running = {}
+        self._running_total = 0
+        self._waiting = [] # sorted by key()
+        self._seq = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._stats = {
+            'admitted': 0, 'admitted_immediately': 0,
+            'rejected_queue_full': 0, 'rejected_timeout': 0,
+            'wait_seconds_sync': 0.0, 'wait_seconds_async': 0.0,
+            'queued_sync': 0, 'queued_async': 0,
+            'max_wait_seconds': 0.0, 'max_queue_depth': 0
+        }
+
+    def limit(self, process_id):
+        return int(self.max_concurrent.get(process_id, self.max_concurrent.get('default', DEFAULT_MAX_CONCURRENT)))
+
+    def _has_slot(self, process_id):
+        return (self._running_total < self.max_concurrent_total and
+            self._running.get(process_id, 0) < self.limit(process_id))
+
+    def _next_eligible(self):
+        # The first waiter (lowest virtual finish time) that can start now:
+        for waiter in self._waiting:
+            if self._has_slot(waiter.process_id):
+                return waiter
+        return None
+
+    def _start(self, process_id):
+        self._running[process_id] = self._running.get(process_id, 0) + 1
+        self._running_total += 1
+        self._stats['admitted'] += 1
+
+    def admit(self, process_id, cost = 1, is_async = False):
+        # Blocks until the execution may start, or raises
+        # exc.TooManyRequestsException. Call release() afterwards!
+        mode = 'async' if is_async else 'sync'
+        cost = max(float(cost), 1.0)
+        with self._cond:
+
+            # Nobody else can start, and there is a free slot:
+            if self._next_eligible() is None and self._has_slot(process_id):
+                self._start(process_id)
+                self._stats['admitted_immediately'] += 1
+                return
+
+            # Reject early, instead of letting the client wait for nothing.
+            # The cost cap only applies behind others: Alone in the queue,
+            # a job whose own cost is above the cap would be rejected
+            # whenever the worker is busy, and retrying would not help.
+            queued_cost = sum(waiter.cost for waiter in self._waiting)
+            if len(self._waiting) >= self.max_queued or (
+                    len(self._waiting) > 0 and queued_cost + cost > self.max_queued_cost):
+                self._stats['rejected_queue_full'] += 1
+                retry_after = int(self.max_wait['sync'])
+                err_msg = (f'Server busy: {len(self._waiting)} executions waiting (cost {queued_cost:.0f}),'
+                    f' cannot queue {process_id} (cost {cost:.0f}). Please retry in {retry_after} seconds.')
+                LOGGER.warning(err_msg)
+                raise exc.TooManyRequestsException(err_msg, retry_after)
+
+            # Virtual finish time (weighted fair queueing), per process and mode:
+            flow = (process_id, mode)
+            tag = max(self._virtual_time, self._last_finish.get(flow, 0.0)) + cost / self.weights[mode]
+            self._last_finish[flow] = tag
+            self._seq += 1
+            waiter = _Waiter(tag, self._seq, process_id, mode, cost)
+            self._waiting.append(waiter)
+            self._waiting.sort(key=_Waiter.key)
+            self._stats[f'queued_{mode}'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._waiting))
+            LOGGER.info(f'Queued {process_id} ({mode}, cost {cost:.0f}), {len(self._waiting)} waiting.')
+
+            deadline = waiter.enqueued + self.max_wait[mode]
+            while self._next_eligible() is not waiter:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(waiter)
+                    self._stats['rejected_timeout'] += 1
+                    self._cond.notify_all()
+                    err_msg = (f'Server busy: {process_id} waited {self.max_wait[mode]:g} seconds'
+                        f' for a free slot. Please retry later.')
+                    LOGGER.warning(err_msg)
+                    raise exc.TooManyRequestsException(err_msg, int(self.max_wait['sync']))
+                self._cond.wait(remaining)
+
+            self._waiting.remove(waiter)
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            self._start(process_id)
+            waited = time.monotonic() - waiter.enqueued
+            self._stats[f'wait_seconds_{mode}'] += waited
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], waited)
+            LOGGER.info(f'Admitted {process_id} ({mode}) after waiting {waited:.3f} seconds.')
+
+    def release(self, process_id):
+        with self._cond:
+            self._running[process_id] -= 1
+            self._running_total -= 1
+            self._cond.notify_all()
+        if self.metrics_file is not None:
+            write_metrics_file(self.metrics_file.replace('{pid}', str(os.getpid())))
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._waiting)
+            stats['running'] = self._running_total
+            stats['running_by_process'] = {key: value for key, value in self._running.items() if value > 0}
+            now = time.monotonic()
+            stats['oldest_wait_seconds'] = max((now - waiter.enqueued for waiter in self._waiting), default=0.0)
+        return stats
+
+
+def get_controller():
+    # One controller per worker, configured on first use:
+    global _CONTROLLER
+    with _LOCK:
+        if _CONTROLLER is None:
+            _CONTROLLER = AdmissionController(_read_config())
+        return _CONTROLLER
+
+
+@contextlib.contextmanager
+def admitted(process_id, cost = 1, is_async = False):
+    controller = get_controller()
+    controller.admit(process_id, cost, is_async)
+    try:
+        yield
+    finally:
+        controller.release(process_id)
+
+
+def get_stats():
+    return get_controller().get_stats()
+
+
+def log_stats(comment=''):
+    stats = get_stats()
+    LOGGER.info(
+        f'Admission{comment}: {stats["running"]} running, {stats["queue_depth"]} waiting'
+        f' (max {stats["max_queue_depth"]}), {stats["admitted"]} admitted'
+        f' ({stats["admitted_immediately"]} immediately), rejected: {stats["rejected_queue_full"]}'
+        f' (queue full), {stats["rejected_timeout"]} (timeout), max wait {stats["max_wait_seconds"]:.3f} seconds.')
+    return stats
+
+
+def write_metrics_file(path):
+    # Prometheus text format (e.g. for the node exporter's textfile collector).
+    # Written to a temporary file first, so readers never see half of it.
+    stats = get_stats()
+    labels = f'worker="{os.getpid()}"'
+    lines = [
+        f'aqua90m_admission_queue_depth{{{labels}}} {stats["queue_depth"]}',
+        f'aqua90m_admission_queue_depth_max{{{labels}}} {stats["max_queue_depth"]}',
+        f'aqua90m_admission_running{{{labels}}} {stats["running"]}',
+        f'aqua90m_admission_oldest_wait_seconds{{{labels}}} {stats["oldest_wait_seconds"]:.3f}',
+        f'aqua90m_admission_wait_seconds_max{{{labels}}} {stats["max_wait_seconds"]:.3f}',
+        f'aqua90m_admission_admitted_total{{{labels}}} {stats["admitted"]}',
+        f'aqua90m_admission_rejected_total{{{labels},reason="queue_full"}} {stats["rejected_queue_full"]}',
+        f'aqua90m_admission_rejected_total{{{labels},reason="timeout"}} {stats["rejected_timeout"]}'
+    ]
+    for mode in DEFAULT_WEIGHTS.keys():
+        lines.append(f'aqua90m_admission_queued_total{{{labels},mode="{mode}"}} {stats[f"queued_{mode}"]}')
+        lines.append(f'aqua90m_admission_wait_seconds_total{{{labels},mode="{mode}"}} {stats[f"wait_seconds_{mode}"]:.3f}')
+    for process_id, num in stats['running_by_process'].items():
+        lines.append(f'aqua90m_admission_running_by_process{{{labels},process="{process_id}"}} {num}')
+    try:
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        LOGGER.warning(f'Could not write admission metrics to {path}: {e}')
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    # Two slots, one sync and three async executions:
+    _CONTROLLER = AdmissionController({'admission_max_concurrent_total': 2})
+    def run(process_id, cost, is_async):
+        try:
+            with admitted(process_id, cost, is_async):
+                time.sleep(0.5)
+        except exc.TooManyRequestsException as e:
+            print(e)
+    threads = [threading.Thread(target=run, args=('get-snapped-points-plural', 50000, True)) for i in range(3)]
+    threads.append(threading.Thread(target=run, args=('get-local-ids', 1, False)))
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    log_stats()
+
+    # A job above the cost cap, at a busy worker with an empty queue, waits
+    # for the slot instead of being rejected:
+    _CONTROLLER = AdmissionController({'admission_max_concurrent_total': 1, 'admission_max_queued_cost': 1000})
+    _CONTROLLER.admit('get-local-ids', 1, False)
+    expensive = threading.Thread(target=run, args=('get-snapped-points-plural', 50000, True))
+    expensive.start()
+    time.sleep(0.1)
+    assert get_stats()['queue_depth'] == 1, get_stats()
+    _CONTROLLER.release('get-local-ids')
+    expensive.join()
+    stats = log_stats()
+    assert stats['rejected_queue_full'] == 0 and stats['admitted'] == 2, stats
+    print('Expensive job alone in the queue was admitted: OK.')
@@ -1,66 +1,30 @@
 import logging
 LOGGER = logging.getLogger(__name__)
 
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.point_table as point_table
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.point_table as point_table
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
 
 def dataframe_to_geojson_points(input_df, colname_lon, colname_lat):
     LOGGER.debug(f'Input data frame has {input_df.shape[1]} columns: {input_df.columns}.')
-
-    features = []
-
-    # Retrieve using column index, not colname - this is faster:
-    colidx_lon = input_df.columns.get_loc(colname_lon)
-    colidx_lat = input_df.columns.get_loc(colname_lat)
-    for row in input_df.itertuples(index=False):
-        lon = row[colidx_lon]
-        lat = row[colidx_lat]
-        feature = {
-          "type": "Feature",
-          "geometry": {
-            "type": "Point",
-            "coordinates": [lon, lat]
-          }
-        }
-        properties = {}
-        for colname in input_df.columns:
-            val = getattr(row, colname)
-            properties[colname] = val
-        feature["properties"] = properties
-        features.append(feature)
-
-    return {
-        "type": "FeatureCollection",
-        "features": features
-    }
+    # All columns (including lon and lat) become properties of the Features:
+    points = point_table.from_dataframe(input_df, colname_lon, colname_lat, keep_coordinate_columns=True)
+    return points.to_feature_collection()
 
 def geojson_points_to_dataframe(points_geojson, colname_lon="lon", colname_lat="lat"):
     # Input must be a FeatureCollection of Point features!
-
-    # The future dataframe needs a list for each future column. The columns
-    # lon and lat are not properties of the Features, but parts of the geometries,
-    # so we predefine them here:
-    everything = {
-        colname_lon: [],
-        colname_lat: []
-    }
-
-    # Find all properties:
-    property_names = set()
-    for feature in points_geojson["features"]:
-        for propname in feature["properties"].keys():
-            property_names.add(propname)
-            # The future dataframe needs a list for each future column:
-            everything[propname] = []
-
-    # Iterate over all features, copy the property values into the dict
-    # that will become the data frame:
-    for feature in points_geojson["features"]:
-        lon, lat = feature["geometry"]["coordinates"]
-        everything[colname_lon].append(lon)
-        everything[colname_lat].append(lon)
-        for propname in property_names:
-            propval = feature["properties"][propname]
-            everything[propname].append(propval)
-
-    # Finished collecting the values, now make pandas dataframe:
-    dataframe = pd.DataFrame(everything)
-    return dataframe
+    # The columns lon and lat come first, then all properties of the Features.
+    points = point_table.from_geojson(points_geojson)
+    return points.to_dataframe(colname_lon=colname_lon, colname_lat=colname_lat)
@@ -1,47 +1,38 @@
-import pandas as pd
 import re
 import operator
+import logging
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
 
 
 def filter_dataframe(input_df, keep_attribute, keep_values):
     # Filter by a list of values to be kept
-
-    everything = []
-
-    # Iterate over all rows:
-    # Retrieve using column index, not colname - this is faster:
-    colidx = input_df.columns.get_loc(keep_attribute)
-    for row in input_df.itertuples(index=False):
-        curr_value = row[colidx]
-
-        if curr_value in keep_values:
-            # keep!!
-            # Collect results in list:
-            everything.append(row)
-
-    # Finished collecting the results, now make pandas dataframe:
-    output_df = pd.DataFrame(everything)
-    return output_df
+    # (For several attributes/conditions at once, see filter_engine)
+    mask = input_df[keep_attribute].isin(keep_values)
+    return input_df[mask].reset_index(drop=True)
 
 def filter_dataframe_by_condition(input_df, keep_attribute, condition_dict):
     # Filter by numeric condition
-
-    everything = []
-
-    # Iterate over all rows:
-    # Retrieve using column index, not colname - this is faster:
-    colidx = input_df.columns.get_loc(keep_attribute)
-    for row in input_df.itertuples(index=False):
-        curr_value = row[colidx]
-
-        if matches_filter_condition(condition_dict, curr_value):
-            # keep!!
-            # Collect results in list:
-            everything.append(row)
-
-    # Finished collecting the results, now make pandas dataframe:
-    output_df = pd.DataFrame(everything)
-    return output_df
+    # (For several attributes/conditions at once, see filter_engine)
+    mask = condition_mask(input_df[keep_attribute], condition_dict)
+    return input_df[mask].reset_index(drop=True)
 
 
 def parse_filter_condition(expr, var="x"):
@@ -125,6 +116,25 @@ def matches_filter_condition(condition_dict, x):
 
 
 
+
+def condition_mask(values, condition_dict):
+    # Like matches_filter_condition(), but for a whole column at once.
+    # Returns a boolean array. Missing values (None, NaN) never match.
+    values = np.asarray(values, dtype='float64')
+
+    OPS = {
+        "<":  np.less,
+        "<=": np.less_equal,
+        ">":  np.greater,
+        ">=": np.greater_equal,
+        "==": np.equal
+    }
+
+    if condition_dict["type"] == "range":
+        return (condition_dict["min"] < values) & (values < condition_dict["max"])
+    return OPS[condition_dict["op"]](values, condition_dict["value"])
+
+
 if __name__ == "__main__":
 
     csv_path = '/home/.../aqua90m/test_input_data/spdata.csv'
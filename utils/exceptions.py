@@ -24,3 +24,10 @@ class GeoFreshNoResultException(Aqua90mException):
 
 class GeoFreshUnexpectedResultException(Aqua90mException):
     pass
+
+class TooManyRequestsException(Aqua90mException):
+    # Request not admitted (server busy, see utils/admission.py). Clients
+    # should retry later (after retry_after seconds, if known).
+    def __init__(self, message, retry_after = None):
+        super().__init__(message)
+        self.retry_after = retry_after
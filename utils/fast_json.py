@@ -0,0 +1,181 @@
+import json
+import math
+import logging
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+
+'''
+Serialising process results (matrices, FeatureCollections, ...) to JSON.
+
+Results may contain NumPy numbers and arrays (e.g. a row of a distance
+matrix, or ids read from a data frame), so the code that builds them does
+not have to convert every element to a Python int or float first. They are
+converted here, when the result is written:
+
+* If orjson is installed, it serialises NumPy scalars and (contiguous)
+  arrays natively, in C. It is optional: "pip install orjson".
+* Otherwise, the standard library json module is used, converting NumPy
+  objects via _default().
+
+Dictionary keys that are NumPy numbers (which neither of them accepts)
+are converted to native types, recursively, as a fallback.
+
+NaN and Infinity (e.g. the distance between unconnected points) are not
+valid JSON. orjson writes them as null, and so do we when using the json
+module (instead of its default, which writes NaN), so the output does not
+depend on whether orjson is installed.
+
+pygeoapi serialises results returned inline (application/json) itself,
+with the standard library, and cannot handle NumPy objects. So these are
+passed through to_native() before returning them, which only copies a
+result if it contains any.
+
+Usage:
+
+    fast_json.dump_to_file(result_json, '/tmp/result.json')
+    return 'application/json', fast_json.to_native(result_json)
+'''
+
+# global variable (imported once per worker, or False if not installed):
+_ORJSON = None
+
+
+def _get_orjson():
+    global _ORJSON
+    if _ORJSON is None:
+        try:
+            import orjson
+            _ORJSON = orjson
+        except ModuleNotFoundError:
+            LOGGER.debug('orjson is not installed, using the json module for serialising results.')
+            _ORJSON = False
+    return _ORJSON or None
+
+
+def _default(obj):
+    # Called by the encoders for objects they cannot serialise themselves:
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if type(obj).__name__ == 'NAType': # pandas.NA, without importing pandas
+        return None
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _to_native(obj):
+    # Slow path: Converts NumPy objects (also dictionary keys) to native
+    # Python types, recursively, and NaN/Infinity to None.
+    if isinstance(obj, dict):
+        return {_to_native_key(key): _to_native(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_native(item) for item in obj]
+    if isinstance(obj, float):
+        return float(obj) if math.isfinite(obj) else None
+    if isinstance(obj, (str, int, bool)) or obj is None:
+        return obj
+    return _to_native(_default(obj))
+
+
+def _to_native_key(key):
+    if isinstance(key, np.generic):
+        return key.item()
+    return key
+
+
+def dumps(obj, pretty=False):
+    # Returns the JSON as bytes (UTF-8).
+    orjson = _get_orjson()
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=_default, option=option)
+        except orjson.JSONEncodeError as e:
+            LOGGER.debug(f'orjson could not serialise the result ({e}), converting it first...')
+            return orjson.dumps(_to_native(obj), default=_default, option=option)
+
+    indent = 2 if pretty else None
+    try:
+        json_str = json.dumps(obj, default=_default, ensure_ascii=False, indent=indent, allow_nan=False)
+    except (TypeError, ValueError) as e:
+        # e.g. "keys must be str, int, float, bool or None, not int64", or
+        # "Out of range float values are not JSON compliant" (NaN)
+        LOGGER.debug(f'Could not serialise the result ({e}), converting it first...')
+        json_str = json.dumps(_to_native(obj), default=_default, ensure_ascii=False, indent=indent, allow_nan=False)
+    return json_str.encode('utf-8')
+
+
+def dump_to_file(obj, filepath, pretty=False):
+    with open(filepath, 'wb') as outfile:
+        outfile.write(dumps(obj, pretty=pretty))
+
+
+def to_native(obj):
+    # Returns the object itself if it contains only native Python types, or
+    # a copy that does, which pygeoapi (or anyone using the json module) can
+    # serialise. Most results contain no NumPy objects, so we only check
+    # (without copying or serialising), and convert only if needed.
+    if _is_native(obj):
+        return obj
+    LOGGER.debug('Result contains non-native objects (e.g. NumPy numbers), converting it...')
+    return _to_native(obj)
+
+
+def _is_native(obj):
+    if isinstance(obj, dict):
+        return all(isinstance(key, str) and _is_native(value) for key, value in obj.items())
+    if isinstance(obj, list):
+        return all(_is_native(item) for item in obj)
+    # bool and int, but not NumPy numbers (np.float64 is a float subclass!),
+    # and no NaN (which the json module would write as invalid JSON):
+    if type(obj) is float:
+        return math.isfinite(obj)
+    return obj is None or type(obj) in (str, int, bool)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    result = {
+        "507294699": dict(zip(["507294699", "507282720"], np.array([0.0, 1234.5]))),
+        "subc_ids": np.array([507294699, 507282720]),
+        "count": np.int64(2),
+        np.int64(58): "numpy key"
+    }
+    print('Using orjson: %s' % (_get_orjson() is not None))
+    print(dumps(result))
+    print(to_native(result))
+
+    # Both encoders write the same JSON for NaN and Infinity (null):
+    result = {"distances": np.array([0.0, np.nan]), "nan": float('nan'), "inf": np.float64('inf'), "ok": 1.5}
+    expected = {"distances": [0.0, None], "nan": None, "inf": None, "ok": 1.5}
+    outputs = {'orjson' if _get_orjson() is not None else 'json': dumps(result)}
+    _ORJSON = False
+    outputs['json'] = dumps(result)
+    for encoder, output in outputs.items():
+        assert json.loads(output) == expected, (encoder, output)
+        print(f'{encoder}: {output} OK.')
+    assert to_native(result) == expected
+    assert json.loads(json.dumps(to_native({"nan": float('nan')}), allow_nan=False)) == {"nan": None}
+    print('to_native(): OK.')
@@ -0,0 +1,195 @@
+import logging
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+    import aqua90m.utils.dataframe_utils as dataframe_utils
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+        import pygeoapi.process.aqua90m.utils.dataframe_utils as dataframe_utils
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+'''
+Filtering tables (pandas data frames) and GeoJSON FeatureCollections by
+attribute values, as in the process filter-by-attribute.
+
+All "keep" clauses (attribute: list of values to keep) and all "conditions"
+(attribute: numeric condition, e.g. "x>=20" or "30<x<40", see
+dataframe_utils.parse_filter_condition()) are compiled once into one filter,
+and evaluated column by column, so each column is compared in one go (NumPy /
+pandas), instead of looking at every row or feature in Python. The clauses are
+combined by AND (keep rows that match all of them) or OR (match any of them).
+
+Usage:
+
+    compiled = filter_engine.compile_filter(
+        keep={"site_id": ["FP1", "FP10"]},
+        conditions={"latitude": "x>=40"},
+        combine="and")
+    output_df = filter_engine.filter_dataframe(input_df, compiled)
+    output_json = filter_engine.filter_feature_collection(feature_coll, compiled)
+'''
+
+COMBINE_OPTIONS = ['and', 'or']
+
+
+def compile_filter(keep=None, conditions=None, combine='and'):
+    combine = combine.lower()
+    if not combine in COMBINE_OPTIONS:
+        err_msg = f"Cannot combine conditions by '{combine}', please use one of: {COMBINE_OPTIONS}."
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+    clauses = []
+    for attribute, values in (keep or {}).items():
+        if not isinstance(values, list):
+            values = [values]
+        clauses.append({'type': 'isin', 'attribute': attribute, 'values': values})
+
+    # TODO: With the dictionary format, users cannot pass several conditions for one attribute, e.g. x>10 and x>5...
+    for attribute, condition in (conditions or {}).items():
+        try:
+            condition_dict = dataframe_utils.parse_filter_condition(condition, var="x")
+        except ValueError as e:
+            err_msg = f"Cannot understand condition for '{attribute}': {condition}"
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        clauses.append({'type': 'condition', 'attribute': attribute, 'condition': condition_dict})
+
+    LOGGER.debug(f'Compiled filter ({combine.upper()}): {clauses}')
+    return {'combine': combine, 'clauses': clauses}
+
+
+def get_attributes(compiled):
+    # The attributes (columns, properties) needed to evaluate the filter:
+    return list(dict.fromkeys(clause['attribute'] for clause in compiled['clauses']))
+
+
+def evaluate_filter(compiled, columns, num_rows):
+    # Returns a boolean array (one per row), True for the rows to keep.
+    # The columns can be a data frame, or a dict of arrays (see
+    # feature_collection_columns()).
+    if compiled['combine'] == 'and':
+        mask = np.ones(num_rows, dtype=bool)
+    else:
+        mask = np.zeros(num_rows, dtype=bool)
+
+    for clause in compiled['clauses']:
+        column = columns[clause['attribute']]
+        if clause['type'] == 'isin':
+            clause_mask = _isin(column, clause['values'])
+        else:
+            clause_mask = _condition_mask(column, clause['attribute'], clause['condition'])
+        LOGGER.debug(f'Filtering based on {clause["attribute"]}: {clause_mask.sum()} of {num_rows} match.')
+
+        if compiled['combine'] == 'and':
+            mask &= clause_mask
+        else:
+            mask |= clause_mask
+
+    return mask
+
+
+def _isin(column, values):
+    # Hash-based, and like Python's "in" for mixed types (1 does not match "1"):
+    if not isinstance(column, pd.Series):
+        column = pd.Series(column, copy=False)
+    return column.isin(values).to_numpy()
+
+
+def _condition_mask(column, attribute, condition_dict):
+    try:
+        return dataframe_utils.condition_mask(column, condition_dict)
+    except (ValueError, TypeError) as e:
+        err_msg = f"Cannot apply numeric condition to '{attribute}', it contains non-numeric values: {e}"
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+
+def filter_dataframe(input_df, compiled):
+    _check_columns(input_df, compiled)
+    mask = evaluate_filter(compiled, input_df, input_df.shape[0])
+    LOGGER.debug(f'Filtering... DONE. Kept {mask.sum()} of {input_df.shape[0]} rows.')
+    return input_df[mask].reset_index(drop=True)
+
+
+def _check_columns(input_df, compiled):
+    for attribute in get_attributes(compiled):
+        if not attribute in input_df.columns:
+            err_msg = f"Cannot filter by '{attribute}', there is no such column. Columns: {list(input_df.columns)}"
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+
+
+def feature_collection_columns(feature_coll, attributes):
+    # Columnar form of the properties of a FeatureCollection: One array per
+    # attribute (only those needed), each with one value per feature.
+    features = feature_coll['features']
+    columns = {}
+    for attribute in attributes:
+        column = np.empty(len(features), dtype=object)
+        try:
+            column[:] = [feature['properties'][attribute] for feature in features]
+        except KeyError:
+            err_msg = f"Please provide '{attribute}' for each Feature in the FeatureCollection."
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+        columns[attribute] = column
+    return columns
+
+
+def filter_feature_collection(feature_coll, compiled):
+    features = feature_coll['features']
+    columns = feature_collection_columns(feature_coll, get_attributes(compiled))
+    mask = evaluate_filter(compiled, columns, len(features))
+    LOGGER.debug(f'Filtering... DONE. Kept {mask.sum()} of {len(features)} features.')
+    return {
+        "type": "FeatureCollection",
+        "features": [features[i] for i in np.flatnonzero(mask)]
+    }
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    input_df = pd.DataFrame({
+        "site_id": ["FP1", "FP2", "FP10", "FP20"],
+        "latitude": [40.1, 41.5, 39.9, 42.0],
+        "temperature": [20, 30, 25, None]
+    })
+
+    print('Keep FP1, FP10, FP20 AND latitude < 41:')
+    compiled = compile_filter(keep={"site_id": ["FP1", "FP10", "FP20"]}, conditions={"latitude": "x<41"})
+    print(filter_dataframe(input_df, compiled))
+
+    print('Keep FP2 OR temperature >= 25:')
+    compiled = compile_filter(keep={"site_id": ["FP2"]}, conditions={"temperature": ">=25"}, combine="or")
+    print(filter_dataframe(input_df, compiled))
+
+    feature_coll = {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "properties": {"site_id": 1, "temperature": 20},
+             "geometry": {"type": "Point", "coordinates": [10.698832912677716, 53.51710727672125]}},
+            {"type": "Feature", "properties": {"site_id": 2, "temperature": 30},
+             "geometry": {"type": "Point", "coordinates": [12.80898022975407, 52.42187129944509]}}
+        ]
+    }
+    print('Keep site_id 1, 5, 6 (FeatureCollection):')
+    compiled = compile_filter(keep={"site_id": [1, 5, 6]})
+    print(filter_feature_collection(feature_coll, compiled))
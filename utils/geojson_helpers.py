@@ -1,16 +1,17 @@
-import geojson
 import logging
 LOGGER = logging.getLogger(__name__)
 
 try:
     # If the package is installed in local python PATH:
     import aqua90m.utils.exceptions as exc
-    import aqua90m.utils.dataframe_utils as dataframe_utils
+    import aqua90m.utils.filter_engine as filter_engine
+    from aqua90m.utils.lazy_imports import lazy_import
 except ModuleNotFoundError as e1:
     try:
         # If we are using this from pygeoapi:
         import pygeoapi.process.aqua90m.utils.exceptions as exc
-        import pygeoapi.process.aqua90m.utils.dataframe_utils as dataframe_utils
+        import pygeoapi.process.aqua90m.utils.filter_engine as filter_engine
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
     except ModuleNotFoundError as e2:
         msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
               ' If this is being run from' + \
@@ -19,6 +20,8 @@ except ModuleNotFoundError as e1:
         print(msg)
         LOGGER.debug(msg)
 
+geojson = lazy_import('geojson')
+
 
 def check_is_geojson(input_data):
 
@@ -92,17 +95,13 @@ def check_feature_collection_property(feature_coll, mandatory_colname):
 
 
 def get_all_properties_per_id(feature_coll, colname_id):
-    properties_by_id = {}
-    for feature in feature_coll['features']:
-        LOGGER.debug(f'This feature: {feature}')
-        LOGGER.debug(f"Properties of this feature: {feature['properties']}")
-        if not colname_id in feature['properties']:
-            err_msg = f"Please provide '{colname_id}' for each Feature in the FeatureCollection. Missing in: {feature}"
-            LOGGER.error(err_msg)
-            raise exc.UserInputException(err_msg)
-        feature_id = feature['properties'][colname_id]
-        properties_by_id[feature_id] = feature['properties']
-    return properties_by_id
+    all_properties = [feature['properties'] for feature in feature_coll['features']]
+    feature_ids = [properties.get(colname_id) for properties in all_properties]
+    if None in feature_ids:
+        err_msg = f"Please provide '{colname_id}' for each Feature in the FeatureCollection. Missing in: {feature_coll['features'][feature_ids.index(None)]}"
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+    return dict(zip(feature_ids, all_properties))
 
 
 def check_is_feature_collection_points(points_geojson):
@@ -125,44 +124,18 @@ def check_is_feature_collection_points(points_geojson):
 
 def filter_geojson_by_condition(points_geojson, keep_attribute, condition_dict):
     # Filter by numeric condition
+    # (For several attributes/conditions at once, see filter_engine)
     LOGGER.debug(f'Filtering property "{keep_attribute}" (condition {condition_dict}).')
-
-    # Iterate over all features:
-    filtered_features = []
-    for feature in points_geojson['features']:
-        val = feature["properties"][keep_attribute]
-        LOGGER.debug(f'Property "{keep_attribute}" has value {val}.')
-        if dataframe_utils.matches_filter_condition(condition_dict, val):
-            # keep!!
-            # Collect results in list:
-            filtered_features.append(feature)
-
-    # Finished collecting the results, now make GeoJSON FeatureCollection:
-    feature_coll = {
-        "type": "FeatureCollection",
-        "features": filtered_features
-    }
-    return feature_coll
+    compiled = {'combine': 'and', 'clauses': [
+        {'type': 'condition', 'attribute': keep_attribute, 'condition': condition_dict}]}
+    return filter_engine.filter_feature_collection(points_geojson, compiled)
 
 
 def filter_geojson(points_geojson, keep_attribute, keep_values):
+    # (For several attributes/conditions at once, see filter_engine)
     LOGGER.debug(f'Filtering property "{keep_attribute}" (condition: contains any of these: {keep_values}).')
-
-    # Iterate over all features:
-    filtered_features = []
-    for feature in points_geojson['features']:
-        val = feature["properties"][keep_attribute]
-        if val in keep_values:
-            # keep!!
-            # Collect results in list:
-            filtered_features.append(feature)
-
-    # Finished collecting the results, now make GeoJSON FeatureCollection:
-    feature_coll = {
-        "type": "FeatureCollection",
-        "features": filtered_features
-    }
-    return feature_coll
+    compiled = filter_engine.compile_filter(keep={keep_attribute: keep_values})
+    return filter_engine.filter_feature_collection(points_geojson, compiled)
 
 
 if __name__ == "__main__":
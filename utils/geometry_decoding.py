@@ -0,0 +1,193 @@
+import logging
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+shapely = lazy_import('shapely')
+
+'''
+Decoding geometries that we get from PostGIS as WKB (ST_AsBinary(geom)),
+instead of WKT (ST_AsText(geom)), which is several times larger, and slow
+to parse row by row (geomet.wkt.loads()).
+
+All rows of a result are decoded at once (shapely 2, vectorised), and
+then converted to GeoJSON geometries (dicts), or kept as array of shapely
+geometries for later stages.
+
+The GeoJSON is the same as we got by parsing the WKT with geomet: Same
+keys, coordinates as lists of floats, and null for NULL geometries. As
+ST_AsText writes at most 15 decimal digits, the coordinates are rounded
+the same way (see _round_like_wkt()), so the results do not change.
+
+Usage:
+
+    cursor.execute('SELECT ST_AsBinary(geom), subc_id FROM ...')
+    rows = cursor.fetchall()
+    geometries = geometry_decoding.wkb_to_geojson([row[0] for row in rows])
+'''
+
+# ST_AsText's default precision (PostGIS >= 3.1):
+WKT_DECIMAL_DIGITS = 15
+
+GEOJSON_TYPES = {
+    0: 'Point',
+    1: 'LineString',
+    2: 'LineString', # LinearRing
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+    7: 'GeometryCollection'
+}
+
+
+def decode_wkb(wkb_values):
+    # WKB as bytes, memoryview (as psycopg2 returns bytea) or hex string,
+    # or None for NULL. Returns array of shapely geometries (None for NULL).
+    wkb_values = [bytes(value) if isinstance(value, memoryview) else value for value in wkb_values]
+    try:
+        return shapely.from_wkb(np.array(wkb_values, dtype=object))
+    except shapely.errors.GEOSException as e:
+        raise ValueError(f'Failed to decode WKB: {e}') from e
+
+
+def wkb_to_geojson(wkb_values, decimal_digits=WKT_DECIMAL_DIGITS, add_srid=False):
+    return to_geojson(decode_wkb(wkb_values), decimal_digits, add_srid)
+
+
+def wkb_to_geojson_one(wkb_value, decimal_digits=WKT_DECIMAL_DIGITS):
+    return wkb_to_geojson([wkb_value], decimal_digits)[0]
+
+
+def to_geojson(geometries, decimal_digits=WKT_DECIMAL_DIGITS, add_srid=False):
+    # Returns list of GeoJSON geometries (dicts, or None), one per geometry.
+    # All coordinates are retrieved in one go, and only sliced per part or
+    # ring (not per coordinate) in Python.
+    # decimal_digits=None keeps the coordinates as they are (as geomet did
+    # when parsing WKB). add_srid adds the SRID of EWKB geometries (e.g.
+    # from ST_AsEWKB(geom)) the way geomet did ("meta" and "crs").
+    geometries = np.asarray(geometries, dtype=object)
+    type_ids = shapely.get_type_id(geometries)
+    result = [None] * len(geometries)
+
+    # GeometryCollections are rare, their members are converted one by one:
+    for i in np.flatnonzero(type_ids == 7):
+        members = shapely.get_parts(geometries[i])
+        result[i] = {"type": "GeometryCollection", "geometries": to_geojson(members, decimal_digits)}
+
+    simple = np.flatnonzero((type_ids >= 0) & (type_ids != 7))
+    if len(simple) == 0:
+        return result
+
+    # Points, LineStrings and Polygons (the parts of Multi-geometries):
+    parts, part_index = shapely.get_parts(geometries[simple], return_index=True)
+    part_types = shapely.get_type_id(parts).tolist()
+    part_num_coords = shapely.get_num_coordinates(parts).tolist()
+    rings, ring_index = shapely.get_rings(parts, return_index=True)
+    part_num_rings = np.bincount(ring_index, minlength=len(parts)).tolist()
+    ring_num_coords = shapely.get_num_coordinates(rings).tolist()
+
+    # Z is decided per part: In a batch with 3D geometries, get_coordinates()
+    # returns NaN as Z of the 2D ones, which we cut off again (NaN is not
+    # valid JSON):
+    part_has_z = shapely.has_z(parts)
+    include_z = bool(part_has_z.any())
+    coords = shapely.get_coordinates(parts, include_z=include_z)
+    if decimal_digits is not None:
+        coords = _round_like_wkt(coords, decimal_digits)
+    if include_z and not part_has_z.all():
+        coords = _drop_z_of_2d_parts(coords, part_has_z, part_num_coords)
+    else:
+        coords = coords.tolist()
+
+    part_coords = []
+    pos = 0
+    ring = 0
+    for k in range(len(parts)):
+        num = part_num_coords[k]
+        if part_types[k] == 3:
+            polygon = []
+            for _ in range(part_num_rings[k]):
+                num_ring = ring_num_coords[ring]
+                polygon.append(coords[pos:pos+num_ring])
+                pos += num_ring
+                ring += 1
+            part_coords.append(polygon)
+        elif part_types[k] == 0:
+            part_coords.append(coords[pos] if num > 0 else [])
+            pos += num
+        else:
+            part_coords.append(coords[pos:pos+num])
+            pos += num
+
+    # Put the parts back together:
+    grouped = [[] for _ in simple]
+    for k, i in enumerate(part_index.tolist()):
+        grouped[i].append(part_coords[k])
+
+    for i, type_id, group in zip(simple.tolist(), type_ids[simple].tolist(), grouped):
+        if type_id >= 4:
+            coordinates = group
+        elif len(group) > 0:
+            coordinates = group[0]
+        else:
+            coordinates = []
+        result[i] = {"type": GEOJSON_TYPES[type_id], "coordinates": coordinates}
+
+    if add_srid:
+        srids = shapely.get_srid(geometries).tolist()
+        for i in np.flatnonzero(type_ids >= 0).tolist():
+            if srids[i] > 0:
+                result[i]["meta"] = {"srid": srids[i]}
+                result[i]["crs"] = {"type": "name", "properties": {"name": f"EPSG{srids[i]}"}}
+
+    return result
+
+
+def _drop_z_of_2d_parts(coords, part_has_z, part_num_coords):
+    # List of coordinates, with [x, y] for the 2D parts, [x, y, z] for the others.
+    is_3d = np.repeat(part_has_z, part_num_coords)
+    result = coords.tolist()
+    for i in np.flatnonzero(~is_3d).tolist():
+        del result[i][2]
+    return result
+
+
+def _round_like_wkt(coords, decimal_digits):
+    # A float needs more than 15 decimal digits only if its absolute value is
+    # below 10 (17 significant digits are always enough), so only these are
+    # rounded (exactly, with Python's round()), the same way as ST_AsText.
+    small = np.abs(coords) < 10**(17-decimal_digits-1)
+    if small.any():
+        coords = coords.copy()
+        coords[small] = [round(value, decimal_digits) for value in coords[small].tolist()]
+    return coords
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    wkt = [
+        'LINESTRING(9.917083333333334 54.70375,9.918750000000001 54.702083333333334)',
+        'MULTIPOLYGON(((0 0,1 0,1 1,0 0),(0.1 0.1,0.2 0.1,0.2 0.2,0.1 0.1)),((5 5,6 5,6 6,5 5)))',
+        'POINT(9.931555 54.69507)',
+        None
+    ]
+    wkb = shapely.to_wkb(shapely.from_wkt(wkt))
+    for geometry in wkb_to_geojson(wkb):
+        print(geometry)
@@ -0,0 +1,72 @@
+import importlib
+import logging
+LOGGER = logging.getLogger(__name__)
+
+'''
+Deferred imports for heavy third party modules.
+
+pygeoapi imports every process module when it starts (and when it lists
+the processes), so anything imported at module level (pandas, psycopg2,
+rasterio, ...) is paid for by every worker, even if the process that
+needs it is never called. Modules use this like:
+
+    pd = lazy_import('pandas')
+    geomet = lazy_import('geomet')
+
+and the real import only happens on the first attribute access, e.g.
+pd.DataFrame(...) or geomet.wkt.loads(...). Submodules that the package
+does not import by itself (geomet.wkt, psycopg2.errors) are imported on
+demand as well.
+
+If the module is not installed, the ModuleNotFoundError is raised on
+first use, not at import time.
+'''
+
+
+class LazyModule:
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            LOGGER.debug('Importing module on first use: %s' % self._lazy_name)
+            module = importlib.import_module(self._lazy_name)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            # Might be a submodule that the package does not import itself:
+            try:
+                return importlib.import_module('%s.%s' % (self._lazy_name, attr))
+            except ModuleNotFoundError:
+                pass
+            raise
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '%s' (not loaded yet)>" % self._lazy_name
+        return repr(self.__dict__['_lazy_module'])
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    # Returns whether a module passed through lazy_import was actually imported.
+    if isinstance(module, LazyModule):
+        return module.__dict__['_lazy_module'] is not None
+    return True
@@ -0,0 +1,242 @@
+import logging
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    import aqua90m.utils.exceptions as exc
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        import pygeoapi.process.aqua90m.utils.exceptions as exc
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+'''
+Columnar representation of many input points (sites), whatever format the
+user passed them in (GeoJSON FeatureCollection, GeometryCollection or
+MultiPoint, or CSV): Coordinates are NumPy arrays, site ids are an array,
+and all other attributes are in one table (pandas data frame), in the same
+order as the points.
+
+The points are read once at the beginning of a process (from_geojson(),
+from_dataframe()), checked once (on the arrays), then passed to the geofresh
+query functions, and only converted back to a user format at the end
+(to_feature_collection(), to_dataframe(), ...).
+
+Usage:
+
+    points = point_table.from_geojson(points_geojson, colname_site_id="site_id")
+    output_df = basic_queries.get_subcid_basinid_regid__points_to_dataframe(conn, points)
+    output_json = snapping.get_snapped_point_xy(conn, points, colname_site_id="site_id")
+
+The processes read the points (and only they do), the query functions
+(basic_queries ..._points_to_dataframe(), snapping ..._xy()) take the
+PointTable. The ..._geojson_to_... and ..._dataframe_to_... variants are
+thin wrappers for the command line tests.
+'''
+
+
+class PointTable:
+
+    def __init__(self, lons, lats, site_ids=None, properties=None):
+        self.lons = np.asarray(lons, dtype='float64')
+        self.lats = np.asarray(lats, dtype='float64')
+        # Array (one per point) or None, if the user did not provide site ids:
+        self.site_ids = None if site_ids is None else np.asarray(site_ids, dtype=object)
+        # Data frame (one row per point) or None:
+        self.properties = properties
+        if not self.lons.shape == self.lats.shape:
+            raise ValueError(f'Got {self.lons.shape[0]} longitudes, but {self.lats.shape[0]} latitudes.')
+
+    def __len__(self):
+        return self.lons.shape[0]
+
+    def __repr__(self):
+        return f'<PointTable> {len(self)} points'
+
+    def valid_coordinates(self):
+        # Boolean array: True for points with coordinates on the globe.
+        return (np.isfinite(self.lons) & np.isfinite(self.lats) &
+            (np.abs(self.lons) <= 180) & (np.abs(self.lats) <= 90))
+
+    def check_coordinates(self):
+        # Logs (does not raise) how many points have missing or impossible coordinates.
+        valid = self.valid_coordinates()
+        num_invalid = int((~valid).sum())
+        if num_invalid > 0:
+            LOGGER.warning(f'{num_invalid} of {len(self)} points have missing or invalid coordinates.')
+        return num_invalid
+
+    def to_multipoint(self):
+        return {
+            "type": "MultiPoint",
+            "coordinates": np.column_stack([self.lons, self.lats]).tolist()
+        }
+
+    def to_geometry_collection(self):
+        return {
+            "type": "GeometryCollection",
+            "geometries": [{"type": "Point", "coordinates": coords}
+                for coords in np.column_stack([self.lons, self.lats]).tolist()]
+        }
+
+    def to_feature_collection(self, colname_site_id=None):
+        # The site ids are written into the properties, if a column name is given:
+        if self.properties is not None:
+            records = self.properties.to_dict('records') # native python types
+        else:
+            records = [{} for _ in range(len(self))]
+        if colname_site_id is not None and self.site_ids is not None:
+            records = [{colname_site_id: site_id, **record}
+                for site_id, record in zip(self.site_ids.tolist(), records)]
+
+        coordinates = np.column_stack([self.lons, self.lats]).tolist()
+        return {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": coords},
+                    "properties": record
+                }
+                for coords, record in zip(coordinates, records)
+            ]
+        }
+
+    def to_dataframe(self, colname_lon="lon", colname_lat="lat", colname_site_id=None):
+        columns = {colname_lon: self.lons, colname_lat: self.lats}
+        if colname_site_id is not None and self.site_ids is not None:
+            columns[colname_site_id] = self.site_ids
+        output_df = pd.DataFrame(columns)
+        if self.properties is not None:
+            other = self.properties.drop(columns=[col for col in columns if col in self.properties.columns])
+            output_df = pd.concat([output_df, other.reset_index(drop=True)], axis=1)
+        return output_df
+
+
+def from_geojson(points_geojson, colname_site_id=None):
+    # MultiPoint, GeometryCollection (of Points) or FeatureCollection (of Points).
+    # Site ids only exist in FeatureCollections.
+    geojson_type = points_geojson.get('type')
+
+    if geojson_type == 'MultiPoint':
+        LOGGER.debug('Reading points from MultiPoint...')
+        coords = _coordinates_array(points_geojson['coordinates'])
+        return PointTable(coords[:, 0], coords[:, 1])
+
+    elif geojson_type == 'GeometryCollection':
+        LOGGER.debug('Reading points from GeometryCollection...')
+        geometries = points_geojson['geometries']
+        _check_all_points([geom['type'] for geom in geometries], 'GeometryCollection')
+        coords = _coordinates_array([geom['coordinates'] for geom in geometries])
+        return PointTable(coords[:, 0], coords[:, 1])
+
+    elif geojson_type == 'FeatureCollection':
+        LOGGER.debug('Reading points from FeatureCollection...')
+        features = points_geojson['features']
+        _check_all_points([feature['geometry']['type'] for feature in features], 'FeatureCollection')
+        coords = _coordinates_array([feature['geometry']['coordinates'] for feature in features])
+        properties = pd.DataFrame.from_records([feature['properties'] or {} for feature in features])
+
+        site_ids = None
+        if colname_site_id is not None:
+            if not colname_site_id in properties.columns or properties[colname_site_id].isna().any():
+                err_msg = f"Please provide '{colname_site_id}' for each Feature in the FeatureCollection."
+                LOGGER.error(err_msg)
+                raise exc.UserInputException(err_msg)
+            site_ids = properties[colname_site_id].to_numpy(dtype=object)
+            properties = properties.drop(columns=[colname_site_id])
+        return PointTable(coords[:, 0], coords[:, 1], site_ids, properties)
+
+    err_msg = f'Cannot read points from GeoJSON of type: {geojson_type}'
+    LOGGER.error(err_msg)
+    raise exc.UserInputException(err_msg)
+
+
+def from_dataframe(input_df, colname_lon, colname_lat, colname_site_id=None, keep_coordinate_columns=False):
+    # The remaining columns become the properties (including lon and lat, if
+    # keep_coordinate_columns, e.g. to write them into GeoJSON properties).
+    for colname in [colname_lon, colname_lat, colname_site_id]:
+        if colname is not None and not colname in input_df.columns:
+            err_msg = f"Column '{colname}' not found in input table. Columns: {list(input_df.columns)}"
+            LOGGER.error(err_msg)
+            raise exc.UserInputException(err_msg)
+
+    try:
+        lons = pd.to_numeric(input_df[colname_lon]).to_numpy(dtype='float64', na_value=np.nan)
+        lats = pd.to_numeric(input_df[colname_lat]).to_numpy(dtype='float64', na_value=np.nan)
+    except (ValueError, TypeError) as e:
+        err_msg = f"Columns '{colname_lon}' and '{colname_lat}' must contain numbers: {e}"
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+    site_ids = None
+    drop_columns = [] if keep_coordinate_columns else [colname_lon, colname_lat]
+    if colname_site_id is not None:
+        site_ids = input_df[colname_site_id].to_numpy(dtype=object)
+        drop_columns.append(colname_site_id)
+    properties = input_df.drop(columns=drop_columns).reset_index(drop=True)
+    return PointTable(lons, lats, site_ids, properties)
+
+
+def _check_all_points(geometry_types, container_name):
+    not_points = set(geometry_types) - {'Point'}
+    if len(not_points) > 0:
+        err_msg = f'Geometries in {container_name} have to be points, not: {", ".join(sorted(not_points))}'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+
+
+def _coordinates_array(coordinates):
+    # Missing values (None) become NaN.
+    if len(coordinates) == 0:
+        return np.empty((0, 2), dtype='float64')
+    try:
+        coords = np.array(coordinates, dtype='float64')
+    except (ValueError, TypeError) as e:
+        err_msg = f'Point coordinates must be pairs of numbers: {e}'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+    if not (coords.ndim == 2 and coords.shape[1] == 2):
+        err_msg = f'Point coordinates must be pairs of numbers (lon, lat), got shape {coords.shape}.'
+        LOGGER.error(err_msg)
+        raise exc.UserInputException(err_msg)
+    return coords
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    feature_coll = {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "properties": {"my_site": "bla1", "species_name": "Hase"},
+             "geometry": {"type": "Point", "coordinates": [9.931555, 54.695070]}},
+            {"type": "Feature", "properties": {"my_site": "bla2", "species_name": "Delphin"},
+             "geometry": {"type": "Point", "coordinates": [9.921555, 54.295070]}}
+        ]
+    }
+    points = from_geojson(feature_coll, colname_site_id="my_site")
+    print(points)
+    print(points.to_dataframe(colname_site_id="my_site"))
+    print(points.to_feature_collection(colname_site_id="my_site"))
+    print(points.to_multipoint())
+
+    example_dataframe = pd.DataFrame(
+        [['aa', 10.041155219078064, 53.07006147583069],
+         ['bb', 10.042726993560791, None]],
+        columns=['my_site', 'lon', 'lat'])
+    points = from_dataframe(example_dataframe, 'lon', 'lat', 'my_site')
+    print(f'Invalid coordinates: {points.check_coordinates()}')
+    print(points.to_geometry_collection())
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import threading
+import collections
+import contextlib
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+rasterio = lazy_import('rasterio')
+
+'''
+Per-worker cache of open raster datasets (rasterio handles).
+
+Opening a raster is not free: For a remote COG or VRT, every open costs
+several HTTP range requests just to read the headers (and for a VRT, the
+XML and the headers of its sources). So instead of opening the rasters
+on every request, we keep them open, in a pool per path, and close the
+idle handles of the least recently used paths once more than
+"raster_cache_size" (config) handles are open.
+
+Rasterio handles must not be shared between threads, so a handle is
+lent to one thread at a time: use_raster() takes an idle handle of the
+path from its pool (or opens a new one, if all are in use, e.g. by the
+other threads of a thread pool), and puts it back afterwards. Handles
+are never closed while they are lent out. As the pool is per path (not
+per thread), the threads of the next request (a new thread pool) find
+the handles of the previous one.
+
+Usage:
+
+    with raster_cache.use_raster(path) as src:
+        data = src.read(1, window=window)
+
+Do NOT close the handle, and do not keep it after the "with" block!
+
+GDAL itself is configured once per worker (block cache size, no directory
+listing on open, VSI cache for remote files), see configure_gdal().
+'''
+
+# Defaults, can be overridden in config:
+DEFAULT_CACHE_SIZE = 16
+DEFAULT_GDAL_CACHEMAX_MB = 512
+DEFAULT_VSI_CACHE_SIZE_MB = 64
+
+# global variables:
+# Path -> pool: idle handles, number of handles lent out, mtime (by recent use):
+_POOLS = collections.OrderedDict()
+_CACHE_SIZE = None
+_LOCK = threading.Lock()
+_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'reopened': 0, 'open_seconds': 0.0}
+_GDAL_CONFIGURED = False
+
+
+def _read_config(config_file_path = None):
+    if config_file_path is None:
+        config_file_path = os.environ.get('AQUA90M_CONFIG_FILE', "./config.json")
+    try:
+        with open(config_file_path, 'r') as config_file:
+            return json.load(config_file)
+    except FileNotFoundError as e:
+        LOGGER.info("Raster cache not configured (config file not found), using defaults.")
+        return {}
+
+
+def configure_gdal(config = None):
+    # Has to happen before the first raster is opened. Values already set in
+    # the environment (e.g. by the admin) take precedence.
+    global _GDAL_CONFIGURED
+    global _CACHE_SIZE
+    if _GDAL_CONFIGURED:
+        return
+
+    if config is None:
+        config = _read_config()
+
+    _CACHE_SIZE = config.get('raster_cache_size', DEFAULT_CACHE_SIZE)
+    gdal_options = {
+        # Block cache shared by all datasets of this worker:
+        'GDAL_CACHEMAX': str(config.get('gdal_cachemax_mb', DEFAULT_GDAL_CACHEMAX_MB)),
+        # Do not list the remote directory (one request per open, useless for COGs):
+        'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+        # Keep fetched bytes of remote files in memory:
+        'VSI_CACHE': 'TRUE',
+        'VSI_CACHE_SIZE': str(config.get('vsi_cache_size_mb', DEFAULT_VSI_CACHE_SIZE_MB)*1024*1024),
+        # Merge adjacent range requests, and reuse HTTP/2 connections:
+        'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+        'GDAL_HTTP_MULTIPLEX': 'YES'
+    }
+    for key, value in gdal_options.items():
+        os.environ.setdefault(key, value)
+    LOGGER.debug(f'Configured GDAL (cache size {_CACHE_SIZE} datasets): {gdal_options}')
+    _GDAL_CONFIGURED = True
+
+
+def _is_remote(path):
+    return path.startswith('http://') or path.startswith('https://') or path.startswith('/vsi')
+
+
+def _modification_time(path):
+    # Local files may be replaced on disk, then we have to reopen them.
+    if _is_remote(path):
+        return None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def use_raster(path):
+    # Lends an open handle of the raster to this thread, see above.
+    pool, src = _checkout(path)
+    try:
+        yield src
+    finally:
+        _checkin(path, pool, src)
+
+
+def _checkout(path):
+    configure_gdal()
+    mtime = _modification_time(path)
+
+    with _LOCK:
+        pool = _POOLS.get(path)
+        if pool is not None and pool['mtime'] != mtime:
+            # Replaced on disk: Close the idle handles now, the lent ones
+            # when they come back (they do not belong to a pool anymore):
+            _STATS['reopened'] += 1
+            del _POOLS[path]
+            for idle in pool['idle']:
+                _close(idle)
+            pool = None
+        if pool is None:
+            pool = _POOLS[path] = {'idle': [], 'in_use': 0, 'mtime': mtime}
+        _POOLS.move_to_end(path)
+        pool['in_use'] += 1
+        while len(pool['idle']) > 0:
+            src = pool['idle'].pop()
+            if not src.closed:
+                _STATS['hits'] += 1
+                LOGGER.log(logging.TRACE, f'Raster cache hit: {path}')
+                return pool, src
+        _STATS['misses'] += 1
+
+    # Open outside the lock, this may take a while for remote files:
+    LOGGER.debug(f'Raster cache miss, opening: {path}')
+    start = time.time()
+    try:
+        src = rasterio.open(path)
+    except Exception:
+        with _LOCK:
+            pool['in_use'] -= 1
+        raise
+    seconds = time.time() - start
+
+    with _LOCK:
+        _STATS['open_seconds'] += seconds
+        _evict_idle()
+    return pool, src
+
+
+def _checkin(path, pool, src):
+    with _LOCK:
+        pool['in_use'] -= 1
+        if _POOLS.get(path) is not pool:
+            _close(src)
+            return
+        pool['idle'].append(src)
+        _evict_idle()
+
+
+def _evict_idle():
+    # Close idle handles of the least recently used paths (lent handles
+    # are closed later, once they are idle), and forget empty pools. Call
+    # with _LOCK held.
+    num_open = sum(len(pool['idle']) + pool['in_use'] for pool in _POOLS.values())
+    for path, pool in list(_POOLS.items()):
+        while num_open > _CACHE_SIZE and len(pool['idle']) > 0:
+            _close(pool['idle'].pop(0))
+            _STATS['evictions'] += 1
+            num_open -= 1
+            LOGGER.debug(f'Raster cache full, closed a handle of: {path}')
+        if len(pool['idle']) == 0 and pool['in_use'] == 0:
+            del _POOLS[path]
+
+
+def _close(src):
+    try:
+        src.close()
+    except Exception as e:
+        LOGGER.warning(f'Could not close raster {src.name}: {e}')
+
+
+def clear_cache():
+    # Closes the idle handles (lent ones are closed when they come back):
+    with _LOCK:
+        while len(_POOLS) > 0:
+            _, pool = _POOLS.popitem()
+            for src in pool['idle']:
+                _close(src)
+
+
+def get_cache_stats():
+    with _LOCK:
+        stats = dict(_STATS)
+        stats['open_datasets'] = sum(len(pool['idle']) + pool['in_use'] for pool in _POOLS.values())
+    requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / requests, 3) if requests > 0 else None
+    return stats
+
+
+def log_cache_stats(comment=''):
+    stats = get_cache_stats()
+    LOGGER.info(
+        f'Raster cache{comment}: {stats["hits"]} hits, {stats["misses"]} misses'
+        f' (hit rate {stats["hit_rate"]}), {stats["evictions"]} evictions,'
+        f' {stats["open_datasets"]} open, {stats["open_seconds"]:.3f} seconds spent opening.')
+    return stats
+
+
+if __name__ == "__main__":
+
+    # Run from the directory above aqua90m, with a raster path as argument:
+    # python aqua90m/utils/raster_cache.py /path/to/some.tif
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    path = sys.argv[1]
+    for i in range(3):
+        with use_raster(path) as src:
+            print(f'Opened {src.name}: {src.width}x{src.height}, block shape {src.block_shapes[0]}')
+    print(get_cache_stats())
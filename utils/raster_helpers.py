@@ -1,18 +1,335 @@
-from osgeo import gdal
+import logging
+import concurrent.futures
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
 
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+    import aqua90m.utils.raster_cache as raster_cache
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+        import pygeoapi.process.aqua90m.utils.raster_cache as raster_cache
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+np = lazy_import('numpy')
+rasterio = lazy_import('rasterio')
+
+
+def import_gdal():
+    # GDAL is only imported when actually needed, as it is slow to import and
+    # not available on every server. We need one of these: # TODO FIXME, does not
+    # currently work on our server due to dependency hell, ever since I had to
+    # reinstall gdal when installing hydrographr.
+    try:
+        from osgeo import gdal # May cause: ModuleNotFoundError: No module named '_gdal'
+    except ModuleNotFoundError:
+        import gdal as gdal    # May cause: ModuleNotFoundError: No module named 'gdal'
+    return gdal
+
+
+# Outputs are written as internally tiled, compressed GeoTIFFs. We do not use
+# GDAL's COG driver, as it can only copy a finished dataset, while the tiled
+# GTiff driver lets us write the output window by window. For the sizes we
+# serve, the overviews of a COG would not help anyway.
+OUTPUT_BLOCKSIZE = 512
+OUTPUT_COMPRESSION = 'LZW'
+
+
+def make_output_profile(src_profile, height, width, transform, nodata=None):
+    # Profile for a tiled, compressed GeoTIFF, based on the input's profile.
+    profile = dict(src_profile)
+    profile.update({
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'transform': transform,
+        'compress': OUTPUT_COMPRESSION,
+        'bigtiff': 'IF_SAFER'
+    })
+    # Smaller blocks for small outputs, so we do not pad them too much:
+    blocksize = OUTPUT_BLOCKSIZE if max(height, width) >= OUTPUT_BLOCKSIZE else 256
+    profile.update({'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize})
+    if nodata is not None:
+        profile['nodata'] = nodata
+    return profile
+
+
+def open_output(profile, result_filepath=None):
+    # Opens the output raster for writing: Either a file (e.g. in the download
+    # dir), or in memory (if result_filepath is None). Returns the dataset to
+    # write into, and the MemoryFile (or None) to pass to finish_output().
+    if result_filepath is not None:
+        LOGGER.debug(f'Writing tiled, compressed GeoTIFF to: {result_filepath}')
+        return rasterio.open(result_filepath, 'w', **profile), None
+    LOGGER.debug('Writing tiled, compressed GeoTIFF to memory...')
+    memfile = rasterio.io.MemoryFile()
+    return memfile.open(**profile), memfile
+
+
+def finish_output(dst, memfile=None):
+    # Closes the output raster. If it was written to memory, returns its
+    # bytes (pygeoapi can only return bytes, dict or list inline) and frees
+    # the MemoryFile. Only the file output is written piece by piece without
+    # holding the result in memory.
+    dst.close()
+    if memfile is None:
+        return None
+    try:
+        memfile.seek(0)
+        return memfile.read()
+    finally:
+        memfile.close()
+
+
+def write_output(data, profile, result_filepath=None):
+    # Write an entire array (bands, rows, cols) or (rows, cols) at once.
+    dst, memfile = open_output(profile, result_filepath)
+    try:
+        if data.ndim == 2:
+            dst.write(data, 1)
+        else:
+            dst.write(data)
+    except Exception:
+        dst.close()
+        if memfile is not None:
+            memfile.close()
+        raise
+    return finish_output(dst, memfile)
+
+
+def mosaic_grid(reference_path, west_lon, south_lat, east_lon, north_lat):
+    # The output grid for a bbox (WGS84), aligned with the pixels of the
+    # reference raster (all tiles of a layer share the same global grid, so
+    # any of them can be the reference). The bbox may extend beyond the
+    # reference raster, then the offsets are just outside its extent.
+    # Returns transform, width, height, dtype and nodata of the output, and
+    # the reference's profile (to base the output profile on).
+    with raster_cache.use_raster(reference_path) as src:
+        rows, cols = rasterio.transform.rowcol(src.transform, [west_lon, east_lon], [south_lat, north_lat])
+        col_off, row_off = cols[0], rows[1] # ! rows[0] > rows[1]
+        return {
+            'transform': src.transform * rasterio.Affine.translation(col_off, row_off),
+            'width': cols[1] - cols[0],
+            'height': rows[0] - rows[1],
+            'dtype': src.dtypes[0],
+            'nodata': src.nodata if src.nodata is not None else 0,
+            'profile': src.profile
+        }
+
+
+def grid_size_bytes(grid, count=1):
+    return grid['width'] * grid['height'] * np.dtype(grid['dtype']).itemsize * count
+
+
+def read_mosaic(raster_paths, grid, band=1, max_threads=4):
+    # Reads the output grid (see mosaic_grid()) from several rasters (e.g.
+    # all tiles that touch a bbox) into one array, without a VRT: The window
+    # of each raster is read in its own thread (GDAL releases the GIL while
+    # reading), and its valid pixels are copied into the array.
+    data = np.full((grid['height'], grid['width']), grid['nodata'], dtype=grid['dtype'])
+
+    num_threads = max(1, min(max_threads, len(raster_paths)))
+    LOGGER.debug(f'Reading {len(raster_paths)} rasters into a {grid["width"]}x{grid["height"]} mosaic ({num_threads} threads)...')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(_read_into_mosaic, path, grid, data, band) for path in raster_paths]
+        for future in futures:
+            future.result() # raises, if reading failed
 
-def compress_tiff(result_filepath_uncompressed, result_filepath_compressed, LOGGER):
+    return data
 
-    # Compress
-    # https://gis.stackexchange.com/questions/368874/read-and-then-write-rasterio-geotiff-file-without-loading-all-data-into-memory
-    # https://gis.stackexchange.com/questions/42584/how-to-call-gdal-translate-from-python-code/237411#237411
-    ds = gdal.Open(result_filepath_uncompressed)
-    gdal.Translate(result_filepath_compressed, ds, creationOptions = ['COMPRESS=LZW'])
+
+def _read_into_mosaic(raster_path, grid, data, band):
+    # Lent to this thread, so no other thread reads it or closes it meanwhile:
+    with raster_cache.use_raster(raster_path) as src:
+        if not np.allclose(src.res, (grid['transform'].a, -grid['transform'].e)):
+            raise ValueError(f'Cannot mosaic {raster_path}: Resolution {src.res} differs from the others.')
+
+        # Offset of the output grid in this raster, in pixels:
+        col_off = int(round((grid['transform'].c - src.transform.c) / src.transform.a))
+        row_off = int(round((grid['transform'].f - src.transform.f) / src.transform.e))
+
+        # Part of the output grid that this raster covers:
+        row_start, row_stop = max(row_off, 0), min(row_off + grid['height'], src.height)
+        col_start, col_stop = max(col_off, 0), min(col_off + grid['width'], src.width)
+        if row_start >= row_stop or col_start >= col_stop:
+            LOGGER.debug(f'Raster does not cover the output grid: {raster_path}')
+            return
+
+        window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        block = src.read(band, window=window)
+        target = data[row_start - row_off:row_stop - row_off, col_start - col_off:col_stop - col_off]
+        # Tiles may overlap at their edges, so do not overwrite with nodata:
+        if src.nodata is None:
+            target[...] = block
+        else:
+            valid = block != src.nodata
+            target[valid] = block[valid]
+        LOGGER.log(logging.TRACE, f'Read {window.width}x{window.height} pixels from {raster_path}')
+
+
+# Minimum size (in pixels) of the pieces that are masked at once, so that
+# rasters with small blocks (or stripes) are not processed row by row:
+MIN_PIECE_SIZE = 256
+
+
+def mask_by_polygon(raster_path, shapes, result_filepath=None, max_threads=4):
+    # Same result as rasterio.mask.mask(src, shapes, crop=True), but without
+    # reading the entire bbox of the shapes: The shapes are rasterised onto
+    # the raster's block grid first, and only the blocks they touch are read
+    # and masked (in a thread pool). Each masked block is written straight
+    # into the tiled output (blocks that are never written are filled with
+    # nodata by GDAL), so memory does not depend on the size of the bbox.
+    # Writes to result_filepath, or (if None) to memory, then returns the
+    # bytes, see finish_output().
+    with raster_cache.use_raster(raster_path) as src:
+        try:
+            window = rasterio.features.geometry_window(src, shapes)
+        except rasterio.errors.WindowError:
+            raise ValueError('Input shapes do not overlap raster.')
+        nodata = src.nodata if src.nodata is not None else 0
+        result_profile = make_output_profile(src.profile,
+            height=int(window.height),
+            width=int(window.width),
+            transform=src.window_transform(window),
+            nodata=nodata)
+        pieces = _pieces_touched_by_shapes(src, shapes, window)
+
+    LOGGER.debug(f'Masking {len(pieces)} pieces of the {window.width}x{window.height} window...')
+
+    dst, memfile = open_output(result_profile, result_filepath)
     try:
-        ds.Close() # Some versions do not have this, apparently.
-    except AttributeError as e:
-        # https://gis.stackexchange.com/questions/80366/why-close-a-dataset-in-gdal-python
-        LOGGER.debug('Cannot close gdal dataset: %s' % e)
-        ds = None
+        # Reading and masking in threads, writing only here (the output is
+        # not thread-safe). Only a few pieces are in flight at any time:
+        num_threads = max(1, min(max_threads, len(pieces)))
+        batch_size = num_threads * 4
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for i in range(0, len(pieces), batch_size):
+                futures = [executor.submit(_mask_piece, raster_path, shapes, piece, nodata)
+                    for piece in pieces[i:i+batch_size]]
+                for future in futures:
+                    piece, data = future.result()
+                    if data is None:
+                        continue
+                    dst.write(data, window=rasterio.windows.Window(
+                        piece.col_off - window.col_off, piece.row_off - window.row_off,
+                        piece.width, piece.height))
+    except Exception:
+        dst.close()
+        if memfile is not None:
+            memfile.close()
+        raise
+    return finish_output(dst, memfile)
+
+
+def _pieces_touched_by_shapes(src, shapes, window):
+    # Pieces are raster blocks (or a few of them, if blocks are small).
+    block_height, block_width = src.block_shapes[0]
+    piece_height = block_height * -(-MIN_PIECE_SIZE // block_height)
+    piece_width = block_width * -(-MIN_PIECE_SIZE // block_width)
+
+    # Grid of pieces that overlap the window, aligned with the blocks:
+    first_row = int(window.row_off) // piece_height
+    first_col = int(window.col_off) // piece_width
+    last_row = (int(window.row_off) + int(window.height) - 1) // piece_height
+    last_col = (int(window.col_off) + int(window.width) - 1) // piece_width
+    grid_transform = src.transform \
+        * rasterio.Affine.translation(first_col * piece_width, first_row * piece_height) \
+        * rasterio.Affine.scale(piece_width, piece_height)
+
+    # Rasterise onto that grid (one pixel per piece):
+    touched = rasterio.features.rasterize(shapes,
+        out_shape=(last_row - first_row + 1, last_col - first_col + 1),
+        transform=grid_transform, all_touched=True, fill=0, default_value=1, dtype='uint8')
+
+    pieces = []
+    for grid_row, grid_col in np.argwhere(touched):
+        piece = rasterio.windows.Window(
+            (first_col + grid_col) * piece_width, (first_row + grid_row) * piece_height,
+            piece_width, piece_height)
+        pieces.append(piece.intersection(window))
+    return pieces
+
+
+def _mask_piece(raster_path, shapes, piece, nodata):
+    # Returns the piece and its masked data (or None, if the shapes do not
+    # contain any pixel centre of this piece).
+    with raster_cache.use_raster(raster_path) as src:
+        inside = rasterio.features.rasterize(shapes,
+            out_shape=(int(piece.height), int(piece.width)),
+            transform=src.window_transform(piece), fill=0, default_value=1, dtype='uint8')
+        if not inside.any():
+            return piece, None
+        data = src.read(window=piece)
+    data[:, inside == 0] = nodata
+    return piece, data
+
+
+def sample_raster_at_points(raster_path, lons, lats, band=1):
+    # Read the raster values at many points (WGS84), without reading more of
+    # the raster than necessary: The points are transformed to pixel rows and
+    # cols once, grouped by the raster block they fall into, and every block
+    # that contains any points is read exactly once. Works for local files and
+    # for remote COGs and VRTs (via HTTP range requests).
+    #
+    # Returns a numpy array with one value per point (in the same order), as
+    # gdallocationinfo would. Points outside the raster get NaN.
+    lons = np.asarray(lons, dtype='float64')
+    lats = np.asarray(lats, dtype='float64')
+    num_points = lons.shape[0]
+
+    # Dataset handle is cached per worker (and GDAL configured for remote files),
+    # see raster_cache:
+    with raster_cache.use_raster(raster_path) as src:
+        # Transform points to the raster's CRS, if needed (all at once):
+        xs, ys = lons, lats
+        if src.crs is not None and not src.crs.to_epsg() == 4326:
+            LOGGER.debug(f'Transforming {num_points} points to {src.crs}...')
+            xs, ys = rasterio.warp.transform('EPSG:4326', src.crs, lons, lats)
+            xs = np.asarray(xs)
+            ys = np.asarray(ys)
+
+        # Pixel row and col of every point:
+        cols_float, rows_float = ~src.transform * (xs, ys)
+        rows = np.floor(rows_float).astype('int64')
+        cols = np.floor(cols_float).astype('int64')
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        if not inside.all():
+            LOGGER.warning(f'{(~inside).sum()} of {num_points} points are outside the raster {raster_path}.')
+
+        # Points outside the raster will be NaN, so we need a float array then:
+        dtype = src.dtypes[band-1]
+        if not inside.all() and not np.issubdtype(np.dtype(dtype), np.floating):
+            dtype = 'float64'
+        values = np.full(num_points, np.nan if np.issubdtype(np.dtype(dtype), np.floating) else 0, dtype=dtype)
+
+        # Group the points by block (sorted by block, so each group is one slice):
+        block_height, block_width = src.block_shapes[band-1]
+        blocks_per_row = (src.width + block_width - 1) // block_width
+        idx_inside = np.nonzero(inside)[0]
+        block_ids = (rows[idx_inside] // block_height) * blocks_per_row + (cols[idx_inside] // block_width)
+        order = np.argsort(block_ids, kind='stable')
+        idx_sorted = idx_inside[order]
+        unique_blocks, starts = np.unique(block_ids[order], return_index=True)
+        LOGGER.debug(f'Reading {unique_blocks.shape[0]} blocks ({block_width}x{block_height} pixels) for {idx_inside.shape[0]} points...')
+
+        # Read each block once and pick all its points at once:
+        for block_id, idx in zip(unique_blocks, np.split(idx_sorted, starts[1:])):
+            row_off = int(block_id // blocks_per_row) * block_height
+            col_off = int(block_id % blocks_per_row) * block_width
+            window = rasterio.windows.Window(col_off, row_off,
+                min(block_width, src.width - col_off),
+                min(block_height, src.height - row_off))
+            block = src.read(band, window=window)
+            values[idx] = block[rows[idx] - row_off, cols[idx] - col_off]
 
-    LOGGER.debug('Written to: %s' % result_filepath_compressed)
+    return values
@@ -0,0 +1,189 @@
+import os
+import json
+import re
+import glob
+import threading
+import logging
+logging.TRACE = 5
+logging.addLevelName(5, "TRACE")
+LOGGER = logging.getLogger(__name__)
+
+try:
+    # If the package is installed in local python PATH:
+    from aqua90m.utils.lazy_imports import lazy_import
+    import aqua90m.utils.raster_cache as raster_cache
+except ModuleNotFoundError as e1:
+    try:
+        # If we are using this from pygeoapi:
+        from pygeoapi.process.aqua90m.utils.lazy_imports import lazy_import
+        import pygeoapi.process.aqua90m.utils.raster_cache as raster_cache
+    except ModuleNotFoundError as e2:
+        msg = 'Module not found: '+e1.name+' (imported in '+__name__+').' + \
+              ' If this is being run from' + \
+              ' command line, the aqua90m directory has to be added to ' + \
+              ' PATH for python to find it.'
+        print(msg)
+        LOGGER.debug(msg)
+
+pd = lazy_import('pandas')
+
+'''
+Footprints of the raster tiles (e.g. the Hydrography90m tiles h18v00, ...)
+in a directory, so we can find the tiles a bbox touches without opening
+them all, and without building a VRT.
+
+The index is a small file in the same directory as the tiles, either
+GeoJSON (one Feature per tile, with the footprint as Polygon and the
+properties "tile_id" and "path"), or Parquet (columns tile_id, path,
+west, south, east, north). Paths are relative to the directory. The
+footprints have to be WGS84, like the tiles.
+
+If there is no index file, it is built by opening the GeoTIFFs of one
+layer in the directory once (the directory holds several layers, so the
+files are picked by a file name pattern, e.g. "sub_catchment_*.tif*"), and
+written as GeoJSON (if the directory is writeable). The tile_id is taken
+from the "hXXvYY" part of the file name.
+
+Example:
+{"type": "FeatureCollection", "features": [{"type": "Feature",
+  "geometry": {"type": "Polygon", "coordinates": [[[0, 80], [20, 80], [20, 60], [0, 60], [0, 80]]]},
+  "properties": {"tile_id": "h18v00", "path": "sub_catchment_h18v00.cog.tiff"}}]}
+'''
+
+DEFAULT_INDEX_FILENAME = 'tile_index.geojson'
+DEFAULT_TILE_PATTERN = 'sub_catchment_*.tif*'
+TILE_ID = re.compile(r'h\d{2}v\d{2}')
+
+# global variable (one index per file, loaded once per worker):
+_INDEXES = {}
+_LOCK = threading.Lock()
+
+
+def get_tile_index(base_dir, index_filename = None, tile_pattern = None):
+    # Returns list of dicts: tile_id, path (absolute), west, south, east, north.
+    # tile_pattern: Which files to index if there is no index file yet.
+    if index_filename is None:
+        index_filename = DEFAULT_INDEX_FILENAME
+    index_path = os.path.join(base_dir, index_filename)
+
+    try:
+        mtime = os.stat(index_path).st_mtime
+    except FileNotFoundError:
+        mtime = None
+
+    with _LOCK:
+        cached = _INDEXES.get(index_path)
+        if cached is not None and cached['mtime'] == mtime:
+            return cached['tiles']
+
+    if mtime is None:
+        LOGGER.warning(f'No tile index found at {index_path}, building it from the tiles...')
+        tiles = build_tile_index(base_dir, tile_pattern)
+        write_tile_index(tiles, index_path)
+    elif index_path.endswith('.parquet'):
+        tiles = _read_parquet_index(index_path, base_dir)
+    else:
+        tiles = _read_geojson_index(index_path, base_dir)
+    LOGGER.debug(f'Loaded tile index with {len(tiles)} tiles: {index_path}')
+
+    with _LOCK:
+        _INDEXES[index_path] = {'mtime': mtime, 'tiles': tiles}
+    return tiles
+
+
+def _read_geojson_index(index_path, base_dir):
+    with open(index_path, 'r') as index_file:
+        index = json.load(index_file)
+
+    tiles = []
+    for feature in index['features']:
+        lons = [coord[0] for ring in feature['geometry']['coordinates'] for coord in ring]
+        lats = [coord[1] for ring in feature['geometry']['coordinates'] for coord in ring]
+        tiles.append({
+            'tile_id': feature['properties']['tile_id'],
+            'path': os.path.join(base_dir, feature['properties']['path']),
+            'west': min(lons), 'south': min(lats), 'east': max(lons), 'north': max(lats)
+        })
+    return tiles
+
+
+def _read_parquet_index(index_path, base_dir):
+    index_df = pd.read_parquet(index_path)
+    tiles = []
+    for row in index_df.itertuples(index=False):
+        tiles.append({
+            'tile_id': row.tile_id,
+            'path': os.path.join(base_dir, row.path),
+            'west': row.west, 'south': row.south, 'east': row.east, 'north': row.north
+        })
+    return tiles
+
+
+def _tile_id(filename):
+    # "sub_catchment_h18v00.cog.tiff" -> "h18v00" (or the name without
+    # extensions, if it has no such part):
+    match = TILE_ID.search(filename)
+    if match is None:
+        return filename.split('.')[0]
+    return match.group(0)
+
+
+def build_tile_index(base_dir, tile_pattern = None):
+    # Only the tiles of one layer (mixing layers would mix variables in
+    # one mosaic):
+    if tile_pattern is None:
+        tile_pattern = DEFAULT_TILE_PATTERN
+    tiles = []
+    for path in sorted(glob.glob(os.path.join(base_dir, tile_pattern))):
+        with raster_cache.use_raster(path) as src:
+            bounds = src.bounds
+        filename = os.path.basename(path)
+        tiles.append({
+            'tile_id': _tile_id(filename),
+            'path': path,
+            'west': bounds.left, 'south': bounds.bottom,
+            'east': bounds.right, 'north': bounds.top
+        })
+    return tiles
+
+
+def write_tile_index(tiles, index_path):
+    features = []
+    for tile in tiles:
+        w, s, e, n = tile['west'], tile['south'], tile['east'], tile['north']
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[w, n], [e, n], [e, s], [w, s], [w, n]]]},
+            "properties": {
+                "tile_id": tile['tile_id'],
+                "path": os.path.relpath(tile['path'], os.path.dirname(index_path))
+            }
+        })
+    try:
+        with open(index_path, 'w') as index_file:
+            json.dump({"type": "FeatureCollection", "features": features}, index_file, indent=2)
+        LOGGER.info(f'Written tile index ({len(tiles)} tiles): {index_path}')
+    except OSError as e:
+        LOGGER.warning(f'Could not write tile index to {index_path}: {e}')
+
+
+def find_tiles(tiles, west_lon, south_lat, east_lon, north_lat):
+    # The tiles whose footprint intersects the bbox (touching edges do not count).
+    return [tile for tile in tiles if
+        tile['west'] < east_lon and tile['east'] > west_lon and
+        tile['south'] < north_lat and tile['north'] > south_lat]
+
+
+if __name__ == "__main__":
+
+    # Build (and write) the tile index for a directory (optionally, for
+    # the files matching a pattern):
+    # python aqua90m/utils/tile_index.py /path/to/tiffs 'sub_catchment_*.tif*'
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    base_dir = sys.argv[1]
+    tile_pattern = sys.argv[2] if len(sys.argv) > 2 else None
+    tiles = build_tile_index(base_dir, tile_pattern)
+    write_tile_index(tiles, os.path.join(base_dir, DEFAULT_INDEX_FILENAME))
+    for tile in tiles:
+        print(tile)